@@ -0,0 +1,147 @@
+"""Capture.
+
+Keep a camera drained at its native rate with grab() and only decode,
+with retrieve(), the frames sent at the target fps. Sleeping between
+read() calls instead leaves the frames in the decoder buffer, and at a
+low target fps every frame read is seconds old.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+IMG_WIDTH = 960
+AGE_HISTORY = 300  # frames
+
+
+def is_live_source(cam_source):
+    """Cameras and network streams, as opposed to video files."""
+    cam_source = str(cam_source)
+    return cam_source.isdigit() or "://" in cam_source
+
+
+def open_cam(cam_source, open_timeout=0, read_timeout=0):
+    """open_cam.
+
+    Network streams get the backend's own open and read timeouts (sec).
+    """
+    if str(cam_source).isdigit():
+        return cv2.VideoCapture(int(cam_source))
+    params = []
+    if open_timeout:
+        params += [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(open_timeout * 1000)]
+    if read_timeout:
+        params += [cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(read_timeout * 1000)]
+    if params and is_live_source(cam_source):
+        return cv2.VideoCapture(cam_source, cv2.CAP_ANY, params)
+    return cv2.VideoCapture(cam_source)
+
+
+def resize_for_transport(img, width=IMG_WIDTH):
+    ratio = width / img.shape[1]
+    height = int(img.shape[0] * ratio + 0.000001)
+    return cv2.resize(img, (width, height))
+
+
+class FrameAges:
+    """FrameAges.
+
+    Capture to send age of the last sent frames.
+    """
+
+    def __init__(self, size=AGE_HISTORY):
+        self.lock = threading.Lock()
+        self.ages = deque(maxlen=size)
+
+    def add(self, age):
+        with self.lock:
+            self.ages.append(age)
+
+    def summary(self):
+        with self.lock:
+            ages = np.array(self.ages)
+        if len(ages) == 0:
+            return {"frames": 0}
+        return {
+            "frames": len(ages),
+            "last": float(ages[-1]),
+            "mean": float(ages.mean()),
+            "p95": float(np.percentile(ages, 95)),
+            "max": float(ages.max()),
+        }
+
+
+class CaptureEngine:
+    """CaptureEngine.
+
+    `step` grabs one frame and returns it decoded and resized when it is
+    due at the target fps. Files are grabbed at their native fps, live
+    sources as fast as they deliver.
+    """
+
+    def __init__(self, cam, fps, live=True, clock=time.monotonic):
+        self.fps = max(0.1, fps)
+        self.live = live
+        self.clock = clock
+        self.grabbed = 0
+        self.retrieved = 0
+        self.next_emit = 0
+        self.next_grab = 0
+        self.set_cam(cam)
+
+    def set_cam(self, cam):
+        self.cam = cam
+        self.native_fps = 0
+        if cam is not None and cam.isOpened():
+            self.native_fps = cam.get(cv2.CAP_PROP_FPS)
+        if 0.0 < self.native_fps < self.fps:
+            self.fps = self.native_fps
+
+    def _pace(self):
+        # Files grab as fast as they decode, play them at their rate
+        if self.live or self.native_fps <= 0:
+            return
+        now = self.clock()
+        if self.next_grab > now:
+            time.sleep(self.next_grab - now)
+            now = self.next_grab
+        self.next_grab = max(self.next_grab + 1 / self.native_fps, now)
+
+    def step(self):
+        """step.
+
+        (is_ok, img, captured) for one grabbed frame. img is None for the
+        frames skipped without decoding, captured the time.time() of the
+        grab.
+        """
+        self._pace()
+        if not self.cam.grab():
+            return False, None, None
+        captured = time.time()
+        self.grabbed += 1
+        now = self.clock()
+        if now < self.next_emit:
+            return True, None, captured
+        is_ok, img = self.cam.retrieve()
+        if not is_ok:
+            return False, None, None
+        self.retrieved += 1
+        period = 1 / self.fps
+        self.next_emit = self.next_emit + period
+        if self.next_emit <= now:
+            self.next_emit = now + period
+        return True, resize_for_transport(img), captured
+
+    def metrics(self):
+        return {
+            "fps": self.fps,
+            "native_fps": self.native_fps,
+            "grabbed": self.grabbed,
+            "decoded": self.retrieved,
+        }
@@ -34,11 +34,20 @@ async def index():
                 "cam_id": stream.cam_id,
                 "cam_source": stream.cam_source,
                 "fps": stream.fps,
+                "metrics": stream.get_metrics(),
             }
         )
     return {"number_of_streams": number_of_streams, "infos": infos}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Capture state, uptime, reconnects and frame age per camera."""
+    return {
+        stream.cam_id: stream.get_metrics() for stream in stream_manager.get_streams()
+    }
+
+
 @app.get("/delete_stream/{stream_id}")
 async def delete_stream(stream_id):
     stream_manager.delete_stream(stream_id)
@@ -57,11 +57,11 @@ class StreamManager(object):
         if stream_id in self.streams:
             s = self.streams.get(stream_id, None)
             if s.check_update(rtsp, fps, endpoint):
-                self._delete_stream_by_id(stream_id)
+                s.update_cam(rtsp, fps, endpoint)
             else:
                 print("nothing change")
-
-        self._add_new_stream(stream_id, rtsp, fps, endpoint)
+        else:
+            self._add_new_stream(stream_id, rtsp, fps, endpoint)
         self.mutex.release()
 
         return "ok"
@@ -0,0 +1,257 @@
+"""Supervisor.
+
+One supervisor thread per camera runs the capture engine through the
+connecting, streaming, stalled and backoff states. Opens and reads are
+bounded by timeouts, and a failed camera reconnects after an exponential
+backoff with jitter. A dead camera only ever blocks its own threads.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+
+from capture import CaptureEngine, is_live_source, open_cam
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_OPEN_TIMEOUT = float(os.environ.get("CAPTURE_OPEN_TIMEOUT", "10"))  # sec
+CAPTURE_READ_TIMEOUT = float(os.environ.get("CAPTURE_READ_TIMEOUT", "5"))  # sec
+CAPTURE_BACKOFF_BASE = float(os.environ.get("CAPTURE_BACKOFF_BASE", "1"))  # sec
+CAPTURE_BACKOFF_MAX = float(os.environ.get("CAPTURE_BACKOFF_MAX", "60"))  # sec
+# Streaming this long resets the backoff
+STABLE_AFTER = 30  # sec
+
+CONNECTING = "connecting"
+STREAMING = "streaming"
+STALLED = "stalled"
+BACKOFF = "backoff"
+STOPPED = "stopped"
+
+
+def backoff_delay(failures, base=CAPTURE_BACKOFF_BASE, maximum=CAPTURE_BACKOFF_MAX,
+                  rand=random.random):
+    """backoff_delay.
+
+    Exponential delay after `failures` consecutive failures, with equal
+    jitter: between half and all of base * 2 ** (failures - 1).
+    """
+    delay = min(maximum, base * 2 ** max(0, failures - 1))
+    return delay / 2 + rand() * delay / 2
+
+
+def release_later(cam):
+    """Release a capture from a thread that may still be blocked in it."""
+    def _release():
+        try:
+            cam.release()
+        except Exception:
+            logger.exception("Failed to release capture")
+
+    threading.Thread(target=_release, daemon=True).start()
+
+
+class CameraSupervisor:
+    """CameraSupervisor.
+
+    `on_frame(img, captured)` is called from the capture thread for the
+    frames due at `fps`.
+    """
+
+    def __init__(self, cam_id, cam_source, fps, on_frame, opener=None,
+                 open_timeout=CAPTURE_OPEN_TIMEOUT, read_timeout=CAPTURE_READ_TIMEOUT,
+                 backoff_base=CAPTURE_BACKOFF_BASE, backoff_max=CAPTURE_BACKOFF_MAX,
+                 stable_after=STABLE_AFTER):
+        self.cam_id = cam_id
+        self.cam_source = cam_source
+        self.fps = fps
+        self.on_frame = on_frame
+        self.opener = opener or (
+            lambda source: open_cam(source, open_timeout, read_timeout))
+        self.open_timeout = open_timeout
+        self.read_timeout = read_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.reconnect_requested = False
+        self.capture = None
+        self.state = STOPPED
+        self.state_since = time.time()
+        self.connected_at = None
+        self.uptime = 0.0
+        self.last_grab = None
+        self.failures = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.delay = 0.0
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name="capture-{}".format(self.cam_id),
+                         daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def reconnect(self, cam_source=None, fps=None):
+        """Reopen the camera, with a new source or fps if given."""
+        with self.lock:
+            if cam_source is not None:
+                self.cam_source = cam_source
+            if fps is not None:
+                self.fps = fps
+            self.reconnect_requested = True
+        self.wakeup.set()
+
+    def _set_state(self, state):
+        with self.lock:
+            if self.state == STREAMING and state != STREAMING:
+                self.uptime += time.time() - self.connected_at
+                self.connected_at = None
+            if state == STREAMING:
+                self.connected_at = time.time()
+            self.state = state
+            self.state_since = time.time()
+        logger.info("Camera %s %s", self.cam_id, state)
+
+    def _open(self, cam_source):
+        """Open in a helper thread, None after open_timeout."""
+        result = {}
+
+        def _run():
+            try:
+                result["cam"] = self.opener(cam_source)
+            except Exception as e:
+                result["error"] = repr(e)
+            if abandoned.is_set() and result.get("cam") is not None:
+                release_later(result["cam"])
+
+        abandoned = threading.Event()
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        thread.join(self.open_timeout)
+        if thread.is_alive():
+            abandoned.set()
+            self.last_error = "open timed out after {} sec".format(self.open_timeout)
+            return None
+        cam = result.get("cam")
+        if cam is None or not cam.isOpened():
+            self.last_error = result.get("error", "failed to open")
+            if cam is not None:
+                release_later(cam)
+            return None
+        return cam
+
+    def _read(self, capture, connection):
+        """Capture thread of one connection, ends when a grab fails.
+
+        Owns the capture: it is only released here, once no grab is in
+        progress, since releasing it under a blocked grab crashes.
+        """
+        try:
+            while self.running and not connection.is_set():
+                is_ok, img, captured = capture.step()
+                if connection.is_set():
+                    break
+                if not is_ok:
+                    self.last_error = "read failed"
+                    break
+                self.last_grab = time.monotonic()
+                if img is not None:
+                    self.on_frame(img, captured)
+        finally:
+            connection.set()
+            try:
+                capture.cam.release()
+            except Exception:
+                logger.exception("Failed to release capture")
+
+    def _wait(self, seconds):
+        """Sleep, woken early by stop() and reconnect()."""
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def _stream(self, cam, cam_source, fps):
+        """Stream `cam` until it fails, stalls or a reconnect is requested.
+
+        True when the failure counts towards the backoff.
+        """
+        capture = CaptureEngine(cam, fps, live=is_live_source(cam_source))
+        self.capture = capture
+        connection = threading.Event()
+        self.last_grab = time.monotonic()
+        self._set_state(STREAMING)
+        reader = threading.Thread(target=self._read, args=(capture, connection),
+                                  daemon=True)
+        reader.start()
+        try:
+            while self.running and not connection.is_set():
+                if self.reconnect_requested:
+                    return False
+                if time.monotonic() - self.last_grab > self.read_timeout:
+                    self.last_error = "no frame for {} sec".format(self.read_timeout)
+                    self._set_state(STALLED)
+                    return True
+                if self.failures and time.time() - self.state_since > self.stable_after:
+                    self.failures = 0
+                connection.wait(min(0.1, self.read_timeout / 10))
+            if not self.running:
+                return False
+            # A video file ended: replay it
+            return is_live_source(cam_source) or capture.grabbed == 0
+        finally:
+            connection.set()
+            # A stalled reader releases the capture when its grab returns
+            reader.join(self.read_timeout)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                cam_source, fps = self.cam_source, self.fps
+                self.reconnect_requested = False
+                self.wakeup.clear()
+            self._set_state(CONNECTING)
+            cam = self._open(cam_source)
+            failed = True
+            if cam is not None:
+                failed = self._stream(cam, cam_source, fps)
+                if failed or self.reconnect_requested:
+                    self.reconnects += 1
+            if not self.running:
+                break
+            if failed and not self.reconnect_requested:
+                self.failures += 1
+                self.delay = backoff_delay(self.failures, self.backoff_base,
+                                           self.backoff_max)
+                logger.warning("Camera %s: %s, reconnecting in %.1f sec",
+                               self.cam_id, self.last_error, self.delay)
+                self._set_state(BACKOFF)
+                self._wait(self.delay)
+        self._set_state(STOPPED)
+
+    def metrics(self):
+        with self.lock:
+            now = time.time()
+            uptime = self.uptime
+            if self.connected_at is not None:
+                uptime += now - self.connected_at
+            metrics = {
+                "state": self.state,
+                "state_seconds": now - self.state_since,
+                "uptime": uptime,
+                "connected_seconds": (
+                    now - self.connected_at if self.connected_at is not None else 0.0),
+                "reconnects": self.reconnects,
+                "consecutive_failures": self.failures,
+                "backoff": self.delay,
+                "last_error": self.last_error,
+            }
+        if self.capture is not None:
+            metrics.update(self.capture.metrics())
+        return metrics
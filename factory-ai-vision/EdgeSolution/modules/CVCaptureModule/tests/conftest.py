@@ -0,0 +1,137 @@
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Modules in this package import each other as top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def frame_timestamp(img):
+    """time.time() a TimestampSource frame was produced at."""
+    return struct.unpack("d", img[0, :8, 0].tobytes())[0]
+
+
+class TimestampSource:
+    """TimestampSource.
+
+    Stand in for a live cv2.VideoCapture: frames arrive at `fps` into an
+    unbounded buffer like a decoder's, each with its production time in
+    its first pixels.
+    """
+
+    def __init__(self, fps=30, width=960, height=540):
+        self.fps = fps
+        self.shape = (height, width, 3)
+        self.buffer = queue.Queue()
+        self.grabbed = None
+        self.decoded = 0
+        self.opened = True
+        self.failing = False
+        self.grabbing = 0
+        self.released_while_grabbing = False
+        self.running = threading.Event()
+        self.running.set()
+        threading.Thread(target=self._produce, daemon=True).start()
+
+    def _produce(self):
+        next_frame = time.time()
+        while self.opened:
+            self.buffer.put(time.time())
+            next_frame += 1 / self.fps
+            time.sleep(max(0, next_frame - time.time()))
+
+    def isOpened(self):
+        return self.opened
+
+    def get(self, prop):
+        return float(self.fps) if prop == cv2.CAP_PROP_FPS else 0.0
+
+    def fail(self):
+        """Drop the connection: every grab fails."""
+        self.failing = True
+
+    def stall(self):
+        """Freeze the connection: grabs block until resume()."""
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def grab(self):
+        self.grabbing += 1
+        try:
+            self.running.wait()
+            if self.failing or not self.opened:
+                return False
+            try:
+                self.grabbed = self.buffer.get(timeout=2)
+            except queue.Empty:
+                return False
+            return True
+        finally:
+            self.grabbing -= 1
+
+    def retrieve(self):
+        if self.grabbed is None:
+            return False, None
+        self.decoded += 1
+        img = np.zeros(self.shape, np.uint8)
+        img[0, :8, 0] = np.frombuffer(struct.pack("d", self.grabbed), np.uint8)
+        return True, img
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        # A real capture is freed under the grab here
+        if self.grabbing:
+            self.released_while_grabbing = True
+        self.opened = False
+
+
+class SourceFactory:
+    """SourceFactory.
+
+    Opens TimestampSources, or fails to open them on command.
+    """
+
+    OK = "ok"
+    REFUSE = "refuse"
+    HANG = "hang"
+
+    def __init__(self, fps=30):
+        self.fps = fps
+        self.mode = self.OK
+        self.opened = []
+        self.attempts = 0
+        self.unhang = threading.Event()
+
+    def __call__(self, cam_source, *args):
+        self.attempts += 1
+        if self.mode == self.HANG:
+            self.unhang.wait()
+        if self.mode == self.REFUSE:
+            cam = TimestampSource(self.fps)
+            cam.release()
+            return cam
+        cam = TimestampSource(self.fps)
+        self.opened.append(cam)
+        return cam
+
+    @property
+    def current(self):
+        return self.opened[-1]
+
+    def close(self):
+        self.unhang.set()
+        for cam in self.opened:
+            cam.release()
+            cam.resume()
@@ -0,0 +1,131 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+
+import streams
+from capture import CaptureEngine, FrameAges, is_live_source
+from conftest import TimestampSource, frame_timestamp
+
+NATIVE_FPS = 30
+TARGET_FPS = 2
+
+
+def run_engine(engine, seconds):
+    ages = []
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        is_ok, img, captured = engine.step()
+        assert is_ok
+        if img is not None:
+            ages.append(time.time() - frame_timestamp(img))
+    return ages
+
+
+def test_engine_keeps_frames_fresh_at_low_fps():
+    cam = TimestampSource(NATIVE_FPS)
+    try:
+        engine = CaptureEngine(cam, TARGET_FPS)
+        ages = run_engine(engine, 3)
+    finally:
+        cam.release()
+    # Drained at the native rate: every frame sent is at most ~a frame old
+    assert max(ages) < 3 / NATIVE_FPS
+    assert 5 <= len(ages) <= 7
+    # Only the frames sent are decoded
+    assert cam.decoded == engine.retrieved == len(ages)
+    assert engine.grabbed > 2 * NATIVE_FPS
+
+
+def test_read_and_sleep_falls_behind():
+    """What the capture threads did: the buffer fills, frames get old."""
+    cam = TimestampSource(NATIVE_FPS)
+    ages = []
+    try:
+        deadline = time.time() + 3
+        while time.time() < deadline:
+            _, img = cam.read()
+            ages.append(time.time() - frame_timestamp(img))
+            time.sleep(1 / TARGET_FPS)
+    finally:
+        cam.release()
+    assert ages[-1] > 1
+    assert cam.decoded == len(ages)
+
+
+def test_file_is_played_at_native_fps(tmp_path):
+    path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 20, (320, 240))
+    for i in range(20):
+        writer.write(np.full((240, 320, 3), i * 10, np.uint8))
+    writer.release()
+
+    assert not is_live_source(path)
+    assert is_live_source("rtsp://cam/stream") and is_live_source("0")
+    cam = cv2.VideoCapture(path)
+    engine = CaptureEngine(cam, 5, live=False)
+    t0 = time.monotonic()
+    frames = []
+    while True:
+        is_ok, img, _ = engine.step()
+        if not is_ok:
+            break
+        if img is not None:
+            frames.append(img)
+    elapsed = time.monotonic() - t0
+    cam.release()
+    assert engine.grabbed == 20
+    assert 0.8 < elapsed < 1.5
+    assert 4 <= len(frames) <= 6
+    # Resized to the transport width
+    assert frames[0].shape == (720, 960, 3)
+
+
+def test_frame_ages_summary():
+    ages = FrameAges(size=3)
+    assert ages.summary() == {"frames": 0}
+    for age in (0.5, 0.1, 0.2, 0.3):
+        ages.add(age)
+    summary = ages.summary()
+    assert summary["frames"] == 3
+    assert summary["max"] == pytest.approx(0.3)
+    assert summary["last"] == pytest.approx(0.3)
+
+
+class _PredictHandler(BaseHTTPRequestHandler):
+    ages = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        img = np.frombuffer(body, np.uint8).reshape(540, 960, 3)
+        self.ages.append(time.time() - frame_timestamp(img))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_stream_sends_fresh_frames(monkeypatch):
+    cam = TimestampSource(NATIVE_FPS)
+    monkeypatch.setattr(streams, "open_cam", lambda source, *args: cam)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PredictHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _PredictHandler.ages = []
+    stream = streams.Stream("cam1", "rtsp://test/stream", TARGET_FPS,
+                            "http://127.0.0.1:%s" % server.server_port, None)
+    try:
+        time.sleep(4)
+    finally:
+        stream.delete()
+        server.shutdown()
+    ages = _PredictHandler.ages
+    assert len(ages) >= 4
+    # Capture to receive, including the send loop's wait
+    assert max(ages) < 1 / TARGET_FPS + 0.2
+    metrics = stream.get_metrics()
+    assert metrics["frame_age"]["frames"] >= len(ages)
+    assert metrics["decoded"] <= metrics["grabbed"] / 5
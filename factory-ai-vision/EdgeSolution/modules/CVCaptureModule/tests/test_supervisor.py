@@ -0,0 +1,167 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import streams
+import supervisor
+from conftest import SourceFactory, frame_timestamp
+from supervisor import BACKOFF, STREAMING, CameraSupervisor, backoff_delay
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class Frames:
+    def __init__(self):
+        self.times = []
+
+    def __call__(self, img, captured):
+        self.times.append(frame_timestamp(img))
+
+
+@pytest.fixture
+def factory():
+    factory = SourceFactory()
+    yield factory
+    factory.close()
+
+
+def make_supervisor(factory, frames, **kwargs):
+    options = dict(open_timeout=0.5, read_timeout=0.5, backoff_base=0.1,
+                   backoff_max=0.4)
+    options.update(kwargs)
+    return CameraSupervisor("cam", "rtsp://test/cam", 10, frames,
+                            opener=factory, **options)
+
+
+def test_backoff_is_exponential_with_jitter():
+    assert backoff_delay(1, 1, 60, rand=lambda: 0) == 0.5
+    assert backoff_delay(1, 1, 60, rand=lambda: 1) == 1
+    assert backoff_delay(4, 1, 60, rand=lambda: 1) == 8
+    assert backoff_delay(20, 1, 60, rand=lambda: 1) == 60
+    delays = {round(backoff_delay(3, 1, 60), 6) for _ in range(50)}
+    assert len(delays) > 40
+    assert all(2 <= d <= 4 for d in delays)
+
+
+def test_reconnects_after_drop(factory):
+    frames = Frames()
+    sup = make_supervisor(factory, frames)
+    sup.start()
+    try:
+        assert wait_for(lambda: sup.state == STREAMING and frames.times)
+        factory.current.fail()
+        assert wait_for(lambda: sup.reconnects == 1 and sup.state == STREAMING)
+        count = len(frames.times)
+        assert wait_for(lambda: len(frames.times) > count + 2)
+        metrics = sup.metrics()
+        assert metrics["reconnects"] == 1
+        assert metrics["uptime"] > 0
+        assert metrics["last_error"] == "read failed"
+        assert len(factory.opened) == 2
+    finally:
+        sup.stop()
+
+
+def test_backs_off_while_the_camera_is_down(factory):
+    frames = Frames()
+    sup = make_supervisor(factory, frames)
+    factory.mode = factory.REFUSE
+    sup.start()
+    try:
+        assert wait_for(lambda: sup.failures >= 3, timeout=3)
+        assert sup.state in (BACKOFF, "connecting")
+        # 0.05-0.1, 0.1-0.2, 0.2-0.4, then capped at 0.4
+        assert factory.attempts <= 6
+        factory.mode = factory.OK
+        assert wait_for(lambda: sup.state == STREAMING, timeout=2)
+        assert wait_for(lambda: frames.times)
+    finally:
+        sup.stop()
+
+
+def test_stalled_camera_is_reopened(factory):
+    frames = Frames()
+    sup = make_supervisor(factory, frames)
+    sup.start()
+    try:
+        assert wait_for(lambda: sup.state == STREAMING and frames.times)
+        stalled = factory.current
+        stalled.stall()
+        assert wait_for(lambda: factory.current is not stalled, timeout=3)
+        assert wait_for(lambda: sup.state == STREAMING)
+        assert sup.reconnects == 1
+        assert "no frame" in sup.last_error
+        # Still blocked in grab, so nobody may release it yet
+        assert stalled.opened
+        # The grab returns (e.g. the read timeout), then the reader releases it
+        stalled.resume()
+        assert wait_for(lambda: not stalled.opened)
+        assert not stalled.released_while_grabbing
+    finally:
+        sup.stop()
+
+
+def test_hanging_open_only_delays_its_own_camera(factory):
+    hanging = SourceFactory()
+    hanging.mode = hanging.HANG
+    dead, live = Frames(), Frames()
+    dead_sup = make_supervisor(hanging, dead)
+    live_sup = make_supervisor(factory, live)
+    try:
+        dead_sup.start()
+        live_sup.start()
+        t0 = time.time()
+        assert wait_for(lambda: live.times, timeout=1)
+        assert time.time() - t0 < 0.5
+        assert wait_for(lambda: dead_sup.failures >= 1, timeout=2)
+        assert "open timed out" in dead_sup.last_error
+        assert not dead.times
+    finally:
+        dead_sup.stop()
+        live_sup.stop()
+        hanging.close()
+
+
+def test_update_cam_switches_source(factory, monkeypatch):
+    monkeypatch.setattr(streams, "open_cam", factory)
+    stream = streams.Stream("cam", "rtsp://test/a", 10, "http://127.0.0.1:9", None)
+    try:
+        assert wait_for(lambda: stream.last_img is not None)
+        first = factory.current
+        assert stream.check_update("rtsp://test/b", 10, "http://127.0.0.1:9")
+        stream.update_cam("rtsp://test/b", 10, "http://127.0.0.1:9")
+        assert wait_for(lambda: factory.current is not first)
+        assert wait_for(lambda: stream.supervisor.state == STREAMING)
+        assert stream.supervisor.cam_source == "rtsp://test/b"
+        # Asked for, not a failure
+        assert stream.supervisor.failures == 0
+        assert not first.opened
+        assert not first.released_while_grabbing
+    finally:
+        stream.delete()
+
+
+def test_metrics_endpoint(factory, monkeypatch):
+    import main
+
+    monkeypatch.setattr(streams, "open_cam", factory)
+    client = TestClient(main.app)
+    client.post("/streams", json={"stream_id": "cam1", "rtsp": "rtsp://test/cam1",
+                                  "fps": 5, "endpoint": "http://127.0.0.1:9"})
+    try:
+        assert wait_for(lambda: client.get("/metrics").json()["cam1"]["state"] == STREAMING)
+        factory.current.fail()
+        assert wait_for(lambda: client.get("/metrics").json()["cam1"]["reconnects"] == 1)
+        metrics = client.get("/metrics").json()["cam1"]
+        assert metrics["uptime"] > 0
+        assert metrics["decoded"] <= metrics["grabbed"]
+    finally:
+        main.stream_manager.delete_stream("cam1")
@@ -0,0 +1,178 @@
+import functools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+
+import streams
+from conftest import SourceFactory
+from transport import JPEG, PNG, RAW, AdaptiveQuality, FrameTransport, negotiate
+
+
+def scene(seed=0):
+    """A 960x540 frame with a factory floor's mix of flat areas and edges."""
+    rng = np.random.RandomState(seed)
+    img = np.full((540, 960, 3), 90, np.uint8)
+    img[:] = np.linspace(60, 160, 960, dtype=np.uint8)[None, :, None]
+    for _ in range(25):
+        x, y = rng.randint(0, 900), rng.randint(0, 500)
+        color = tuple(int(c) for c in rng.randint(0, 256, 3))
+        cv2.rectangle(img, (x, y), (x + rng.randint(20, 120), y + rng.randint(20, 80)),
+                      color, -1)
+    noise = rng.normal(0, 4, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+class _Receiver(BaseHTTPRequestHandler):
+    encodings = ["raw", "jpeg", "png"]
+    received = []
+
+    def do_GET(self):
+        if self.path != "/transport" or self.encodings is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({"encodings": self.encodings}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append((self.headers.get("Content-Type"), body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def receiver():
+    _Receiver.encodings = ["raw", "jpeg", "png"]
+    _Receiver.received = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%s" % server.server_port
+    server.shutdown()
+
+
+def test_negotiation(receiver):
+    assert negotiate(receiver, JPEG) == (JPEG, True)
+    _Receiver.encodings = ["raw"]
+    assert negotiate(receiver, PNG) == (RAW, True)
+    # Receivers without /transport only take raw frames
+    _Receiver.encodings = None
+    assert negotiate(receiver, JPEG) == (RAW, True)
+    # Not reachable yet: raw until asked again
+    assert negotiate("http://127.0.0.1:9", JPEG, timeout=1) == (RAW, False)
+    assert negotiate("http://127.0.0.1:9", RAW) == (RAW, True)
+
+
+def test_encodings_round_trip(receiver):
+    img = scene()
+    for encoding in (RAW, JPEG, PNG):
+        transport = FrameTransport(receiver, encoding)
+        data, headers = transport.encode(img)
+        assert transport.encoding == encoding
+        if encoding == RAW:
+            decoded = np.frombuffer(data, np.uint8).reshape(img.shape)
+            assert headers["X-Frame-Width"] == "960"
+        else:
+            decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        assert headers["Content-Type"] == "image/" + {"raw": "x-raw-bgr"}.get(
+            encoding, encoding)
+        if encoding == JPEG:
+            assert np.abs(decoded.astype(int) - img).mean() < 4
+        else:
+            assert np.array_equal(decoded, img)
+
+
+def test_quality_adapts_to_latency_and_backlog():
+    quality = AdaptiveQuality(quality=85, minimum=40, maximum=95)
+    assert quality.update(0.3, 0, 0.1) == 68
+    assert quality.update(0.05, 2, 0.1) == 54
+    for _ in range(20):
+        quality.update(0.3, 1, 0.1)
+    assert quality.quality == 40
+    for _ in range(100):
+        quality.update(0.01, 0, 0.1)
+    assert quality.quality == 95
+    # In between: hold
+    assert quality.update(0.07, 0, 0.1) == 95
+
+
+def test_quality_converges_on_a_slow_link(receiver):
+    """A simulated link that fits a frame at about quality 50 at 10 fps."""
+    img = scene()
+    interval = 0.1
+    budget = len(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 50])[1])
+    bandwidth = budget / interval
+    transport = FrameTransport(receiver, JPEG)
+    history = []
+    for _ in range(60):
+        data, _ = transport.encode(img)
+        latency = len(data) / bandwidth
+        transport.sent(latency, 0, interval)
+        history.append((transport.quality.quality, latency))
+    qualities = [q for q, _ in history[-20:]]
+    latencies = [l for _, l in history[-20:]]
+    # Oscillates just below the link's capacity
+    assert max(qualities) <= 60
+    assert np.mean(latencies) < interval
+    assert transport.metrics()["bytes_per_frame"] < img.nbytes / 10
+
+
+def test_benchmark_encodings(receiver):
+    """Bytes per frame, sender and receiver CPU per encoding."""
+    frames = [scene(seed) for seed in range(5)]
+    results = {}
+    for encoding, quality in ((RAW, None), (PNG, None), (JPEG, 90), (JPEG, 70), (JPEG, 50)):
+        transport = FrameTransport(receiver, encoding,
+                                   AdaptiveQuality(quality or 85, minimum=10))
+        bodies = [transport.encode(img)[0] for img in frames]
+        t0 = time.process_time()
+        for body in bodies:
+            if encoding == RAW:
+                np.frombuffer(body, np.uint8).reshape(-1, 960, 3).copy()
+            else:
+                cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        receive_ms = (time.process_time() - t0) / len(frames) * 1000
+        metrics = transport.metrics()
+        results["%s%s" % (encoding, quality or "")] = (
+            metrics["bytes_per_frame"], metrics["encode_ms"], receive_ms)
+    for name, (size, send_ms, receive_ms) in results.items():
+        print("%-7s %9.0f bytes/frame  send %6.2f ms  receive %6.2f ms" % (
+            name, size, send_ms, receive_ms))
+    raw = results["raw"][0]
+    assert raw == 960 * 540 * 3
+    assert results["png"][0] < raw
+    assert results["jpeg90"][0] < raw / 10
+    assert results["jpeg50"][0] < results["jpeg70"][0] < results["jpeg90"][0]
+
+
+def test_stream_sends_negotiated_jpeg(receiver, monkeypatch):
+    factory = SourceFactory()
+    monkeypatch.setattr(streams, "open_cam", factory)
+    monkeypatch.setattr(streams, "FrameTransport",
+                        functools.partial(FrameTransport, preferred=JPEG))
+    stream = streams.Stream("cam1", "rtsp://test/cam1", 5, receiver, None)
+    try:
+        deadline = time.time() + 5
+        while len(_Receiver.received) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        stream.delete()
+        factory.close()
+    content_type, body = _Receiver.received[-1]
+    assert content_type == "image/jpeg"
+    img = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+    assert img.shape == (540, 960, 3)
+    transport = stream.get_metrics()["transport"]
+    assert transport["encoding"] == JPEG
+    assert transport["bytes_per_frame"] < 960 * 540 * 3 / 10
@@ -0,0 +1,169 @@
+"""Transport.
+
+Encode the frames posted to InferenceModule's /predict. FRAME_ENCODING
+picks the encoding per deployment:
+- raw: BGR pixels, 1.5 MB per 960x540 frame, for modules on one host
+- jpeg: quality adapted to the measured send latency and backlog
+- png: lossless, smaller than raw at a higher CPU cost
+The encoding is agreed with the receiver's /transport endpoint, an
+InferenceModule without it gets raw frames.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import cv2
+import requests
+
+logger = logging.getLogger(__name__)
+
+RAW = "raw"
+JPEG = "jpeg"
+PNG = "png"
+
+CONTENT_TYPES = {
+    RAW: "image/x-raw-bgr",
+    JPEG: "image/jpeg",
+    PNG: "image/png",
+}
+
+FRAME_ENCODING = os.environ.get("FRAME_ENCODING", RAW).lower()
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "85"))
+JPEG_QUALITY_MIN = int(os.environ.get("JPEG_QUALITY_MIN", "40"))
+JPEG_QUALITY_MAX = 95
+PNG_COMPRESSION = 1  # zlib level, fastest that still compresses well
+RENEGOTIATE_INTERVAL = 30  # sec
+NEGOTIATE_TIMEOUT = 5  # sec
+
+
+def negotiate(endpoint, preferred=FRAME_ENCODING, timeout=NEGOTIATE_TIMEOUT):
+    """negotiate.
+
+    (encoding, agreed): `preferred` if the receiver supports it, raw
+    otherwise. agreed is False when the receiver could not be asked.
+    """
+    if preferred == RAW:
+        return RAW, True
+    try:
+        res = requests.get(endpoint + "/transport", timeout=timeout)
+        if res.status_code == 404:
+            # Receiver older than the transport negotiation
+            return RAW, True
+        encodings = res.json()["encodings"]
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+        return RAW, False
+    if preferred in encodings:
+        return preferred, True
+    logger.warning("Receiver does not accept %s frames, sending raw", preferred)
+    return RAW, True
+
+
+class AdaptiveQuality:
+    """AdaptiveQuality.
+
+    JPEG quality steered by additive increase, multiplicative decrease: a
+    send slower than the frame interval, or frames replaced while it was
+    in flight, cut the quality; fast sends raise it again step by step.
+    """
+
+    def __init__(self, quality=JPEG_QUALITY, minimum=JPEG_QUALITY_MIN,
+                 maximum=JPEG_QUALITY_MAX, step_up=2, decrease=0.8):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quality = min(maximum, max(minimum, quality))
+        self.step_up = step_up
+        self.decrease = decrease
+
+    def update(self, latency, backlog, interval):
+        if latency > interval or backlog > 0:
+            self.quality = max(self.minimum, int(self.quality * self.decrease))
+        elif latency < interval / 2:
+            self.quality = min(self.maximum, self.quality + self.step_up)
+        return self.quality
+
+
+class FrameTransport:
+    """FrameTransport.
+
+    `encode` a frame into a request body and headers, report the send
+    with `sent`.
+    """
+
+    def __init__(self, endpoint, preferred=FRAME_ENCODING, quality=None):
+        self.endpoint = endpoint
+        self.preferred = preferred if preferred in CONTENT_TYPES else RAW
+        if self.preferred != preferred:
+            logger.warning("Unknown FRAME_ENCODING %s, sending raw", preferred)
+        self.quality = quality or AdaptiveQuality()
+        self.lock = threading.Lock()
+        self.encoding = RAW
+        self.agreed = False
+        self.negotiated_at = None
+        self.frames = 0
+        self.bytes = 0
+        self.encode_time = 0.0
+        self.latency = 0.0
+
+    def set_endpoint(self, endpoint):
+        with self.lock:
+            if endpoint != self.endpoint:
+                self.endpoint = endpoint
+                self.agreed = False
+                self.negotiated_at = None
+
+    def _negotiate(self):
+        now = time.monotonic()
+        if self.agreed or (self.negotiated_at is not None
+                           and now - self.negotiated_at < RENEGOTIATE_INTERVAL):
+            return
+        self.negotiated_at = now
+        self.encoding, self.agreed = negotiate(self.endpoint, self.preferred)
+        logger.info("Sending %s frames to %s", self.encoding, self.endpoint)
+
+    def encode(self, img):
+        """(body, headers) of a BGR frame."""
+        with self.lock:
+            self._negotiate()
+            encoding = self.encoding
+        t0 = time.process_time()
+        if encoding == JPEG:
+            _, data = cv2.imencode(
+                ".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality.quality])
+            data = data.tobytes()
+        elif encoding == PNG:
+            _, data = cv2.imencode(
+                ".png", img, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+            data = data.tobytes()
+        else:
+            data = img.tobytes()
+        with self.lock:
+            self.encode_time += time.process_time() - t0
+            self.frames += 1
+            self.bytes += len(data)
+        headers = {"Content-Type": CONTENT_TYPES[encoding]}
+        if encoding == RAW:
+            headers["X-Frame-Width"] = str(img.shape[1])
+        return data, headers
+
+    def sent(self, latency, backlog, interval):
+        """Adapt to a send that took `latency` sec while `backlog` newer
+        frames were captured."""
+        with self.lock:
+            self.latency = latency
+            if self.encoding == JPEG:
+                self.quality.update(latency, backlog, interval)
+
+    def metrics(self):
+        with self.lock:
+            frames = max(1, self.frames)
+            return {
+                "encoding": self.encoding,
+                "preferred": self.preferred,
+                "quality": self.quality.quality if self.encoding == JPEG else None,
+                "frames": self.frames,
+                "bytes_per_frame": self.bytes / frames,
+                "encode_ms": self.encode_time / frames * 1000,
+                "send_latency": self.latency,
+            }
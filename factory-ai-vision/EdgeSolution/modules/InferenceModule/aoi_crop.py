@@ -0,0 +1,236 @@
+"""AOI crop.
+
+Infer on the areas of interest instead of the whole frame. The padded AOI
+regions are cut from the full resolution frame and packed into one mosaic
+that is sent to inference in place of the resized frame, so small parts in
+a small AOI keep their pixels. Detections are mapped back to the frame.
+
+Enable with AOI_CROP=true, per camera through /update_cams.
+"""
+
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AOI_CROP_ENABLED = os.environ.get("AOI_CROP", "false") == "true"
+# Padding around each AOI, as a fraction of its size
+AOI_CROP_PADDING = float(os.environ.get("AOI_CROP_PADDING", "0.1"))
+# Above this share of the frame, cropping saves nothing
+AOI_CROP_MAX_AREA_RATIO = float(os.environ.get("AOI_CROP_MAX_AREA_RATIO", "0.8"))
+
+MIN_PADDING = 16  # px, in frame pixels
+MOSAIC_GAP = 8  # px
+MOSAIC_ASPECT = 16 / 9
+
+
+def aoi_boxes(aoi_info):
+    """aoi_boxes.
+
+    Bounding box [x1, y1, x2, y2] of each BBox or Polygon AOI.
+    """
+    boxes = []
+    for aoi_area in aoi_info or []:
+        label = aoi_area["label"]
+        if aoi_area["type"] == "BBox":
+            boxes.append([label["x1"], label["y1"], label["x2"], label["y2"]])
+        elif aoi_area["type"] == "Polygon" and label:
+            xs = [point["x"] for point in label]
+            ys = [point["y"] for point in label]
+            boxes.append([min(xs), min(ys), max(xs), max(ys)])
+    return boxes
+
+
+def _overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def merge_regions(regions):
+    """merge_regions.
+
+    Replace overlapping regions by their union until all are disjoint, so
+    no object is inferred twice.
+    """
+    regions = [list(r) for r in regions]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                if _overlap(regions[i], regions[j]):
+                    a, b = regions[i], regions.pop(j)
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                  max(a[2], b[2]), max(a[3], b[3])]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def crop_regions(aoi_info, scale_x, scale_y, frame_width, frame_height,
+                 padding=AOI_CROP_PADDING):
+    """crop_regions.
+
+    Padded, disjoint AOI regions in frame pixels. AOIs are given in stream
+    image coordinates, `scale_x` and `scale_y` map them to the frame.
+    """
+    regions = []
+    for x1, y1, x2, y2 in aoi_boxes(aoi_info):
+        x1, x2 = sorted((x1 * scale_x, x2 * scale_x))
+        y1, y2 = sorted((y1 * scale_y, y2 * scale_y))
+        pad_x = max(padding * (x2 - x1), MIN_PADDING)
+        pad_y = max(padding * (y2 - y1), MIN_PADDING)
+        region = [
+            int(max(x1 - pad_x, 0)),
+            int(max(y1 - pad_y, 0)),
+            int(min(x2 + pad_x, frame_width)),
+            int(min(y2 + pad_y, frame_height)),
+        ]
+        if region[2] > region[0] and region[3] > region[1]:
+            regions.append(region)
+    return merge_regions(regions)
+
+
+class CropBatch:
+    """CropBatch.
+
+    Mosaic of frame regions. `slots` holds, per region, its frame box and
+    its offset in the mosaic; crops keep the frame resolution.
+    """
+
+    def __init__(self, image, slots, frame_width, frame_height):
+        self.image = image
+        self.slots = slots
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+
+    @classmethod
+    def pack(cls, frame, regions, gap=MOSAIC_GAP):
+        """pack.
+
+        Shelf-pack the regions in rows about MOSAIC_ASPECT wide, tallest
+        first. The mosaic is made at least as wide as it is tall so it
+        keeps a sane size once resized to the stream width.
+        """
+        sizes = [(r[2] - r[0], r[3] - r[1]) for r in regions]
+        total_area = sum((w + gap) * (h + gap) for w, h in sizes)
+        row_width = max(max(w for w, _ in sizes), int(np.sqrt(total_area * MOSAIC_ASPECT)))
+
+        slots = []
+        x = y = row_height = 0
+        for i in sorted(range(len(regions)), key=lambda i: -sizes[i][1]):
+            w, h = sizes[i]
+            if x > 0 and x + w > row_width:
+                x, y = 0, y + row_height + gap
+                row_height = 0
+            slots.append((regions[i], (x, y)))
+            x += w + gap
+            row_height = max(row_height, h)
+        used_width = max(mx + r[2] - r[0] for r, (mx, _) in slots)
+        used_height = y + row_height
+
+        image = np.zeros(
+            (used_height, max(used_width, used_height)) + frame.shape[2:], frame.dtype)
+        for (x1, y1, x2, y2), (mx, my) in slots:
+            image[my:my + y2 - y1, mx:mx + x2 - x1] = frame[y1:y2, x1:x2]
+        return cls(image, slots, frame.shape[1], frame.shape[0])
+
+    def to_frame(self, predictions):
+        """to_frame.
+
+        Map Custom Vision predictions made on the mosaic to the frame.
+        Boxes are assigned to the slot holding their center and clipped
+        to it; predictions on the padding are dropped.
+        """
+        height, width = self.image.shape[:2]
+        results = []
+        for prediction in predictions:
+            box = prediction["boundingBox"]
+            x1 = box["left"] * width
+            y1 = box["top"] * height
+            x2 = x1 + box["width"] * width
+            y2 = y1 + box["height"] * height
+            cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+            for (fx1, fy1, fx2, fy2), (mx, my) in self.slots:
+                if not (mx <= cx < mx + fx2 - fx1 and my <= cy < my + fy2 - fy1):
+                    continue
+                left = min(max(x1 - mx, 0), fx2 - fx1) + fx1
+                top = min(max(y1 - my, 0), fy2 - fy1) + fy1
+                right = min(max(x2 - mx, 0), fx2 - fx1) + fx1
+                bottom = min(max(y2 - my, 0), fy2 - fy1) + fy1
+                results.append(dict(prediction, boundingBox={
+                    "left": left / self.frame_width,
+                    "top": top / self.frame_height,
+                    "width": (right - left) / self.frame_width,
+                    "height": (bottom - top) / self.frame_height,
+                }))
+                break
+        return results
+
+
+class AoiCropper:
+    """AoiCropper.
+
+    Per stream settings and metrics of AOI cropped inference.
+    """
+
+    def __init__(self, enabled=AOI_CROP_ENABLED, padding=AOI_CROP_PADDING,
+                 max_area_ratio=AOI_CROP_MAX_AREA_RATIO):
+        self.enabled = enabled
+        self.padding = padding
+        self.max_area_ratio = max_area_ratio
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.frames = 0
+        self.cropped = 0
+        self.crops = 0
+        self.area_ratio = 0.0
+        self.crop_time = 0.0
+
+    def update(self, enabled=None, padding=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if padding is not None:
+            self.padding = padding
+
+    def plan(self, frame, aoi_info, width, height):
+        """plan.
+
+        CropBatch for `frame` given AOIs in `width` x `height` stream image
+        coordinates, or None when the whole frame should be inferred.
+        """
+        t0 = time.perf_counter()
+        self.frames += 1
+        frame_height, frame_width = frame.shape[:2]
+        regions = crop_regions(
+            aoi_info, frame_width / width, frame_height / height,
+            frame_width, frame_height, self.padding)
+        if not regions:
+            return None
+        area = sum((r[2] - r[0]) * (r[3] - r[1]) for r in regions)
+        area_ratio = area / (frame_width * frame_height)
+        if area_ratio > self.max_area_ratio:
+            return None
+        batch = CropBatch.pack(frame, regions)
+        self.cropped += 1
+        self.crops = len(regions)
+        self.area_ratio = area_ratio
+        self.crop_time += time.perf_counter() - t0
+        return batch
+
+    def metrics(self):
+        return {
+            "enabled": self.enabled,
+            "padding": self.padding,
+            "frames": self.frames,
+            "cropped": self.cropped,
+            "crops": self.crops,
+            "area_ratio": self.area_ratio,
+            "crop_time": self.crop_time,
+        }
@@ -35,6 +35,8 @@ class PartDetectionModeEnum(str, Enum):
 class UploadModelBody(BaseModel):
     model_uri: str = None
     model_dir: str = None
+    # Used instead of model_uri on a VPU
+    model_uri_fp16: str = None
 
 
 class UpdateEndpointBody(BaseModel):
@@ -55,9 +57,53 @@ class CameraModel(BaseModel):
     send_video_to_cloud_threshold: int = 60
     recording_duration: int = 60
     enable_tracking: bool
+    change_gate: bool = None
+    change_gate_sensitivity: float = None
+    detection_schedule: bool = None
+    detection_max_interval: int = None
+    aoi_crop: bool = None
+    aoi_crop_padding: float = None
+    tiled_inference: bool = None
+    # ms
+    tile_latency_budget: float = None
+    # Groups of part names a tracked part may switch between
+    class_switch_groups: List[List[str]] = None
+    class_switch_hits: int = None
 
 
 class CamerasModel(BaseModel):
     lva_mode: Literal["http", "grpc"]
     fps: float
     cameras: List[CameraModel]
+
+
+class RetrainParametersModel(BaseModel):
+    is_retrain: bool
+    confidence_min: int
+    confidence_max: int
+    max_images: int
+
+
+class IothubParametersModel(BaseModel):
+    is_send: bool
+    threshold: int
+    fpm: int
+
+
+class DeployConfigModel(BaseModel):
+    """DeployConfigModel.
+
+    Every setting of a deployment, each section optional. boot_id is
+    the InferenceModule run the sender diffed against, if any.
+    """
+
+    boot_id: str = None
+    part_detection_id: int = None
+    part_detection_mode: PartDetectionModeEnum = None
+    endpoint: UpdateEndpointBody = None
+    model: UploadModelBody = None
+    parts: PartsModel = None
+    cams: CamerasModel = None
+    retrain: RetrainParametersModel = None
+    iothub: IothubParametersModel = None
+    prob_threshold: int = None
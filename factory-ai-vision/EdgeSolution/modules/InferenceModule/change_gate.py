@@ -0,0 +1,136 @@
+"""Change gate.
+
+Cheap scene-change test in front of inference. A frame is compared with
+the last frame that was sent to inference; when no block of the scene
+changed enough the previous detections are reused instead.
+
+Enable with CHANGE_GATE=true, per camera through /update_cams.
+"""
+
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHANGE_GATE_ENABLED = os.environ.get("CHANGE_GATE", "false") == "true"
+# 0 (only large changes) .. 1 (any change) infers
+CHANGE_GATE_SENSITIVITY = float(os.environ.get("CHANGE_GATE_SENSITIVITY", "0.5"))
+# Previous detections are never reused for longer than this
+CHANGE_GATE_MAX_REUSE_AGE = float(os.environ.get("CHANGE_GATE_MAX_REUSE_AGE", "2"))  # sec
+
+GATE_WIDTH = 128
+GATE_HEIGHT = 72
+GATE_BLOCKS = (16, 9)
+# Mean absolute grey level difference of a block at sensitivity 0 and 1
+MAX_THRESHOLD = 40.0
+MIN_THRESHOLD = 2.0
+
+
+def sensitivity_to_threshold(sensitivity):
+    sensitivity = min(max(sensitivity, 0.0), 1.0)
+    return MAX_THRESHOLD - sensitivity * (MAX_THRESHOLD - MIN_THRESHOLD)
+
+
+class ChangeGate:
+    """ChangeGate.
+
+    The score of a frame is the largest block-wise mean difference between
+    its downsampled, blurred grey image and the last inferred one, so a
+    small object entering one block is not averaged away by a static
+    background. Comparing with the last inferred frame (not the previous
+    one) keeps slow drifts from being skipped forever.
+    """
+
+    def __init__(self, enabled=CHANGE_GATE_ENABLED,
+                 sensitivity=CHANGE_GATE_SENSITIVITY,
+                 max_reuse_age=CHANGE_GATE_MAX_REUSE_AGE):
+        self.enabled = enabled
+        self.sensitivity = sensitivity
+        self.threshold = sensitivity_to_threshold(sensitivity)
+        self.max_reuse_age = max_reuse_age
+        self.reference = None
+        self.last_inference = 0
+        self.last_score = 0.0
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.frames = 0
+        self.inferred = 0
+        self.skipped = 0
+        self.gate_time = 0.0
+        self.inference_time = 0.0
+
+    def update(self, enabled=None, sensitivity=None, max_reuse_age=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sensitivity is not None:
+            self.sensitivity = sensitivity
+            self.threshold = sensitivity_to_threshold(sensitivity)
+        if max_reuse_age is not None:
+            self.max_reuse_age = max_reuse_age
+        # Next frame is always inferred with the new settings
+        self.reference = None
+
+    def _signature(self, img):
+        small = cv2.resize(img, (GATE_WIDTH, GATE_HEIGHT), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0).astype(np.int16)
+
+    def score(self, signature):
+        if self.reference is None:
+            return 255.0
+        diff = np.abs(signature - self.reference).astype(np.float32)
+        blocks = cv2.resize(diff, GATE_BLOCKS, interpolation=cv2.INTER_AREA)
+        return float(blocks.max())
+
+    def should_infer(self, img, now=None):
+        """should_infer.
+
+        Whether `img` has to go to inference. The frame becomes the new
+        reference when it does.
+        """
+        now = time.time() if now is None else now
+        self.frames += 1
+        if not self.enabled:
+            self.inferred += 1
+            return True
+        t0 = time.perf_counter()
+        signature = self._signature(img)
+        self.last_score = self.score(signature)
+        infer = (
+            self.last_score >= self.threshold
+            or now - self.last_inference >= self.max_reuse_age
+        )
+        if infer:
+            self.reference = signature
+            self.last_inference = now
+            self.inferred += 1
+        else:
+            self.skipped += 1
+        self.gate_time += time.perf_counter() - t0
+        return infer
+
+    def record_inference_time(self, inf_time):
+        self.inference_time += inf_time
+
+    def metrics(self):
+        avg_inference_time = self.inference_time / self.inferred if self.inferred else 0
+        return {
+            "enabled": self.enabled,
+            "sensitivity": self.sensitivity,
+            "threshold": self.threshold,
+            "max_reuse_age": self.max_reuse_age,
+            "frames": self.frames,
+            "inferred": self.inferred,
+            "skipped": self.skipped,
+            "skip_ratio": self.skipped / self.frames if self.frames else 0,
+            "last_score": self.last_score,
+            # Estimated from the average inference time, net of the gate cost
+            "saved_time": max(0.0, self.skipped * avg_inference_time - self.gate_time),
+            "gate_time": self.gate_time,
+        }
@@ -0,0 +1,337 @@
+"""Detection schedule.
+
+Run the detector every N frames for the tracking scenarios (PartCounter,
+DangerZone, PartDetection) and propagate the detected objects in between,
+like the retail people counter alternates its detector with per object
+trackers every `skip_frames`.
+
+Between detections each object is moved by a constant velocity Kalman
+filter, optionally corrected by a local template or optical flow match.
+N follows the scene motion, and a detection is forced as soon as a track
+loses confidence.
+
+Enable with DETECTION_SCHEDULE=true, per camera through /update_cams.
+"""
+
+import logging
+import os
+
+import cv2
+import numpy as np
+from filterpy.kalman import KalmanFilter
+
+from scenarios import Detection
+from sort import associate_detections_to_trackers, convert_bbox_to_z, convert_x_to_bbox
+
+logger = logging.getLogger(__name__)
+
+REFINE_NONE = "none"
+REFINE_TEMPLATE = "template"
+REFINE_FLOW = "flow"
+REFINES = (REFINE_NONE, REFINE_TEMPLATE, REFINE_FLOW)
+
+DETECTION_SCHEDULE_ENABLED = os.environ.get("DETECTION_SCHEDULE", "false") == "true"
+# Frames between two detections never exceed this
+DETECTION_MAX_INTERVAL = int(os.environ.get("DETECTION_MAX_INTERVAL", "8"))
+# A track below this confidence (1 right after a detection) forces a detection
+DETECTION_MIN_CONFIDENCE = float(os.environ.get("DETECTION_MIN_CONFIDENCE", "0.5"))
+DETECTION_REFINE = os.environ.get("DETECTION_REFINE", REFINE_TEMPLATE)
+
+# Fraction of the box size an object may move before it is detected again
+MAX_DRIFT = 0.5
+# Confidence kept per propagated frame without a local match
+PREDICT_DECAY = 0.9
+MATCH_DECAY = 0.5
+MIN_MATCH_SCORE = 0.6
+MIN_FLOW_POINTS = 4
+# Search window around the predicted box, in box sizes
+SEARCH_MARGIN = 0.5
+ASSOCIATION_IOU = 0.1
+
+
+class PropagatedTrack:
+    """PropagatedTrack.
+
+    Detected object carried between detections. Uses the same state and
+    noise model as SORT's KalmanBoxTracker, without consuming its ids.
+    """
+
+    def __init__(self, detection):
+        self.kf = KalmanFilter(dim_x=7, dim_z=4)
+        self.kf.F = np.array([
+            [1, 0, 0, 0, 1, 0, 0], [0, 1, 0, 0, 0, 1, 0], [0, 0, 1, 0, 0, 0, 1],
+            [0, 0, 0, 1, 0, 0, 0], [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0],
+            [0, 0, 0, 0, 0, 0, 1]])
+        self.kf.H = np.array([
+            [1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0],
+            [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]])
+        self.kf.R[2:, 2:] *= 10.0
+        self.kf.P[4:, 4:] *= 1000.0
+        self.kf.P *= 10.0
+        self.kf.Q[-1, -1] *= 0.01
+        self.kf.Q[4:, 4:] *= 0.01
+        self.kf.x[:4] = convert_bbox_to_z(detection_box(detection))
+        self.hits = 0
+        self.observe(detection)
+
+    def observe(self, detection):
+        if self.hits:
+            self.kf.update(convert_bbox_to_z(detection_box(detection)))
+        self.hits += 1
+        self.detected_box = detection_box(detection)
+        self.tag = detection.tag
+        self.score = detection.score
+        self.confidence = 1.0
+        self.template = None
+        self.points = None
+        # Box around `points`, moved with them independently of the filter
+        self.flow_box = None
+
+    def predict(self):
+        if self.kf.x[6] + self.kf.x[2] <= 0:
+            self.kf.x[6] *= 0.0
+        self.kf.predict()
+        return self.box()
+
+    def correct(self, box):
+        self.kf.update(convert_bbox_to_z(box))
+
+    def box(self):
+        return convert_x_to_bbox(self.kf.x)[0]
+
+    def speed(self):
+        return float(np.hypot(self.kf.x[4, 0], self.kf.x[5, 0]))
+
+    def size(self):
+        x1, y1, x2, y2 = self.box()
+        return float(np.sqrt(max(x2 - x1, 1) * max(y2 - y1, 1)))
+
+
+def detection_box(detection):
+    return np.array([detection.x1, detection.y1, detection.x2, detection.y2], dtype=np.float64)
+
+
+def clip_box(box, width, height):
+    x1, y1, x2, y2 = box
+    x1 = int(min(max(x1, 0), width - 1))
+    y1 = int(min(max(y1, 0), height - 1))
+    x2 = int(min(max(x2, x1 + 1), width))
+    y2 = int(min(max(y2, y1 + 1), height))
+    return x1, y1, x2, y2
+
+
+def to_grey(img):
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+class DetectionSchedule:
+    """DetectionSchedule.
+
+    Usage per frame: `should_detect()`, then either `observe(img, detections)`
+    with the detector output or `propagate(img)` to get the tracked objects.
+    Detections are scenarios.Detection tuples in frame pixels.
+    """
+
+    def __init__(self, enabled=DETECTION_SCHEDULE_ENABLED,
+                 max_interval=DETECTION_MAX_INTERVAL,
+                 min_confidence=DETECTION_MIN_CONFIDENCE,
+                 refine=DETECTION_REFINE):
+        if refine not in REFINES:
+            raise ValueError("Unknown refine: {}".format(refine))
+        self.enabled = enabled
+        self.max_interval = max(1, max_interval)
+        self.min_confidence = min_confidence
+        self.refine = refine
+        self.tracks = []
+        self.prev_grey = None
+        self.since_detection = 0
+        self.interval = 1
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.frames = 0
+        self.detections = 0
+        self.propagated = 0
+        self.forced = 0
+
+    def update(self, enabled=None, max_interval=None, refine=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if max_interval is not None:
+            self.max_interval = max(1, max_interval)
+        if refine is not None:
+            if refine not in REFINES:
+                raise ValueError("Unknown refine: {}".format(refine))
+            self.refine = refine
+        # Next frame is always detected with the new settings
+        self.tracks = []
+        self.prev_grey = None
+        self.interval = 1
+
+    def should_detect(self):
+        """should_detect.
+
+        Whether the next frame has to go to the detector.
+        """
+        self.frames += 1
+        if not self.enabled or not self.tracks and self.prev_grey is None:
+            detect = True
+        elif any(t.confidence < self.min_confidence for t in self.tracks):
+            detect = True
+            self.forced += 1
+        else:
+            detect = self.since_detection + 1 >= self.interval
+        if detect:
+            self.detections += 1
+        else:
+            self.propagated += 1
+        return detect
+
+    def observe(self, img, detections):
+        """observe.
+
+        Restart propagation from the detector output on `img`. Detections
+        are matched with the current tracks to keep their velocities.
+        """
+        if not self.enabled:
+            return
+        predicted = np.array([t.predict() for t in self.tracks]).reshape(-1, 4)
+        boxes = np.array([detection_box(d) for d in detections]).reshape(-1, 4)
+        matched, unmatched, _ = associate_detections_to_trackers(
+            boxes, predicted, ASSOCIATION_IOU)
+        tracks = []
+        for d, t in matched:
+            self.tracks[t].observe(detections[d])
+            tracks.append(self.tracks[t])
+        for d in unmatched:
+            tracks.append(PropagatedTrack(detections[d]))
+        self.tracks = tracks
+
+        grey = to_grey(img)
+        height, width = grey.shape
+        for track in self.tracks:
+            x1, y1, x2, y2 = clip_box(track.detected_box, width, height)
+            if self.refine == REFINE_TEMPLATE:
+                track.template = grey[y1:y2, x1:x2].copy()
+            elif self.refine == REFINE_FLOW:
+                track.points = cv2.goodFeaturesToTrack(
+                    grey[y1:y2, x1:x2], 20, 0.01, 3)
+                if track.points is not None:
+                    track.points = track.points + np.array([x1, y1], dtype=np.float32)
+                    track.flow_box = track.detected_box.copy()
+        self.prev_grey = grey
+        self.since_detection = 0
+        self.interval = self.next_interval()
+
+    def propagate(self, img):
+        """propagate.
+
+        Move every track to `img` and return them as detections.
+        """
+        grey = to_grey(img)
+        height, width = grey.shape
+        tracks = []
+        for track in self.tracks:
+            box = track.predict()
+            if box[2] <= 0 or box[3] <= 0 or box[0] >= width or box[1] >= height:
+                # Left the frame
+                continue
+            tracks.append(track)
+            if box[0] < 0 or box[1] < 0 or box[2] > width or box[3] > height:
+                # Partly visible objects do not match their template
+                score, measured = None, None
+            elif self.refine == REFINE_TEMPLATE:
+                score, measured = self._match_template(grey, track, box)
+            elif self.refine == REFINE_FLOW:
+                score, measured = self._match_flow(grey, track)
+            else:
+                score, measured = None, None
+            if measured is not None and score >= MIN_MATCH_SCORE:
+                track.correct(measured)
+                track.confidence *= score
+            elif score is None:
+                track.confidence *= PREDICT_DECAY
+            else:
+                track.confidence *= MATCH_DECAY
+        self.tracks = tracks
+        self.prev_grey = grey
+        self.since_detection += 1
+        self.interval = min(self.interval, self.next_interval())
+        return self.get_detections()
+
+    def _match_template(self, grey, track, box):
+        if track.template is None or track.template.size == 0:
+            return 0.0, None
+        height, width = grey.shape
+        th, tw = track.template.shape
+        margin = int(SEARCH_MARGIN * max(tw, th)) + 4
+        cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+        x1, y1, x2, y2 = clip_box(
+            (cx - tw / 2 - margin, cy - th / 2 - margin,
+             cx + tw / 2 + margin, cy + th / 2 + margin), width, height)
+        window = grey[y1:y2, x1:x2]
+        if window.shape[0] < th or window.shape[1] < tw:
+            return 0.0, None
+        result = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (mx, my) = cv2.minMaxLoc(result)
+        # Flat templates give NaN scores
+        if not np.isfinite(score):
+            return 0.0, None
+        return float(score), np.array([x1 + mx, y1 + my, x1 + mx + tw, y1 + my + th])
+
+    def _match_flow(self, grey, track):
+        if track.points is None or len(track.points) < MIN_FLOW_POINTS:
+            return 0.0, None
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.prev_grey, grey, track.points, None, winSize=(15, 15), maxLevel=2)
+        good = status.reshape(-1) == 1
+        if good.sum() < MIN_FLOW_POINTS:
+            track.points = None
+            return 0.0, None
+        shift = np.median(points[good] - track.points[good], axis=0).reshape(-1)
+        score = float(good.mean())
+        track.points = points[good].reshape(-1, 1, 2)
+        # track.box() is already predicted, the shift applies to the points' box
+        track.flow_box = track.flow_box + np.array([shift[0], shift[1], shift[0], shift[1]])
+        return score, track.flow_box
+
+    def next_interval(self):
+        """next_interval.
+
+        Frames until the fastest object may have moved MAX_DRIFT of its
+        size. New tracks without a known velocity are detected again on
+        the next frame unless they are followed by a local match.
+        """
+        if not self.tracks:
+            return self.max_interval
+        interval = self.max_interval
+        for track in self.tracks:
+            if track.hits < 2 and self.refine == REFINE_NONE:
+                return 1
+            speed = track.speed()
+            if speed > 0:
+                interval = min(interval, int(MAX_DRIFT * track.size() / speed))
+        return max(1, interval)
+
+    def get_detections(self):
+        detections = []
+        for track in self.tracks:
+            x1, y1, x2, y2 = track.box()
+            detections.append(Detection(track.tag, x1, y1, x2, y2, track.score))
+        return detections
+
+    def metrics(self):
+        return {
+            "enabled": self.enabled,
+            "refine": self.refine,
+            "max_interval": self.max_interval,
+            "interval": self.interval,
+            "frames": self.frames,
+            "detections": self.detections,
+            "propagated": self.propagated,
+            "forced": self.forced,
+            "saved_ratio": self.propagated / self.frames if self.frames else 0,
+            "tracks": len(self.tracks),
+        }
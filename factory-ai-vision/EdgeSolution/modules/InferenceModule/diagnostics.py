@@ -0,0 +1,211 @@
+"""Diagnostics.
+
+Opt-in memory diagnostics for long-running modules: RSS samples,
+tracemalloc allocation-site growth and sizes of registered structures.
+
+Enable with DIAGNOSTICS=true, sample period with DIAGNOSTICS_INTERVAL
+(seconds).
+"""
+
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DIAGNOSTICS_ENABLED = os.environ.get("DIAGNOSTICS", "false") == "true"
+DIAGNOSTICS_INTERVAL = float(os.environ.get("DIAGNOSTICS_INTERVAL", "60"))
+DIAGNOSTICS_HISTORY = 120
+DIAGNOSTICS_TOP = 10
+
+
+def get_rss():
+    """get_rss.
+
+    Current resident set size in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak rather than current, but the best available without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten("{}.{}".format(prefix, k), v, out)
+    else:
+        out[prefix] = value
+
+
+class Diagnostics:
+    """Diagnostics.
+
+    Structures are registered by name with either a sized object or a
+    callable returning an int or a (nested) dict of ints. Callables are
+    preferred for per-stream state so removed streams drop out naturally.
+    """
+
+    def __init__(self, history=DIAGNOSTICS_HISTORY, top=DIAGNOSTICS_TOP):
+        self.structures = {}
+        self.samples = deque(maxlen=history)
+        self.top = top
+        self.baseline = None
+        self.snapshot = None
+        self.mutex = threading.Lock()
+        self.is_running = False
+        self.is_tracing = False
+        self.thread = None
+
+    def register(self, name, target):
+        with self.mutex:
+            self.structures[name] = target
+
+    def unregister(self, name):
+        with self.mutex:
+            self.structures.pop(name, None)
+
+    def get_structure_sizes(self):
+        with self.mutex:
+            structures = dict(self.structures)
+        sizes = {}
+        for name, target in structures.items():
+            try:
+                value = target() if callable(target) else len(target)
+            except Exception:
+                logger.exception("Failed to size structure %s", name)
+                continue
+            _flatten(name, value, sizes)
+        return sizes
+
+    def _take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def sample(self):
+        """sample.
+
+        Record RSS, traced memory and structure sizes. Takes a tracemalloc
+        snapshot when tracing is on; the first one becomes the baseline.
+        """
+        sample = {
+            "time": time.time(),
+            "rss": get_rss(),
+            "structures": self.get_structure_sizes(),
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            sample["traced_current"] = current
+            sample["traced_peak"] = peak
+            snapshot = self._take_snapshot()
+            with self.mutex:
+                if self.baseline is None:
+                    self.baseline = snapshot
+                self.snapshot = snapshot
+        with self.mutex:
+            self.samples.append(sample)
+        return sample
+
+    def top_growth(self, limit=None):
+        """top_growth.
+
+        Allocation sites that grew the most between the baseline and the
+        latest snapshot.
+        """
+        with self.mutex:
+            baseline, snapshot = self.baseline, self.snapshot
+        if baseline is None or snapshot is None:
+            return []
+        stats = snapshot.compare_to(baseline, "lineno")
+        return [
+            {
+                "site": str(stat.traceback),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+            }
+            for stat in stats[: limit or self.top]
+            if stat.size_diff > 0
+        ]
+
+    def reset_baseline(self):
+        with self.mutex:
+            self.baseline = self.snapshot
+
+    def start(self, interval=DIAGNOSTICS_INTERVAL, frames=1):
+        """start.
+
+        Start tracemalloc and a background sampler.
+        """
+        if self.is_running:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.is_tracing = True
+        self.is_running = True
+
+        def _run():
+            while self.is_running:
+                try:
+                    self.sample()
+                except Exception:
+                    logger.exception("Diagnostics sample failed")
+                time.sleep(interval)
+
+        self.thread = threading.Thread(target=_run, daemon=True)
+        self.thread.start()
+        logger.info("Diagnostics started, interval %s sec", interval)
+
+    def stop(self):
+        """stop.
+
+        Stop the sampler, and tracemalloc if start() turned it on.
+        """
+        self.is_running = False
+        if self.is_tracing:
+            tracemalloc.stop()
+            self.is_tracing = False
+
+    def report(self):
+        """report.
+
+        Summary of the samples recorded so far; does not take a sample.
+        """
+        with self.mutex:
+            samples = list(self.samples)
+        if not samples:
+            return {"enabled": self.is_running, "samples": []}
+        first, latest = samples[0], samples[-1]
+        elapsed = latest["time"] - first["time"]
+        structure_growth = {
+            name: size - first["structures"].get(name, 0)
+            for name, size in latest["structures"].items()
+            if isinstance(size, (int, float))
+        }
+        return {
+            "enabled": self.is_running,
+            "rss": latest["rss"],
+            "rss_growth": latest["rss"] - first["rss"],
+            "elapsed": elapsed,
+            "structures": latest["structures"],
+            "structure_growth": structure_growth,
+            "top_growth": self.top_growth(),
+            "samples": [
+                {"time": s["time"], "rss": s["rss"],
+                 "traced_current": s.get("traced_current")}
+                for s in samples
+            ],
+        }
+
+
+diagnostics = Diagnostics()
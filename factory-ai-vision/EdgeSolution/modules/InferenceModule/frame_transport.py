@@ -0,0 +1,50 @@
+"""Frame transport.
+
+Encodings the /predict endpoint accepts from CVCaptureModule, told apart
+by the Content-Type of the request. Requests without one are raw BGR
+frames 960 pixels wide, as CVCaptureModule always sent them.
+"""
+
+import logging
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RAW = "raw"
+JPEG = "jpeg"
+PNG = "png"
+
+CONTENT_TYPES = {
+    "image/x-raw-bgr": RAW,
+    "image/jpeg": JPEG,
+    "image/png": PNG,
+}
+ENCODINGS = [RAW, JPEG, PNG]
+RAW_WIDTH = 960
+
+
+def frame_encoding(content_type):
+    """Encoding of a Content-Type header, None for other types."""
+    if not content_type:
+        return None
+    return CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+
+
+def decode_frame(body, encoding, width=RAW_WIDTH):
+    """decode_frame.
+
+    BGR image of a request body, None when it does not decode.
+    """
+    buffer = np.frombuffer(body, np.uint8)
+    if encoding == RAW:
+        if width <= 0 or len(buffer) == 0 or len(buffer) % (width * 3):
+            logger.warning("Raw frame of %d bytes is not %d pixels wide",
+                           len(buffer), width)
+            return None
+        return buffer.reshape(-1, width, 3)
+    img = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if img is None:
+        logger.warning("Failed to decode %s frame of %d bytes", encoding, len(buffer))
+    return img
@@ -0,0 +1,292 @@
+"""Graph operations.
+
+Concurrent, coalescing execution of LVA graph direct methods and a
+desired-state reconciler on top of it.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from invoke import gm
+
+logger = logging.getLogger(__name__)
+
+GRAPH_OPERATION_WORKERS = int(os.environ.get("GRAPH_OPERATION_WORKERS", "8"))
+
+OP_SET = "set"
+OP_ACTIVATE = "activate"
+OP_DEACTIVATE = "deactivate"
+OP_DELETE = "delete"
+OP_RECONFIGURE = "reconfigure"
+OP_TOPOLOGY_SET = "topology_set"
+OP_TOPOLOGY_DELETE = "topology_delete"
+
+# Pending operations (same graph, not started yet) that an incoming
+# operation makes redundant. Only the trailing run of such operations is
+# dropped, so ordering against any other kind of operation is preserved.
+# Callers waiting on a dropped operation get the result of the one that
+# replaced it.
+SUPERSEDES = {
+    OP_SET: (OP_SET,),
+    OP_ACTIVATE: (OP_ACTIVATE,),
+    OP_DEACTIVATE: (OP_DEACTIVATE, OP_ACTIVATE),
+    OP_DELETE: (OP_SET, OP_ACTIVATE, OP_DEACTIVATE, OP_RECONFIGURE, OP_DELETE),
+    OP_RECONFIGURE: (OP_SET, OP_ACTIVATE, OP_DEACTIVATE, OP_RECONFIGURE),
+    OP_TOPOLOGY_SET: (OP_TOPOLOGY_SET,),
+    OP_TOPOLOGY_DELETE: (OP_TOPOLOGY_SET, OP_TOPOLOGY_DELETE),
+}
+
+
+def _is_ok(res):
+    return isinstance(res, dict) and "error" not in res and res.get("status", 200) < 300
+
+
+class _Operation:
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.payload = payload
+        self.futures = [Future()]
+
+    def absorb(self, other):
+        """absorb.
+
+        Take over the waiters of a superseded operation.
+        """
+        self.futures.extend(other.futures)
+
+    def resolve(self, result):
+        for future in self.futures:
+            future.set_result(result)
+
+
+class GraphOperations:
+    """GraphOperations.
+
+    Queue of LVA direct methods keyed by graph name. Operations on different
+    graphs run concurrently on a thread pool, operations on the same graph
+    run in submission order, and redundant pending operations on the same
+    graph are coalesced (e.g. a set followed by a set only runs the last one).
+    """
+
+    def __init__(self, graph_manager, max_workers=GRAPH_OPERATION_WORKERS):
+        self.graph_manager = graph_manager
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.mutex = threading.Lock()
+        self.pending = {}
+        self.running = set()
+        self.coalesced = 0
+
+    def submit(self, key, kind, payload=None):
+        """submit.
+
+        Queue an operation for graph `key` and return a Future resolving to
+        the direct method result.
+        """
+        op = _Operation(kind, payload)
+        with self.mutex:
+            queue = self.pending.setdefault(key, [])
+            superseded = SUPERSEDES.get(kind, ())
+            while queue and queue[-1].kind in superseded:
+                op.absorb(queue.pop())
+                self.coalesced += 1
+            queue.append(op)
+            if key not in self.running:
+                self.running.add(key)
+                self.executor.submit(self._drain, key)
+        return op.futures[0]
+
+    def _drain(self, key):
+        while True:
+            with self.mutex:
+                queue = self.pending.get(key)
+                if not queue:
+                    self.pending.pop(key, None)
+                    self.running.discard(key)
+                    return
+                op = queue.pop(0)
+            try:
+                result = self._run(key, op)
+            except Exception as e:
+                logger.exception("Graph operation %s on %s failed", op.kind, key)
+                result = {"error": str(e)}
+            op.resolve(result)
+
+    def _run(self, key, op):
+        name = key.split(":", 1)[1]
+        gm_ = self.graph_manager
+        if op.kind == OP_SET:
+            return gm_.invoke_graph_instance_set(name, op.payload)
+        if op.kind == OP_ACTIVATE:
+            return gm_.invoke_graph_instance_activate(name)
+        if op.kind == OP_DEACTIVATE:
+            return gm_.invoke_graph_instance_deactivate(name)
+        if op.kind == OP_DELETE:
+            gm_.invoke_graph_instance_deactivate(name)
+            return gm_.invoke_graph_instance_delete(name)
+        if op.kind == OP_RECONFIGURE:
+            gm_.invoke_graph_instance_deactivate(name)
+            res = gm_.invoke_graph_instance_set(name, op.payload)
+            if not _is_ok(res):
+                return res
+            return gm_.invoke_graph_instance_activate(name)
+        if op.kind == OP_TOPOLOGY_SET:
+            return gm_.invoke_graph_topology_set(name, op.payload)
+        if op.kind == OP_TOPOLOGY_DELETE:
+            return gm_.invoke_graph_topology_delete(name)
+        raise ValueError("Unknown graph operation: {}".format(op.kind))
+
+    def instance_set(self, name, properties):
+        return self.submit("instance:" + name, OP_SET, properties)
+
+    def instance_activate(self, name):
+        return self.submit("instance:" + name, OP_ACTIVATE)
+
+    def instance_deactivate(self, name):
+        return self.submit("instance:" + name, OP_DEACTIVATE)
+
+    def instance_delete(self, name):
+        """instance_delete.
+
+        Deactivate and delete the instance.
+        """
+        return self.submit("instance:" + name, OP_DELETE)
+
+    def instance_reconfigure(self, name, properties):
+        """instance_reconfigure.
+
+        Deactivate, set and activate the instance as one operation.
+        """
+        return self.submit("instance:" + name, OP_RECONFIGURE, properties)
+
+    def topology_set(self, name, properties):
+        return self.submit("topology:" + name, OP_TOPOLOGY_SET, properties)
+
+    def topology_delete(self, name):
+        return self.submit("topology:" + name, OP_TOPOLOGY_DELETE)
+
+    def wait(self, futures, timeout=None):
+        return [future.result(timeout=timeout) for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def _parameters(properties):
+    return {
+        p["name"]: p.get("value") for p in properties.get("parameters", [])
+    }
+
+
+def _same_instance(current, desired):
+    return (
+        current.get("topologyName") == desired.get("topologyName")
+        and _parameters(current) == _parameters(desired)
+    )
+
+
+def _same_topology(current, desired):
+    keys = ("description", "parameters", "sources", "processors", "sinks")
+    return all(current.get(k) == desired.get(k) for k in keys)
+
+
+class GraphReconciler:
+    """GraphReconciler.
+
+    Diff the desired topologies and instances against what LVA reports and
+    apply only the changes through GraphOperations.
+    """
+
+    def __init__(self, graph_manager, graph_operations):
+        self.graph_manager = graph_manager
+        self.graph_operations = graph_operations
+
+    def _list(self, res):
+        if not _is_ok(res):
+            return None
+        return {item["name"]: item.get("properties", {})
+                for item in res["payload"].get("value", [])}
+
+    def reconcile(self, topologies, instances, delete_unknown=True):
+        """reconcile.
+
+        Args:
+            topologies: {name: properties} of wanted graph topologies.
+            instances: {name: {"properties": ..., "active": bool}} of wanted
+                graph instances.
+            delete_unknown: delete instances and topologies not listed.
+
+        Returns:
+            A dict of the applied changes, or None when the current state
+            cannot be listed.
+        """
+        current_topologies = self._list(
+            self.graph_manager.invoke_graph_topology_list())
+        current_instances = self._list(
+            self.graph_manager.invoke_graph_instance_list())
+        if current_topologies is None or current_instances is None:
+            logger.warning("Failed to list current graph state")
+            return None
+
+        changes = {"topology_set": [], "topology_delete": [],
+                   "instance_set": [], "instance_activate": [],
+                   "instance_deactivate": [], "instance_delete": []}
+        ops = self.graph_operations
+
+        # Topologies first, instances may reference them
+        futures = []
+        for name, properties in topologies.items():
+            current = current_topologies.get(name)
+            if current is None or not _same_topology(current, properties):
+                futures.append(ops.topology_set(name, properties))
+                changes["topology_set"].append(name)
+        ops.wait(futures)
+
+        futures = []
+        for name, current in current_instances.items():
+            if name not in instances and delete_unknown:
+                futures.append(ops.instance_delete(name))
+                changes["instance_delete"].append(name)
+        for name, wanted in instances.items():
+            current = current_instances.get(name)
+            active = wanted.get("active", True)
+            is_active = current is not None and current.get(
+                "state", "").lower() == "active"
+            if current is None or not _same_instance(current, wanted["properties"]):
+                changes["instance_set"].append(name)
+                if active:
+                    futures.append(ops.instance_reconfigure(
+                        name, wanted["properties"]))
+                    changes["instance_activate"].append(name)
+                else:
+                    if is_active:
+                        futures.append(ops.instance_deactivate(name))
+                        changes["instance_deactivate"].append(name)
+                    futures.append(ops.instance_set(
+                        name, wanted["properties"]))
+            elif active and not is_active:
+                futures.append(ops.instance_activate(name))
+                changes["instance_activate"].append(name)
+            elif not active and is_active:
+                futures.append(ops.instance_deactivate(name))
+                changes["instance_deactivate"].append(name)
+        ops.wait(futures)
+
+        # Topologies can only be deleted once no instance references them
+        futures = []
+        if delete_unknown:
+            for name in current_topologies:
+                if name not in topologies:
+                    futures.append(ops.topology_delete(name))
+                    changes["topology_delete"].append(name)
+        ops.wait(futures)
+
+        logger.info("Graph reconcile changes: %s", changes)
+        return changes
+
+
+if gm:
+    graph_operations = GraphOperations(gm)
+else:
+    graph_operations = None
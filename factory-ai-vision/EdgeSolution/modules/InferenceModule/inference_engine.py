@@ -15,6 +15,7 @@ import extension_pb2_grpc
 import inferencing_pb2
 import media_pb2
 from exception_handler import PrintGetExceptionDetails
+from raw_frame import decode_raw_frame
 from shared_memory import SharedMemoryManager
 
 # Get debug flag from env variable (Returns None if not set)
@@ -192,33 +193,23 @@ class InferenceEngine(extension_pb2_grpc.MediaGraphExtensionServicer):
                 cvImage = cv2.imdecode(np.frombuffer(
                     rawBytes, dtype=np.uint8), -1)
 
-            # Handle RAW content (Just place holder for the user to handle each variation...)
+            # Handle RAW content
             elif (
                 encoding
                 == clientState._mediaStreamDescriptor.media_descriptor.video_frame_sample_format.Encoding.RAW
             ):
-                pixelFormat = (
-                    clientState._mediaStreamDescriptor.media_descriptor.video_frame_sample_format.pixel_format
+                frameFormat = (
+                    clientState._mediaStreamDescriptor.media_descriptor.video_frame_sample_format
+                )
+                # Zero copy view for BGR layouts, one conversion otherwise
+                cvImage = decode_raw_frame(
+                    rawBytes,
+                    media_pb2.VideoFrameSampleFormat.PixelFormat.Name(
+                        frameFormat.pixel_format),
+                    frameFormat.dimensions.width,
+                    frameFormat.dimensions.height,
+                    frameFormat.stride_bytes,
                 )
-                if pixelFormat == media_pb2.VideoFrameSampleFormat.PixelFormat.RGBA:
-                    cvImage = cv2.cvtColor(
-                        np.frombuffer(
-                            rawBytes, dtype=np.uint8), cv2.COLOR_RGBA2RGB
-                    )
-                elif pixelFormat == media_pb2.VideoFrameSampleFormat.PixelFormat.BGR24:
-                    # logging.info('&&&&&&&&&& BGR mode &&&&&&&&&&')
-                    cvImage = np.frombuffer(rawBytes, dtype=np.uint8).reshape(
-                        540, 960, 3
-                    )
-                elif pixelFormat == media_pb2.VideoFrameSampleFormat.PixelFormat.RGB24:
-                    # logging.info('&&&&&&&&&& RGB mode &&&&&&&&&&')
-                    cvImage = np.frombuffer(rawBytes, dtype=np.uint8).reshape(
-                        540, 960, 3
-                    )
-                elif (
-                    pixelFormat == media_pb2.VideoFrameSampleFormat.PixelFormat.YUV420P
-                ):
-                    cvImage = None
 
             return cvImage
 
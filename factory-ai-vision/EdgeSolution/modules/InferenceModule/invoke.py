@@ -25,7 +25,10 @@ logger = logging.getLogger(__name__)
 
 # Known issue from LVA
 # https://docs.microsoft.com/en-us/azure/media-services/live-video-analytics-edge/troubleshoot-how-to#multiple-direct-methods-in-parallel--timeout-failure
-mutex = threading.Lock()
+# Direct methods are serialized by default; deployments whose LVA version
+# handles parallel calls can raise LVA_MAX_PARALLEL_METHODS.
+LVA_MAX_PARALLEL_METHODS = int(os.environ.get("LVA_MAX_PARALLEL_METHODS", "1"))
+mutex = threading.BoundedSemaphore(LVA_MAX_PARALLEL_METHODS)
 
 
 class GraphManager:
@@ -50,21 +53,19 @@ class GraphManager:
             print(
                 "[WARNING] Not int edge evironment, ignore direct message", flush=True
             )
-        mutex.acquire()
-        try:
-            module_method = CloudToDeviceMethod(
-                method_name=method_name, payload=payload, response_timeout_in_seconds=30
-            )
-            res = self.registry_manager.invoke_device_module_method(
-                self.device_id, self.module_id, module_method
-            )
-            mutex.release()
-            return res.as_dict()
-        except:
-            mutex.release()
-            print("[ERROR] Failed to invoke direct method:",
-                  sys.exc_info(), flush=True)
-            return {"error": "failed to invoke direct method"}
+        with mutex:
+            try:
+                module_method = CloudToDeviceMethod(
+                    method_name=method_name, payload=payload, response_timeout_in_seconds=30
+                )
+                res = self.registry_manager.invoke_device_module_method(
+                    self.device_id, self.module_id, module_method
+                )
+                return res.as_dict()
+            except:
+                print("[ERROR] Failed to invoke direct method:",
+                      sys.exc_info(), flush=True)
+                return {"error": "failed to invoke direct method"}
 
     def invoke_graph_topology_get(self, name):
         method = "GraphTopologyGet"
@@ -154,6 +155,11 @@ class GraphManager:
         return self.invoke_method(method, payload)
 
     def invoke_graph_grpc_instance_set(self, name, rtspUrl, frameRate, recording_duration):
+        properties = self.graph_grpc_instance_properties(
+            name, rtspUrl, frameRate, recording_duration)
+        return self.invoke_graph_instance_set(name, properties)
+
+    def graph_grpc_instance_properties(self, name, rtspUrl, frameRate, recording_duration):
         recordingDuration = "PT{}S".format(recording_duration)
         properties = {
             "topologyName": "InferencingWithGrpcExtension",
@@ -171,7 +177,7 @@ class GraphManager:
                 {"name": "frameWidth", "value": "960"},
             ],
         }
-        return self.invoke_graph_instance_set(name, properties)
+        return properties
 
     # default http extension settings
     def invoke_graph_http_topology_set(self):
@@ -181,6 +187,11 @@ class GraphManager:
         return self.invoke_method(method, payload)
 
     def invoke_graph_http_instance_set(self, name, rtspUrl, frameRate, recording_duration):
+        properties = self.graph_http_instance_properties(
+            name, rtspUrl, frameRate, recording_duration)
+        return self.invoke_graph_instance_set(name, properties)
+
+    def graph_http_instance_properties(self, name, rtspUrl, frameRate, recording_duration):
         inferencingUrl = "http://inferencemodule:5000/predict?camera_id=" + \
             str(name)
         recordingDuration = "PT{}S".format(recording_duration)
@@ -197,7 +208,25 @@ class GraphManager:
                 {"name": "frameWidth", "value": "960"},
             ],
         }
-        return self.invoke_graph_instance_set(name, properties)
+        return properties
+
+    def graph_topology_payload(self, mode):
+        if mode == "grpc":
+            topology_file = "grpc_topology.json"
+        elif mode == "http":
+            topology_file = "http_topology.json"
+        else:
+            return None
+        with open(topology_file) as f:
+            return json.load(f)
+
+    def graph_instance_properties(self, mode, name, rtspUrl, frameRate, recording_duration):
+        if mode == "grpc":
+            return self.graph_grpc_instance_properties(name, rtspUrl, frameRate, recording_duration)
+        elif mode == "http":
+            return self.graph_http_instance_properties(name, rtspUrl, frameRate, recording_duration)
+        else:
+            return None
 
     def invoke_topology_set(self, mode):
         if mode == "grpc":
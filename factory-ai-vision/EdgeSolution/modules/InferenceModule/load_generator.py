@@ -0,0 +1,411 @@
+"""Load generator.
+
+Emulate N cameras and feed frames to the InferenceModule ingestion paths
+(HTTP /predict, ZMQ or the LVA gRPC extension) for capacity planning.
+
+    python load_generator.py --cameras 8 --fps 10 --transport http \
+        --endpoint http://localhost:5000 --duration 60 --seed 1
+"""
+
+import argparse
+import collections
+import json
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+import requests
+
+logger = logging.getLogger(__name__)
+
+IMG_WIDTH = 960
+
+SCENE_MOVING_BOXES = "moving_boxes"
+SCENE_STATIC = "static"
+SCENE_BURST = "burst"
+SCENES = (SCENE_MOVING_BOXES, SCENE_STATIC, SCENE_BURST)
+
+TRANSPORT_HTTP = "http"
+TRANSPORT_ZMQ = "zmq"
+TRANSPORT_GRPC = "grpc"
+TRANSPORTS = (TRANSPORT_HTTP, TRANSPORT_ZMQ, TRANSPORT_GRPC)
+
+# Latencies kept per camera for the percentiles, the most recent ones win
+LATENCY_SAMPLES = 10000
+
+
+class SyntheticCamera:
+    """SyntheticCamera.
+
+    Deterministic frame source. Frame `i` only depends on the seed, the
+    camera settings and `i`, so runs are reproducible.
+    """
+
+    def __init__(self, cam_id, width=1280, height=720, fps=10,
+                 scene=SCENE_MOVING_BOXES, n_objects=5, seed=0,
+                 burst_period=100, burst_length=20):
+        if scene not in SCENES:
+            raise ValueError("Unknown scene: {}".format(scene))
+        self.cam_id = cam_id
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.scene = scene
+        self.n_objects = n_objects
+        self.burst_period = burst_period
+        self.burst_length = burst_length
+
+        rng = np.random.RandomState(seed)
+        self.background = rng.randint(
+            0, 64, size=(height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+        self.background = cv2.resize(
+            self.background, (width, height), interpolation=cv2.INTER_NEAREST)
+        size = np.array([width, height], dtype=np.float64)
+        self.sizes = (rng.uniform(0.05, 0.15, size=(n_objects, 2))
+                      * size).astype(np.int64)
+        self.starts = rng.uniform(0, 1, size=(n_objects, 2)) * size
+        self.velocities = rng.uniform(-0.02, 0.02,
+                                      size=(n_objects, 2)) * size
+        self.colors = rng.randint(96, 256, size=(n_objects, 3))
+
+    def is_active(self, index):
+        """is_active.
+
+        Whether objects are visible in frame `index`.
+        """
+        if self.scene == SCENE_BURST:
+            return index % self.burst_period < self.burst_length
+        return True
+
+    def boxes(self, index):
+        """boxes.
+
+        Ground truth [x1, y1, x2, y2] of the objects in frame `index`.
+        """
+        if not self.is_active(index):
+            return np.zeros((0, 4), dtype=np.int64)
+        if self.scene == SCENE_STATIC:
+            pos = self.starts
+        else:
+            limit = np.array([self.width, self.height]) - self.sizes
+            # Bounce between the frame borders
+            travel = self.starts + self.velocities * index
+            period = 2 * np.maximum(limit, 1)
+            travel = np.mod(travel, period)
+            pos = np.where(travel > limit, period - travel, travel)
+        pos = np.clip(pos, 0, None).astype(np.int64)
+        return np.hstack([pos, pos + self.sizes])
+
+    def frame(self, index):
+        img = self.background.copy()
+        for (x1, y1, x2, y2), color in zip(self.boxes(index), self.colors):
+            cv2.rectangle(img, (int(x1), int(y1)), (int(x2), int(y2)),
+                          tuple(int(c) for c in color), -1)
+        return img
+
+
+def resize_for_transport(img):
+    """resize_for_transport.
+
+    Same pre-resize as CVCaptureModule: 960 wide, keep the aspect ratio.
+    """
+    if img.shape[1] == IMG_WIDTH:
+        return img
+    ratio = IMG_WIDTH / img.shape[1]
+    height = int(img.shape[0] * ratio + 0.000001)
+    return cv2.resize(img, (IMG_WIDTH, height))
+
+
+class HttpSender:
+    """HttpSender.
+
+    POST raw BGR frames to `/predict`, like CVCaptureModule does.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint.rstrip("/")
+        self.local = threading.local()
+
+    def send(self, cam_id, img):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        res = session.post(
+            self.endpoint + "/predict",
+            params={"camera_id": cam_id},
+            data=resize_for_transport(img).tobytes(),
+        )
+        return res.status_code < 300
+
+    def close(self):
+        pass
+
+
+class ZmqSender:
+    """ZmqSender.
+
+    Publish [cam_id, raw BGR frame] like CVCaptureModule's zmq channel.
+    """
+
+    def __init__(self, endpoint="tcp://*:5556"):
+        import zmq
+
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.bind(endpoint)
+        self.mutex = threading.Lock()
+
+    def send(self, cam_id, img):
+        data = resize_for_transport(img).tobytes()
+        with self.mutex:
+            self.socket.send_multipart([bytes(cam_id, "utf-8"), data])
+        return True
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+
+class GrpcSender:
+    """GrpcSender.
+
+    Act as the LVA gRPC extension client: one ProcessMediaStream call per
+    camera with embedded JPG content.
+    """
+
+    def __init__(self, endpoint="localhost:44000"):
+        import grpc
+
+        self.channel = grpc.insecure_channel(endpoint)
+        self.streams = {}
+        self.mutex = threading.Lock()
+
+    def _open(self, cam_id, img):
+        import queue
+
+        import extension_pb2
+        import extension_pb2_grpc
+        import media_pb2
+
+        requests_queue = queue.Queue(maxsize=1)
+        descriptor = extension_pb2.MediaStreamMessage(
+            sequence_number=1,
+            media_stream_descriptor=extension_pb2.MediaStreamDescriptor(
+                graph_identifier=extension_pb2.GraphIdentifier(
+                    graph_instance_name=cam_id),
+                media_descriptor=media_pb2.MediaDescriptor(
+                    timescale=90000,
+                    video_frame_sample_format=media_pb2.VideoFrameSampleFormat(
+                        encoding=media_pb2.VideoFrameSampleFormat.Encoding.JPG,
+                        dimensions=media_pb2.Dimensions(
+                            width=img.shape[1], height=img.shape[0]),
+                    ),
+                ),
+            ),
+        )
+
+        def _requests():
+            yield descriptor
+            while True:
+                msg = requests_queue.get()
+                if msg is None:
+                    return
+                yield msg
+
+        stub = extension_pb2_grpc.MediaGraphExtensionStub(self.channel)
+        responses = stub.ProcessMediaStream(_requests())
+        # Descriptor acknowledgement
+        next(responses)
+        return {"queue": requests_queue, "responses": responses, "seq": 1}
+
+    def send(self, cam_id, img):
+        import extension_pb2
+        import media_pb2
+
+        with self.mutex:
+            stream = self.streams.get(cam_id)
+            if stream is None:
+                stream = self.streams[cam_id] = self._open(cam_id, img)
+        stream["seq"] += 1
+        msg = extension_pb2.MediaStreamMessage(
+            sequence_number=stream["seq"],
+            media_sample=extension_pb2.MediaSample(
+                timestamp=int(time.time() * 90000),
+                content_bytes=media_pb2.ContentBytes(
+                    bytes=cv2.imencode(".jpg", img)[1].tobytes()),
+            ),
+        )
+        stream["queue"].put(msg)
+        next(stream["responses"])
+        return True
+
+    def close(self):
+        for stream in self.streams.values():
+            stream["queue"].put(None)
+        self.channel.close()
+
+
+def create_sender(transport, endpoint):
+    if transport == TRANSPORT_HTTP:
+        return HttpSender(endpoint)
+    if transport == TRANSPORT_ZMQ:
+        return ZmqSender(endpoint)
+    if transport == TRANSPORT_GRPC:
+        return GrpcSender(endpoint)
+    raise ValueError("Unknown transport: {}".format(transport))
+
+
+def _percentile(values, q):
+    if not values:
+        return 0
+    return float(np.percentile(values, q))
+
+
+class LoadGenerator:
+    """LoadGenerator.
+
+    Drive every camera on its own thread at its frame rate and collect
+    per-camera send statistics. A frame whose send overruns the frame
+    interval delays the next one; frames that would start late are counted
+    as dropped instead of being sent in a burst.
+    """
+
+    def __init__(self, cameras, sender):
+        self.cameras = cameras
+        self.sender = sender
+        self.stats = {}
+        self.is_running = False
+
+    def _run_camera(self, cam, duration, n_frames):
+        stats = {
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+            "latencies": collections.deque(maxlen=LATENCY_SAMPLES),
+        }
+        self.stats[cam.cam_id] = stats
+        interval = 1 / cam.fps
+        t_start = time.time()
+        index = 0
+        while self.is_running:
+            if n_frames is not None and index >= n_frames:
+                break
+            due = t_start + index * interval
+            now = time.time()
+            if duration is not None and now - t_start >= duration:
+                break
+            if now < due:
+                time.sleep(due - now)
+            elif now - due > interval:
+                # Behind schedule, skip to the current frame
+                late = int((now - due) / interval)
+                if n_frames is not None:
+                    late = min(late, n_frames - index)
+                stats["dropped"] += late
+                index += late
+                continue
+            img = cam.frame(index)
+            t0 = time.time()
+            try:
+                ok = self.sender.send(cam.cam_id, img)
+            except Exception:
+                logger.exception("Send failed for camera %s", cam.cam_id)
+                ok = False
+            stats["latencies"].append(time.time() - t0)
+            stats["sent" if ok else "failed"] += 1
+            index += 1
+        stats["elapsed"] = time.time() - t_start
+
+    def run(self, duration=None, n_frames=None):
+        """run.
+
+        Run until `duration` seconds or `n_frames` frames per camera, then
+        return the report.
+        """
+        self.is_running = True
+        threads = [
+            threading.Thread(target=self._run_camera,
+                             args=(cam, duration, n_frames), daemon=True)
+            for cam in self.cameras
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.is_running = False
+        return self.report()
+
+    def stop(self):
+        self.is_running = False
+
+    def report(self):
+        cameras = {}
+        total_sent = 0
+        all_latencies = []
+        for cam in self.cameras:
+            stats = self.stats.get(cam.cam_id)
+            if not stats:
+                continue
+            elapsed = max(stats.get("elapsed", 0), 1e-6)
+            total_sent += stats["sent"]
+            all_latencies += stats["latencies"]
+            cameras[cam.cam_id] = {
+                "target_fps": cam.fps,
+                "achieved_fps": stats["sent"] / elapsed,
+                "sent": stats["sent"],
+                "failed": stats["failed"],
+                "dropped": stats["dropped"],
+                "latency_p50": _percentile(stats["latencies"], 50),
+                "latency_p95": _percentile(stats["latencies"], 95),
+            }
+        elapsed = max([s.get("elapsed", 0) for s in self.stats.values()] + [1e-6])
+        return {
+            "cameras": cameras,
+            "total_fps": total_sent / elapsed,
+            "latency_p50": _percentile(all_latencies, 50),
+            "latency_p95": _percentile(all_latencies, 95),
+        }
+
+
+def create_cameras(n, width, height, fps, scene, seed, n_objects=5):
+    """create_cameras.
+
+    Camera `i` is seeded with `seed + i`.
+    """
+    return [
+        SyntheticCamera(str(i), width=width, height=height, fps=fps,
+                        scene=scene, n_objects=n_objects, seed=seed + i)
+        for i in range(n)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic camera load generator.")
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=10)
+    parser.add_argument("--scene", choices=SCENES, default=SCENE_MOVING_BOXES)
+    parser.add_argument("--objects", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--transport", choices=TRANSPORTS, default=TRANSPORT_HTTP)
+    parser.add_argument("--endpoint", default="http://localhost:5000",
+                        help="http url, zmq bind address or grpc host:port")
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cameras = create_cameras(args.cameras, args.width, args.height, args.fps,
+                             args.scene, args.seed, args.objects)
+    sender = create_sender(args.transport, args.endpoint)
+    try:
+        report = LoadGenerator(cameras, sender).run(duration=args.duration)
+    finally:
+        sender.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
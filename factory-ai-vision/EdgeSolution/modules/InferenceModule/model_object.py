@@ -15,6 +15,9 @@ IMG_HEIGHT = 540
 GPU_MAX_FRAME_RATE = 30
 CPU_MAX_FRAME_RATE = 10
 
+DEFAULT_DEVICE = "cpu"
+DEVICE_REQUEST_TIMEOUT = 0.5  # sec
+
 LVA_MODE = os.environ.get("LVA_MODE", "grpc")
 
 logger = logging.getLogger(__name__)
@@ -29,6 +32,7 @@ class ModelObject():
         # )
         self.model = None
         self.model_uri = None
+        self.model_dir = None
         self.model_downloading = False
         self.lva_mode = LVA_MODE
         self.endpoint = 'http://predictmodule:7777/predict'
@@ -45,35 +49,84 @@ class ModelObject():
         # Part that we want to detect
         self.parts = []
 
-        # self.is_gpu = onnxruntime.get_device() == "GPU"
-        self.is_gpu = self.get_device() == "gpu"
-
-        if self.is_gpu:
-            self.max_total_frame_rate = GPU_MAX_FRAME_RATE
-        else:
-            self.max_total_frame_rate = CPU_MAX_FRAME_RATE
+        # Discovered lazily from PredictModule, see get_device
+        self.device = None
+        self.quantization = None
+        self.max_total_frame_rate = CPU_MAX_FRAME_RATE
+        self.max_total_frame_rate_is_set = False
         self.update_frame_rate_by_number_of_streams(1)
 
+    @property
+    def is_gpu(self):
+        return self.get_device(block=False) == "gpu"
+
     @property
     def is_vpu(self):
-        return self.get_device() == 'vpu'
+        return self.get_device(block=False) == "vpu"
+
+    def fetch_device(self, timeout=DEVICE_REQUEST_TIMEOUT):
+        response = requests.get(
+            "http://" + predict_module_url() + "/get_device", timeout=timeout)
+        self.quantization = response.json().get("quantization")
+        device = response.json()["device"]
+        if device == 'CPU-OPENVINO_MYRIAD':
+            device = 'vpu'
+        return device.lower()
 
-    def get_device(self):
+    def get_device(self, block=True):
+        """get_device.
+
+        Device of PredictModule, cached once known. The device phase of
+        startup blocks until PredictModule answers; with block=False
+        DEFAULT_DEVICE is returned until then, without any request, so
+        request handlers and frames never wait on it.
+        """
+        if self.device is not None:
+            return self.device
+        if not block:
+            return DEFAULT_DEVICE
         while True:
             try:
-                response = requests.get(
-                    "http://" + predict_module_url() + "/get_device")
-                device = response.json()["device"]
-                if device == 'CPU-OPENVINO_MYRIAD':
-                    device = 'vpu'
+                device = self.fetch_device()
                 break
-            except:
+            except Exception:
                 time.sleep(2)
-                continue
-        # device = onnxruntime.get_device()
-        # if device == 'CPU-OPENVINO_MYRIAD':
-        #     device = 'vpu'
-        return device.lower()
+        self.set_device(device)
+        return device
+
+    def get_quantization(self):
+        """get_quantization.
+
+        Model variant chosen by PredictModule, as last refreshed or pushed
+        by it.
+        """
+        return self.quantization
+
+    def refresh_quantization(self):
+        """refresh_quantization.
+
+        Ask PredictModule again, e.g. after a model update. The cached
+        variant is kept if it does not answer.
+        """
+        try:
+            device = self.fetch_device()
+        except Exception:
+            return self.quantization
+        if self.device is None:
+            self.set_device(device)
+        return self.quantization
+
+    def set_quantization(self, quantization):
+        self.quantization = quantization
+
+    def set_device(self, device):
+        self.device = device
+        # Device default until a benchmark (or its cached result) says otherwise
+        if not self.max_total_frame_rate_is_set:
+            if device == "gpu":
+                self.max_total_frame_rate = GPU_MAX_FRAME_RATE
+            else:
+                self.max_total_frame_rate = CPU_MAX_FRAME_RATE
 
     def set_is_scenario(self, is_scenario):
         self.is_scenario = is_scenario
@@ -89,6 +142,7 @@ class ModelObject():
 
     def set_max_total_frame_rate(self, fps):
         self.max_total_frame_rate = fps
+        self.max_total_frame_rate_is_set = True
         print("[INFO] set max total frame rate as", fps, flush=True)
 
     def update_frame_rate_by_number_of_streams(self, number_of_streams):
@@ -3,8 +3,12 @@
 # 2. resize network input size to (w', h')
 # 3. pass the image to network and do inference
 # (4. if inference speed is too slow for you, try to make w' x h' smaller, which is defined with DEFAULT_INPUT_SIZE (in object_detection.py or ObjectDetection.cs))
+import hashlib
+import logging
 import os
 import sys
+import time
+import cv2
 import onnxruntime
 import onnx
 import numpy as np
@@ -12,33 +16,110 @@ from PIL import Image, ImageDraw
 from object_detection2 import ObjectDetection
 import tempfile
 
+logger = logging.getLogger(__name__)
+
 MODEL_FILENAME = 'model/model.onnx'
 LABELS_FILENAME = 'model/labels.txt'
+# Models patched with dynamic input dims are kept here across restarts,
+# empty to disable
+MODEL_CACHE_DIR = os.environ.get(
+    'MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'onnx_model_cache'))
+# Intra-op threads per session, 0 lets onnxruntime use every core
+SESSION_THREADS = int(os.environ.get('ONNX_SESSION_THREADS', '0'))
+
+
+def make_dims_dynamic(model_filename, output_filename):
+    model = onnx.load(model_filename)
+    model.graph.input[0].type.tensor_type.shape.dim[0].dim_param = 'batch'
+    model.graph.input[0].type.tensor_type.shape.dim[-1].dim_param = 'dim1'
+    model.graph.input[0].type.tensor_type.shape.dim[-2].dim_param = 'dim2'
+    onnx.save(model, output_filename)
+
+
+def cached_dynamic_model(model_filename, cache_dir=MODEL_CACHE_DIR):
+    """Path of `model_filename` patched with dynamic input dims.
+
+    Patching needs a full onnx load and save, so the result is cached by
+    source path, size and mtime and reused on the next cold start.
+    """
+    stat = os.stat(model_filename)
+    key = '{}:{}:{}:batch'.format(
+        os.path.abspath(model_filename), stat.st_size, stat.st_mtime)
+    cached = os.path.join(
+        cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.onnx')
+    if not os.path.exists(cached):
+        os.makedirs(cache_dir, exist_ok=True)
+        temp = cached + '.tmp'
+        make_dims_dynamic(model_filename, temp)
+        os.replace(temp, cached)
+    return cached
+
+
+def session_options():
+    options = onnxruntime.SessionOptions()
+    if SESSION_THREADS:
+        options.intra_op_num_threads = SESSION_THREADS
+    return options
+
 
 class ONNXRuntimeObjectDetection(ObjectDetection):
     """Object Detection class for ONNX Runtime"""
     def __init__(self, model_filename, labels):
         super(ONNXRuntimeObjectDetection, self).__init__(labels)
-        model = onnx.load(model_filename)
-        with tempfile.TemporaryDirectory() as dirpath:
-            temp = os.path.join(dirpath, os.path.basename(MODEL_FILENAME))
-            model.graph.input[0].type.tensor_type.shape.dim[-1].dim_param = 'dim1'
-            model.graph.input[0].type.tensor_type.shape.dim[-2].dim_param = 'dim2'
-            onnx.save(model, temp)
-            self.session = onnxruntime.InferenceSession(temp)
+        if MODEL_CACHE_DIR:
+            self.session = onnxruntime.InferenceSession(
+                cached_dynamic_model(model_filename), session_options())
+        else:
+            with tempfile.TemporaryDirectory() as dirpath:
+                temp = os.path.join(dirpath, os.path.basename(MODEL_FILENAME))
+                make_dims_dynamic(model_filename, temp)
+                self.session = onnxruntime.InferenceSession(temp, session_options())
         self.input_name = self.session.get_inputs()[0].name
         self.is_fp16 = self.session.get_inputs()[0].type == 'tensor(float16)'
+        self.batch_supported = True
 
-    def predict(self, preprocessed_image):
+    def to_input(self, preprocessed_image):
         inputs = np.array(preprocessed_image, dtype=np.float32)[np.newaxis,:,:,(2,1,0)] # RGB -> BGR
         inputs = np.ascontiguousarray(np.rollaxis(inputs, 3, 1))
 
         if self.is_fp16:
             inputs = inputs.astype(np.float16)
+        return inputs
 
+    def predict(self, preprocessed_image):
+        inputs = self.to_input(preprocessed_image)
         outputs = self.session.run(None, {self.input_name: inputs})
         return np.squeeze(outputs).transpose((1,2,0)).astype(np.float32)
 
+    def predict_batch(self, images):
+        """Predictions for each BGR image of a list of same sized images.
+
+        The images go through the session as one batch. Models exported
+        with a fixed batch size fall back to one run per image.
+        """
+        start = time.time()
+        inputs = [self.to_input(self.preprocess(Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))))
+                  for img in images]
+        self.pre.append(time.time() - start)
+
+        start = time.time()
+        outputs = None
+        if self.batch_supported and len(inputs) > 1:
+            try:
+                outputs = self.session.run(None, {self.input_name: np.concatenate(inputs)})[0]
+            except Exception:
+                logger.warning('Model does not support batches, running images one by one')
+                self.batch_supported = False
+        if outputs is None:
+            outputs = np.concatenate(
+                [self.session.run(None, {self.input_name: x})[0] for x in inputs])
+        inference_time = time.time() - start
+        self.inf.append(inference_time)
+
+        predictions = [self.postprocess(output.transpose((1,2,0)).astype(np.float32))
+                       for output in outputs]
+        return predictions, inference_time
+
 #def main(image_filename):
 #    # Load labels
 #    with open(LABELS_FILENAME, 'r') as f:
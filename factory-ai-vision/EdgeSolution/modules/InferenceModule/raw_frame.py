@@ -0,0 +1,118 @@
+"""Raw frame.
+
+Decode RAW video frames sent by LVA into the BGR HxWx3 image the streams
+infer on. Width, height, stride and pixel format come from the media
+descriptor, so any resolution works without a JPEG round trip.
+
+Packed BGR frames are returned as read-only views of the received buffer;
+the other formats need exactly one conversion.
+"""
+
+import logging
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Used when the media descriptor has no dimensions
+DEFAULT_WIDTH = 960
+DEFAULT_HEIGHT = 540
+
+# Packed formats: bytes per pixel, OpenCV conversion to BGR (None: view)
+PACKED_FORMATS = {
+    "BGR24": (3, None),
+    "RGB24": (3, cv2.COLOR_RGB2BGR),
+    "BGRA": (4, None),
+    "RGBA": (4, cv2.COLOR_RGBA2BGR),
+}
+# Planar 4:2:0 formats, OpenCV conversion of the stacked planes to BGR
+PLANAR_FORMATS = {
+    "YUV420P": cv2.COLOR_YUV2BGR_I420,
+    "NV12": cv2.COLOR_YUV2BGR_NV12,
+}
+RAW_FORMATS = tuple(PACKED_FORMATS) + tuple(PLANAR_FORMATS) + ("ARGB", "ABGR")
+
+
+def _bytes_per_pixel(pixel_format):
+    if pixel_format in ("ARGB", "ABGR"):
+        return 4
+    return PACKED_FORMATS[pixel_format][0]
+
+
+def frame_size(pixel_format, width, height, stride=0):
+    """frame_size.
+
+    Bytes of a `pixel_format` frame; `stride` is the length of a (luma)
+    row, 0 for tightly packed rows. The padding of the last packed row is
+    not required.
+    """
+    if pixel_format in PLANAR_FORMATS:
+        stride = stride or width
+        return stride * height + stride * (height // 2)
+    bpp = _bytes_per_pixel(pixel_format)
+    return (stride or width * bpp) * (height - 1) + width * bpp
+
+
+def _packed(buffer, width, height, stride, bpp):
+    # Rows may be padded: view the pixels through the row stride
+    return np.ndarray((height, width, bpp), dtype=np.uint8, buffer=buffer,
+                      strides=(stride or width * bpp, bpp, 1))
+
+
+def _planar(buffer, pixel_format, width, height, stride):
+    """Y plane then chroma, as the (height * 3 / 2) x width array OpenCV takes."""
+    stride = stride or width
+    data = np.frombuffer(buffer, dtype=np.uint8, count=frame_size(
+        pixel_format, width, height, stride))
+    if stride == width:
+        return data.reshape(height * 3 // 2, width)
+    luma = data[:stride * height].reshape(height, stride)[:, :width]
+    chroma = data[stride * height:].reshape(height // 2, stride)
+    if pixel_format == "NV12":
+        # Interleaved UV rows, as wide as the luma rows
+        chroma = chroma[:, :width]
+    else:
+        # U then V, each half the height and half the stride
+        half = chroma.reshape(height, stride // 2)[:, :width // 2]
+        chroma = half.reshape(height // 2, width)
+    return np.vstack((luma, chroma))
+
+
+def decode_raw_frame(buffer, pixel_format, width=0, height=0, stride=0):
+    """decode_raw_frame.
+
+    BGR image of a RAW frame, or None when the format is not supported or
+    the buffer is too short. `pixel_format` is a PixelFormat name of the
+    LVA media descriptor (or "NV12").
+    """
+    width = width or DEFAULT_WIDTH
+    height = height or DEFAULT_HEIGHT
+    if pixel_format not in RAW_FORMATS:
+        logger.warning("Unsupported raw pixel format: %s", pixel_format)
+        return None
+    if pixel_format in PLANAR_FORMATS and (width % 2 or height % 2):
+        logger.warning("%s frames need even dimensions, got %dx%d",
+                       pixel_format, width, height)
+        return None
+    size = frame_size(pixel_format, width, height, stride)
+    if len(buffer) < size:
+        logger.warning("Raw %s frame of %d bytes, expected %d for %dx%d",
+                       pixel_format, len(buffer), size, width, height)
+        return None
+
+    if pixel_format in PLANAR_FORMATS:
+        yuv = _planar(buffer, pixel_format, width, height, stride)
+        return cv2.cvtColor(yuv, PLANAR_FORMATS[pixel_format])
+    if pixel_format in ("ARGB", "ABGR"):
+        pixels = _packed(buffer, width, height, stride, 4)
+        # Drop the leading alpha: RGB or BGR view
+        pixels = pixels[:, :, 1:]
+        if pixel_format == "ABGR":
+            return pixels
+        return cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_RGB2BGR)
+    bpp, conversion = PACKED_FORMATS[pixel_format]
+    pixels = _packed(buffer, width, height, stride, bpp)
+    if conversion is None:
+        return pixels[:, :, :3]
+    return cv2.cvtColor(pixels, conversion)
@@ -1,14 +1,58 @@
+import os
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
 
 import cv2
-
-from tracker import Line, Rect, Tracker
-from tracker import bb_intersection_over_union as compute_iou
+import numpy as np
+
+from tracker import (
+    ClassTracker,
+    Line,
+    Rect,
+    Tracker,
+    bb_iou_batch,
+    bb_iou_matrix,
+    is_inside_rects,
+)
 from utility import draw_label
 
 Detection = namedtuple("Detection", ["tag", "x1", "y1", "x2", "y2", "score"])
 
+# Seconds the state of a track is kept after the tracker ended it
+SCENARIO_STATE_GRACE = float(os.environ.get("SCENARIO_STATE_GRACE", "10"))
+
+
+class TrackStates(dict):
+    """TrackStates.
+
+    Scenario state per track id. Tracks ended by the tracker are evicted
+    `grace` seconds later, so only live tracks are kept on a line running
+    for months.
+    """
+
+    def __init__(self, grace=SCENARIO_STATE_GRACE, clock=time.monotonic):
+        super().__init__()
+        self.grace = grace
+        self.clock = clock
+        # (end time, track id), oldest first
+        self.ended = deque()
+        self.evicted = 0
+
+    def end(self, oids):
+        now = self.clock()
+        for oid in oids:
+            if oid in self:
+                self.ended.append((now, oid))
+        self.evict(now)
+
+    def evict(self, now=None):
+        if now is None:
+            now = self.clock()
+        while self.ended and self.ended[0][0] <= now - self.grace:
+            _, oid = self.ended.popleft()
+            if self.pop(oid, None) is not None:
+                self.evicted += 1
+
 
 class Scenario:
     def __init__(self):
@@ -23,38 +67,53 @@ class Scenario:
     def get_metrics(self):
         raise NotImplementedError
 
+    def get_structure_sizes(self):
+        sizes = {"detected": len(self.detected)}
+        if isinstance(self.detected, TrackStates):
+            sizes["live_tracks"] = len(self.tracker.live_ids)
+            sizes["ending"] = len(self.detected.ended)
+        return sizes
+
 
 class PartDetection(Scenario):
-    def __init__(self, threshold=0.3, max_age=5, min_hits=2, iou_threshold=0.3):
-        # self.tracker = Tracker(
-        #    max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
-        # )
+    def __init__(self, threshold=0.3, max_age=5, min_hits=2, iou_threshold=0.3,
+                 switch_groups=None, switch_hits=3):
         self.detected = {}
         self.counter = 0
         self.threshold = threshold
         self.max_age = max_age
         self.min_hits = min_hits
         self.iou_threshold = iou_threshold
-        self.trackers = {}
+        # Groups of near identical parts a track may switch between
+        self.switch_groups = switch_groups or []
+        self.switch_hits = switch_hits
+        self.tracker = ClassTracker(
+            max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold,
+            switch_groups=self.switch_groups, switch_hits=switch_hits
+        )
         self.parts = []
 
     def set_parts(self, parts):
         self.parts = parts
-        self.trackers = {}
-        for part in parts:
-            self.trackers[part] = Tracker(
-                max_age=self.max_age, min_hits=self.min_hits, iou_threshold=self.iou_threshold
-            )
-        # print(self.parts)
+        self.tracker = ClassTracker(
+            max_age=self.max_age, min_hits=self.min_hits, iou_threshold=self.iou_threshold,
+            switch_groups=self.switch_groups, switch_hits=self.switch_hits
+        )
+
+    def set_switch_groups(self, switch_groups, switch_hits=None):
+        self.switch_groups = switch_groups or []
+        self.tracker.set_switch_groups(self.switch_groups)
+        if switch_hits is not None:
+            self.switch_hits = switch_hits
+            self.tracker.switch_hits = switch_hits
 
     def update(self, detections):
-        for part in self.parts:
-            _detections = list(d for d in detections if (
-                d.score > self.threshold and d.tag in self.parts))
-            _detections = list([d.x1, d.y1, d.x2, d.y2, d.score]
-                               for d in _detections)
-            self.trackers[part].update(_detections)
-            #objs = self.tracker.get_objs()
+        detections = list(d for d in detections if (
+            d.score > self.threshold and d.tag in self.parts))
+        self.tracker.update(
+            list([d.x1, d.y1, d.x2, d.y2, d.score] for d in detections),
+            list(d.tag for d in detections),
+        )
 
     def reset_metrics(self):
         return
@@ -62,6 +121,9 @@ class PartDetection(Scenario):
     def get_metrics(self):
         return []
 
+    def get_structure_sizes(self):
+        return {"detected": len(self.detected), "tracks": len(self.tracker.trackers)}
+
     def draw_counter(self, img):
         return
 
@@ -69,26 +131,20 @@ class PartDetection(Scenario):
         return
 
     def draw_objs(self, img, is_id=True, is_rect=True):
-        for part in self.parts:
-            # print(part)
-            for obj in self.trackers[part].get_objs():
-                # print(obj)
-                font = cv2.FONT_HERSHEY_DUPLEX
-                font_scale = 0.7
-                thickness = 1
-                x1, y1, x2, y2, oid = obj
-                x1 = int(x1)
-                y1 = int(y1)
-                x2 = int(x2)
-                y2 = int(y2)
-                oid = int(oid)
-                x = x1
-                y = y1 - 5
-                if is_id:
-                    img = draw_label(img, str(part), (x, y))
-                if is_rect:
-                    img = cv2.rectangle(
-                        img, (x1, y1), (x2, y2), (255, 255, 255), thickness)
+        for obj, part in zip(self.tracker.get_objs(), self.tracker.get_labels()):
+            thickness = 1
+            x1, y1, x2, y2, oid = obj
+            x1 = int(x1)
+            y1 = int(y1)
+            x2 = int(x2)
+            y2 = int(y2)
+            x = x1
+            y = y1 - 5
+            if is_id:
+                img = draw_label(img, str(part), (x, y))
+            if is_rect:
+                img = cv2.rectangle(
+                    img, (x1, y1), (x2, y2), (255, 255, 255), thickness)
         return img
 
 
@@ -98,7 +154,7 @@ class PartCounter(Scenario):
         self.tracker = Tracker(
             max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
         )
-        self.detected = {}
+        self.detected = TrackStates()
         self.counter = {}
         self.line = []
         self.threshold = threshold
@@ -130,6 +186,7 @@ class PartCounter(Scenario):
         detections = list([d.x1, d.y1, d.x2, d.y2, d.score]
                           for d in detections)
         self.tracker.update(detections)
+        self.detected.end(self.tracker.ended_ids)
         objs = self.tracker.get_objs()
         counted = []
         for obj in objs:
@@ -228,7 +285,7 @@ class DefeatDetection(Scenario):
         self.tracker = Tracker(
             max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
         )
-        self.detected = {}
+        self.detected = TrackStates()
         self.ok_counter = 0
         self.ng_counter = 0
         self.objs_with_labels = []
@@ -255,55 +312,48 @@ class DefeatDetection(Scenario):
     def set_line(self, x1, y1, x2, y2):
         self.line = Line(x1, y1, x2, y2)
 
+    def remove_overlaps(self, detections):
+        """Delete the lower score of the first overlapping neighbours."""
+        if len(detections) < 2:
+            return detections
+        boxes = detection_boxes(detections)
+        overlaps = np.flatnonzero(bb_iou_batch(boxes[:-1], boxes[1:]) > 0.3)
+        if len(overlaps):
+            i = int(overlaps[0])
+            if detections[i].score < detections[i + 1].score:
+                del detections[i]
+            else:
+                del detections[i + 1]
+            print("delete overlayed obj", i)
+        return detections
+
+    def match_detections(self, objs, detections):
+        """(tag, score) of each object: the first detection it overlaps."""
+        matches = bb_iou_matrix(obj_boxes(objs), detection_boxes(detections)) > 0.3
+        labels = []
+        for match in matches:
+            if match.any():
+                d = detections[match.argmax()]
+                labels.append((d.tag, d.score))
+            else:
+                labels.append((self.ok_name, 0.0))
+        return labels
+
     def update(self, detections):
         detections = list(d for d in detections if d.score > self.threshold)
         # delete overlayed ok & ng
-        found = True
-        while found:
-            found = False
-            if len(detections) < 2:
-                break
-            for i in range(len(detections) - 1):
-                box1 = [
-                    detections[i].x1,
-                    detections[i].y1,
-                    detections[i].x2,
-                    detections[i].y2,
-                ]
-                box2 = [
-                    detections[i + 1].x1,
-                    detections[i + 1].y1,
-                    detections[i + 1].x2,
-                    detections[i + 1].y2,
-                ]
-                if compute_iou(box1, box2) > 0.3:
-                    if detections[i].score < detections[i + 1].score:
-                        del detections[i]
-                    else:
-                        del detections[i + 1]
-                    Found = True
-                    print("delete overlayed obj", i)
-                    break
+        detections = self.remove_overlaps(detections)
 
         _detections = list([d.x1, d.y1, d.x2, d.y2, d.score]
                            for d in detections)
         self.tracker.update(_detections)
+        self.detected.end(self.tracker.ended_ids)
         objs = self.tracker.get_objs()
 
-        for obj in objs:
-            x1, y1, x2, y2, oid = obj
-            tag = self.ok_name
-            score = 0.0
-            box1 = [x1, y1, x2, y2]
-            got = False
-            for d in detections:
-                box2 = [d.x1, d.y1, d.x2, d.y2]
-                iou = compute_iou(box1, box2)
-                if iou > 0.3:
-                    tag = d.tag
-                    score = d.score
-                    break
+        labels = self.match_detections(objs, detections)
 
+        for obj, (tag, score) in zip(objs, labels):
+            x1, y1, x2, y2, oid = obj
             xc, yc = compute_center(x1, y1, x2, y2)
 
             if oid in self.detected:
@@ -419,7 +469,7 @@ class DangerZone(Scenario):
         self.tracker = Tracker(
             max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
         )
-        self.detected = {}
+        self.detected = TrackStates()
         self.counter = {}
         self.zones = []
         self.targets = []
@@ -450,10 +500,7 @@ class DangerZone(Scenario):
             self.zones.append(_zone)
 
     def is_inside_zones(self, x1, y1, x2, y2):
-        for zone in self.zones:
-            if zone.is_inside(x1, y1, x2, y2):
-                return True
-        return False
+        return bool(is_inside_rects([[x1, y1, x2, y2]], self.zones).any())
 
     def update(self, detections):
         detections = list(d for d in detections if d.score > self.threshold)
@@ -464,17 +511,19 @@ class DangerZone(Scenario):
         )
 
         self.tracker.update(detections)
+        self.detected.end(self.tracker.ended_ids)
         objs = self.tracker.get_objs()
         counted = []
         has_new_event = False
-        for obj in objs:
+        insides = is_inside_rects(obj_boxes(objs), self.zones)
+        for obj, inside in zip(objs, insides):
             x1, y1, x2, y2, oid = obj
             if oid in self.detected:
-                for zone in self.zones:
+                for zone, is_inside in zip(self.zones, inside):
                     if zone.id not in self.detected[oid]["expired"].keys():
                         self.detected[oid]["expired"][zone.id] = False
                     if self.detected[oid]["expired"][zone.id] is False:
-                        if zone.is_inside(x1, y1, x2, y2):
+                        if is_inside:
                             self.detected[oid]["expired"][zone.id] = True
                             print("*** new object counted", flush=True)
                             has_new_event = True
@@ -553,3 +602,12 @@ class DangerZone(Scenario):
 
 def compute_center(x1, y1, x2, y2):
     return (x1 + x2) / 2, (y1 + y2) / 2
+
+
+def detection_boxes(detections):
+    return np.array([[d.x1, d.y1, d.x2, d.y2] for d in detections],
+                    dtype=np.float64).reshape(-1, 4)
+
+
+def obj_boxes(objs):
+    return np.asarray(objs, dtype=np.float64).reshape(-1, 5)[:, :4]
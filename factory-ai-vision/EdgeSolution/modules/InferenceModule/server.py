@@ -1,16 +1,21 @@
 """Server.
 """
 
+import hashlib
 import json
 import logging
 import logging.config
 import os
+import platform
 import requests
 import socket
 import sys
+import tempfile
 import threading
 import time
+import uuid
 from concurrent import futures
+from functools import wraps
 from typing import List
 
 import cv2
@@ -20,11 +25,12 @@ import numpy as np
 import uvicorn
 import zmq
 from fastapi import BackgroundTasks, FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 import extension_pb2_grpc
 from api.models import (
     CamerasModel,
+    DeployConfigModel,
     PartDetectionModeEnum,
     PartsModel,
     StreamModel,
@@ -32,14 +38,19 @@ from api.models import (
     UpdateEndpointBody,
 )
 from arguments import ArgumentParser, ArgumentsType
+from diagnostics import DIAGNOSTICS_ENABLED, diagnostics
 from exception_handler import PrintGetExceptionDetails
+from frame_transport import ENCODINGS, RAW_WIDTH, decode_frame, frame_encoding
 from http_inference_engine import HttpInferenceEngine
 from inference_engine import InferenceEngine
+from graph_operations import GraphReconciler, graph_operations
 from invoke import gm
 from logging_conf import logging_config
 # from model_wrapper import ONNXRuntimeModelDeploy
 from model_object import ModelObject
+from startup import timeline
 from stream_manager import StreamManager
+from streams import Stream
 from utility import is_edge
 
 # sys.path.insert(0, '../lib')
@@ -63,11 +74,26 @@ IS_OPENCV = os.environ.get("IS_OPENCV", "false")
 
 NO_DISPLAY = os.environ.get("NO_DISPLAY", "false")
 
+# Recommended fps from a previous benchmark of the same model and device,
+# empty to always benchmark
+BENCHMARK_CACHE = os.environ.get(
+    "BENCHMARK_CACHE",
+    os.path.join(tempfile.gettempdir(), "inference_benchmark.json"))
+# How long camera updates wait for the LVA topology to be initialized
+STARTUP_WAIT_TIMEOUT = 30  # sec
+# Tells WebModule this process has not applied any configuration it diffed
+BOOT_ID = uuid.uuid4().hex
+PREDICT_MODULE_TIMEOUT = 5  # sec
+# Held by the benchmark while it runs the scenario model, so deployments
+# wait for it instead of being overwritten
+deploy_lock = threading.RLock()
+
 # Main thread
 
 # onnx = ONNXRuntimeModelDeploy()
 onnx = ModelObject()
 stream_manager = StreamManager(onnx)
+diagnostics.register("stream_manager", stream_manager.get_structure_sizes)
 
 app = FastAPI(
     title="InferenceModule",
@@ -76,6 +102,20 @@ app = FastAPI(
 )
 
 
+def waits_for_benchmark(func):
+    """waits_for_benchmark.
+
+    Run the endpoint under deploy_lock.
+    """
+
+    @wraps(func)
+    def _wrapper(*args, **kwargs):
+        with deploy_lock:
+            return func(*args, **kwargs)
+
+    return _wrapper
+
+
 ## FIXME ##
 # injest to flask/fastapi context
 http_inference_engine = HttpInferenceEngine(stream_manager)
@@ -98,11 +138,26 @@ def prediction(cam_id: str):
     return json.dumps(stream.last_prediction)
 
 
+@app.get("/transport")
+def transport():
+    """Frame encodings /predict accepts."""
+    return {"encodings": ENCODINGS}
+
+
 @app.post("/predict")
 async def predict(camera_id: str, request: Request):
     """predict."""
     img_raw = await request.body()
-    if IS_OPENCV:
+    encoding = frame_encoding(request.headers.get("content-type"))
+    if encoding:
+        try:
+            width = int(request.headers.get("x-frame-width", RAW_WIDTH))
+        except ValueError:
+            return Response(status_code=400)
+        img = decode_frame(img_raw, encoding, width)
+        if img is None:
+            return Response(status_code=400)
+    elif IS_OPENCV:
         nparr = np.frombuffer(img_raw, np.uint8)
         img = nparr.reshape(-1, 960, 3)
     else:
@@ -127,7 +182,11 @@ def metrics(cam_id: str):
     last_prediction_count = {}
     is_gpu = onnx.is_gpu
     scenario_metrics = []
-    device = onnx.get_device()
+    change_gate_metrics = {}
+    detection_schedule_metrics = {}
+    aoi_crop_metrics = {}
+    tiled_inference_metrics = {}
+    device = onnx.get_device(block=False)
 
     stream = stream_manager.get_stream_by_id_danger(cam_id)
     if stream:
@@ -138,6 +197,12 @@ def metrics(cam_id: str):
         average_inference_time = stream.average_inference_time
         last_prediction_count = stream.last_prediction_count
         scenario_metrics = stream.get_scenario_metrics()
+        change_gate_metrics = stream.change_gate.metrics()
+        detection_schedule_metrics = stream.detection_schedule.metrics()
+        aoi_crop_metrics = stream.aoi_crop.metrics()
+        tiled_inference_metrics = dict(
+            stream.tiling, enabled=stream.tiled_inference,
+            latency_budget=stream.tile_latency_budget)
         if total == 0:
             success_rate = 0
         else:
@@ -151,6 +216,10 @@ def metrics(cam_id: str):
         "average_inference_time": average_inference_time,
         "last_prediction_count": last_prediction_count,
         "scenario_metrics": scenario_metrics,
+        "change_gate": change_gate_metrics,
+        "detection_schedule": detection_schedule_metrics,
+        "aoi_crop": aoi_crop_metrics,
+        "tiled_inference": tiled_inference_metrics,
     }
 
 
@@ -204,7 +273,54 @@ def update_endpoint(request_body: UpdateEndpointBody):
     return 'ok', 200
 
 
+def post_predict_module_model(body):
+    """post_predict_module_model.
+
+    Send the model to PredictModule. None when it took it, else the error.
+    """
+    try:
+        r = requests.post(
+            "http://" + predict_module_url() + "/update_model", json=body
+        )
+    except requests.exceptions.RequestException as e:
+        logger.exception("PredictModule did not take the model")
+        return "PredictModule unreachable: {}".format(e)
+    if r.status_code >= 400:
+        return "PredictModule answered {}".format(r.status_code)
+    # Its handlers answer errors as a (message, status) pair with a 200
+    try:
+        result = r.json()
+    except ValueError:
+        return None
+    if isinstance(result, list) and len(result) == 2 and result[1] >= 400:
+        return "PredictModule: {}".format(result[0])
+    return None
+
+
+def predict_module_id():
+    """predict_module_id.
+
+    Changes when PredictModule restarts or fails to download a model, so
+    a deployment diffed against it sends the model again. Empty when it
+    does not answer.
+    """
+    try:
+        status = requests.get(
+            "http://" + predict_module_url() + "/health",
+            timeout=PREDICT_MODULE_TIMEOUT,
+        ).json()
+        return "{}.{}".format(status["boot_id"], status["model_failures"])
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+        return ""
+
+
+def deploy_id():
+    """Identity WebModule diffs deployments against: this run and PredictModule's."""
+    return "{}-{}".format(BOOT_ID, predict_module_id())
+
+
 @app.post("/update_model")
+@waits_for_benchmark
 def update_model(request_body: UploadModelBody):
     """update_model."""
 
@@ -219,10 +335,10 @@ def update_model(request_body: UploadModelBody):
 
         logger.info("Got Model URI %s", request_body.model_uri)
 
-        r = requests.post(
-            "http://" + predict_module_url() + "/update_model",
-            json={"model_uri": model_uri}
-        )
+        error = post_predict_module_model({"model_uri": model_uri})
+        if error:
+            return error, 502
+        onnx.refresh_quantization()
 
         # FIXME webmodule didnt send set detection_mode as Part Detection sometimes.
         # workaround
@@ -251,18 +367,20 @@ def update_model(request_body: UploadModelBody):
     if request_body.model_dir:
         logger.info("Got Model DIR %s", request_body.model_dir)
 
-        r = requests.post(
-            "http://" + predict_module_url() + "/update_model",
-            json={"model_dir": model_dir}
-        )
+        error = post_predict_module_model({"model_dir": model_dir})
+        if error:
+            return error, 502
+        onnx.refresh_quantization()
 
         onnx.set_is_scenario(True)
+        onnx.model_dir = model_dir
         # onnx.update_model(request_body.model_dir)
         logger.info("Update Finished ...")
         return "ok"
 
 
 @app.post("/update_cams")
+@waits_for_benchmark
 def update_cams(request_body: CamerasModel):
     """update_cams.
 
@@ -270,6 +388,8 @@ def update_cams(request_body: CamerasModel):
     Cameras not in List should not inferecence.
     """
     logger.info(request_body)
+    if is_lva_startup() and not timeline.wait_phase("init_topology", STARTUP_WAIT_TIMEOUT):
+        logger.warning("LVA topology not initialized yet, updating cameras anyway")
     frame_rate = request_body.fps
     stream_manager.update_streams([cam.id for cam in request_body.cameras])
     n = stream_manager.get_streams_num_danger()
@@ -331,6 +451,16 @@ def update_cams(request_body: CamerasModel):
             int(cam.send_video_to_cloud_threshold) * 0.01
         )
         stream.use_tracker = cam.enable_tracking
+        stream.change_gate.update(
+            enabled=cam.change_gate, sensitivity=cam.change_gate_sensitivity)
+        stream.detection_schedule.update(
+            enabled=cam.detection_schedule, max_interval=cam.detection_max_interval)
+        stream.aoi_crop.update(enabled=cam.aoi_crop, padding=cam.aoi_crop_padding)
+        if cam.tiled_inference is not None:
+            stream.tiled_inference = cam.tiled_inference
+        if cam.tile_latency_budget is not None:
+            stream.tile_latency_budget = cam.tile_latency_budget
+        stream.set_class_switch(cam.class_switch_groups, cam.class_switch_hits)
         # recording_duration is set in topology, sould be handled in s.update_cam, not here
         # stream.recording_duration = int(cam.recording_duration*60)
 
@@ -365,6 +495,74 @@ def update_parts(parts: PartsModel):
     return "ok"
 
 
+@app.post("/update_config")
+@waits_for_benchmark
+def update_config(config: DeployConfigModel):
+    """update_config.
+
+    Apply a deployment in one request. Sections are applied in the
+    order their update_* endpoints depend on: the detection mode before
+    the model and the cameras, the cameras before the parameters set on
+    every stream. A boot_id other than deploy_id() means the sender
+    diffed against another run of this module or of PredictModule:
+    nothing is applied and it should send it all.
+    Sections whose handler fails are answered in `failed`, with the
+    error, and the others still applied.
+    """
+    boot_id = deploy_id()
+    if config.boot_id and config.boot_id != boot_id:
+        return JSONResponse(
+            status_code=409,
+            content={"boot_id": boot_id, "applied": [], "failed": {}})
+    sections = []
+    if config.part_detection_id is not None:
+        sections.append(("part_detection_id", update_part_detection_id,
+                         (config.part_detection_id,)))
+    if config.part_detection_mode is not None:
+        sections.append(("part_detection_mode", update_part_detection_mode,
+                         (config.part_detection_mode,)))
+    if config.endpoint is not None:
+        sections.append(("endpoint", update_endpoint, (config.endpoint,)))
+    if config.model is not None:
+        model = config.model
+        if model.model_uri_fp16 and onnx.is_vpu:
+            model = UploadModelBody(model_uri=model.model_uri_fp16)
+        sections.append(("model", update_model, (model,)))
+    if config.parts is not None:
+        sections.append(("parts", update_parts, (config.parts,)))
+    if config.cams is not None:
+        sections.append(("cams", update_cams, (config.cams,)))
+    if config.retrain is not None:
+        retrain = config.retrain
+        sections.append(("retrain", update_retrain_parameters, (
+            retrain.is_retrain, retrain.confidence_min, retrain.confidence_max,
+            retrain.max_images)))
+    if config.iothub is not None:
+        iothub = config.iothub
+        sections.append(("iothub", update_iothub_parameters, (
+            iothub.is_send, iothub.threshold, iothub.fpm)))
+    if config.prob_threshold is not None:
+        sections.append(("prob_threshold", update_prob_threshold,
+                         (config.prob_threshold,)))
+
+    applied = []
+    failed = {}
+    for section, handler, args in sections:
+        try:
+            result = handler(*args)
+        except Exception as e:
+            logger.exception("Failed to apply %s", section)
+            failed[section] = repr(e)
+            continue
+        # Handlers answer errors as a (message, status) tuple
+        if isinstance(result, tuple) and len(result) == 2 and result[1] >= 400:
+            failed[section] = result[0]
+        else:
+            applied.append(section)
+    logger.info("Applied %s, failed %s", applied, failed)
+    return {"boot_id": boot_id, "applied": applied, "failed": failed}
+
+
 @app.get("/update_iothub_parameters")
 def update_iothub_parameters(is_send: bool, threshold: int, fpm: int):
     """update_iothub_parameters."""
@@ -518,8 +716,45 @@ async def keep_alive(cam_id: str):
 
 @app.get("/get_device")
 def get_device():
-    device = onnx.get_device()
-    return {"device": device}
+    quantization = onnx.get_quantization()
+    device = onnx.get_device(block=False)
+    return {"device": device, "quantization": quantization}
+
+
+@app.post("/update_quantization")
+def update_quantization(quantization: dict):
+    """update_quantization.
+
+    Sent by PredictModule whenever the model it serves changes.
+    """
+    onnx.set_quantization(quantization)
+    return "ok"
+
+
+@app.get("/health")
+def health():
+    """health.
+
+    Startup readiness and phase timings.
+    """
+    return timeline.to_dict()
+
+
+@app.on_event("startup")
+def on_startup():
+    timeline.mark("http_ready")
+
+
+@app.get("/diagnostics")
+def get_diagnostics():
+    """diagnostics.
+
+    Memory samples, allocation growth and registered structure sizes.
+    Answers {"enabled": false} unless DIAGNOSTICS is on.
+    """
+    if not DIAGNOSTICS_ENABLED:
+        return {"enabled": False}
+    return diagnostics.report()
 
 
 def init_topology():
@@ -535,40 +770,28 @@ def init_topology():
             "[HttpOperationError] Probably caused by invalid IoTHub connection string. The server will terminate in 10 seconds."
         )
         time.sleep(10)
-        sys.exit(-1)
+        # Runs on the startup thread, sys.exit would only end the thread
+        os._exit(-1)
     if instances["status"] != 200:
         logger.warning("Failed to invoke direct method: %s",
                        instances["payload"])
         return -1
-    logger.info(
-        "========== Deleting %s instance(s) ==========",
-        len(instances["payload"]["value"]),
-    )
-
-    for i in range(len(instances["payload"]["value"])):
-        gm.invoke_graph_instance_deactivate(
-            instances["payload"]["value"][i]["name"])
-        gm.invoke_graph_instance_delete(
-            instances["payload"]["value"][i]["name"])
 
-    topologies = gm.invoke_graph_topology_list()
-    if instances["status"] != 200:
-        logger.warning("Failed to invoker direct method: %s",
-                       instances["payload"])
+    logger.info("========== Reconciling default grpc/http topology ==========")
+    topologies = {}
+    for mode in ("grpc", "http"):
+        payload = gm.graph_topology_payload(mode)
+        topologies[payload["name"]] = payload["properties"]
+    changes = GraphReconciler(gm, graph_operations).reconcile(topologies, {})
+    if changes is None:
+        logger.warning("Failed to reconcile graph topologies")
         return -1
     logger.info(
-        "========== Deleting %s topology ==========",
-        len(topologies["payload"]["value"]),
+        "========== Deleted %s instance(s), set %s topology ==========",
+        len(changes["instance_delete"]),
+        len(changes["topology_set"]),
     )
 
-    for i in range(len(topologies["payload"]["value"])):
-        gm.invoke_graph_topology_delete(
-            topologies["payload"]["value"][i]["name"])
-
-    logger.info("========== Setting default grpc/http topology ==========")
-    ret = gm.invoke_topology_set("grpc")
-    ret = gm.invoke_topology_set("http")
-
     return 1
 
 
@@ -577,9 +800,52 @@ def local_main():
 
     For local development.
     """
+    timeline.set_ready()
     uvicorn.run(app, host="0.0.0.0", port=5000)
 
 
+def benchmark_cache_key(model_dir, device):
+    """benchmark_cache_key.
+
+    Benchmark results are reused only for the same model files, device and
+    host.
+    """
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(model_dir)):
+        for name in sorted(files):
+            digest.update(name.encode())
+            with open(os.path.join(root, name), "rb") as f:
+                digest.update(f.read())
+    for item in (device, os.cpu_count(), platform.machine()):
+        digest.update(str(item).encode())
+    return digest.hexdigest()
+
+
+def load_cached_benchmark(key, path=None):
+    path = BENCHMARK_CACHE if path is None else path
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached.get("max_total_frame_rate")
+
+
+def save_cached_benchmark(key, max_total_frame_rate, path=None):
+    path = BENCHMARK_CACHE if path is None else path
+    if not path:
+        return
+    try:
+        with open(path, "w") as f:
+            json.dump({"key": key, "max_total_frame_rate": max_total_frame_rate}, f)
+    except OSError:
+        logger.warning("Failed to save benchmark result to %s", path)
+
+
 def benchmark():
     """benchmark."""
     # app.run(host='0.0.0.0', debug=False)
@@ -589,22 +855,56 @@ def benchmark():
 
     n_threads = 3
     n_images = 15
+
+    key = benchmark_cache_key(SCENARIO1_MODEL, onnx.get_device())
+    cached = load_cached_benchmark(key)
+    if cached is not None:
+        logger.info("Using cached benchmark, Recommended Total FPS: %s", cached)
+        onnx.set_max_total_frame_rate(cached)
+        return
+
+    with deploy_lock:
+        # Deployed before the benchmark started, loaded again after it
+        is_scenario = onnx.is_scenario
+        model = {"model_dir": onnx.model_dir} if is_scenario else {
+            "model_uri": onnx.model_uri}
+        try:
+            max_total_frame_rate = run_benchmark(
+                SCENARIO1_MODEL, SAMPLE_VIDEO, n_threads, n_images)
+        finally:
+            onnx.set_is_scenario(is_scenario)
+            if any(model.values()):
+                logger.info("Restoring model %s", model)
+                requests.post(
+                    "http://" + predict_module_url() + "/update_model",
+                    json=model
+                )
+    onnx.set_max_total_frame_rate(max_total_frame_rate)
+    save_cached_benchmark(key, max_total_frame_rate)
+
+
+def run_benchmark(model_dir, video, n_threads, n_images):
+    """run_benchmark.
+
+    Recommended total fps of model_dir, it replaces the model loaded.
+    """
     logger.info("============= BenchMarking (Begin) ==================")
     logger.info("--- Settings ----")
     logger.info("%s threads", n_threads)
     logger.info("%s images", n_images)
 
-    stream_ids = list(str(i + 10000) for i in range(n_threads))
-    stream_manager.update_streams(stream_ids)
+    # Not registered in stream_manager
+    streams = [Stream(str(i + 10000), onnx, stream_manager.sender)
+               for i in range(n_threads)]
     onnx.set_is_scenario(True)
     r = requests.post(
         "http://" + predict_module_url() + "/update_model",
-        json={"model_dir": SCENARIO1_MODEL}
+        json={"model_dir": model_dir}
     )
     # onnx.update_model(SCENARIO1_MODEL)
-    for s in stream_manager.get_streams():
+    for s in streams:
         s.set_is_benchmark(True)
-        s.update_cam("video", SAMPLE_VIDEO, 30,
+        s.update_cam("video", video, 30,
                      s.cam_id, False, None, "PC", [], [])
 
     # vpu's first image take long time
@@ -634,7 +934,6 @@ def benchmark():
         threads[i].join()
     t1 = time.time()
     # print(t1-t0)
-    stream_manager.update_streams([])
 
     discount = 0.75
     max_total_frame_rate = discount * (n_images * n_threads) / (t1 - t0)
@@ -647,11 +946,9 @@ def benchmark():
     logger.info("  Recommended Total FPS: %s", max_total_frame_rate)
     logger.info("============= BenchMarking (End) ==================")
 
-    stream_manager.update_streams([])
-
     max_total_frame_rate = max(1, max_total_frame_rate)
     max_total_frame_rate = min(30, max_total_frame_rate)
-    onnx.set_max_total_frame_rate(max_total_frame_rate)
+    return max_total_frame_rate
 
 
 def cvcapture_url():
@@ -710,43 +1007,64 @@ def opencv_zmq():
     # threading.Thread(target=run).start()
 
 
-def main():
-    """main.
+def is_lva_startup():
+    return is_edge() and IS_OPENCV == "false"
 
-    Main loop.
+
+def startup():
+    """startup.
+
+    Slow startup work, run in background while the HTTP server is already
+    serving. LVA topology comes first so cameras can be configured as soon
+    as possible; the benchmark only tunes the recommended fps.
     """
-    try:
+    with timeline.phase("device"):
+        logger.info("Device: %s", onnx.get_device())
+
+    if IS_OPENCV == "false":
         # Get application arguments
         argument_parser = ArgumentParser(ArgumentsType.SERVER)
+        # Get port number
+        grpcServerPort = argument_parser.GetGrpcServerPort()
+        logger.info("gRPC server port: %s", grpcServerPort)
 
-        if IS_OPENCV == "false":
-            # Get port number
-            grpcServerPort = argument_parser.GetGrpcServerPort()
-            logger.info("gRPC server port: %s", grpcServerPort)
-
-            # init graph topology & instance
+        # init graph topology & instance
+        with timeline.phase("init_topology"):
             counter = 0
             while init_topology() == -1:
                 if counter == 100:
                     logger.critical(
                         "Failed to init topology, please check whether direct method still works"
                     )
-                    sys.exit(-1)
+                    os._exit(-1)
                 logger.warning(
                     "Failed to init topology, try again 10 secs later")
                 time.sleep(10)
                 counter += 1
 
-            # create gRPC server and start running
+        # create gRPC server and start running
+        with timeline.phase("grpc_server"):
             server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
             extension_pb2_grpc.add_MediaGraphExtensionServicer_to_server(
                 InferenceEngine(stream_manager), server
             )
             server.add_insecure_port(f"[::]:{grpcServerPort}")
             server.start()
-        else:
-            logger.info("opencv server")
-            # opencv_zmq()
+    else:
+        logger.info("opencv server")
+        # opencv_zmq()
+
+    with timeline.phase("benchmark"):
+        benchmark()
+
+
+def main():
+    """main.
+
+    Main loop.
+    """
+    try:
+        timeline.run_in_background(startup)
         uvicorn.run(app, host="0.0.0.0", port=5000)
         # server.wait_for_termination()
 
@@ -766,10 +1084,10 @@ if __name__ == "__main__":
 
     logger.info("is_edge: %s", is_edge())
 
+    if DIAGNOSTICS_ENABLED:
+        diagnostics.start()
+
     if is_edge():
-        print('==== Benchmark start ====', flush=True)
-        benchmark()
-        print('==== Benchmark  end  ====', flush=True)
         main()
     else:
         logger.info("Assume running at local development.")
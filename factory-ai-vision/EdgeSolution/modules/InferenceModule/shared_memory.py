@@ -31,10 +31,6 @@ class SharedMemoryManager:
                 os.ftruncate(self._shmFile, self._shmFileSize)
                 self._shm = mmap.mmap(self._shmFile, self._shmFileSize, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
 
-            # Dictionary to host reserved mem blocks
-            # self._mem_slots[sequenceNo] = [Begin, End]        (closed interval)
-            self._memSlots = dict()
-
             logging.info('Shared memory name: {0}'.format(self._shmFileFullPath))
         except:
             PrintGetExceptionDetails()
@@ -54,51 +50,6 @@ class SharedMemoryManager:
             PrintGetExceptionDetails()
             raise
 
-    # Returns None if no availability
-    # Returns closed interval [Begin, End] address with available slot
-    def GetEmptySlot(self, seqNo, sizeNeeded):
-        address = None
-
-        if sizeNeeded < 1:
-            return address
-
-        # Empty memory
-        if len(self._memSlots) < 1:
-            if self._shmFileSize >= sizeNeeded:
-                self._memSlots[seqNo] = (0, sizeNeeded - 1)
-                address = (0, sizeNeeded - 1)
-            else:
-                address = None
-        else:
-            self._memSlots = {k: v for k, v in sorted(
-                self._memSlots.items(), key=lambda item: item[1])}
-
-            # find an available memory gap = sizeNeeded
-            prevSlotEnd = 0
-            for k, v in self._memSlots.items():
-                if (v[0] - prevSlotEnd - 1) >= sizeNeeded:
-                    address = (prevSlotEnd + 1, prevSlotEnd + sizeNeeded)
-                    self._memSlots[seqNo] = (address[0], address[1])
-                    break
-                else:
-                    prevSlotEnd = v[1]
-
-            # no gap in between, check last possible gap
-            if address is None:
-                if (self._shmFileSize - prevSlotEnd + 1) >= sizeNeeded:
-                    address = (prevSlotEnd + 1, prevSlotEnd + sizeNeeded)
-                    self._memSlots[seqNo] = (address[0], address[1])
-
-        # interval [Begin, End]
-        return address
-
-    def DeleteSlot(self, seqNo):
-        try:
-            del self._memSlots[seqNo]
-            return True
-        except KeyError:
-            return False
-
     def __del__(self):
         try:
             if self._shmFlags is None:
@@ -0,0 +1,142 @@
+"""Startup.
+
+Cold start timeline. Slow startup work (model load and warm-up, device
+discovery, benchmark, LVA topology) runs as named phases on a background
+thread so the HTTP server can answer health checks right away.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def process_start_time():
+    """process_start_time.
+
+    Wall clock time the process was started, so import time is part of the
+    timeline. Falls back to now when /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        with open("/proc/stat") as f:
+            boot_time = next(
+                int(line.split()[1]) for line in f if line.startswith("btime")
+            )
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class StartupTimeline:
+    """StartupTimeline.
+
+    Records startup phases and events relative to process start and tracks
+    readiness.
+    """
+
+    def __init__(self, t0=None):
+        self.t0 = process_start_time() if t0 is None else t0
+        self.phases = []
+        self.events = {}
+        self.error = None
+        self.mutex = threading.Lock()
+        self.ready = threading.Event()
+        self.done = {}
+
+    def _now(self):
+        return time.time() - self.t0
+
+    @contextmanager
+    def phase(self, name):
+        """phase.
+
+        Time the wrapped block as phase `name`. Exceptions are recorded and
+        re-raised.
+        """
+        record = {"name": name, "start": self._now(), "end": None, "error": None}
+        with self.mutex:
+            self.phases.append(record)
+            self.done.setdefault(name, threading.Event())
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["end"] = self._now()
+            record["duration"] = record["end"] - record["start"]
+            logger.info("Startup phase %s took %.3f sec", name, record["duration"])
+            self.done[name].set()
+
+    def mark(self, name):
+        """mark.
+
+        Record the first occurrence of event `name` (e.g. first inference).
+        """
+        if name in self.events:
+            return
+        with self.mutex:
+            if name not in self.events:
+                self.events[name] = self._now()
+                logger.info("Startup event %s at %.3f sec", name, self.events[name])
+
+    def set_ready(self):
+        self.mark("ready")
+        self.ready.set()
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def wait_phase(self, name, timeout=None):
+        """wait_phase.
+
+        Block until phase `name` has finished, returns False on timeout.
+        """
+        with self.mutex:
+            event = self.done.setdefault(name, threading.Event())
+        return event.wait(timeout)
+
+    def run_in_background(self, target, *args, **kwargs):
+        """run_in_background.
+
+        Run `target` on a daemon thread and mark the process ready when it
+        returns. A failure is kept in `error` and reported by to_dict.
+        """
+
+        def _run():
+            try:
+                target(*args, **kwargs)
+            except Exception as e:
+                logger.exception("Startup failed")
+                self.error = str(e)
+                return
+            self.set_ready()
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        return thread
+
+    def to_dict(self):
+        with self.mutex:
+            phases = [dict(p) for p in self.phases]
+            events = dict(self.events)
+        return {
+            "ready": self.is_ready(),
+            "error": self.error,
+            "uptime": self._now(),
+            "phases": phases,
+            "events": events,
+        }
+
+
+timeline = StartupTimeline()
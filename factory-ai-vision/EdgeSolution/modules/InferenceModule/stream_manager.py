@@ -118,6 +118,12 @@ class StreamManager(object):
         logger.info("Deleted stream: %s", stream_id)
         return True
 
+    def get_structure_sizes(self):
+        sizes = {"streams": len(self.streams)}
+        for stream in self.get_streams():
+            sizes[stream.cam_id] = stream.get_structure_sizes()
+        return sizes
+
     def summary(self):
         self.mutex.acquire()
         logger.info("==== Stream Manager Summary ====")
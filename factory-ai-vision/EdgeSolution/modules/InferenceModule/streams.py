@@ -15,11 +15,16 @@ from azure.iot.device import IoTHubModuleClient, Message
 from shapely.geometry import Polygon
 
 from api.models import StreamModel
+from aoi_crop import AoiCropper
+from change_gate import ChangeGate
+from detection_schedule import DetectionSchedule
 from exception_handler import PrintGetExceptionDetails
+from graph_operations import graph_operations
 from invoke import gm
 
 # from tracker import Tracker
 from scenarios import DangerZone, DefeatDetection, Detection, PartCounter, PartDetection
+from startup import timeline
 from utility import draw_label, get_file_zip, is_edge, normalize_rtsp
 
 DETECTION_TYPE_NOTHING = "nothing"
@@ -32,6 +37,12 @@ UPLOAD_INTERVAL = 5
 
 LVA_MODE = os.environ.get("LVA_MODE", "grpc")
 IS_OPENCV = os.environ.get("IS_OPENCV", "false")
+# Send full resolution frames to PredictModule and infer them in tiles
+TILED_INFERENCE = os.environ.get("TILED_INFERENCE", "false") == "true"
+# Default class switch tolerance of the part tracker, e.g.
+# CLASS_SWITCH_GROUPS='[["screw", "bolt"]]'
+CLASS_SWITCH_GROUPS = json.loads(os.environ.get("CLASS_SWITCH_GROUPS", "[]"))
+CLASS_SWITCH_HITS = int(os.environ.get("CLASS_SWITCH_HITS", "3"))
 
 DISPLAY_KEEP_ALIVE_THRESHOLD = 10  # seconds
 
@@ -133,19 +144,52 @@ class Stream:
         # self.start_zmq()
         self.is_benchmark = False
         self.use_tracker = False
+        self.change_gate = ChangeGate()
+        self.aoi_crop = AoiCropper()
+        self.tiled_inference = TILED_INFERENCE
+        self.tile_latency_budget = None
+        self.tiling = {}
+        self.detection_schedule = DetectionSchedule()
+        self.class_switch_groups = CLASS_SWITCH_GROUPS
+        self.class_switch_hits = CLASS_SWITCH_HITS
 
     def set_is_benchmark(self, is_benchmark):
         self.is_benchmark = is_benchmark
 
+    def set_class_switch(self, groups=None, hits=None):
+        """set_class_switch.
+
+        Class switch tolerance of the part tracker, None keeps the current
+        setting.
+        """
+        if groups is not None:
+            self.class_switch_groups = groups
+        if hits is not None:
+            self.class_switch_hits = hits
+        if isinstance(self.scenario, PartDetection):
+            self.scenario.set_switch_groups(
+                self.class_switch_groups, self.class_switch_hits)
+
     def _stop(self):
-        gm.invoke_graph_instance_deactivate(self.cam_id)
+        graph_operations.instance_deactivate(self.cam_id)
 
     def _set(self, rtspUrl, frameRate, recording_duration):
-        gm.invoke_instance_set(self.lva_mode, self.cam_id,
-                               rtspUrl, frameRate, recording_duration)
+        properties = gm.graph_instance_properties(
+            self.lva_mode, self.cam_id, rtspUrl, frameRate, recording_duration)
+        if properties is None:
+            return "LVA mode error"
+        graph_operations.instance_set(self.cam_id, properties)
 
     def _start(self):
-        gm.invoke_graph_instance_activate(self.cam_id)
+        graph_operations.instance_activate(self.cam_id)
+
+    def _reconfigure(self, rtspUrl, frameRate, recording_duration, lva_mode=None):
+        properties = gm.graph_instance_properties(
+            lva_mode or self.lva_mode, self.cam_id, rtspUrl, frameRate,
+            recording_duration)
+        if properties is None:
+            return "LVA mode error"
+        graph_operations.instance_reconfigure(self.cam_id, properties)
 
     def reset_metrics(self):
         # self.mutex.acquire()
@@ -154,6 +198,9 @@ class Stream:
         self.detection_total = 0
         self.detections = []
         self.use_tracker = False
+        self.change_gate.reset_metrics()
+        self.aoi_crop.reset_metrics()
+        self.detection_schedule.reset_metrics()
         # self.last_prediction_count = {}
         if self.scenario:
             self.scenario.reset_metrics()
@@ -192,6 +239,15 @@ class Stream:
 
         threading.Thread(target=run, args=(self,)).start()
 
+    def get_structure_sizes(self):
+        sizes = {
+            "detections": len(self.detections),
+            "last_prediction": len(self.last_prediction),
+        }
+        if self.scenario:
+            sizes["scenario"] = self.scenario.get_structure_sizes()
+        return sizes
+
     def get_scenario_metrics(self):
         if self.scenario:
             return self.scenario.get_metrics()
@@ -260,7 +316,9 @@ class Stream:
 
         detection_mode = self.model.get_detection_mode()
         if detection_mode == "PD":
-            self.scenario = PartDetection()
+            self.scenario = PartDetection(
+                switch_groups=self.class_switch_groups,
+                switch_hits=self.class_switch_hits)
             self.scenario.set_parts(self.model.parts)
             self.scenario_type = self.model.detection_mode
 
@@ -397,9 +455,7 @@ class Stream:
 
     def _update_instance(self, rtspUrl, frameRate, recording_duration):
         if not self.is_benchmark:
-            self._stop()
-            self._set(rtspUrl, frameRate, recording_duration)
-            self._start()
+            self._reconfigure(rtspUrl, frameRate, recording_duration)
         logger.info(
             "Instance {} updated, rtsp = {}, frameRate = {}, recording_duration = {}".format(
                 self.cam_id, rtspUrl, frameRate, recording_duration
@@ -431,10 +487,11 @@ class Stream:
         if lva_mode == self.lva_mode:
             logger.info("Not changing lva_mode.")
         else:
-            self._stop()
+            if self._reconfigure(self.cam_source, self.frameRate,
+                                 self.recording_duration, lva_mode):
+                logger.error("Unknown lva_mode {}".format(lva_mode))
+                return
             self.lva_mode = lva_mode
-            self._set(self.cam_source, self.frameRate, self.recording_duration)
-            self._start()
             logger.info("Change lva_mode to {}".format(lva_mode))
 
     def delete(self):
@@ -448,7 +505,7 @@ class Stream:
                 "http://cvcapturemodule:9000/delete_stream/" + self.cam_id
             )
         else:
-            gm.invoke_graph_instance_deactivate(self.cam_id)
+            graph_operations.instance_deactivate(self.cam_id)
         logger.info("Deactivate stream {}".format(self.cam_id))
 
     def predict(self, image):
@@ -461,36 +518,35 @@ class Stream:
             ratio = self.IMG_HEIGHT / image.shape[0]
             width = int(image.shape[1] * ratio + 0.000001)
 
+        # Benchmark repeats one image, it must not be gated
+        if not self.is_benchmark and not self.change_gate.should_infer(image):
+            self.reuse_prediction(image, width, height)
+            return
+        if (not self.is_benchmark and self.is_tracking_scenario()
+                and not self.detection_schedule.should_detect()):
+            self.propagate_prediction(image, width, height)
+            return
+
         # prediction
         # self.mutex.acquire()
         # predictions, inf_time = self.model.Score(image)
-        if ':7777/predict' in self.model.endpoint.lower():
+        batch = None
+        if self.has_aoi and self.aoi_crop.enabled:
+            batch = self.aoi_crop.plan(image, self.aoi_info, width, height)
+        if batch is not None:
+            predictions, inf_time = self.request_prediction(
+                self.resize_for_endpoint(batch.image))
+            predictions = batch.to_frame(predictions)
             image = cv2.resize(image, (width, height))
-            data = image.tobytes()
-            res = requests.post(self.model.endpoint, data=data)
-            if res.json()[1] == 200:
-                lva_prediction = json.loads(res.json()[0])['inferences']
-                inf_time = json.loads(res.json()[0])['inf_time']
-                predictions = lva_to_customvision_format(lva_prediction)
-            else:
-                logger.warning('No inference result')
-                predictions = []
-                inf_time = 0
+        elif ':7777/predict' in self.model.endpoint.lower() and self.tiled_inference:
+            predictions, inf_time = self.request_prediction(image, tiled=True)
+            image = cv2.resize(image, (width, height))
+        elif ':7777/predict' in self.model.endpoint.lower():
+            image = cv2.resize(image, (width, height))
+            predictions, inf_time = self.request_prediction(image)
         else:
-            image = cv2.resize(image, (416, 416))   # for yolo enpoint testing
-            str_encode = cv2.imencode('.jpg', image)[1].tostring()
-            f4 = BytesIO(str_encode)
-            f5 = BufferedReader(f4)
-            s = time.time()
-            res = requests.post(self.model.endpoint, data=f5)
-            inf_time = time.time() - s
-            if res.status_code == 200:
-                lva_prediction = res.json()['inferences']
-                predictions = lva_to_customvision_format(lva_prediction)
-            else:
-                logger.warning('No inference result')
-                predictions = []
-            logger.warning('request prediction time: {}'.format(inf_time))
+            image = self.resize_for_endpoint(image)
+            predictions, inf_time = self.request_prediction(image)
         # print('predictions', predictions, flush=True)
         # self.mutex.release()
 
@@ -544,17 +600,101 @@ class Stream:
             )
         if self.scenario:
             self.scenario.update(_detections)
+        if self.is_tracking_scenario():
+            if image.shape[:2] != (height, width):
+                image = cv2.resize(image, (width, height))
+            self.detection_schedule.observe(image, _detections)
 
         self.draw_img()
+        self.draw_scenario()
+        self.send_events(predictions)
 
-        if self.scenario:
-            if (self.get_mode() == 'ES' and self.use_zone == True) or (self.get_mode() in ['DD', 'PD', 'PC'] and self.use_line == True):
-                self.scenario.draw_counter(self.last_drawn_img)
-            if self.get_mode() == "DD":
-                self.scenario.draw_objs(self.last_drawn_img)
-            if self.get_mode() == 'PD' and self.use_tracker is True:
-                self.scenario.draw_objs(self.last_drawn_img)
+        # update avg inference time (moving avg)
+        inf_time_ms = inf_time * 1000
+        self.average_inference_time = (
+            1 / 16 * inf_time_ms + 15 / 16 * self.average_inference_time
+        )
+        self.change_gate.record_inference_time(inf_time)
+        if not self.is_benchmark:
+            timeline.mark("first_inference")
+
+    def resize_for_endpoint(self, image):
+        if ':7777/predict' in self.model.endpoint.lower():
+            # PredictModule expects raw frames IMG_WIDTH wide
+            height = int(image.shape[0] * self.IMG_WIDTH / image.shape[1] + 0.000001)
+            return cv2.resize(image, (self.IMG_WIDTH, max(height, 1)))
+        return cv2.resize(image, (416, 416))   # for yolo enpoint testing
+
+    def request_prediction(self, image, tiled=False):
+        """request_prediction.
+
+        Send `image` to the model endpoint, return Custom Vision format
+        predictions and the inference time. PredictModule infers `tiled`
+        images in tiles at their full resolution.
+        """
+        if ':7777/predict' in self.model.endpoint.lower():
+            data = image.tobytes()
+            params = {}
+            if tiled:
+                params = {"width": image.shape[1], "tiled": "true"}
+                if self.tile_latency_budget:
+                    params["tile_budget"] = self.tile_latency_budget
+            res = requests.post(self.model.endpoint, data=data, params=params)
+            if res.json()[1] == 200:
+                result = json.loads(res.json()[0])
+                lva_prediction = result['inferences']
+                inf_time = result['inf_time']
+                predictions = lva_to_customvision_format(lva_prediction)
+                self.tiling = result.get('tiling', {})
+            else:
+                logger.warning('No inference result')
+                predictions = []
+                inf_time = 0
+        else:
+            str_encode = cv2.imencode('.jpg', image)[1].tostring()
+            f4 = BytesIO(str_encode)
+            f5 = BufferedReader(f4)
+            s = time.time()
+            res = requests.post(self.model.endpoint, data=f5)
+            inf_time = time.time() - s
+            if res.status_code == 200:
+                lva_prediction = res.json()['inferences']
+                predictions = lva_to_customvision_format(lva_prediction)
+            else:
+                logger.warning('No inference result')
+                predictions = []
+            logger.warning('request prediction time: {}'.format(inf_time))
+        return predictions, inf_time
+
+    def reuse_prediction(self, image, width, height):
+        """reuse_prediction.
+
+        Scene did not change since the last inference: show the new frame
+        with the previous detections and leave scenario state untouched.
+        """
+        self.last_img = cv2.resize(image, (width, height))
+        self.draw_img()
+        self.draw_scenario()
+
+    def propagate_prediction(self, image, width, height):
+        """propagate_prediction.
+
+        Frame between two scheduled detections: move the tracked objects to
+        it and update the scenario with them instead of running inference.
+        """
+        self.last_img = cv2.resize(image, (width, height))
+        detections = self.detection_schedule.propagate(self.last_img)
+        self.last_prediction = list(
+            detection_to_prediction(d, width, height) for d in detections)
+        self.scenario.update(detections)
+        self.draw_img()
+        self.draw_scenario()
+        self.send_events(self.last_prediction)
+
+    def is_tracking_scenario(self):
+        return isinstance(self.scenario, (PartCounter, DangerZone, PartDetection))
 
+    def send_events(self, predictions):
         if self.iothub_is_send:
             if self.get_mode() == 'ES':
                 if self.scenario.has_new_event:
@@ -569,12 +709,6 @@ class Stream:
             else:
                 self.precess_send_signal_to_lva()
 
-        # update avg inference time (moving avg)
-        inf_time_ms = inf_time * 1000
-        self.average_inference_time = (
-            1 / 16 * inf_time_ms + 15 / 16 * self.average_inference_time
-        )
-
     def process_retrain_image(self, predictions, img):
         for prediction in predictions:
             if self.last_upload_time + UPLOAD_INTERVAL < time.time():
@@ -664,6 +798,15 @@ class Stream:
         self.last_drawn_img = img
         self.last_update = time.time()
 
+    def draw_scenario(self):
+        if self.scenario:
+            if (self.get_mode() == 'ES' and self.use_zone == True) or (self.get_mode() in ['DD', 'PD', 'PC'] and self.use_line == True):
+                self.scenario.draw_counter(self.last_drawn_img)
+            if self.get_mode() == "DD":
+                self.scenario.draw_objs(self.last_drawn_img)
+            if self.get_mode() == 'PD' and self.use_tracker is True:
+                self.scenario.draw_objs(self.last_drawn_img)
+
     def to_api_model(self):
         return StreamModel(
             cam_id=self.cam_id,
@@ -774,6 +917,19 @@ def parse_bbox(prediction, width, height):
     return (x1, y1), (x2, y2)
 
 
+def detection_to_prediction(detection, width, height):
+    return {
+        "tagName": detection.tag,
+        "probability": detection.score,
+        "boundingBox": {
+            "left": detection.x1 / width,
+            "top": detection.y1 / height,
+            "width": (detection.x2 - detection.x1) / width,
+            "height": (detection.y2 - detection.y1) / height,
+        },
+    }
+
+
 def draw_confidence_level(img, prediction):
     height, width = img.shape[0], img.shape[1]
 
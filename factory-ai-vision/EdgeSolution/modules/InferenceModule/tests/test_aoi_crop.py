@@ -0,0 +1,214 @@
+import json
+import math
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import streams
+from aoi_crop import AoiCropper, CropBatch, crop_regions, merge_regions
+from model_object import ModelObject
+
+# 4K camera, AOIs are drawn on the 960 wide stream image
+FRAME_WIDTH = 3840
+FRAME_HEIGHT = 2160
+SCALE = FRAME_WIDTH / 960
+# Same input area as the Custom Vision exported models
+MODEL_AREA = 512 * 512
+# Smallest object side the fake detector finds, in model input pixels
+MIN_SIZE = 4
+PART = 12  # px on the 4K frame
+
+
+def bbox_aoi(x1, y1, x2, y2):
+    return {"type": "BBox", "label": {"x1": x1, "y1": y1, "x2": x2, "y2": y2}}
+
+
+def scene(aois, per_aoi=6, seed=0):
+    """4K frame with small bright parts inside each AOI."""
+    rng = np.random.RandomState(seed)
+    frame = cv2.resize(
+        rng.randint(0, 64, (FRAME_HEIGHT // 16, FRAME_WIDTH // 16, 3), dtype=np.uint8),
+        (FRAME_WIDTH, FRAME_HEIGHT), interpolation=cv2.INTER_NEAREST)
+    parts = []
+    for aoi in aois:
+        label = aoi["label"]
+        for _ in range(per_aoi):
+            x = int(rng.uniform(label["x1"] * SCALE, label["x2"] * SCALE - PART))
+            y = int(rng.uniform(label["y1"] * SCALE, label["y2"] * SCALE - PART))
+            if any(abs(x - px) < 3 * PART and abs(y - py) < 3 * PART for px, py in parts):
+                continue
+            frame[y:y + PART, x:x + PART] = 255
+            parts.append((x, y))
+    return frame, parts
+
+
+def fake_detector(img):
+    """Threshold detector run at the model input resolution."""
+    height, width = img.shape[:2]
+    ratio = math.sqrt(MODEL_AREA / (width * height))
+    small = cv2.resize(img, (max(int(width * ratio), 1), max(int(height * ratio), 1)),
+                       interpolation=cv2.INTER_AREA)
+    mask = (small.max(axis=2) > 128).astype(np.uint8)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+    h, w = mask.shape
+    predictions = []
+    for x, y, bw, bh, _ in stats[1:]:
+        if bw >= MIN_SIZE and bh >= MIN_SIZE:
+            predictions.append({"type": "entity", "entity": {
+                "tag": {"value": "part", "confidence": 0.9},
+                "box": {"l": x / w, "t": y / h, "w": bw / w, "h": bh / h}}})
+    return predictions
+
+
+class FakeResponse:
+    def __init__(self, inferences):
+        self.payload = [json.dumps({"inferences": inferences, "inf_time": 0.01}), 200]
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def requests_sent(monkeypatch):
+    sent = []
+
+    def _post(url, data=None, **kwargs):
+        img = np.frombuffer(data, np.uint8).reshape(-1, 960, 3)
+        sent.append(img.shape)
+        return FakeResponse(fake_detector(img))
+
+    monkeypatch.setattr(streams.requests, "post", _post)
+    return sent
+
+
+def make_stream(aois, crop):
+    model = ModelObject()
+    model.device = "cpu"
+    model.parts = ["part"]
+    stream = streams.Stream("cam", model, None)
+    stream.has_aoi = True
+    stream.aoi_info = aois
+    stream.aoi_crop.update(enabled=crop)
+    return stream
+
+
+def recall(predictions, parts):
+    found = 0
+    for x, y in parts:
+        for p in predictions:
+            (x1, y1), (x2, y2) = streams.parse_bbox(p, 960, 540)
+            if x1 - 2 <= (x + PART / 2) / SCALE <= x2 + 2 and y1 - 2 <= (y + PART / 2) / SCALE <= y2 + 2:
+                found += 1
+                break
+    return found / len(parts)
+
+
+def test_merge_regions_makes_them_disjoint():
+    regions = merge_regions([[0, 0, 10, 10], [5, 5, 20, 20], [100, 100, 110, 110]])
+    assert sorted(regions) == [[0, 0, 20, 20], [100, 100, 110, 110]]
+    # Chained overlaps collapse into one
+    assert merge_regions([[0, 0, 10, 10], [9, 0, 20, 10], [19, 0, 30, 10]]) == [[0, 0, 30, 10]]
+
+
+def test_crop_regions_are_padded_and_scaled():
+    polygon = {"type": "Polygon", "label": [
+        {"x": 100, "y": 100}, {"x": 200, "y": 120}, {"x": 150, "y": 200}]}
+    regions = crop_regions([polygon], SCALE, SCALE, FRAME_WIDTH, FRAME_HEIGHT, padding=0.1)
+    assert regions == [[360, 360, 840, 840]]
+    # Clipped to the frame
+    regions = crop_regions([bbox_aoi(0, 0, 50, 50)], SCALE, SCALE, FRAME_WIDTH, FRAME_HEIGHT)
+    assert regions[0][:2] == [0, 0]
+
+
+def test_batch_maps_detections_back_to_the_frame():
+    frame = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), np.uint8)
+    regions = [[100, 200, 500, 400], [2000, 1000, 2300, 1600]]
+    batch = CropBatch.pack(frame, regions)
+    height, width = batch.image.shape[:2]
+    assert width >= height
+    predictions = []
+    for (x1, y1, x2, y2), (mx, my) in batch.slots:
+        # Object at the center of each region
+        cx, cy = mx + (x2 - x1) / 2, my + (y2 - y1) / 2
+        predictions.append({"tagName": "part", "probability": 0.9, "boundingBox": {
+            "left": (cx - 10) / width, "top": (cy - 10) / height,
+            "width": 20 / width, "height": 20 / height}})
+    # On the padding: dropped
+    predictions.append({"tagName": "part", "probability": 0.9, "boundingBox": {
+        "left": (width - 4) / width, "top": (height - 4) / height,
+        "width": 2 / width, "height": 2 / height}})
+
+    results = batch.to_frame(predictions)
+    assert len(results) == 2
+    centers = sorted(
+        (round((r["boundingBox"]["left"] + r["boundingBox"]["width"] / 2) * FRAME_WIDTH),
+         round((r["boundingBox"]["top"] + r["boundingBox"]["height"] / 2) * FRAME_HEIGHT))
+        for r in results)
+    assert centers == [(300, 300), (2150, 1300)]
+
+
+def test_large_aoi_infers_full_frame():
+    frame = np.zeros((540, 960, 3), np.uint8)
+    cropper = AoiCropper(enabled=True, max_area_ratio=0.8)
+    assert cropper.plan(frame, [bbox_aoi(10, 10, 950, 530)], 960, 540) is None
+    assert cropper.plan(frame, [bbox_aoi(10, 10, 200, 200)], 960, 540) is not None
+    assert cropper.metrics()["cropped"] == 1
+
+
+@pytest.mark.parametrize("aois", [
+    [bbox_aoi(400, 200, 560, 300)],
+    [bbox_aoi(50, 50, 200, 150), bbox_aoi(700, 350, 900, 500)],
+], ids=["single", "disjoint"])
+def test_small_object_recall(requests_sent, aois):
+    frame, parts = scene(aois)
+    results = {}
+    for crop in (False, True):
+        stream = make_stream(aois, crop)
+        stream.predict(frame)
+        results[crop] = recall(stream.last_prediction, parts)
+
+    # Parts are ~2 px at model resolution on the full frame
+    assert results[False] < 0.5
+    assert results[True] >= 0.9
+    # Disjoint AOIs still go out as a single request
+    assert len(requests_sent) == 2
+    assert stream.aoi_crop.metrics()["crops"] == len(aois)
+
+
+def test_crop_latency(requests_sent):
+    aois = [bbox_aoi(50, 50, 200, 150), bbox_aoi(700, 350, 900, 500)]
+    frame, _ = scene(aois)
+    timings = {}
+    for crop in (False, True):
+        stream = make_stream(aois, crop)
+        runs = []
+        for _ in range(5):
+            t0 = time.perf_counter()
+            stream.predict(frame)
+            runs.append(time.perf_counter() - t0)
+        timings[crop] = min(runs)
+    # Cropping adds a copy of the AOI pixels on top of the frame resize
+    assert timings[True] < 2 * timings[False] + 0.01
+
+
+def test_tiled_stream_sends_full_frame(monkeypatch):
+    sent = []
+
+    def _post(url, data=None, params=None, **kwargs):
+        sent.append(params)
+        img = np.frombuffer(data, np.uint8).reshape(-1, params["width"], 3)
+        assert img.shape == (FRAME_HEIGHT, FRAME_WIDTH, 3)
+        return FakeResponse([])
+
+    monkeypatch.setattr(streams.requests, "post", _post)
+    stream = make_stream([], crop=False)
+    stream.has_aoi = False
+    stream.tiled_inference = True
+    stream.tile_latency_budget = 150
+    frame, _ = scene([])
+    stream.predict(frame)
+    assert sent == [{"width": FRAME_WIDTH, "tiled": "true", "tile_budget": 150}]
+    # Drawn on the stream image as usual
+    assert stream.last_img.shape == (540, 960, 3)
@@ -0,0 +1,146 @@
+import json
+
+import numpy as np
+import pytest
+
+import streams
+from change_gate import ChangeGate
+from load_generator import SCENE_BURST, SyntheticCamera
+from model_object import ModelObject
+
+FPS = 10
+
+
+def run_gate(gate, cam, n_frames, noise=0, seed=0):
+    # Sensor noise, cycled from a few precomputed patterns
+    rng = np.random.RandomState(seed)
+    shape = (cam.height, cam.width, 3)
+    patterns = [rng.normal(0, noise, shape).astype(np.int16) for _ in range(4)]
+    decisions = []
+    for i in range(n_frames):
+        img = cam.frame(i)
+        if noise:
+            img = np.clip(img + patterns[i % 4], 0, 255).astype(np.uint8)
+        decisions.append(gate.should_infer(img, now=i / FPS))
+    return decisions
+
+
+@pytest.fixture
+def burst_camera():
+    # Idle belt with a batch of parts passing every 10 seconds
+    return SyntheticCamera("cam", width=640, height=360, fps=FPS,
+                           scene=SCENE_BURST, n_objects=3, seed=1,
+                           burst_period=100, burst_length=20)
+
+
+def test_disabled_gate_infers_every_frame(burst_camera):
+    gate = ChangeGate(enabled=False)
+    assert all(run_gate(gate, burst_camera, 50))
+    assert gate.metrics()["skip_ratio"] == 0
+
+
+def test_no_event_is_missed(burst_camera):
+    n_frames = 500
+    gate = ChangeGate(enabled=True, sensitivity=0.5, max_reuse_age=2)
+    decisions = run_gate(gate, burst_camera, n_frames, noise=2)
+
+    active = [burst_camera.is_active(i) for i in range(n_frames)]
+    for i in range(1, n_frames):
+        if active[i] != active[i - 1]:
+            # Parts appearing and leaving are always inferred
+            assert decisions[i], "missed change at frame {}".format(i)
+
+    last_inferred = 0
+    for i in range(n_frames):
+        if decisions[i]:
+            last_inferred = i
+            continue
+        # Reused detections still describe the frame: same parts, and
+        # each moved less than the gate tolerates
+        assert active[i] == active[last_inferred]
+        if active[i]:
+            shift = np.abs(burst_camera.boxes(i) - burst_camera.boxes(last_inferred))
+            assert shift.max() < 16, "stale detections at frame {}".format(i)
+
+
+def test_idle_frames_are_skipped_with_bounded_age(burst_camera):
+    n_frames = 500
+    gate = ChangeGate(enabled=True, sensitivity=0.5, max_reuse_age=2)
+    decisions = run_gate(gate, burst_camera, n_frames, noise=2)
+
+    idle = [i for i in range(n_frames) if not burst_camera.is_active(i)]
+    idle_inferred = sum(decisions[i] for i in idle)
+    # One inference per max_reuse_age while idle, plus the transitions
+    assert idle_inferred <= len(idle) / (2 * FPS) + 2 * (n_frames // 100) + 1
+
+    run = longest = 0
+    for infer in decisions:
+        run = 0 if infer else run + 1
+        longest = max(longest, run)
+    assert longest < 2 * FPS
+
+    metrics = gate.metrics()
+    assert metrics["skip_ratio"] > 0.5
+    assert metrics["frames"] == n_frames
+    assert metrics["inferred"] + metrics["skipped"] == n_frames
+
+
+def test_sensitivity_orders_skip_ratio(burst_camera):
+    ratios = []
+    for sensitivity in (0.0, 0.5, 1.0):
+        gate = ChangeGate(enabled=True, sensitivity=sensitivity, max_reuse_age=10)
+        run_gate(gate, burst_camera, 300, noise=2)
+        ratios.append(gate.metrics()["skip_ratio"])
+    assert ratios[0] >= ratios[1] >= ratios[2]
+
+
+def test_update_forces_next_inference(burst_camera):
+    gate = ChangeGate(enabled=True, max_reuse_age=100)
+    img = burst_camera.frame(50)
+    assert gate.should_infer(img, now=0)
+    assert not gate.should_infer(img, now=0.1)
+    gate.update(sensitivity=0.9)
+    assert gate.should_infer(img, now=0.2)
+
+
+class FakeResponse:
+    def __init__(self, inferences):
+        self.payload = [json.dumps({"inferences": inferences, "inf_time": 0.05}), 200]
+
+    def json(self):
+        return self.payload
+
+
+def test_stream_reuses_detections_when_gated(monkeypatch, burst_camera):
+    calls = []
+    inference = {"type": "entity", "entity": {
+        "tag": {"value": "box", "confidence": 0.9},
+        "box": {"l": 0.1, "t": 0.1, "w": 0.2, "h": 0.2}}}
+
+    def _post(url, data=None, **kwargs):
+        calls.append(url)
+        return FakeResponse([inference])
+
+    monkeypatch.setattr(streams.requests, "post", _post)
+    model = ModelObject()
+    model.device = "cpu"
+    model.parts = ["box"]
+    stream = streams.Stream("cam", model, None)
+    stream.change_gate.update(enabled=True, max_reuse_age=100)
+
+    img = burst_camera.frame(50)
+    stream.predict(img)
+    for _ in range(5):
+        stream.predict(img)
+
+    assert len(calls) == 1
+    assert [p["tagName"] for p in stream.last_prediction] == ["box"]
+    assert stream.last_drawn_img is not None
+    metrics = stream.change_gate.metrics()
+    assert metrics["skipped"] == 5
+    assert metrics["saved_time"] > 0
+
+    # Benchmark streams always infer
+    stream.set_is_benchmark(True)
+    stream.predict(img)
+    assert len(calls) == 2
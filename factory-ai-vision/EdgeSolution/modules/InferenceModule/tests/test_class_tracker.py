@@ -0,0 +1,145 @@
+import time
+
+import numpy as np
+import pytest
+
+from scenarios import Detection, PartDetection
+from tracker import ClassTracker, Tracker
+
+PARTS = ["bolt", "nut", "washer", "screw", "gear"]
+
+
+def recorded_sequence(seed, n_frames=120, n_objects=12, parts=PARTS):
+    """Parts moving over the frame, some of them crossing each other."""
+    rng = np.random.RandomState(seed)
+    start = rng.randint(0, n_frames // 2, n_objects)
+    life = rng.randint(10, n_frames // 2, n_objects)
+    xy = rng.uniform(0, 800, (n_objects, 2))
+    velocity = rng.uniform(-6, 6, (n_objects, 2))
+    size = rng.uniform(40, 90, (n_objects, 2))
+    tags = [parts[i % len(parts)] for i in range(n_objects)]
+    for frame in range(n_frames):
+        detections = []
+        for i in range(n_objects):
+            age = frame - start[i]
+            # Missed detections now and then
+            if not 0 <= age < life[i] or rng.rand() < 0.05:
+                continue
+            x, y = xy[i] + velocity[i] * age + rng.normal(0, 1, 2)
+            detections.append(Detection(tags[i], x, y, x + size[i, 0], y + size[i, 1],
+                                        rng.uniform(0.5, 1)))
+        yield detections
+
+
+def per_part_tracks(sequence, parts=PARTS):
+    """The per part Trackers, each fed the detections of its part."""
+    trackers = {part: Tracker(max_age=5, min_hits=2) for part in parts}
+    for detections in sequence:
+        frame = []
+        for part, tracker in trackers.items():
+            tracker.update([[d.x1, d.y1, d.x2, d.y2, d.score]
+                            for d in detections if d.tag == part])
+            frame += [(part, obj) for obj in tracker.get_objs()]
+        yield frame
+
+
+def class_tracks(sequence, **kwargs):
+    tracker = ClassTracker(max_age=5, min_hits=2, **kwargs)
+    for detections in sequence:
+        tracker.update([[d.x1, d.y1, d.x2, d.y2, d.score] for d in detections],
+                       [d.tag for d in detections])
+        yield list(zip(tracker.get_labels(), tracker.get_objs()))
+
+
+def trajectories(frames):
+    """{(part, id): [(frame, rounded box), ...]} with ids renumbered."""
+    tracks = {}
+    for n, frame in enumerate(frames):
+        for part, obj in frame:
+            tracks.setdefault((part, int(obj[4])), []).append(
+                (n, tuple(np.round(obj[:4], 3))))
+    return sorted(tracks.values())
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_matches_per_part_trackers(seed):
+    expected = trajectories(per_part_tracks(recorded_sequence(seed)))
+    assert trajectories(class_tracks(recorded_sequence(seed))) == expected
+    assert len(expected) >= 12
+
+
+def test_parts_do_not_associate_across_classes():
+    tracker = ClassTracker(max_age=5, min_hits=1)
+    tracker.update([[0, 0, 50, 50, 0.9]], ["bolt"])
+    (oid,) = tracker.get_objs()[:, 4]
+    # Same place, other part: a new track
+    tracker.update([[1, 1, 51, 51, 0.9]], ["nut"])
+    assert [trk.label for trk in tracker.trackers] == ["bolt", "nut"]
+    assert len(tracker.get_objs()) == 0
+    assert oid in tracker.live_ids
+
+
+def test_switch_groups_keep_the_id():
+    tracker = ClassTracker(max_age=5, min_hits=1, switch_groups=[["ok", "ng"]],
+                           switch_hits=2)
+    tracker.update([[0, 0, 50, 50, 0.9]], ["ok"])
+    (oid,) = tracker.get_objs()[:, 4]
+    labels = []
+    for tag in ["ng", "ok", "ng", "ng", "ng"]:
+        tracker.update([[0, 0, 50, 50, 0.9]], [tag])
+        assert tracker.get_objs()[:, 4].tolist() == [oid]
+        labels += tracker.get_labels()
+    # Flickers are ignored, a part seen as another for switch_hits frames
+    # switches
+    assert labels == ["ok", "ok", "ok", "ng", "ng"]
+
+
+def test_part_detection_tracks_each_object_once():
+    scenario = PartDetection()
+    scenario.set_parts(PARTS[:3])
+    for detections in recorded_sequence(0, n_objects=6):
+        scenario.update(detections + [Detection("gear", 0, 0, 10, 10, 0.9)])
+    objs = scenario.tracker.get_objs()
+    assert len(objs) == len(set(objs[:, 4]))
+    assert set(scenario.tracker.get_labels()) <= set(PARTS[:3])
+    assert scenario.get_structure_sizes()["tracks"] <= 6
+    img = np.zeros((1000, 1000, 3), np.uint8)
+    assert scenario.draw_objs(img).shape == img.shape
+
+
+def test_single_pass_benchmark():
+    """One tracker vs the per part trackers fed every detection."""
+    frames = list(recorded_sequence(0, n_frames=60, n_objects=40))
+    t0 = time.perf_counter()
+    trackers = {part: Tracker(max_age=5, min_hits=2) for part in PARTS}
+    for detections in frames:
+        for tracker in trackers.values():
+            tracker.update([[d.x1, d.y1, d.x2, d.y2, d.score] for d in detections])
+    per_part = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    list(class_tracks(frames))
+    single = time.perf_counter() - t0
+    print("per part: %.1f ms/frame, class aware: %.1f ms/frame" % (
+        per_part / len(frames) * 1000, single / len(frames) * 1000))
+    assert single < per_part / 2
+
+
+def test_stream_applies_class_switch_settings(monkeypatch):
+    import streams
+    from model_object import ModelObject
+
+    model = ModelObject()
+    model.device = "cpu"
+    model.parts = ["ok", "ng"]
+    stream = streams.Stream("cam", model, None)
+    monkeypatch.setattr(stream, "_update_instance", lambda *args: None)
+    stream.set_class_switch([["ok", "ng"]], 2)
+    stream.update_cam("rtsp", "rtsp://cam", 10, 60, "grpc", "cam", "cam",
+                      False, None)
+
+    tracker = stream.scenario.tracker
+    assert tracker.group_keys == {"ok": ("group", 0), "ng": ("group", 0)}
+    assert tracker.switch_hits == 2
+    stream.set_class_switch(hits=4)
+    assert stream.scenario.tracker.switch_hits == 4
+    assert stream.scenario.switch_groups == [["ok", "ng"]]
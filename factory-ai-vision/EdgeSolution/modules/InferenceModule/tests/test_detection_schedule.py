@@ -0,0 +1,212 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import streams
+from detection_schedule import REFINES, DetectionSchedule
+from model_object import ModelObject
+from scenarios import DangerZone, Detection, PartCounter
+
+WIDTH = 960
+HEIGHT = 540
+SIZE = 64
+
+
+class Conveyor:
+    """Textured parts entering on the left every `period` frames."""
+
+    def __init__(self, n_parts=12, speed=8, period=30, seed=0, tag="box"):
+        rng = np.random.RandomState(seed)
+        background = rng.randint(0, 64, (HEIGHT // 8, WIDTH // 8, 3), dtype=np.uint8)
+        self.background = cv2.resize(
+            background, (WIDTH, HEIGHT), interpolation=cv2.INTER_NEAREST)
+        self.parts = []
+        for i in range(n_parts):
+            texture = rng.randint(96, 256, (8, 8, 3), dtype=np.uint8)
+            texture = cv2.resize(texture, (SIZE, SIZE), interpolation=cv2.INTER_NEAREST)
+            self.parts.append((i * period, rng.randint(40, HEIGHT - 40 - SIZE), texture))
+        self.speed = speed
+        self.tag = tag
+        self.n_frames = (n_parts - 1) * period + (WIDTH + SIZE) // speed + 1
+
+    def visible(self, i):
+        for start, y, texture in self.parts:
+            x = (i - start) * self.speed - SIZE
+            if i >= start and x < WIDTH:
+                yield x, y, texture
+
+    def frame(self, i):
+        img = self.background.copy()
+        for x, y, texture in self.visible(i):
+            x1, x2 = max(x, 0), min(x + SIZE, WIDTH)
+            if x2 > x1:
+                img[y:y + SIZE, x1:x2] = texture[:, x1 - x:x2 - x]
+        return img
+
+    def detect(self, i):
+        return [Detection(self.tag, float(max(x, 0)), float(y),
+                          float(min(x + SIZE, WIDTH - 1)), float(y + SIZE), 0.9)
+                for x, y, _ in self.visible(i) if x + SIZE > 0]
+
+
+def run(scenario, conveyor, schedule=None):
+    calls = 0
+    for i in range(conveyor.n_frames):
+        img = conveyor.frame(i)
+        if schedule is None or schedule.should_detect():
+            detections = conveyor.detect(i)
+            calls += 1
+            scenario.update(detections)
+            if schedule is not None:
+                schedule.observe(img, detections)
+        else:
+            scenario.update(schedule.propagate(img))
+    return calls
+
+
+def line_counter():
+    counter = PartCounter()
+    counter.set_line([[WIDTH // 2, 0, WIDTH // 2, HEIGHT, "0"]])
+    return counter
+
+
+def test_disabled_schedule_detects_every_frame():
+    conveyor = Conveyor(n_parts=2)
+    schedule = DetectionSchedule(enabled=False)
+    assert run(line_counter(), conveyor, schedule) == conveyor.n_frames
+    assert schedule.metrics()["saved_ratio"] == 0
+
+
+@pytest.mark.parametrize("refine", REFINES)
+def test_counts_match_with_fewer_inferences(refine):
+    conveyor = Conveyor(speed=8)
+    counter = line_counter()
+    schedule = DetectionSchedule(enabled=True, max_interval=8, refine=refine)
+    calls = run(counter, conveyor, schedule)
+
+    # Every part crosses the line once
+    assert counter.counter["0"] == len(conveyor.parts)
+    assert calls < conveyor.n_frames / 2
+    metrics = schedule.metrics()
+    assert metrics["detections"] == calls
+    assert metrics["detections"] + metrics["propagated"] == conveyor.n_frames
+    assert metrics["saved_ratio"] > 0.5
+
+
+@pytest.mark.parametrize("refine", REFINES)
+def test_propagated_box_follows_moving_part(refine):
+    conveyor = Conveyor(n_parts=1, speed=6)
+    schedule = DetectionSchedule(enabled=True, max_interval=100, refine=refine)
+    # Seed the velocity with two detections, then propagate only
+    for i in (30, 31):
+        schedule.observe(conveyor.frame(i), conveyor.detect(i))
+    errors = []
+    for i in range(32, 44):
+        (propagated,) = schedule.propagate(conveyor.frame(i))
+        (truth,) = conveyor.detect(i)
+        errors.append(max(abs(propagated.x1 - truth.x1), abs(propagated.y1 - truth.y1)))
+    assert max(errors) < 3
+
+
+def test_danger_zone_violations_match():
+    zone = [[WIDTH // 2, 0, WIDTH // 2 + 100, HEIGHT, "0"]]
+    baseline = DangerZone()
+    baseline.set_targets(["Person"])
+    baseline.set_zones(zone)
+    run(baseline, Conveyor(tag="Person"))
+
+    zone_scenario = DangerZone()
+    zone_scenario.set_targets(["Person"])
+    zone_scenario.set_zones(zone)
+    conveyor = Conveyor(tag="Person")
+    calls = run(zone_scenario, conveyor, DetectionSchedule(enabled=True))
+
+    assert zone_scenario.counter["0"] == baseline.counter["0"] == len(conveyor.parts)
+    assert calls < conveyor.n_frames / 2
+
+
+def test_interval_follows_motion():
+    ratios = []
+    for speed in (4, 16):
+        conveyor = Conveyor(n_parts=4, speed=speed)
+        calls = run(line_counter(), conveyor, DetectionSchedule(enabled=True, max_interval=8))
+        ratios.append(calls / conveyor.n_frames)
+    # Fast parts are detected more often
+    assert ratios[0] < ratios[1]
+
+
+def test_lost_track_forces_detection():
+    conveyor = Conveyor(n_parts=1, speed=4)
+    schedule = DetectionSchedule(enabled=True, max_interval=100, refine="template")
+    i = 60
+    assert schedule.should_detect()
+    schedule.observe(conveyor.frame(i), conveyor.detect(i))
+    assert not schedule.should_detect()
+    schedule.propagate(conveyor.frame(i + 1))
+    assert not schedule.should_detect()
+
+    # Part removed from the belt: the template does not match any more
+    schedule.propagate(conveyor.background)
+    assert schedule.should_detect()
+    assert schedule.metrics()["forced"] == 1
+
+
+def test_update_forces_next_detection():
+    conveyor = Conveyor(n_parts=1)
+    schedule = DetectionSchedule(enabled=True, max_interval=100)
+    schedule.should_detect()
+    schedule.observe(conveyor.frame(40), conveyor.detect(40))
+    assert not schedule.should_detect()
+    schedule.update(max_interval=4)
+    assert schedule.should_detect()
+
+
+class FakeResponse:
+    def __init__(self, inferences):
+        self.payload = [json.dumps({"inferences": inferences, "inf_time": 0.05}), 200]
+
+    def json(self):
+        return self.payload
+
+
+def test_stream_propagates_between_detections(monkeypatch):
+    conveyor = Conveyor(n_parts=4, speed=8)
+    calls = []
+    frame_index = [0]
+
+    def _post(url, data=None, **kwargs):
+        calls.append(frame_index[0])
+        inferences = []
+        for d in conveyor.detect(frame_index[0]):
+            inferences.append({"type": "entity", "entity": {
+                "tag": {"value": d.tag, "confidence": d.score},
+                "box": {"l": d.x1 / WIDTH, "t": d.y1 / HEIGHT,
+                        "w": (d.x2 - d.x1) / WIDTH, "h": (d.y2 - d.y1) / HEIGHT}}})
+        return FakeResponse(inferences)
+
+    monkeypatch.setattr(streams.requests, "post", _post)
+    model = ModelObject()
+    model.device = "cpu"
+    model.parts = ["box"]
+    model.detection_mode = "PC"
+    stream = streams.Stream("cam", model, None)
+    stream.scenario = line_counter()
+    stream.detection_schedule.update(enabled=True, max_interval=8)
+
+    for i in range(conveyor.n_frames):
+        frame_index[0] = i
+        stream.predict(conveyor.frame(i))
+        if i == 100:
+            # Propagated objects are reported like detected ones
+            assert len(stream.last_prediction) == len(conveyor.detect(i))
+
+    assert stream.scenario.counter["0"] == len(conveyor.parts)
+    assert len(calls) < conveyor.n_frames / 2
+    assert stream.detection_schedule.metrics()["detections"] == len(calls)
+
+    # Benchmark streams always infer
+    stream.set_is_benchmark(True)
+    stream.predict(conveyor.frame(0))
+    assert len(calls) == stream.detection_schedule.metrics()["detections"] + 1
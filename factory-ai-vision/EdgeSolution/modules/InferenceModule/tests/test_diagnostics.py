@@ -0,0 +1,118 @@
+"""Tests for diagnostics.
+"""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from diagnostics import Diagnostics
+from object_detection2 import ObjectDetection
+
+LABELS = ["part"]
+
+
+class FakeObjectDetection(ObjectDetection):
+    """Skip the model, every frame yields a single detection."""
+
+    def __init__(self, labels):
+        super().__init__(labels)
+        self.outputs = np.full((13, 13, 5 * (5 + len(labels))), -10.0)
+        self.outputs[6, 6, 4] = 10.0
+
+    def preprocess(self, image):
+        return image
+
+    def predict(self, preprocessed_inputs):
+        return self.outputs.copy()
+
+
+@pytest.fixture
+def diagnostics():
+    d = Diagnostics()
+    yield d
+    d.stop()
+
+
+def test_structure_sizes(diagnostics):
+    streams = {"cam1": [1, 2, 3]}
+    diagnostics.register("list", [1, 2])
+    diagnostics.register("streams", lambda: {
+        k: {"detected": len(v)} for k, v in streams.items()})
+    sample = diagnostics.sample()
+    assert sample["structures"] == {"list": 2, "streams.cam1.detected": 3}
+    assert sample["rss"] > 0
+
+    # Removed streams drop out of the report
+    streams.clear()
+    diagnostics.sample()
+    report = diagnostics.report()
+    assert report["structures"] == {"list": 2}
+
+    # Reports do not record samples
+    diagnostics.report()
+    assert len(report["samples"]) == len(diagnostics.samples) == 2
+
+    diagnostics.unregister("list")
+    assert diagnostics.get_structure_sizes() == {}
+
+
+def test_top_growth_finds_leak(diagnostics):
+    diagnostics.start(interval=3600)
+    diagnostics.sample()
+    leak = [bytearray(1024) for _ in range(2000)]
+    diagnostics.sample()
+    report = diagnostics.report()
+    assert report["enabled"]
+    assert report["top_growth"]
+    top = report["top_growth"][0]
+    assert "test_diagnostics.py" in top["site"]
+    assert top["size_diff"] >= 2000 * 1024
+    del leak
+
+
+def test_stop_leaves_foreign_tracing_on(diagnostics):
+    assert diagnostics.report() == {"enabled": False, "samples": []}
+    tracemalloc.start()
+    try:
+        diagnostics.start(interval=3600)
+        diagnostics.stop()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_endpoint_answers_disabled(monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "DIAGNOSTICS_ENABLED", False)
+    res = TestClient(server.app).get("/diagnostics")
+    assert res.json() == {"enabled": False}
+
+
+def test_soak_object_detection_timings_stay_flat(diagnostics):
+    """Two simulated hours of frames at 1 fps."""
+    model = FakeObjectDetection(LABELS)
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    diagnostics.register("pre", model.pre)
+    diagnostics.register("inf", model.inf)
+    diagnostics.register("post", model.post)
+
+    tracemalloc.start()
+    try:
+        for _ in range(model.TIMING_HISTORY):
+            model.predict_image(image)
+        diagnostics.sample()
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in range(2 * 3600):
+            model.predict_image(image)
+        end, _ = tracemalloc.get_traced_memory()
+        diagnostics.sample()
+        report = diagnostics.report()
+    finally:
+        tracemalloc.stop()
+
+    assert end - start < 64 * 1024
+    assert report["structures"]["pre"] == model.TIMING_HISTORY
+    assert all(v == 0 for v in report["structure_growth"].values())
@@ -0,0 +1,71 @@
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from frame_transport import JPEG, PNG, RAW, decode_frame, frame_encoding
+
+
+@pytest.fixture(scope="module")
+def frame():
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (54, 96, 3), dtype=np.uint8)
+    return cv2.resize(img, (960, 540), interpolation=cv2.INTER_LINEAR)
+
+
+def test_frame_encoding_from_content_type():
+    assert frame_encoding("image/jpeg") == JPEG
+    assert frame_encoding("Image/PNG; charset=binary") == PNG
+    assert frame_encoding("image/x-raw-bgr") == RAW
+    assert frame_encoding("application/octet-stream") is None
+    assert frame_encoding(None) is None
+
+
+def test_decode_frame(frame):
+    assert np.array_equal(decode_frame(frame.tobytes(), RAW), frame)
+    assert decode_frame(frame[:, :640].tobytes(), RAW, 640).shape == (540, 640, 3)
+    assert decode_frame(frame.tobytes()[:-1], RAW) is None
+    png = cv2.imencode(".png", frame)[1].tobytes()
+    assert np.array_equal(decode_frame(png, PNG), frame)
+    jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+    assert np.abs(decode_frame(jpeg, JPEG).astype(int) - frame).mean() < 3
+    assert decode_frame(b"not a jpeg", JPEG) is None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import server
+
+    received = []
+
+    def _predict(camera_id, img):
+        received.append((camera_id, img))
+        return []
+
+    monkeypatch.setattr(server.http_inference_engine, "predict", _predict)
+    client = TestClient(server.app)
+    client.received = received
+    return client
+
+
+def test_predict_decodes_by_content_type(client, frame):
+    assert client.get("/transport").json() == {"encodings": ["raw", "jpeg", "png"]}
+    png = cv2.imencode(".png", frame)[1].tobytes()
+    client.post("/predict?camera_id=1", content=png, headers={"Content-Type": "image/png"})
+    # Without a content type: raw frames as before
+    client.post("/predict?camera_id=2", content=frame.tobytes())
+    client.post("/predict?camera_id=3", content=frame[:, :480].tobytes(),
+                headers={"Content-Type": "image/x-raw-bgr", "X-Frame-Width": "480"})
+    (_, png_img), (_, raw_img), (_, narrow) = client.received
+    assert np.array_equal(png_img, frame)
+    assert np.array_equal(raw_img, frame)
+    assert narrow.shape == (540, 480, 3)
+
+    res = client.post("/predict?camera_id=1", content=b"broken",
+                      headers={"Content-Type": "image/jpeg"})
+    assert res.status_code == 400
+    res = client.post("/predict?camera_id=3", content=frame.tobytes(),
+                      headers={"Content-Type": "image/x-raw-bgr",
+                               "X-Frame-Width": "wide"})
+    assert res.status_code == 400
+    assert len(client.received) == 3
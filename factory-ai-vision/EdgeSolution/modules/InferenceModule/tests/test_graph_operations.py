@@ -0,0 +1,224 @@
+"""Tests for graph_operations.
+"""
+
+import threading
+import time
+
+import pytest
+
+from graph_operations import GraphOperations, GraphReconciler
+from invoke import GraphManager
+
+LATENCY = 0.02
+N_CAMERAS = 16
+
+
+class FakeGraphManager(GraphManager):
+    """Fake LVA direct method endpoint with injected latency."""
+
+    def __init__(self, latency=LATENCY):
+        self.latency = latency
+        self.calls = []
+        self.topologies = {}
+        self.instances = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def invoke_method(self, method_name, payload):
+        with self.lock:
+            self.calls.append((method_name, payload.get("name")))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+            return self._apply(method_name, payload)
+
+    def _apply(self, method_name, payload):
+        name = payload.get("name")
+        if method_name == "GraphTopologySet":
+            self.topologies[name] = payload["properties"]
+        elif method_name == "GraphTopologyDelete":
+            self.topologies.pop(name, None)
+        elif method_name == "GraphTopologyList":
+            return _listing(self.topologies)
+        elif method_name == "GraphInstanceSet":
+            properties = dict(payload["properties"], state="Inactive")
+            self.instances[name] = properties
+        elif method_name == "GraphInstanceActivate":
+            self.instances[name]["state"] = "Active"
+        elif method_name == "GraphInstanceDeactivate":
+            if name in self.instances:
+                self.instances[name]["state"] = "Inactive"
+        elif method_name == "GraphInstanceDelete":
+            self.instances.pop(name, None)
+        elif method_name == "GraphInstanceList":
+            return _listing(self.instances)
+        return {"status": 200, "payload": {}}
+
+    def methods(self, name):
+        return [m for m, n in self.calls if n == name]
+
+
+def _listing(items):
+    return {
+        "status": 200,
+        "payload": {"value": [{"name": k, "properties": v} for k, v in items.items()]},
+    }
+
+
+def _wait_started(gm):
+    while not gm.in_flight:
+        time.sleep(0.001)
+
+
+def _properties(gm, cam_id, fps="10"):
+    return gm.graph_http_instance_properties(cam_id, "rtsp://cam/" + cam_id, fps, "60")
+
+
+@pytest.fixture
+def gm():
+    return FakeGraphManager()
+
+
+def test_configure_cameras_concurrently(gm):
+    ops = GraphOperations(gm, max_workers=N_CAMERAS)
+    t0 = time.time()
+    futures = [
+        ops.instance_reconfigure(str(i), _properties(gm, str(i)))
+        for i in range(N_CAMERAS)
+    ]
+    ops.wait(futures)
+    elapsed = time.time() - t0
+    ops.shutdown()
+
+    serial = N_CAMERAS * 3 * LATENCY
+    print("configured %s cameras in %.3fs (serial %.3fs)" % (N_CAMERAS, elapsed, serial))
+    assert elapsed < serial / 4
+    assert gm.max_in_flight > 1
+    assert all(p["state"] == "Active" for p in gm.instances.values())
+    assert len(gm.instances) == N_CAMERAS
+
+
+def test_same_instance_runs_in_order(gm):
+    ops = GraphOperations(gm)
+    ops.instance_set("cam", _properties(gm, "cam")).result()
+    ops.instance_activate("cam").result()
+    ops.instance_deactivate("cam").result()
+    ops.shutdown()
+    assert gm.methods("cam") == [
+        "GraphInstanceSet", "GraphInstanceActivate", "GraphInstanceDeactivate"]
+
+
+def test_delete_supersedes_pending_operations(gm):
+    ops = GraphOperations(gm)
+    first = ops.instance_set("cam", _properties(gm, "cam"))
+    _wait_started(gm)
+    ops.wait([
+        first,
+        ops.instance_activate("cam"),
+        ops.instance_deactivate("cam"),
+        ops.instance_delete("cam"),
+    ])
+    ops.shutdown()
+    # The set is already running, activate/deactivate are folded into delete
+    assert gm.methods("cam") == [
+        "GraphInstanceSet", "GraphInstanceDeactivate", "GraphInstanceDelete"]
+    assert "cam" not in gm.instances
+
+
+def test_set_followed_by_set_is_coalesced(gm):
+    ops = GraphOperations(gm)
+    # Keep the instance busy so the following sets are still pending
+    busy = ops.instance_activate("cam")
+    first = ops.instance_set("cam", _properties(gm, "cam", fps="5"))
+    second = ops.instance_set("cam", _properties(gm, "cam", fps="15"))
+    ops.wait([busy, first, second])
+    ops.shutdown()
+
+    assert gm.methods("cam").count("GraphInstanceSet") == 1
+    assert ops.coalesced == 1
+    params = {p["name"]: p["value"] for p in gm.instances["cam"]["parameters"]}
+    assert params["frameRate"] == "15"
+    assert first.result() == second.result()
+
+
+def test_reconfigure_supersedes_pending_reconfigure(gm):
+    ops = GraphOperations(gm)
+    busy = ops.instance_deactivate("cam")
+    futures = [
+        ops.instance_reconfigure("cam", _properties(gm, "cam", fps=str(fps)))
+        for fps in range(1, 6)
+    ]
+    ops.wait([busy] + futures)
+    ops.shutdown()
+
+    assert gm.methods("cam").count("GraphInstanceSet") == 1
+    params = {p["name"]: p["value"] for p in gm.instances["cam"]["parameters"]}
+    assert params["frameRate"] == "5"
+
+
+def test_reconcile_applies_only_changes(gm):
+    ops = GraphOperations(gm)
+    reconciler = GraphReconciler(gm, ops)
+    topologies = {"InferencingWithHttpExtension": {"description": "http"}}
+    instances = {
+        str(i): {"properties": _properties(gm, str(i)), "active": True}
+        for i in range(N_CAMERAS)
+    }
+    changes = reconciler.reconcile(topologies, instances)
+    assert len(changes["instance_set"]) == N_CAMERAS
+    assert changes["topology_set"] == ["InferencingWithHttpExtension"]
+
+    # Second pass is a no-op apart from the two list calls
+    n_calls = len(gm.calls)
+    changes = reconciler.reconcile(topologies, instances)
+    assert not any(changes.values())
+    assert len(gm.calls) == n_calls + 2
+
+    # Change one camera, drop another, deactivate a third
+    instances["0"]["properties"] = _properties(gm, "0", fps="30")
+    del instances["1"]
+    instances["2"]["active"] = False
+    changes = reconciler.reconcile(topologies, instances)
+    ops.shutdown()
+    assert changes["instance_set"] == ["0"]
+    assert changes["instance_delete"] == ["1"]
+    assert changes["instance_deactivate"] == ["2"]
+    assert "1" not in gm.instances
+    assert gm.instances["2"]["state"] == "Inactive"
+    assert gm.instances["0"]["state"] == "Active"
+
+
+def test_reconcile_deletes_unknown_topology_after_instances(gm):
+    gm.topologies["Old"] = {"description": "old"}
+    gm.instances["stale"] = {"topologyName": "Old", "state": "Active"}
+    ops = GraphOperations(gm)
+    changes = GraphReconciler(gm, ops).reconcile({}, {})
+    ops.shutdown()
+    assert changes["instance_delete"] == ["stale"]
+    assert changes["topology_delete"] == ["Old"]
+    names = [n for _, n in gm.calls]
+    assert names.index("Old") > max(i for i, n in enumerate(names) if n == "stale")
+    assert not gm.topologies and not gm.instances
+
+
+def test_unknown_lva_mode_sends_nothing(gm, monkeypatch):
+    import streams
+    from model_object import ModelObject
+
+    ops = GraphOperations(gm)
+    monkeypatch.setattr(streams, "graph_operations", ops)
+    monkeypatch.setattr(streams, "gm", gm)
+    model = ModelObject()
+    model.device = "cpu"
+    stream = streams.Stream("cam", model, None)
+    stream.lva_mode = "http"
+
+    assert stream._reconfigure("rtsp://cam", "10", "60", "bogus") == "LVA mode error"
+    stream.update_lva_mode("bogus")
+    ops.shutdown()
+
+    assert stream.lva_mode == "http"
+    assert gm.calls == []
@@ -0,0 +1,177 @@
+"""Tests for load_generator.
+"""
+
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import grpc
+import numpy as np
+import pytest
+import zmq
+
+import extension_pb2_grpc
+import load_generator
+from inference_engine import InferenceEngine
+from load_generator import (
+    SCENE_BURST,
+    SCENE_STATIC,
+    GrpcSender,
+    HttpSender,
+    LoadGenerator,
+    SyntheticCamera,
+    ZmqSender,
+    create_cameras,
+)
+
+
+def test_frames_are_deterministic():
+    a = SyntheticCamera("0", width=320, height=240, seed=7)
+    b = SyntheticCamera("0", width=320, height=240, seed=7)
+    c = SyntheticCamera("0", width=320, height=240, seed=8)
+    for i in (0, 5, 123):
+        assert np.array_equal(a.frame(i), b.frame(i))
+    assert not np.array_equal(a.frame(0), c.frame(0))
+    assert a.frame(3).shape == (240, 320, 3)
+
+
+def test_scenes():
+    moving = SyntheticCamera("0", width=320, height=240, seed=1)
+    assert not np.array_equal(moving.boxes(0), moving.boxes(10))
+    boxes = moving.boxes(1000)
+    assert (boxes[:, :2] >= 0).all()
+    assert (boxes[:, 2] <= 320).all() and (boxes[:, 3] <= 240).all()
+
+    static = SyntheticCamera("0", width=320, height=240, scene=SCENE_STATIC, seed=1)
+    assert np.array_equal(static.frame(0), static.frame(50))
+
+    burst = SyntheticCamera("0", width=320, height=240, scene=SCENE_BURST,
+                            seed=1, burst_period=10, burst_length=3)
+    assert len(burst.boxes(1)) == 5
+    assert len(burst.boxes(5)) == 0
+    assert len(burst.boxes(11)) == 5
+
+
+class _PredictHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        cam_id = parse_qs(urlparse(self.path).query)["camera_id"][0]
+        self.received.append((cam_id, len(body)))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_endpoint():
+    _PredictHandler.received = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PredictHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%s" % server.server_port
+    server.shutdown()
+
+
+def test_http_load(http_endpoint):
+    cameras = create_cameras(4, 1280, 720, 50, "moving_boxes", seed=3)
+    report = LoadGenerator(cameras, HttpSender(http_endpoint)).run(n_frames=10)
+    sent = sum(c["sent"] for c in report["cameras"].values())
+    assert sent == len(_PredictHandler.received) > 0
+    # 1280x720 is sent pre-resized to 960x540 raw BGR
+    assert {size for _, size in _PredictHandler.received} == {960 * 540 * 3}
+    assert set(report["cameras"]) == {"0", "1", "2", "3"}
+    assert all(c["sent"] + c["dropped"] == 10 for c in report["cameras"].values())
+
+
+class _StallingSender:
+    """Stalls on the first frame, as a camera falling far behind."""
+
+    def __init__(self, stall):
+        self.stall = stall
+        self.sent = 0
+
+    def send(self, cam_id, img):
+        if not self.sent:
+            time.sleep(self.stall)
+        self.sent += 1
+        return True
+
+
+def test_late_frames_stay_within_n_frames():
+    cameras = create_cameras(1, 320, 240, 100, "static", seed=0)
+    report = LoadGenerator(cameras, _StallingSender(0.5)).run(n_frames=10)
+    stats = report["cameras"]["0"]
+    assert stats["dropped"] > 0
+    assert stats["sent"] + stats["dropped"] == 10
+
+
+def test_latencies_are_bounded(monkeypatch):
+    monkeypatch.setattr(load_generator, "LATENCY_SAMPLES", 5)
+    cameras = create_cameras(1, 32, 24, 100, "static", seed=0)
+    generator = LoadGenerator(cameras, _StallingSender(0))
+    generator.run(n_frames=20)
+    assert len(generator.stats["0"]["latencies"]) == 5
+
+
+def test_zmq_load():
+    sender = ZmqSender("tcp://127.0.0.1:25556")
+    receiver = zmq.Context.instance().socket(zmq.SUB)
+    receiver.setsockopt(zmq.SUBSCRIBE, b"")
+    receiver.setsockopt(zmq.RCVTIMEO, 5000)
+    receiver.connect("tcp://127.0.0.1:25556")
+    # Give the subscription time to propagate, PUB drops until then
+    cam = SyntheticCamera("cam", width=960, height=540, fps=100, seed=0)
+    LoadGenerator([cam], sender).run(n_frames=20)
+    report = LoadGenerator([cam], sender).run(n_frames=5)
+    cam_id, data = receiver.recv_multipart()
+    receiver.close()
+    sender.close()
+    assert cam_id == b"cam"
+    assert len(data) == 960 * 540 * 3
+    assert report["cameras"]["cam"]["sent"] > 0
+
+
+class _FakeStream:
+    def __init__(self):
+        self.frames = 0
+        self.last_prediction = []
+
+    def predict(self, img):
+        self.frames += 1
+        self.last_prediction = [{
+            "tagName": "box", "probability": 0.9,
+            "boundingBox": {"left": 0.1, "top": 0.1, "width": 0.2, "height": 0.2},
+        }]
+
+
+class _FakeStreamManager:
+    def __init__(self):
+        self.streams = {}
+
+    def get_stream_by_id(self, cam_id):
+        return self.streams.setdefault(cam_id, _FakeStream())
+
+
+def test_grpc_load():
+    stream_manager = _FakeStreamManager()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    extension_pb2_grpc.add_MediaGraphExtensionServicer_to_server(
+        InferenceEngine(stream_manager), server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    try:
+        sender = GrpcSender("127.0.0.1:%s" % port)
+        cameras = create_cameras(2, 640, 360, 50, "moving_boxes", seed=5)
+        report = LoadGenerator(cameras, sender).run(n_frames=5)
+        sender.close()
+    finally:
+        server.stop(0)
+    for cam_id in ("0", "1"):
+        stats = report["cameras"][cam_id]
+        assert stream_manager.streams[cam_id].frames == stats["sent"] > 0
+        assert stats["sent"] + stats["dropped"] == 5
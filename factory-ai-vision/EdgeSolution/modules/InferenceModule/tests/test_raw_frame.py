@@ -0,0 +1,142 @@
+import cv2
+import numpy as np
+import pytest
+
+import extension_pb2
+import media_pb2
+from inference_engine import InferenceEngine, State
+from raw_frame import decode_raw_frame
+
+WIDTH = 1280
+HEIGHT = 720
+
+
+@pytest.fixture(scope="module")
+def bgr():
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (HEIGHT // 8, WIDTH // 8, 3), dtype=np.uint8)
+    return cv2.resize(img, (WIDTH, HEIGHT), interpolation=cv2.INTER_LINEAR)
+
+
+def pad_rows(plane, stride):
+    """Rows of `plane` followed by garbage up to `stride` bytes."""
+    rows = plane.reshape(plane.shape[0], -1)
+    padded = np.full((rows.shape[0], stride), 77, np.uint8)
+    padded[:, :rows.shape[1]] = rows
+    return padded
+
+
+def i420(bgr, stride=0):
+    yuv = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    if not stride:
+        return yuv.tobytes(), cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+    y = yuv[:HEIGHT]
+    chroma = yuv[HEIGHT:].reshape(-1, WIDTH // 2)
+    u, v = chroma[:HEIGHT // 2], chroma[HEIGHT // 2:]
+    raw = b"".join(pad_rows(p, s).tobytes()
+                   for p, s in ((y, stride), (u, stride // 2), (v, stride // 2)))
+    return raw, cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+
+
+def nv12(bgr, stride=0):
+    yuv = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    y = yuv[:HEIGHT]
+    chroma = yuv[HEIGHT:].reshape(-1, WIDTH // 2)
+    uv = np.dstack((chroma[:HEIGHT // 2], chroma[HEIGHT // 2:])).reshape(HEIGHT // 2, WIDTH)
+    reference = cv2.cvtColor(np.vstack((y, uv)), cv2.COLOR_YUV2BGR_NV12)
+    stride = stride or WIDTH
+    return pad_rows(y, stride).tobytes() + pad_rows(uv, stride).tobytes(), reference
+
+
+def packed(bgr, conversion, stride=0):
+    pixels = bgr if conversion is None else cv2.cvtColor(bgr, conversion)
+    if stride:
+        return pad_rows(pixels, stride).tobytes(), bgr
+    return pixels.tobytes(), bgr
+
+
+def argb(bgr, stride=0):
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    pixels = np.dstack((np.full((HEIGHT, WIDTH), 255, np.uint8), rgb))
+    return (pad_rows(pixels, stride) if stride else pixels).tobytes(), bgr
+
+
+def abgr(bgr, stride=0):
+    pixels = np.dstack((np.full((HEIGHT, WIDTH), 255, np.uint8), bgr))
+    return (pad_rows(pixels, stride) if stride else pixels).tobytes(), bgr
+
+
+ENCODERS = {
+    "BGR24": lambda img, stride: packed(img, None, stride),
+    "RGB24": lambda img, stride: packed(img, cv2.COLOR_BGR2RGB, stride),
+    "BGRA": lambda img, stride: packed(img, cv2.COLOR_BGR2BGRA, stride),
+    "RGBA": lambda img, stride: packed(img, cv2.COLOR_BGR2RGBA, stride),
+    "ARGB": argb,
+    "ABGR": abgr,
+    "YUV420P": i420,
+    "NV12": nv12,
+}
+STRIDES = {"BGR24": 3 * WIDTH + 64, "RGB24": 3 * WIDTH + 64, "BGRA": 4 * WIDTH + 64,
+           "RGBA": 4 * WIDTH + 64, "ARGB": 4 * WIDTH + 64, "ABGR": 4 * WIDTH + 64,
+           "YUV420P": WIDTH + 64, "NV12": WIDTH + 64}
+
+
+@pytest.mark.parametrize("padded", [False, True], ids=["packed", "stride"])
+@pytest.mark.parametrize("pixel_format", sorted(ENCODERS))
+def test_matches_reference_conversion(bgr, pixel_format, padded):
+    stride = STRIDES[pixel_format] if padded else 0
+    raw, reference = ENCODERS[pixel_format](bgr, stride)
+    img = decode_raw_frame(raw, pixel_format, WIDTH, HEIGHT, stride)
+    assert img.shape == (HEIGHT, WIDTH, 3)
+    assert np.array_equal(img, reference)
+    # Streams resize and draw on it
+    assert cv2.resize(img, (960, 540)).shape == (540, 960, 3)
+
+
+@pytest.mark.parametrize("pixel_format", ["BGR24", "BGRA", "ABGR"])
+def test_bgr_layouts_are_zero_copy(bgr, pixel_format):
+    raw, _ = ENCODERS[pixel_format](bgr, STRIDES[pixel_format])
+    buffer = np.frombuffer(raw, np.uint8)
+    img = decode_raw_frame(memoryview(raw).toreadonly(), pixel_format,
+                           WIDTH, HEIGHT, STRIDES[pixel_format])
+    assert np.shares_memory(img, buffer)
+    assert not img.flags.writeable
+
+
+def test_invalid_frames_are_rejected(bgr):
+    raw, _ = i420(bgr)
+    assert decode_raw_frame(raw[:-1], "YUV420P", WIDTH, HEIGHT) is None
+    assert decode_raw_frame(raw, "RGB565LE", WIDTH, HEIGHT) is None
+    assert decode_raw_frame(raw, "YUV420P", WIDTH - 1, HEIGHT) is None
+
+
+def state(pixel_format, width, height, stride=0):
+    return State(extension_pb2.MediaStreamDescriptor(
+        media_descriptor=media_pb2.MediaDescriptor(
+            timescale=90000,
+            video_frame_sample_format=media_pb2.VideoFrameSampleFormat(
+                encoding=media_pb2.VideoFrameSampleFormat.Encoding.RAW,
+                pixel_format=media_pb2.VideoFrameSampleFormat.PixelFormat.Value(pixel_format),
+                dimensions=media_pb2.Dimensions(width=width, height=height),
+                stride_bytes=stride,
+            ),
+        ),
+    ))
+
+
+@pytest.mark.parametrize("pixel_format", ["BGR24", "RGB24", "YUV420P"])
+def test_engine_reads_descriptor(bgr, pixel_format):
+    stride = STRIDES[pixel_format]
+    raw, reference = ENCODERS[pixel_format](bgr, stride)
+    sample = extension_pb2.MediaSample(content_bytes=media_pb2.ContentBytes(bytes=raw))
+    img = InferenceEngine(None).GetCvImageFromRawBytes(
+        state(pixel_format, WIDTH, HEIGHT, stride), sample)
+    assert np.array_equal(img, reference)
+
+
+def test_engine_defaults_to_stream_size():
+    img = np.zeros((540, 960, 3), np.uint8)
+    sample = extension_pb2.MediaSample(
+        content_bytes=media_pb2.ContentBytes(bytes=img.tobytes()))
+    decoded = InferenceEngine(None).GetCvImageFromRawBytes(state("BGR24", 0, 0), sample)
+    assert decoded.shape == (540, 960, 3)
@@ -0,0 +1,124 @@
+import time
+
+import numpy as np
+import pytest
+
+from scenarios import DangerZone, DefeatDetection, Detection
+from tracker import Rect, bb_intersection_over_union, bb_iou_matrix, is_inside_rects
+
+
+def random_boxes(rng, n, size=960, integer=True):
+    xy = rng.uniform(0, size, (n, 2))
+    wh = rng.uniform(5, 120, (n, 2))
+    boxes = np.hstack((xy, xy + wh))
+    return np.round(boxes) if integer else boxes
+
+
+def random_detections(rng, n, tags=("ok", "ng")):
+    boxes = random_boxes(rng, n)
+    # Neighbours overlap often, like duplicate ok / ng boxes of one part
+    boxes[1::2] = boxes[::2][:n // 2] + rng.randint(-8, 9, (n // 2, 4))
+    return [Detection(tags[rng.randint(len(tags))], *box.tolist(), rng.rand())
+            for box in boxes]
+
+
+def reference_remove_overlaps(detections):
+    """DefeatDetection's pairwise loop before the batched version."""
+    detections = list(detections)
+    found = True
+    while found:
+        found = False
+        if len(detections) < 2:
+            break
+        for i in range(len(detections) - 1):
+            box1 = [detections[i].x1, detections[i].y1, detections[i].x2, detections[i].y2]
+            box2 = [detections[i + 1].x1, detections[i + 1].y1,
+                    detections[i + 1].x2, detections[i + 1].y2]
+            if bb_intersection_over_union(box1, box2) > 0.3:
+                if detections[i].score < detections[i + 1].score:
+                    del detections[i]
+                else:
+                    del detections[i + 1]
+                Found = True  # sic: one pair per frame
+                break
+    return detections
+
+
+def reference_match_detections(objs, detections, ok_name):
+    labels = []
+    for obj in objs:
+        tag, score = ok_name, 0.0
+        for d in detections:
+            if bb_intersection_over_union(obj[:4], [d.x1, d.y1, d.x2, d.y2]) > 0.3:
+                tag, score = d.tag, d.score
+                break
+        labels.append((tag, score))
+    return labels
+
+
+@pytest.mark.parametrize("integer", [True, False], ids=["int", "float"])
+@pytest.mark.parametrize("seed", range(5))
+def test_iou_matrix_matches_scalar(seed, integer):
+    rng = np.random.RandomState(seed)
+    a, b = random_boxes(rng, 40, integer=integer), random_boxes(rng, 30, integer=integer)
+    matrix = bb_iou_matrix(a, b)
+    expected = [[bb_intersection_over_union(x, y) for y in b] for x in a]
+    assert np.array_equal(matrix, expected)
+    assert bb_iou_matrix(a, []).shape == (40, 0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_zone_tests_match_rect(seed):
+    rng = np.random.RandomState(seed)
+    boxes = random_boxes(rng, 200)
+    zones = [Rect(*box) for box in random_boxes(rng, 25, integer=False)]
+    inside = is_inside_rects(boxes, zones)
+    expected = [[zone.is_inside(*box) for zone in zones] for box in boxes]
+    assert np.array_equal(inside, expected)
+
+    danger = DangerZone()
+    danger.zones = zones
+    for box, row in zip(boxes[:20], expected):
+        assert danger.is_inside_zones(*box) == any(row)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_defect_overlaps_and_labels_match_loops(seed):
+    rng = np.random.RandomState(seed)
+    defect = DefeatDetection()
+    detections = random_detections(rng, 120)
+    assert defect.remove_overlaps(list(detections)) == reference_remove_overlaps(detections)
+    objs = np.hstack((random_boxes(rng, 60), np.arange(60)[:, None]))
+    objs[:30, :4] = [[d.x1 + 2, d.y1, d.x2, d.y2 - 2] for d in detections[:30]]
+    assert defect.match_detections(objs, detections) == \
+        reference_match_detections(objs, detections, defect.ok_name)
+    assert defect.match_detections([], detections) == []
+    assert defect.match_detections(objs, []) == [("ok", 0.0)] * 60
+
+
+def test_dense_frames_benchmark():
+    """Batched vs pairwise scenario checks on a dense frame."""
+    rng = np.random.RandomState(0)
+    detections = random_detections(rng, 200)
+    objs = np.hstack((random_boxes(rng, 150), np.arange(150)[:, None]))
+    zones = [Rect(*box) for box in random_boxes(rng, 50)]
+    defect = DefeatDetection()
+
+    def timed(fn, repeat=5):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        return (time.perf_counter() - t0) / repeat, result
+
+    loop_time, expected = timed(
+        lambda: reference_match_detections(objs, detections, "ok"))
+    batch_time, labels = timed(lambda: defect.match_detections(objs, detections))
+    assert labels == expected
+    zone_loop, expected = timed(
+        lambda: [[z.is_inside(*box) for z in zones] for box in objs[:, :4]])
+    zone_batch, inside = timed(lambda: is_inside_rects(objs[:, :4], zones))
+    assert np.array_equal(inside, expected)
+    print("labels: %.2f ms -> %.2f ms, zones: %.2f ms -> %.2f ms" % (
+        loop_time * 1000, batch_time * 1000, zone_loop * 1000, zone_batch * 1000))
+    assert batch_time < loop_time / 5
+    assert zone_batch < zone_loop / 5
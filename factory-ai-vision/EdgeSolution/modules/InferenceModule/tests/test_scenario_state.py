@@ -0,0 +1,128 @@
+import time
+import tracemalloc
+
+import pytest
+
+from scenarios import DangerZone, DefeatDetection, Detection, PartCounter, TrackStates
+
+FPS = 10
+LANES = 5
+PERIOD = 4  # frames between two new parts
+LIFE = 24  # frames a part is visible
+SPEED = 10  # px per frame
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def conveyor(n_parts, tag="box"):
+    """Detections per frame of `n_parts` parts crossing x = 120."""
+    for frame in range(n_parts * PERIOD + LIFE):
+        detections = []
+        first = max(0, (frame - LIFE) // PERIOD + 1)
+        for part in range(first, min(frame // PERIOD + 1, n_parts)):
+            age = frame - part * PERIOD
+            if age >= LIFE:
+                continue
+            x = age * SPEED
+            y = (part % LANES) * 100
+            detections.append(Detection(tag, x, y, x + 40, y + 40, 0.9))
+        yield detections
+
+
+def test_ended_tracks_are_evicted_after_grace():
+    clock = FakeClock()
+    states = TrackStates(grace=10, clock=clock)
+    states[1] = {"xc": 0}
+    states[2] = {"xc": 0}
+    states.end([1, 3])
+    clock.now = 9.9
+    states.evict()
+    assert set(states) == {1, 2}
+    clock.now = 10
+    states.evict()
+    assert set(states) == {2}
+    assert states.evicted == 1
+
+
+def test_soak_a_million_tracks_stays_flat():
+    clock = FakeClock()
+    states = TrackStates(grace=1, clock=clock)
+    tracemalloc.start()
+    try:
+        sizes = []
+        for oid in range(1000000):
+            states[oid] = {"xc": 0, "yc": 0, "expired": {}}
+            if oid >= 50:
+                # Tracks live for 50 frames
+                states.end([oid - 50])
+            clock.now += 0.01
+            if oid % 250000 == 249999:
+                sizes.append((len(states), tracemalloc.get_traced_memory()[0]))
+    finally:
+        tracemalloc.stop()
+    assert all(n <= 50 + 101 for n, _ in sizes)
+    first_memory = sizes[0][1]
+    assert all(memory < first_memory * 1.1 + 100000 for _, memory in sizes)
+    assert states.evicted > 990000
+
+
+def make_counter(clock):
+    counter = PartCounter(min_hits=2)
+    counter.set_line([[120, 0, 120, 1000, "0"]])
+    counter.detected.clock = clock
+    return counter
+
+
+def make_zone(clock):
+    zone = DangerZone(min_hits=2)
+    zone.set_targets(["box"])
+    zone.set_zones([[120, 0, 180, 1000, "0"]])
+    zone.detected.clock = clock
+    return zone
+
+
+def make_defect(clock):
+    defect = DefeatDetection()
+    defect.set_ok("box")
+    defect.set_line(120, 0, 120, 1000)
+    defect.detected.clock = clock
+    return defect
+
+
+def count(scenario):
+    if isinstance(scenario, DefeatDetection):
+        return scenario.ok_counter
+    return scenario.counter["0"]
+
+
+@pytest.mark.parametrize("make", [make_counter, make_zone, make_defect],
+                         ids=["counter", "zone", "defect"])
+def test_soak_scenario_state_is_bounded(make):
+    """Ten simulated minutes of a busy line at 10 fps."""
+    clock = FakeClock()
+    scenario = make(clock)
+    n_parts = 1500
+    sizes, timings = [], []
+    t0 = time.perf_counter()
+    for frame, detections in enumerate(conveyor(n_parts)):
+        clock.now = frame / FPS
+        scenario.update(detections)
+        if frame % 1000 == 999:
+            sizes.append(len(scenario.detected))
+            timings.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+
+    # Every part is counted once and only the recent tracks are kept
+    assert count(scenario) == n_parts
+    live = LIFE // PERIOD + 1
+    grace_tracks = scenario.detected.grace * FPS // PERIOD + 1
+    assert max(sizes) <= live + grace_tracks + 5
+    assert scenario.get_structure_sizes()["live_tracks"] <= live + 5
+    # Per frame cost does not grow with the tracks seen so far
+    assert timings[-1] < 2 * timings[0] + 0.05
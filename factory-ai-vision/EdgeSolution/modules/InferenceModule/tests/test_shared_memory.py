@@ -0,0 +1,23 @@
+import os
+import uuid
+
+from shared_memory import SharedMemoryManager
+
+SIZE = 1024 * 1024
+
+
+def test_manager_on_dev_shm():
+    name = "test-{}".format(uuid.uuid4().hex)
+    manager = SharedMemoryManager(os.O_RDWR | os.O_CREAT, name, SIZE)
+    frame = None
+    try:
+        # LVA writes the frame, the extension reads it in place
+        manager._shm[4096:5096] = b"x" * 1000
+        frame = manager.ReadBytes(4096, 1000)
+        assert bytes(frame) == b"x" * 1000
+        assert frame.readonly
+    finally:
+        # The view must go before the mapping is closed
+        frame = None
+        del manager
+        os.remove(os.path.join("/dev/shm", name))
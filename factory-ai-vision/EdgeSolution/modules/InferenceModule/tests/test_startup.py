@@ -0,0 +1,256 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi.testclient import TestClient
+
+import model_object
+from model_object import CPU_MAX_FRAME_RATE, GPU_MAX_FRAME_RATE, ModelObject
+from startup import StartupTimeline
+
+
+@pytest.fixture
+def predict_module(monkeypatch):
+    """Minimal PredictModule answering /get_device."""
+    state = {"device": "GPU", "quantization": None, "requests": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["requests"] += 1
+            body = json.dumps({"device": state["device"],
+                               "quantization": state["quantization"]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(model_object, "predict_module_url",
+                        lambda: "127.0.0.1:{}".format(httpd.server_port))
+    yield state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def no_predict_module(monkeypatch):
+    monkeypatch.setattr(model_object, "predict_module_url",
+                        lambda: "127.0.0.1:9")
+
+
+def test_timeline_records_phases_and_events():
+    timeline = StartupTimeline(t0=time.time())
+    with timeline.phase("load"):
+        time.sleep(0.05)
+    with pytest.raises(RuntimeError):
+        with timeline.phase("broken"):
+            raise RuntimeError("boom")
+    timeline.mark("first_inference")
+    timeline.mark("first_inference")
+
+    status = timeline.to_dict()
+    load, broken = status["phases"]
+    assert load["name"] == "load" and load["duration"] >= 0.05
+    assert broken["error"] == "boom"
+    assert list(status["events"]) == ["first_inference"]
+    assert timeline.wait_phase("load", 0)
+    assert not timeline.wait_phase("never", 0)
+
+
+def test_run_in_background_sets_ready():
+    timeline = StartupTimeline(t0=time.time())
+    gate = threading.Event()
+
+    def _startup():
+        with timeline.phase("slow"):
+            gate.wait(5)
+
+    timeline.run_in_background(_startup)
+    assert not timeline.is_ready()
+    gate.set()
+    assert timeline.wait_ready(5)
+    assert "ready" in timeline.to_dict()["events"]
+
+
+def test_run_in_background_keeps_error():
+    timeline = StartupTimeline(t0=time.time())
+
+    def _startup():
+        raise ValueError("no topology")
+
+    timeline.run_in_background(_startup).join(5)
+    assert not timeline.is_ready()
+    assert timeline.to_dict()["error"] == "no topology"
+
+
+def test_model_object_does_not_block_without_predict_module(no_predict_module):
+    t0 = time.time()
+    model = ModelObject()
+    assert model.get_device(block=False) == "cpu"
+    assert not model.is_gpu
+    assert time.time() - t0 < 3
+    # Not cached, PredictModule may still come up
+    assert model.device is None
+
+
+def test_model_object_caches_device(predict_module):
+    model = ModelObject()
+    # Until the startup device phase resolves it
+    assert model.get_device(block=False) == "cpu"
+    assert not model.is_gpu and not model.is_vpu
+    assert predict_module["requests"] == 0
+    assert model.get_device() == "gpu"
+    assert model.is_gpu
+    assert model.get_recommended_total_frame_rate() == GPU_MAX_FRAME_RATE
+    assert predict_module["requests"] == 1
+
+
+def test_benchmark_result_overrides_device_default(predict_module):
+    model = ModelObject()
+    model.set_max_total_frame_rate(7)
+    model.get_device()
+    assert model.get_recommended_total_frame_rate() == 7
+    assert CPU_MAX_FRAME_RATE != 7
+
+
+def test_model_object_caches_quantization(predict_module):
+    model = ModelObject()
+    assert model.refresh_quantization() is None
+    assert model.device == "gpu"
+    predict_module["quantization"] = {"variant": "int8", "speedup": 1.7}
+    assert model.get_quantization() is None
+    assert predict_module["requests"] == 1
+    assert model.refresh_quantization()["variant"] == "int8"
+    assert model.get_quantization()["variant"] == "int8"
+
+
+def test_model_object_quantization_without_predict_module(no_predict_module):
+    model = ModelObject()
+    model.set_quantization({"variant": "fp32"})
+    assert model.refresh_quantization() == {"variant": "fp32"}
+
+
+@pytest.fixture(scope="module")
+def server():
+    import server
+
+    return server
+
+
+def test_benchmark_cache(server, tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "labels.txt").write_text("box\n")
+    key = server.benchmark_cache_key(str(model_dir), "cpu")
+    assert key == server.benchmark_cache_key(str(model_dir), "cpu")
+    assert key != server.benchmark_cache_key(str(model_dir), "gpu")
+
+    path = str(tmp_path / "benchmark.json")
+    assert server.load_cached_benchmark(key, path) is None
+    server.save_cached_benchmark(key, 12.5, path)
+    assert server.load_cached_benchmark(key, path) == 12.5
+
+    (model_dir / "labels.txt").write_text("box\nbolt\n")
+    new_key = server.benchmark_cache_key(str(model_dir), "cpu")
+    assert server.load_cached_benchmark(new_key, path) is None
+
+
+def test_benchmark_uses_cache(server, monkeypatch, tmp_path):
+    path = str(tmp_path / "benchmark.json")
+    monkeypatch.setattr(server.onnx, "device", "cpu")
+    monkeypatch.setattr(server, "BENCHMARK_CACHE", path)
+    key = server.benchmark_cache_key("scenario_models/1", "cpu")
+    server.save_cached_benchmark(key, 17)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("benchmark should not run")
+
+    monkeypatch.setattr(server.requests, "post", _fail)
+    server.benchmark()
+    assert server.onnx.get_recommended_total_frame_rate() == 17
+
+
+def test_benchmark_holds_deployments_and_restores_model(server, monkeypatch):
+    monkeypatch.setattr(server, "BENCHMARK_CACHE", "")
+    monkeypatch.setattr(server.onnx, "device", "cpu")
+    monkeypatch.setattr(server.onnx, "is_scenario", False)
+    monkeypatch.setattr(server.onnx, "model_uri", "https://export/deployed")
+    posts = []
+    monkeypatch.setattr(server.requests, "post",
+                        lambda url, json: posts.append(json))
+    started, gate = threading.Event(), threading.Event()
+
+    def _run_benchmark(model_dir, *args):
+        server.onnx.set_is_scenario(True)
+        posts.append({"model_dir": model_dir})
+        started.set()
+        gate.wait(5)
+        return 12
+
+    monkeypatch.setattr(server, "run_benchmark", _run_benchmark)
+    benchmark = threading.Thread(target=server.benchmark)
+    benchmark.start()
+    assert started.wait(5)
+    deploy = threading.Thread(target=server.update_model, args=(
+        server.UploadModelBody(model_uri="https://export/new"),))
+    deploy.start()
+    deploy.join(0.2)
+    assert deploy.is_alive()
+    gate.set()
+    benchmark.join(5)
+    deploy.join(5)
+
+    assert posts == [
+        {"model_dir": "scenario_models/1"},
+        {"model_uri": "https://export/deployed"},
+        {"model_uri": "https://export/new"},
+    ]
+    assert not server.onnx.is_scenario
+    assert server.onnx.get_recommended_total_frame_rate() == 12
+
+
+def test_get_device_serves_pushed_quantization(server, predict_module,
+                                               monkeypatch):
+    monkeypatch.setattr(server.onnx, "device", "cpu")
+    monkeypatch.setattr(server.onnx, "quantization", None)
+    client = TestClient(server.app)
+    client.post("/update_quantization", json={"variant": "int8"})
+    for _ in range(3):
+        assert client.get("/get_device").json() == {
+            "device": "cpu", "quantization": {"variant": "int8"}}
+    assert predict_module["requests"] == 0
+
+
+def test_health_answers_before_startup_finishes(server, monkeypatch):
+    timeline = StartupTimeline()
+    monkeypatch.setattr(server, "timeline", timeline)
+    gate = threading.Event()
+
+    def _startup():
+        with timeline.phase("init_topology"):
+            gate.wait(10)
+        with timeline.phase("benchmark"):
+            pass
+
+    with TestClient(server.app) as client:
+        timeline.run_in_background(_startup)
+        t0 = time.time()
+        status = client.get("/health").json()
+        time_to_health = time.time() - t0
+        device = client.get("/get_device").json()["device"]
+        gate.set()
+        assert timeline.wait_ready(5)
+        ready = client.get("/health").json()
+
+    assert time_to_health < 1
+    assert not status["ready"]
+    assert device in ("cpu", "gpu", "vpu")
+    assert ready["ready"]
+    assert [p["name"] for p in ready["phases"]] == ["init_topology", "benchmark"]
+    assert ready["events"]["http_ready"] <= ready["events"]["ready"]
@@ -0,0 +1,149 @@
+import pytest
+import requests
+from fastapi.testclient import TestClient
+
+HANDLERS = [
+    "update_part_detection_id",
+    "update_part_detection_mode",
+    "update_endpoint",
+    "update_model",
+    "update_parts",
+    "update_cams",
+    "update_retrain_parameters",
+    "update_iothub_parameters",
+    "update_prob_threshold",
+]
+
+CONFIG = {
+    "part_detection_id": 1,
+    "part_detection_mode": "PD",
+    "endpoint": {"endpoint": "predictmodule:7777"},
+    "model": {"model_uri": "https://export/onnx", "model_uri_fp16": "https://export/fp16"},
+    "parts": {"parts": [{"id": "1", "name": "bolt"}]},
+    "cams": {"lva_mode": "grpc", "fps": 10, "cameras": []},
+    "retrain": {"is_retrain": True, "confidence_min": 30, "confidence_max": 80,
+                "max_images": 10},
+    "iothub": {"is_send": False, "threshold": 50, "fpm": 6},
+    "prob_threshold": 60,
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import server
+
+    calls = []
+    for name in HANDLERS:
+        def _handler(*args, name=name):
+            calls.append((name, args))
+            return "ok"
+        monkeypatch.setattr(server, name, _handler)
+    predict_module = {"id": "predict.0"}
+    monkeypatch.setattr(server, "predict_module_id", lambda: predict_module["id"])
+    client = TestClient(server.app)
+    client.calls = calls
+    client.predict_module = predict_module
+    client.server = server
+    return client
+
+
+def test_update_config_applies_sections_in_order(client):
+    res = client.post("/update_config", json=CONFIG).json()
+    assert res["boot_id"] == client.server.BOOT_ID + "-predict.0"
+    assert res["applied"] == list(CONFIG)
+    assert [name for name, _ in client.calls] == HANDLERS
+    calls = dict(client.calls)
+    assert calls["update_retrain_parameters"] == (True, 30, 80, 10)
+    assert calls["update_model"][0].model_uri == "https://export/onnx"
+
+
+def test_update_config_sends_fp16_model_to_vpu(client, monkeypatch):
+    monkeypatch.setattr(client.server.onnx, "get_device", lambda block=True: "vpu")
+    client.post("/update_config", json={"model": CONFIG["model"]})
+    (name, (model,)), = client.calls
+    assert model.model_uri == "https://export/fp16"
+
+
+def test_update_config_applies_only_sections_sent(client):
+    boot_id = client.server.deploy_id()
+    res = client.post("/update_config", json={"boot_id": boot_id, "prob_threshold": 70})
+    assert res.json() == {"boot_id": boot_id, "applied": ["prob_threshold"],
+                          "failed": {}}
+    assert client.calls == [("update_prob_threshold", (70,))]
+
+
+def test_update_config_refuses_diff_against_another_run(client):
+    res = client.post("/update_config", json={"boot_id": "old", "prob_threshold": 70})
+    assert res.status_code == 409
+    assert res.json()["boot_id"] == client.server.deploy_id()
+    assert client.calls == []
+
+
+def test_update_config_refuses_diff_against_another_predict_module(client):
+    boot_id = client.server.deploy_id()
+    # PredictModule restarted, or failed to download the model
+    client.predict_module["id"] = "predict.1"
+    res = client.post("/update_config", json={"boot_id": boot_id, "prob_threshold": 70})
+    assert res.status_code == 409
+    assert res.json()["boot_id"] == client.server.BOOT_ID + "-predict.1"
+    assert client.calls == []
+
+
+def test_update_config_reports_failed_sections(client, monkeypatch):
+    monkeypatch.setattr(client.server, "update_model",
+                        lambda model: ("Already downloading model", 400))
+
+    def _broken(parts):
+        raise ValueError("bad parts")
+
+    monkeypatch.setattr(client.server, "update_parts", _broken)
+    res = client.post("/update_config", json=CONFIG).json()
+    assert res["failed"] == {"model": "Already downloading model",
+                             "parts": "ValueError('bad parts')"}
+    assert res["applied"] == [section for section in CONFIG
+                              if section not in ("model", "parts")]
+
+
+class FakePredictResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+@pytest.mark.parametrize("answer, error", [
+    (FakePredictResponse(200, ["Already downloading model", 400]),
+     "PredictModule: Already downloading model"),
+    (FakePredictResponse(500, "Internal Server Error"), "PredictModule answered 500"),
+    (requests.exceptions.ConnectionError("refused"), "PredictModule unreachable"),
+])
+def test_update_config_reports_predict_module_errors(monkeypatch, answer, error):
+    import server
+
+    def _post(url, json=None, **kwargs):
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(server.requests, "post", _post)
+    monkeypatch.setattr(server, "predict_module_id", lambda: "predict.0")
+    res = TestClient(server.app).post(
+        "/update_config", json={"model": {"model_uri": "https://export/onnx"}})
+    assert res.json()["applied"] == []
+    assert res.json()["failed"]["model"].startswith(error)
+
+
+def test_predict_module_id(monkeypatch):
+    import server
+
+    monkeypatch.setattr(server.requests, "get", lambda url, timeout: FakePredictResponse(
+        200, {"boot_id": "abc", "model_failures": 2, "ready": True}))
+    assert server.predict_module_id() == "abc.2"
+
+    def _down(url, timeout):
+        raise requests.exceptions.ConnectionError("refused")
+
+    monkeypatch.setattr(server.requests, "get", _down)
+    assert server.predict_module_id() == ""
@@ -16,6 +16,9 @@ class Tracker():
         self.tracker = Sort(
             max_age=max_age, min_hits=min_hits, iou_threshold=0.3)
         self.objs = []
+        # Ids of the live tracklets, and of the ones the last update ended
+        self.live_ids = set()
+        self.ended_ids = []
 
     def update(self, detections):
         #_detections = list([d.x1, d.x2, d.y1, d.y2, d.score] for d in detections)
@@ -23,11 +26,138 @@ class Tracker():
             self.objs = self.tracker.update(np.array(detections))
         else:
             self.objs = self.tracker.update(np.empty((0, 5)))
+        # Same ids as the objs: +1 as MOT benchmark requires positive
+        live_ids = {trk.id + 1 for trk in self.tracker.trackers}
+        self.ended_ids = list(self.live_ids - live_ids)
+        self.live_ids = live_ids
 
     def get_objs(self):
         return self.objs
 
 
+class ClassTracker():
+    """ClassTracker.
+
+    One SORT tracker for many parts. Detections only associate with
+    tracks of a compatible part: the same part, or another part of the
+    same switch group. A track takes the part of its detections once it
+    was detected as that part `switch_hits` frames in a row.
+    """
+
+    def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3,
+                 switch_groups=(), switch_hits=3):
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.iou_threshold = iou_threshold
+        self.switch_hits = switch_hits
+        self.trackers = []
+        self.frame_count = 0
+        self.objs = np.empty((0, 5))
+        self.obj_labels = []
+        self.live_ids = set()
+        self.ended_ids = []
+        self.set_switch_groups(switch_groups)
+
+    def set_switch_groups(self, switch_groups):
+        # Parts of a group share a key, the others are their own key
+        self.group_keys = {}
+        for i, group in enumerate(switch_groups or ()):
+            for label in group:
+                self.group_keys[label] = ('group', i)
+
+    def compatibility(self, det_labels, trk_labels):
+        """Detections x tracks mask of the parts allowed to associate."""
+        keys = [self.group_keys.get(label, label)
+                for label in list(det_labels) + list(trk_labels)]
+        index = {}
+        codes = np.array([index.setdefault(key, len(index)) for key in keys],
+                         dtype=np.int64)
+        det_codes, trk_codes = codes[:len(det_labels)], codes[len(det_labels):]
+        return det_codes[:, None] == trk_codes[None, :]
+
+    def associate(self, dets, trks, det_labels, trk_labels):
+        """associate_detections_to_trackers on a class gated IoU matrix."""
+        if len(trks) == 0 or len(dets) == 0:
+            return (np.empty((0, 2), dtype=int), np.arange(len(dets)),
+                    np.arange(len(trks)))
+        iou_matrix = np.where(self.compatibility(det_labels, trk_labels),
+                              iou_batch(dets, trks), 0.)
+        a = (iou_matrix > self.iou_threshold).astype(np.int32)
+        if a.sum(1).max() == 1 and a.sum(0).max() == 1:
+            matched = np.stack(np.where(a), axis=1)
+        else:
+            matched = linear_assignment(-iou_matrix).reshape(-1, 2)
+        # filter out matched with low IOU
+        matched = matched[iou_matrix[matched[:, 0], matched[:, 1]] >= self.iou_threshold]
+        unmatched_dets = np.setdiff1d(np.arange(len(dets)), matched[:, 0])
+        unmatched_trks = np.setdiff1d(np.arange(len(trks)), matched[:, 1])
+        return matched, unmatched_dets, unmatched_trks
+
+    def _relabel(self, trk, label):
+        if label == trk.label:
+            trk.switch_label, trk.switch_count = None, 0
+            return
+        if label == trk.switch_label:
+            trk.switch_count += 1
+        else:
+            trk.switch_label, trk.switch_count = label, 1
+        if trk.switch_count >= self.switch_hits:
+            trk.label, trk.switch_label, trk.switch_count = label, None, 0
+
+    def update(self, detections, labels):
+        """update.
+
+        `detections` are [x1, y1, x2, y2, score] lists, `labels` their part
+        names. Same steps as Sort.update, in a single association pass.
+        """
+        dets = np.array(detections, dtype=np.float64).reshape(-1, 5)
+        self.frame_count += 1
+        # get predicted locations from existing trackers.
+        trks = np.zeros((len(self.trackers), 4))
+        for t, trk in enumerate(self.trackers):
+            trks[t] = trk.predict()[0][:4]
+        valid = ~np.any(np.isnan(trks), axis=1)
+        self.trackers = [trk for trk, ok in zip(self.trackers, valid) if ok]
+        trks = trks[valid]
+        matched, unmatched_dets, _ = self.associate(
+            dets, trks, labels, [trk.label for trk in self.trackers])
+
+        # update matched trackers with assigned detections
+        for d, t in matched:
+            self.trackers[t].update(dets[d, :])
+            self._relabel(self.trackers[t], labels[d])
+
+        # create and initialise new trackers for unmatched detections
+        for d in unmatched_dets:
+            trk = KalmanBoxTracker(dets[d, :])
+            trk.label, trk.switch_label, trk.switch_count = labels[d], None, 0
+            self.trackers.append(trk)
+
+        objs, obj_labels, live = [], [], []
+        for trk in reversed(self.trackers):
+            if trk.time_since_update < 1 and (
+                    trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
+                # +1 as MOT benchmark requires positive
+                objs.append(np.concatenate((trk.get_state()[0], [trk.id + 1])))
+                obj_labels.append(trk.label)
+            # remove dead tracklet
+            if trk.time_since_update <= self.max_age:
+                live.append(trk)
+        self.trackers = live[::-1]
+        self.objs = np.array(objs).reshape(-1, 5)
+        self.obj_labels = obj_labels
+
+        live_ids = {trk.id + 1 for trk in self.trackers}
+        self.ended_ids = list(self.live_ids - live_ids)
+        self.live_ids = live_ids
+
+    def get_objs(self):
+        return self.objs
+
+    def get_labels(self):
+        return self.obj_labels
+
+
 class Line():
     def __init__(self, x1, y1, x2, y2):
         self.id = None
@@ -76,6 +206,34 @@ def bb_intersection_over_union(boxA, boxB):
     return iou
 
 
+def bb_iou_batch(boxesA, boxesB):
+    """bb_iou_batch.
+
+    bb_intersection_over_union of (..., 4) box arrays, broadcast against
+    each other: `bb_iou_batch(a[:, None], b[None])` is the IoU matrix.
+    """
+    boxesA = np.asarray(boxesA, dtype=np.float64)
+    boxesB = np.asarray(boxesB, dtype=np.float64)
+    xA = np.maximum(boxesA[..., 0], boxesB[..., 0])
+    yA = np.maximum(boxesA[..., 1], boxesB[..., 1])
+    xB = np.minimum(boxesA[..., 2], boxesB[..., 2])
+    yB = np.minimum(boxesA[..., 3], boxesB[..., 3])
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+    boxAArea = (boxesA[..., 2] - boxesA[..., 0] + 1) * \
+        (boxesA[..., 3] - boxesA[..., 1] + 1)
+    boxBArea = (boxesB[..., 2] - boxesB[..., 0] + 1) * \
+        (boxesB[..., 3] - boxesB[..., 1] + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return interArea / (boxAArea + boxBArea - interArea)
+
+
+def bb_iou_matrix(boxesA, boxesB):
+    """IoU of every box in `boxesA` with every box in `boxesB`."""
+    boxesA = np.asarray(boxesA, dtype=np.float64).reshape(-1, 4)
+    boxesB = np.asarray(boxesB, dtype=np.float64).reshape(-1, 4)
+    return bb_iou_batch(boxesA[:, None], boxesB[None])
+
+
 class Rect():
     def __init__(self, x1, y1, x2, y2):
         self.id = None
@@ -92,6 +250,14 @@ class Rect():
         else:
             return False
 
+    def box(self):
+        return [self.x1, self.y1, self.x2, self.y2]
+
+
+def is_inside_rects(boxes, rects):
+    """Rect.is_inside of every box in every rect, a boxes x rects matrix."""
+    return bb_iou_matrix(boxes, [rect.box() for rect in rects]) > 0.000001
+
 
 def draw_counter(img, counter):
     font = cv2.FONT_HERSHEY_SIMPLEX
@@ -17,6 +17,17 @@ from shapely.geometry import Polygon
 from exception_handler import PrintGetExceptionDetails
 from object_detection import ObjectDetection
 from onnxruntime_predict import ONNXRuntimeObjectDetection
+from quantization import (
+    INT8_MODEL_FILENAME,
+    QUANTIZATION,
+    QUANTIZATION_NONE,
+    load_calibration_images,
+    load_report,
+    quantize_if_better,
+    save_report,
+)
+from startup import timeline
+from tiling import TiledInference
 from utility import get_file_zip, normalize_rtsp
 
 IMG_WIDTH = 960
@@ -40,8 +51,15 @@ class ONNXRuntimeModelDeploy(ObjectDetection):
         #    model_dir, is_default_model=True, is_scenario_model=False
         # )
         self.model = None
+        self.model_dir = None
         self.model_uri = None
+        self.quantization = {"mode": QUANTIZATION, "variant": "fp32"}
+        self.tiling = TiledInference()
+        # Called with (model_dir, quantization) when the served model changes
+        self.model_listeners = []
         self.model_downloading = False
+        # Failed downloads, InferenceModule sends the model again after one
+        self.model_failures = 0
         self.lva_mode = LVA_MODE
 
         self.image_shape = [IMG_HEIGHT, IMG_WIDTH]
@@ -177,6 +195,9 @@ class ONNXRuntimeModelDeploy(ObjectDetection):
             except Exception:
                 self.lock.release()
                 self.model_downloading = False
+                # Not served, so the same uri is downloaded again
+                self.model_uri = None
+                self.model_failures += 1
                 print(
                     "Download URL failed. Model_URI: %s, MODEL_DIR: %s"
                     % (model_uri, MODEL_DIR)
@@ -187,6 +208,7 @@ class ONNXRuntimeModelDeploy(ObjectDetection):
             self, model_uri, MODEL_DIR,)).start()
 
     def update_model(self, model_dir):
+        requested_dir = model_dir
         is_default_model = "default_model" in model_dir
         is_scenario_model = "scenario_models" in model_dir
 
@@ -198,16 +220,120 @@ class ONNXRuntimeModelDeploy(ObjectDetection):
             #     model_dir += '/onnx'
 
         model = self.load_model(model_dir, is_default_model, is_scenario_model)
+        self.warm_up(model)
 
         # Protected by Mutex
         self.lock.acquire()
         self.model = model
+        self.model_dir = requested_dir
+        self.quantization = {"mode": QUANTIZATION, "variant": "fp32"}
         self.lock.release()
+        self.notify_model_listeners()
+
+        # Downloaded models only, scenario models are fixed
+        if QUANTIZATION != QUANTIZATION_NONE and not (is_default_model or is_scenario_model):
+            threading.Thread(target=self.quantize, args=(
+                model_dir, model), daemon=True).start()
+
+    def quantize(self, model_dir, model):
+        """quantize.
+
+        Swap `model` for its INT8 variant if that passes the accuracy and
+        latency gates. The decision is saved next to the model so reloading
+        the same download does not evaluate again.
+        """
+        if self.get_device() != "cpu":
+            self.quantization = {"mode": QUANTIZATION, "variant": "fp32",
+                                 "reason": "device " + self.get_device()}
+            return
+        with open(model_dir + "/labels.txt", "r") as f:
+            labels = [l.strip() for l in f.readlines()]
+        int8_path = os.path.join(model_dir, INT8_MODEL_FILENAME)
+        report = load_report(model_dir)
+        try:
+            if report and report.get("mode") == QUANTIZATION:
+                quantized = model
+                if report["variant"] == "int8" and os.path.exists(int8_path):
+                    quantized = ONNXRuntimeObjectDetection(int8_path, labels)
+                    self.warm_up(quantized)
+            else:
+                quantized, report = quantize_if_better(
+                    model, model_dir + "/model.onnx", labels,
+                    load_calibration_images(), ONNXRuntimeObjectDetection)
+                save_report(model_dir, report)
+        except Exception:
+            logger.exception("Quantization of %s failed", model_dir)
+            return
+        with self.lock:
+            # Skip if another model was loaded meanwhile
+            if self.model is not model:
+                return
+            self.model = quantized
+            self.quantization = report
+        self.notify_model_listeners()
+
+    def preload_model(self, model_dir):
+        """preload_model.
+
+        Load and warm up `model_dir` at startup unless a model was already
+        set by an /update_model request meanwhile.
+        """
+        is_scenario_model = "scenario_models" in model_dir
+        path = model_dir + '/onnx' if is_scenario_model else model_dir
+        model = self.load_model(path, "default_model" in model_dir,
+                                is_scenario_model)
+        self.warm_up(model)
+        with self.lock:
+            if self.model is not None:
+                return
+            self.model = model
+            self.model_dir = model_dir
+        self.notify_model_listeners()
+
+    def notify_model_listeners(self):
+        for listener in self.model_listeners:
+            try:
+                listener(self.model_dir, dict(self.quantization))
+            except Exception:
+                logger.exception("Model listener %s failed", listener)
+
+    def warm_up(self, model):
+        """warm_up.
+
+        Run one blank frame so session initialization (memory arenas, kernel
+        selection) is not paid by the first real request.
+        """
+        if model is None:
+            return
+        try:
+            model.predict_image(np.zeros((IMG_HEIGHT, IMG_WIDTH, 3), np.uint8))
+        except Exception:
+            logger.exception("Model warm up failed")
+            return
+        for timings in (getattr(model, name, None) for name in ("pre", "inf", "post")):
+            if timings is not None:
+                timings.clear()
 
     def Score(self, image):
 
         # self.lock.acquire()
         predictions, inf_time = self.model.predict_image(image)
         # self.lock.release()
+        timeline.mark("first_inference")
 
         return predictions, inf_time
+
+    def ScoreTiled(self, image, budget=None):
+        """ScoreTiled.
+
+        Tiled inference of a high resolution frame within `budget` ms.
+        Falls back to Score when a single tile would do or the model
+        cannot run batches.
+        """
+        model = self.model
+        if hasattr(model, "predict_batch"):
+            predictions, inf_time, tiles = self.tiling.predict(model, image, budget)
+            if predictions is not None:
+                timeline.mark("first_inference")
+                return predictions, inf_time
+        return self.Score(image)
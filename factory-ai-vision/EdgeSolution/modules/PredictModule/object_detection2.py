@@ -8,6 +8,7 @@ import math
 import time
 import cv2
 import logging
+from collections import deque
 from PIL import Image
 
 
@@ -18,6 +19,8 @@ class ObjectDetection(object):
     ANCHORS = np.array([[0.573, 0.677], [1.87, 2.06], [
                        3.34, 5.47], [7.88, 3.53], [9.77, 9.17]])
     IOU_THRESHOLD = 0.45
+    # Recent pre/inference/post processing times kept for averaging
+    TIMING_HISTORY = 1000
     DEFAULT_INPUT_SIZE = 512 * 512
 
     def __init__(self, labels, prob_threshold=0.10, max_detections=20):
@@ -34,9 +37,9 @@ class ObjectDetection(object):
         self.labels = labels
         self.prob_threshold = prob_threshold
         self.max_detections = max_detections
-        self.pre = []
-        self.inf = []
-        self.post = []
+        self.pre = deque(maxlen=self.TIMING_HISTORY)
+        self.inf = deque(maxlen=self.TIMING_HISTORY)
+        self.post = deque(maxlen=self.TIMING_HISTORY)
 
     def _logistic(self, x):
         return np.where(x > 0, 1 / (1 + np.exp(-x)), np.exp(x) / (1 + np.exp(x)))
@@ -0,0 +1,288 @@
+"""Quantization.
+
+Optional INT8 variant of downloaded ONNX models. The variant is only kept
+when its detections agree with the fp32 model on calibration images and it
+is measurably faster.
+
+Enable with QUANTIZATION=dynamic or QUANTIZATION=static. Calibration
+images come from WebModule and from CALIBRATION_DIR.
+"""
+
+import glob
+import json
+import logging
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import requests
+from PIL import Image
+
+from onnxruntime_predict import make_dims_dynamic
+from utility import is_edge
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_NONE = "none"
+QUANTIZATION_DYNAMIC = "dynamic"
+QUANTIZATION_STATIC = "static"
+
+QUANTIZATION = os.environ.get("QUANTIZATION", QUANTIZATION_NONE)
+# Gates: mAP of INT8 detections against fp32 ones, and latency speedup
+QUANTIZATION_MIN_MAP = float(os.environ.get("QUANTIZATION_MIN_MAP", "0.9"))
+QUANTIZATION_MIN_SPEEDUP = float(os.environ.get("QUANTIZATION_MIN_SPEEDUP", "1.2"))
+QUANTIZATION_IMAGES = int(os.environ.get("QUANTIZATION_IMAGES", "32"))
+CALIBRATION_DIR = os.environ.get("CALIBRATION_DIR", "calibration_images")
+
+INT8_MODEL_FILENAME = "model.int8.onnx"
+REPORT_FILENAME = "quantization.json"
+IOU_THRESHOLD = 0.5
+BENCHMARK_RUNS = 3
+IMG_WIDTH = 960
+
+
+def web_module_url():
+    if is_edge():
+        ip = socket.gethostbyname("webmodule")
+        return ip + ":8000"
+    else:
+        return "localhost:8000"
+
+
+def _resize(img):
+    ratio = IMG_WIDTH / img.shape[1]
+    return cv2.resize(img, (IMG_WIDTH, int(img.shape[0] * ratio + 0.000001)))
+
+
+def load_calibration_images(limit=QUANTIZATION_IMAGES, calibration_dir=CALIBRATION_DIR,
+                            use_web_module=True):
+    """load_calibration_images.
+
+    Up to `limit` BGR images, resized like camera frames. Images captured
+    in WebModule come first since they show the actual scene.
+    """
+    images = []
+    if use_web_module:
+        try:
+            res = requests.get(
+                "http://" + web_module_url() + "/api/images/", timeout=5)
+            for item in res.json():
+                if len(images) >= limit:
+                    break
+                content = requests.get(item["image"], timeout=5).content
+                img = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+                if img is not None:
+                    images.append(_resize(img))
+        except Exception:
+            logger.warning("Cannot get calibration images from WebModule")
+    for path in sorted(glob.glob(os.path.join(calibration_dir, "*"))):
+        if len(images) >= limit:
+            break
+        img = cv2.imread(path)
+        if img is not None:
+            images.append(_resize(img))
+    return images
+
+
+def _box(prediction):
+    box = prediction["boundingBox"]
+    return (box["left"], box["top"],
+            box["left"] + box["width"], box["top"] + box["height"])
+
+
+def _iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _average_precision(matches, n_references):
+    """All-point interpolated AP from (probability, is_match) pairs."""
+    if n_references == 0:
+        return 1.0 if not matches else 0.0
+    matches = sorted(matches, key=lambda m: -m[0])
+    tp = np.cumsum([m[1] for m in matches])
+    fp = np.cumsum([not m[1] for m in matches])
+    recall = np.concatenate([[0], tp / n_references, [1]])
+    precision = np.concatenate([[1], tp / np.maximum(tp + fp, 1), [0]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    return float(np.sum((recall[1:] - recall[:-1]) * precision[1:]))
+
+
+def detection_agreement(references, candidates, iou_threshold=IOU_THRESHOLD):
+    """detection_agreement.
+
+    Score candidate detections using the reference (fp32) detections as
+    ground truth, per image.
+
+    Returns:
+        {"map": mean AP over tags, "iou": mean IoU of matched boxes}
+    """
+    matches = {}
+    n_references = {}
+    ious = []
+    for reference, candidate in zip(references, candidates):
+        for p in reference:
+            n_references[p["tagName"]] = n_references.get(p["tagName"], 0) + 1
+        used = set()
+        for p in sorted(candidate, key=lambda p: -p["probability"]):
+            best, best_iou = None, iou_threshold
+            for i, r in enumerate(reference):
+                if i in used or r["tagName"] != p["tagName"]:
+                    continue
+                iou = _iou(_box(p), _box(r))
+                if iou >= best_iou:
+                    best, best_iou = i, iou
+            if best is not None:
+                used.add(best)
+                ious.append(best_iou)
+            matches.setdefault(p["tagName"], []).append(
+                (p["probability"], best is not None))
+    tags = set(matches) | set(n_references)
+    if not tags:
+        return {"map": 1.0, "iou": 1.0}
+    aps = [_average_precision(matches.get(t, []), n_references.get(t, 0)) for t in tags]
+    return {"map": float(np.mean(aps)), "iou": float(np.mean(ious)) if ious else 0.0}
+
+
+def measure_latency(model, inputs, runs=BENCHMARK_RUNS):
+    """measure_latency.
+
+    Median session time per input, after one warm-up pass.
+    """
+    times = []
+    for i in range(runs + 1):
+        for x in inputs:
+            t0 = time.perf_counter()
+            model.session.run(None, {model.input_name: x})
+            if i > 0:
+                times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def quantize_model(model_path, output_path, mode, inputs=None):
+    """quantize_model.
+
+    Write the INT8 variant of `model_path`. Static quantization calibrates
+    activations on `inputs` (model input tensors).
+    """
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        # Calibration inputs are not the exported fixed size
+        source = os.path.join(dirpath, "model.onnx")
+        make_dims_dynamic(model_path, source)
+        if mode == QUANTIZATION_DYNAMIC:
+            quantize_dynamic(source, output_path, weight_type=QuantType.QUInt8)
+        elif mode == QUANTIZATION_STATIC:
+            import onnx
+
+            input_name = onnx.load(source).graph.input[0].name
+
+            class _Reader(CalibrationDataReader):
+                def __init__(self):
+                    self.items = iter(inputs)
+
+                def get_next(self):
+                    x = next(self.items, None)
+                    return None if x is None else {input_name: x}
+
+            quantize_static(source, output_path, _Reader(),
+                            quant_format=QuantFormat.QDQ,
+                            activation_type=QuantType.QUInt8,
+                            weight_type=QuantType.QInt8)
+        else:
+            raise ValueError("Unknown quantization mode: {}".format(mode))
+
+
+def _clear_timings(model):
+    for name in ("pre", "inf", "post"):
+        timings = getattr(model, name, None)
+        if timings is not None:
+            timings.clear()
+
+
+def quantize_if_better(model, model_path, labels, images, model_class,
+                       mode=QUANTIZATION, min_map=QUANTIZATION_MIN_MAP,
+                       min_speedup=QUANTIZATION_MIN_SPEEDUP):
+    """quantize_if_better.
+
+    Build the INT8 variant of `model` (loaded from `model_path`) and return
+    it when it passes the accuracy and latency gates, else `model`.
+
+    Returns:
+        (model, report) where report describes the chosen variant.
+    """
+    report = {"mode": mode, "variant": "fp32"}
+    if mode == QUANTIZATION_NONE:
+        return model, report
+    if getattr(model, "is_fp16", False):
+        report["reason"] = "fp16 model"
+        return model, report
+    if not images:
+        report["reason"] = "no calibration images"
+        return model, report
+
+    pil_images = [Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)) for img in images]
+    inputs = [model.to_input(model.preprocess(img)) for img in pil_images]
+    output_path = os.path.join(os.path.dirname(model_path), INT8_MODEL_FILENAME)
+    try:
+        quantize_model(model_path, output_path, mode, inputs)
+        int8 = model_class(output_path, labels)
+    except Exception as e:
+        logger.exception("Quantization failed")
+        report["reason"] = "quantization failed: {}".format(e)
+        return model, report
+
+    references = [model.predict_image(img)[0] for img in images]
+    candidates = [int8.predict_image(img)[0] for img in images]
+    report.update(detection_agreement(references, candidates))
+    fp32_latency = measure_latency(model, inputs)
+    int8_latency = measure_latency(int8, inputs)
+    report["fp32_latency"] = fp32_latency
+    report["int8_latency"] = int8_latency
+    report["speedup"] = fp32_latency / int8_latency if int8_latency > 0 else 0.0
+    _clear_timings(model)
+    _clear_timings(int8)
+
+    if report["map"] < min_map:
+        report["reason"] = "mAP {:.3f} below {}".format(report["map"], min_map)
+    elif report["speedup"] < min_speedup:
+        report["reason"] = "speedup {:.2f} below {}".format(report["speedup"], min_speedup)
+    else:
+        report["variant"] = "int8"
+    logger.info("Quantization report: %s", report)
+    if report["variant"] == "int8":
+        return int8, report
+    os.remove(output_path)
+    return model, report
+
+
+def load_report(model_dir):
+    try:
+        with open(os.path.join(model_dir, REPORT_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_report(model_dir, report):
+    try:
+        with open(os.path.join(model_dir, REPORT_FILENAME), "w") as f:
+            json.dump(report, f)
+    except OSError:
+        logger.warning("Failed to save quantization report to %s", model_dir)
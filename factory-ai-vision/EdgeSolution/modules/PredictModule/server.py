@@ -9,15 +9,18 @@ import socket
 import sys
 import threading
 import time
+import uuid
 from concurrent import futures
 from typing import List
 
 import cv2
 import numpy as np
+import requests
 import uvicorn
 import zmq
 from fastapi import BackgroundTasks, FastAPI, Request
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from api.models import (
     PartDetectionModeEnum,
@@ -25,10 +28,13 @@ from api.models import (
     StreamModel,
     UploadModelBody,
 )
+from diagnostics import DIAGNOSTICS_ENABLED, diagnostics
 from exception_handler import PrintGetExceptionDetails
 from logging_conf import logging_config
 from model_wrapper import ONNXRuntimeModelDeploy
+from startup import timeline
 from utility import is_edge
+from worker_pool import INFERENCE_WORKERS, WorkerPool
 
 # sys.path.insert(0, '../lib')
 # Set logging parameters
@@ -49,9 +55,29 @@ IMG_HEIGHT = 540
 LVA_MODE = os.environ.get("LVA_MODE", "grpc")
 IS_OPENCV = os.environ.get("IS_OPENCV", "false")
 
+# Loaded and warmed up at startup, InferenceModule benchmarks with it
+PRELOAD_MODEL_DIR = os.environ.get("PRELOAD_MODEL_DIR", "scenario_models/1")
+NOTIFY_TIMEOUT = 5  # sec
+# Lets InferenceModule tell a restarted PredictModule from the one it configured
+BOOT_ID = uuid.uuid4().hex
+
 # Main thread
 
 onnx = ONNXRuntimeModelDeploy()
+# Started at startup, loads the models set on onnx
+pool = WorkerPool(INFERENCE_WORKERS) if INFERENCE_WORKERS > 0 else None
+
+
+def _model_structure_sizes():
+    model = onnx.model
+    return {
+        name: len(getattr(model, name))
+        for name in ("pre", "inf", "post")
+        if hasattr(model, name)
+    }
+
+
+diagnostics.register("model", _model_structure_sizes)
 
 app = FastAPI(
     title="PredictModule", description="Factory AI PredictModule.", version="0.0.1",
@@ -71,18 +97,36 @@ def prediction(cam_id: str):
 
 
 @app.post("/predict")
-async def predict(request: Request):
-    """predict."""
+async def predict(request: Request, width: int = IMG_WIDTH, tiled: bool = False,
+                  tile_budget: float = None):
+    """predict.
+
+    Raw BGR frame `width` pixels wide. With `tiled`, the frame is inferred
+    in tiles within `tile_budget` ms.
+    """
     img_raw = await request.body()
+    if onnx.model is None:
+        return json.dumps({"inferences": [], "inf_time": 0}), 503
     nparr = np.frombuffer(img_raw, np.uint8)
-    img = nparr.reshape(-1, 960, 3)
+    img = nparr.reshape(-1, width, 3)
     # img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    predictions, inf_time = onnx.Score(img)
+    if pool is not None:
+        # Blocks until a worker is free, keep the event loop serving
+        predictions, inf_time, tiling = await run_in_threadpool(
+            pool.score, img, tiled, tile_budget)
+    elif tiled:
+        predictions, inf_time = onnx.ScoreTiled(img, tile_budget)
+        tiling = onnx.tiling.metrics()
+    else:
+        predictions, inf_time = onnx.Score(img)
     results = customvision_to_lva_format(predictions)
     if int(time.time()) % 5 == 0:
         logger.info(predictions)
 
-    return json.dumps({"inferences": results, "inf_time": inf_time}), 200
+    response = {"inferences": results, "inf_time": inf_time}
+    if tiled:
+        response["tiling"] = tiling
+    return json.dumps(response), 200
     # return json.dumps({"predictions": predictions, "inf_time": inf_time}), 200
     # return "", 204
 
@@ -129,6 +173,9 @@ def update_model(request_body: UploadModelBody):
     if request_body.model_dir:
         logger.info("Got Model DIR %s", request_body.model_dir)
         onnx.set_is_scenario(True)
+        if onnx.model_dir == model_dir:
+            logger.info("Model DIR already loaded.")
+            return "ok"
         onnx.update_model(request_body.model_dir)
         logger.info("Update Finished ...")
         return "ok"
@@ -137,7 +184,40 @@ def update_model(request_body: UploadModelBody):
 @app.get("/get_device")
 def get_device():
     device = onnx.get_device()
-    return {"device": device}
+    return {"device": device, "quantization": onnx.quantization}
+
+
+@app.get("/health")
+def health():
+    """health.
+
+    Startup readiness and phase timings, and what tells this run apart
+    to InferenceModule.
+    """
+    status = timeline.to_dict()
+    status["model_loaded"] = onnx.model is not None
+    status["boot_id"] = BOOT_ID
+    status["model_failures"] = onnx.model_failures
+    if pool is not None:
+        status["workers"] = pool.metrics()
+    return status
+
+
+@app.on_event("startup")
+def on_startup():
+    timeline.mark("http_ready")
+
+
+@app.get("/diagnostics")
+def get_diagnostics():
+    """diagnostics.
+
+    Memory samples, allocation growth and registered structure sizes.
+    Answers {"enabled": false} unless DIAGNOSTICS is on.
+    """
+    if not DIAGNOSTICS_ENABLED:
+        return {"enabled": False}
+    return diagnostics.report()
 
 
 def customvision_to_lva_format(predictions):
@@ -184,11 +264,63 @@ def lva_to_customvision_format(predictions):
     return(results)
 
 
+def inference_module_url():
+    if is_edge():
+        ip = socket.gethostbyname("inferencemodule")
+        return ip + ":5000"
+    else:
+        return "localhost:5000"
+
+
+def notify_inference_module(model_dir, quantization):
+    """notify_inference_module.
+
+    Model listener pushing the variant served to InferenceModule, which
+    caches it for its /get_device.
+    """
+
+    def _post():
+        try:
+            requests.post(
+                "http://" + inference_module_url() + "/update_quantization",
+                json=quantization,
+                timeout=NOTIFY_TIMEOUT,
+            )
+        except Exception:
+            logger.warning("Failed to send quantization to InferenceModule")
+
+    threading.Thread(target=_post, daemon=True).start()
+
+
+def startup():
+    """startup.
+
+    Load and warm up the preload model in background while the HTTP server
+    is already serving.
+    """
+    onnx.model_listeners.append(notify_inference_module)
+    if pool is not None:
+        pool.start()
+        onnx.model_listeners.append(pool.load_model)
+        if onnx.model_dir is not None:
+            # Updated before the pool started
+            pool.load_model(onnx.model_dir, dict(onnx.quantization))
+    if not PRELOAD_MODEL_DIR:
+        return
+    with timeline.phase("load_model"):
+        try:
+            onnx.preload_model(PRELOAD_MODEL_DIR)
+        except Exception:
+            # e.g. the model is not in the image, wait for /update_model
+            logger.exception("Failed to preload model %s", PRELOAD_MODEL_DIR)
+
+
 def local_main():
     """local_main.
 
     For local development.
     """
+    timeline.run_in_background(startup)
     uvicorn.run(app, host="0.0.0.0", port=7777)
 
 
@@ -198,6 +330,7 @@ def main():
     Main loop.
     """
     try:
+        timeline.run_in_background(startup)
         uvicorn.run(app, host="0.0.0.0", port=7777)
 
     except:
@@ -215,6 +348,8 @@ if __name__ == "__main__":
         logging.config.dictConfig(logging_config.LOGGING_CONFIG_DEV)
 
     logger.info("is_edge: %s", is_edge())
+    if DIAGNOSTICS_ENABLED:
+        diagnostics.start()
     if is_edge():
         main()
     else:
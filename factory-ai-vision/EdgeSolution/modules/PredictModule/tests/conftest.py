@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Modules in this package import each other as top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LABELS = ["box"]
+
+
+def save_tiny_model(path):
+    """Conv with the Custom Vision output layout: 5 anchors x (5 + labels)."""
+    import onnx
+    from onnx import TensorProto, helper
+
+    channels = 5 * (5 + len(LABELS))
+    weight = np.random.RandomState(0).uniform(
+        -0.0001, 0.0001, (channels, 3, 32, 32)).astype(np.float32)
+    graph = helper.make_graph(
+        [helper.make_node("Conv", ["data", "weight"], ["model_outputs0"],
+                          strides=[32, 32])],
+        "tiny",
+        [helper.make_tensor_value_info("data", TensorProto.FLOAT, [1, 3, 416, 416])],
+        [helper.make_tensor_value_info("model_outputs0", TensorProto.FLOAT, None)],
+        [helper.make_tensor("weight", TensorProto.FLOAT, weight.shape, weight.ravel())],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 11)])
+    model.ir_version = 6
+    onnx.save(model, str(path))
+
+
+def save_model_dir(path):
+    path.mkdir(parents=True)
+    save_tiny_model(path / "model.onnx")
+    (path / "labels.txt").write_text("\n".join(LABELS))
+
+
+@pytest.fixture
+def model_cache(tmp_path, monkeypatch):
+    import onnxruntime_predict
+
+    monkeypatch.setattr(onnxruntime_predict, "MODEL_CACHE_DIR",
+                        str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def scenario_model(tmp_path, model_cache):
+    model_dir = tmp_path / "scenario_models" / "1"
+    save_model_dir(model_dir / "onnx")
+    return str(model_dir)
@@ -0,0 +1,127 @@
+import functools
+import os
+
+import numpy as np
+import pytest
+
+import model_wrapper
+import quantization
+from conftest import LABELS, save_model_dir
+from model_wrapper import ONNXRuntimeModelDeploy
+from onnxruntime_predict import ONNXRuntimeObjectDetection
+from quantization import detection_agreement, quantize_if_better
+
+
+def detection(tag, left, top, width=0.2, height=0.2, probability=0.9):
+    return {
+        "tagName": tag,
+        "probability": probability,
+        "boundingBox": {"left": left, "top": top, "width": width, "height": height},
+    }
+
+
+@pytest.fixture
+def images():
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 256, (540, 960, 3), dtype=np.uint8) for _ in range(4)]
+
+
+@pytest.fixture
+def model_dir(tmp_path, model_cache):
+    path = tmp_path / "model"
+    save_model_dir(path)
+    return str(path)
+
+
+def test_agreement_identical_detections():
+    frames = [[detection("box", 0.1, 0.1), detection("bolt", 0.5, 0.5)], []]
+    assert detection_agreement(frames, frames) == {"map": 1.0, "iou": 1.0}
+    assert detection_agreement([[], []], [[], []]) == {"map": 1.0, "iou": 1.0}
+
+
+def test_agreement_penalizes_misses_and_shifts():
+    references = [[detection("box", 0.1, 0.1), detection("box", 0.5, 0.5)]]
+    missed = [[detection("box", 0.1, 0.1)]]
+    assert detection_agreement(references, missed)["map"] == pytest.approx(0.5)
+
+    shifted = [[detection("box", 0.12, 0.1), detection("box", 0.52, 0.5)]]
+    result = detection_agreement(references, shifted)
+    assert result["map"] == 1.0
+    assert 0.5 < result["iou"] < 1.0
+
+    wrong_tag = [[detection("bolt", 0.1, 0.1), detection("bolt", 0.5, 0.5)]]
+    assert detection_agreement(references, wrong_tag)["map"] == 0.0
+
+
+@pytest.mark.parametrize("mode", ["dynamic", "static"])
+def test_int8_kept_when_gates_pass(model_dir, images, mode):
+    path = os.path.join(model_dir, "model.onnx")
+    fp32 = ONNXRuntimeObjectDetection(path, LABELS)
+    model, report = quantize_if_better(
+        fp32, path, LABELS, images, ONNXRuntimeObjectDetection,
+        mode=mode, min_map=0.5, min_speedup=0)
+
+    assert report["variant"] == "int8"
+    assert model is not fp32
+    assert report["map"] >= 0.5
+    assert report["speedup"] > 0
+    assert os.path.exists(os.path.join(model_dir, quantization.INT8_MODEL_FILENAME))
+    assert len(model.predict_image(images[0])[0]) > 0
+
+
+def test_fp32_kept_when_not_faster(model_dir, images):
+    path = os.path.join(model_dir, "model.onnx")
+    fp32 = ONNXRuntimeObjectDetection(path, LABELS)
+    model, report = quantize_if_better(
+        fp32, path, LABELS, images, ONNXRuntimeObjectDetection,
+        mode="dynamic", min_map=0, min_speedup=1000)
+
+    assert model is fp32
+    assert report["variant"] == "fp32"
+    assert "speedup" in report["reason"]
+    assert not os.path.exists(os.path.join(model_dir, quantization.INT8_MODEL_FILENAME))
+
+
+def test_fp32_kept_without_calibration_images(model_dir):
+    path = os.path.join(model_dir, "model.onnx")
+    fp32 = ONNXRuntimeObjectDetection(path, LABELS)
+    model, report = quantize_if_better(
+        fp32, path, LABELS, [], ONNXRuntimeObjectDetection, mode="dynamic")
+    assert model is fp32
+    assert report["reason"] == "no calibration images"
+
+
+def test_deploy_reports_and_reuses_decision(model_dir, images, monkeypatch):
+    monkeypatch.setattr(model_wrapper, "QUANTIZATION", "dynamic")
+    monkeypatch.setattr(model_wrapper, "load_calibration_images", lambda: images)
+    monkeypatch.setattr(model_wrapper, "quantize_if_better", functools.partial(
+        quantize_if_better, mode="dynamic", min_map=0.5, min_speedup=0))
+
+    deploy = ONNXRuntimeModelDeploy()
+    fp32 = ONNXRuntimeObjectDetection(os.path.join(model_dir, "model.onnx"), LABELS)
+    deploy.model = fp32
+    deploy.quantize(model_dir, fp32)
+    assert deploy.quantization["variant"] == "int8"
+    assert deploy.model is not fp32
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("decision should be reused")
+
+    monkeypatch.setattr(model_wrapper, "quantize_if_better", _fail)
+    deploy.model = fp32
+    deploy.quantize(model_dir, fp32)
+    assert deploy.quantization["variant"] == "int8"
+    assert deploy.model is not fp32
+
+
+def test_get_device_reports_quantization(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import server
+
+    deploy = ONNXRuntimeModelDeploy()
+    deploy.quantization = {"mode": "dynamic", "variant": "int8", "speedup": 1.8}
+    monkeypatch.setattr(server, "onnx", deploy)
+    res = TestClient(server.app).get("/get_device").json()
+    assert res["device"] == "cpu"
+    assert res["quantization"]["variant"] == "int8"
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import numpy as np
+import onnx
+import pytest
+from fastapi.testclient import TestClient
+
+import onnxruntime_predict
+from model_wrapper import ONNXRuntimeModelDeploy
+from startup import StartupTimeline
+
+
+def test_dynamic_model_is_cached(scenario_model, tmp_path, monkeypatch):
+    source = scenario_model + "/onnx/model.onnx"
+    cache_dir = str(tmp_path / "cache")
+    first = onnxruntime_predict.cached_dynamic_model(source, cache_dir)
+
+    def _fail(*args):
+        raise AssertionError("model should not be patched again")
+
+    monkeypatch.setattr(onnxruntime_predict, "make_dims_dynamic", _fail)
+    assert onnxruntime_predict.cached_dynamic_model(source, cache_dir) == first
+    dims = onnx.load(first).graph.input[0].type.tensor_type.shape.dim
+    assert [d.dim_param for d in dims[-2:]] == ["dim2", "dim1"]
+
+
+def test_preload_warms_up_model(scenario_model):
+    deploy = ONNXRuntimeModelDeploy()
+    deploy.preload_model(scenario_model)
+    assert deploy.model is not None
+    assert deploy.model_dir == scenario_model
+    # Warm up run is not part of the reported timings
+    assert len(deploy.model.inf) == 0
+
+    t0 = time.time()
+    deploy.Score(np.zeros((540, 960, 3), np.uint8))
+    assert time.time() - t0 < 1
+    assert len(deploy.model.inf) == 1
+
+
+def test_preload_keeps_updated_model(scenario_model):
+    deploy = ONNXRuntimeModelDeploy()
+    deploy.update_model(scenario_model)
+    model = deploy.model
+    deploy.preload_model(scenario_model)
+    assert deploy.model is model
+
+
+@pytest.fixture(scope="module")
+def server():
+    import server
+
+    return server
+
+
+def test_time_to_first_inference(server, scenario_model, monkeypatch):
+    timeline = StartupTimeline(t0=time.time())
+    monkeypatch.setattr(server, "timeline", timeline)
+    monkeypatch.setattr(server, "PRELOAD_MODEL_DIR", scenario_model)
+    monkeypatch.setattr(server, "onnx", ONNXRuntimeModelDeploy())
+    # Score marks first_inference on the module level timeline
+    monkeypatch.setattr("model_wrapper.timeline", timeline)
+    img = np.zeros((540, 960, 3), np.uint8).tobytes()
+
+    with TestClient(server.app) as client:
+        status = client.get("/health").json()
+        assert client.post("/predict", content=img).json()[1] == 503
+
+        timeline.run_in_background(server.startup)
+        assert timeline.wait_ready(30)
+        assert client.get("/health").json()["model_loaded"]
+        assert client.post("/predict", content=img).json()[1] == 200
+        # Already loaded, no reload
+        client.post("/update_model", json={"model_dir": scenario_model})
+
+    assert not status["ready"] and not status["model_loaded"]
+    events = timeline.to_dict()["events"]
+    assert events["http_ready"] <= events["ready"] <= events["first_inference"]
+    assert [p["name"] for p in timeline.to_dict()["phases"]] == ["load_model"]
+
+
+def test_model_changes_are_pushed_to_inference_module(server, scenario_model,
+                                                      monkeypatch):
+    monkeypatch.setattr(server, "onnx", ONNXRuntimeModelDeploy())
+    monkeypatch.setattr(server, "pool", None)
+    monkeypatch.setattr(server, "PRELOAD_MODEL_DIR", scenario_model)
+    monkeypatch.setattr(server, "inference_module_url", lambda: "inference:5000")
+    posts = []
+    posted = threading.Event()
+
+    def _post(url, json, timeout):
+        posts.append((url, json))
+        posted.set()
+
+    monkeypatch.setattr(server.requests, "post", _post)
+    server.startup()
+    assert posted.wait(5)
+    assert posts == [("http://inference:5000/update_quantization",
+                      {"mode": server.onnx.quantization["mode"], "variant": "fp32"})]
+
+
+def test_failed_download_changes_health(server, monkeypatch):
+    monkeypatch.setattr(server, "onnx", ONNXRuntimeModelDeploy())
+    monkeypatch.setattr(server, "pool", None)
+
+    def _broken(model_uri, model_dir):
+        raise OSError("connection reset")
+
+    monkeypatch.setattr("model_wrapper.get_file_zip", _broken)
+    client = TestClient(server.app)
+    before = client.get("/health").json()
+    client.post("/update_model", json={"model_uri": "https://export/onnx"})
+    deadline = time.time() + 5
+    while server.onnx.model_downloading and time.time() < deadline:
+        time.sleep(0.01)
+
+    after = client.get("/health").json()
+    assert after["boot_id"] == before["boot_id"] == server.BOOT_ID
+    assert after["model_failures"] == before["model_failures"] + 1
+    # Sent again, the same model is downloaded again
+    assert server.onnx.model_uri is None
@@ -0,0 +1,186 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import LABELS, save_tiny_model
+from model_wrapper import ONNXRuntimeModelDeploy
+from onnxruntime_predict import ONNXRuntimeObjectDetection
+from tiling import MERGE_NMS, MERGE_WBF, TiledInference, merge_detections, tile_grid
+
+WIDTH = 1920
+HEIGHT = 1080
+TILE = 416
+
+
+class FakeTileModel:
+    """Threshold detector on tiles of the model input size."""
+
+    DEFAULT_INPUT_SIZE = TILE * TILE
+
+    def __init__(self, tile_time=0.01):
+        self.tile_time = tile_time
+        self.batches = []
+
+    def detect(self, img):
+        height, width = img.shape[:2]
+        mask = (img.max(axis=2) > 128).astype(np.uint8)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        return [{
+            "tagName": "box", "tagId": 0, "probability": 0.9,
+            "boundingBox": {"left": x / width, "top": y / height,
+                            "width": w / width, "height": h / height},
+        } for x, y, w, h, _ in stats[1:]]
+
+    def predict_batch(self, images):
+        self.batches.append(len(images))
+        return [self.detect(img) for img in images], self.tile_time * len(images)
+
+
+def scene(boxes):
+    frame = np.zeros((HEIGHT, WIDTH, 3), np.uint8)
+    for x1, y1, x2, y2 in boxes:
+        frame[y1:y2, x1:x2] = 255
+    return frame
+
+
+def seam_boxes():
+    """Parts across the seams of the tile grid, one wider than the overlap."""
+    tiles = tile_grid(WIDTH, HEIGHT, TILE)
+    x_seam = sorted({t[0] for t in tiles})[2]
+    y_seam = sorted({t[1] for t in tiles})[1]
+    return [
+        [x_seam - 20, 100, x_seam + 20, 140],
+        [300, y_seam - 15, 340, y_seam + 25],
+        [x_seam - 30, y_seam - 30, x_seam + 10, y_seam + 10],
+        [x_seam - 120, 800, x_seam + 140, 840],
+        [1700, 900, 1740, 940],
+    ]
+
+
+def frame_boxes(predictions):
+    return np.array([[
+        p["boundingBox"]["left"] * WIDTH,
+        p["boundingBox"]["top"] * HEIGHT,
+        (p["boundingBox"]["left"] + p["boundingBox"]["width"]) * WIDTH,
+        (p["boundingBox"]["top"] + p["boundingBox"]["height"]) * HEIGHT,
+    ] for p in predictions]).reshape(-1, 4)
+
+
+def iou(a, b):
+    w = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = w * h
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
+
+
+def test_tile_grid_covers_frame_with_overlap():
+    tiles = tile_grid(WIDTH, HEIGHT, TILE, overlap=0.2)
+    covered = np.zeros((HEIGHT, WIDTH), bool)
+    for x1, y1, x2, y2 in tiles:
+        assert (x2 - x1, y2 - y1) == (TILE, TILE)
+        covered[y1:y2, x1:x2] = True
+    assert covered.all()
+    xs = sorted({t[0] for t in tiles})
+    assert all(b - a <= TILE * 0.8 for a, b in zip(xs, xs[1:]))
+    # Frames smaller than a tile are a single tile
+    assert tile_grid(300, 200, TILE) == [[0, 0, 300, 200]]
+
+
+@pytest.mark.parametrize("method", [MERGE_NMS, MERGE_WBF])
+def test_merge_is_class_aware(method):
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [0, 0, 10, 10]], dtype=float)
+    scores = np.array([0.9, 0.8, 0.7])
+    labels = np.array(["box", "box", "bolt"], dtype=object)
+    cut = np.zeros(3, bool)
+    merged, merged_scores, merged_labels = merge_detections(boxes, scores, labels, cut, method)
+    assert sorted(merged_labels) == ["bolt", "box"]
+    assert merged_scores.max() == 0.9
+    box = merged[list(merged_labels).index("box")]
+    if method == MERGE_NMS:
+        assert box.tolist() == [0, 0, 10, 10]
+    else:
+        assert 0 < box[0] < 1
+
+
+def test_merge_prefers_whole_boxes_and_unions_cut_ones():
+    # Cut half with the higher score, whole box from the neighbouring tile
+    boxes = np.array([[0, 0, 5, 10], [0, 0, 10, 10]], dtype=float)
+    merged, _, _ = merge_detections(
+        boxes, np.array([0.95, 0.8]), np.array(["box", "box"], dtype=object),
+        np.array([True, False]), MERGE_NMS)
+    assert merged.tolist() == [[0, 0, 10, 10]]
+
+    # Wider than the overlap: every tile sees a cut part
+    boxes = np.array([[0, 0, 60, 10], [40, 0, 100, 10]], dtype=float)
+    merged, _, _ = merge_detections(
+        boxes, np.array([0.9, 0.9]), np.array(["box", "box"], dtype=object),
+        np.array([True, True]))
+    assert merged.tolist() == [[0, 0, 100, 10]]
+
+
+@pytest.mark.parametrize("method", [MERGE_NMS, MERGE_WBF])
+def test_parts_across_seams_are_found_once(method):
+    truth = seam_boxes()
+    model = FakeTileModel()
+    tiling = TiledInference(max_tiles=32, merge=method)
+    predictions, inf_time, n_tiles = tiling.predict(model, scene(truth))
+
+    assert n_tiles == len(tile_grid(WIDTH, HEIGHT, TILE))
+    # All tiles in one batch
+    assert model.batches == [n_tiles]
+    boxes = frame_boxes(predictions)
+    assert len(boxes) == len(truth)
+    for t in truth:
+        assert max(iou(t, b) for b in boxes) > 0.9
+
+
+def test_latency_budget_limits_tiles():
+    model = FakeTileModel(tile_time=0.02)
+    tiling = TiledInference(budget=1000, max_tiles=32)
+    frame = scene(seam_boxes())
+    _, _, n_tiles = tiling.predict(model, frame)
+    assert n_tiles == 18
+    assert tiling.tile_latency == pytest.approx(0.02)
+
+    # 100 ms at 20 ms per tile: the frame is downscaled to 5 tiles
+    predictions, _, n_tiles = tiling.predict(model, frame, budget=100)
+    assert 1 < n_tiles <= 5
+    assert tiling.last_scale < 1
+    assert len(predictions) == len(seam_boxes())
+
+    # A single tile is plain inference
+    assert tiling.predict(model, frame, budget=10) == (None, 0, 0)
+
+
+@pytest.fixture
+def tiny_model(tmp_path, model_cache):
+    path = tmp_path / "model.onnx"
+    save_tiny_model(path)
+    return ONNXRuntimeObjectDetection(str(path), LABELS)
+
+
+def test_predict_batch_matches_single_runs(tiny_model):
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, (TILE, TILE, 3), dtype=np.uint8) for _ in range(3)]
+    batch, _ = tiny_model.predict_batch(images)
+    assert tiny_model.batch_supported
+    assert batch == [tiny_model.predict_image(img)[0] for img in images]
+
+
+def test_predict_endpoint_tiled(scenario_model, monkeypatch):
+    import server
+
+    deploy = ONNXRuntimeModelDeploy()
+    deploy.update_model(scenario_model)
+    monkeypatch.setattr(server, "onnx", deploy)
+    frame = np.zeros((HEIGHT, WIDTH, 3), np.uint8)
+    res = TestClient(server.app).post(
+        "/predict", params={"width": WIDTH, "tiled": "true"}, content=frame.tobytes())
+    body, status = res.json()
+    assert status == 200
+    result = json.loads(body)
+    assert isinstance(result["inferences"], list)
+    assert result["tiling"]["last_tiles"] > 1
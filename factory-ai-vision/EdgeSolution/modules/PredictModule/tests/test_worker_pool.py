@@ -0,0 +1,146 @@
+import json
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import save_model_dir
+from model_wrapper import ONNXRuntimeModelDeploy
+from worker_pool import WorkerPool
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 256, (540, 960, 3), dtype=np.uint8) for _ in range(4)]
+
+
+@pytest.fixture
+def worker_env(tmp_path, monkeypatch):
+    # Spawned workers read their settings from the environment
+    monkeypatch.setenv("MODEL_CACHE_DIR", str(tmp_path / "worker_cache"))
+
+
+def make_pool(scenario_model, size=2, threads=1):
+    pool = WorkerPool(size, threads=threads, timeout=30, health_interval=0)
+    pool.start()
+    pool.load_model(scenario_model)
+    return pool
+
+
+def test_pool_matches_in_process(scenario_model, worker_env, frames):
+    deploy = ONNXRuntimeModelDeploy()
+    deploy.update_model(scenario_model)
+    pool = make_pool(scenario_model)
+    try:
+        assert [w.generation for w in pool.workers] == [1, 1]
+        for img in frames:
+            predictions, inf_time, tiling = pool.score(img)
+            assert predictions == deploy.Score(img)[0]
+            assert inf_time > 0 and tiling is None
+        # Frames larger than the initial buffer
+        big = np.zeros((2160, 3840, 3), np.uint8)
+        predictions, _, tiling = pool.score(big, tiled=True)
+        assert predictions == deploy.ScoreTiled(big)[0]
+        assert tiling["last_tiles"] > 1
+        assert sum(pool.metrics()["served"]) == len(frames) + 1
+    finally:
+        pool.stop()
+
+
+def test_crashed_worker_is_restarted(scenario_model, worker_env, frames):
+    pool = make_pool(scenario_model)
+    try:
+        for worker in list(pool.workers):
+            os.kill(worker.process.pid, signal.SIGKILL)
+        worker.process.join(5)
+        # Lost request is retried, every worker comes back with the model
+        predictions, _, _ = pool.score(frames[0])
+        assert isinstance(predictions, list)
+        pool.check_health()
+        metrics = pool.metrics()
+        assert metrics["restarts"] == 2
+        assert metrics["alive"] == 2
+        assert all(w.generation == 1 for w in pool.workers)
+    finally:
+        pool.stop()
+
+
+def test_model_reload_rolls_over_workers(scenario_model, worker_env, tmp_path, frames):
+    other = tmp_path / "scenario_models" / "2"
+    save_model_dir(other / "onnx")
+    (other / "onnx" / "labels.txt").write_text("bolt")
+    pool = make_pool(scenario_model)
+    try:
+        assert {p["tagName"] for p in pool.score(frames[0])[0]} == {"box"}
+        busy = threading.Thread(target=lambda: [pool.score(f) for f in frames])
+        busy.start()
+        pool.load_model(str(other))
+        busy.join()
+        assert all(w.generation == 2 for w in pool.workers)
+        for _ in range(pool.size):
+            assert {p["tagName"] for p in pool.score(frames[0])[0]} == {"bolt"}
+    finally:
+        pool.stop()
+
+
+def test_predict_endpoint_uses_pool(scenario_model, worker_env, monkeypatch, frames):
+    import server
+
+    deploy = ONNXRuntimeModelDeploy()
+    pool = WorkerPool(1, threads=1, health_interval=0)
+    monkeypatch.setattr(server, "onnx", deploy)
+    monkeypatch.setattr(server, "pool", pool)
+    monkeypatch.setattr(server, "PRELOAD_MODEL_DIR", scenario_model)
+    server.startup()
+    try:
+        assert pool.model_dir == scenario_model
+        res = TestClient(server.app).post("/predict", content=frames[0].tobytes())
+        body, status = res.json()
+        assert status == 200
+        assert json.loads(body)["inferences"]
+        assert server.health()["workers"]["served"] == [1]
+    finally:
+        pool.stop()
+
+
+def throughput(pool, frames, seconds=3, clients=4):
+    done = []
+    deadline = time.time() + seconds
+
+    def _client():
+        n = 0
+        while time.time() < deadline:
+            pool.score(frames[n % len(frames)])
+            n += 1
+        done.append(n)
+
+    threads = [threading.Thread(target=_client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(done) / seconds
+
+
+def test_throughput_scales_with_workers(scenario_model, worker_env, frames):
+    """Frames per second with 1 and N single threaded workers."""
+    cores = os.cpu_count() or 1
+    results = {}
+    for size in sorted({1, min(cores, 4)}):
+        pool = make_pool(scenario_model, size=size)
+        try:
+            for img in frames:
+                pool.score(img)
+            results[size] = throughput(pool, frames)
+        finally:
+            pool.stop()
+    print("inference workers fps:", results)
+    if cores < 2:
+        pytest.skip("single core, nothing to scale over")
+    n = max(results)
+    assert results[n] > 1.3 * results[1]
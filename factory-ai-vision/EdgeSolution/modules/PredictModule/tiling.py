@@ -0,0 +1,238 @@
+"""Tiling.
+
+Tiled inference for high resolution frames. The frame is split into
+overlapping tiles of the model input size, the tiles run as one batch and
+detections are merged across tile seams.
+
+The number of tiles is limited by a latency budget: when the frame needs
+more tiles than the budget allows, it is downscaled until it fits.
+"""
+
+import logging
+import math
+import os
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MERGE_NMS = "nms"
+MERGE_WBF = "wbf"
+
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.2"))
+TILE_LATENCY_BUDGET = float(os.environ.get("TILE_LATENCY_BUDGET", "200"))  # ms
+TILE_MAX_TILES = int(os.environ.get("TILE_MAX_TILES", "16"))
+TILE_MERGE = os.environ.get("TILE_MERGE", MERGE_WBF)
+# Intersection over the smaller box, so a part cut by a seam still matches
+# the whole part seen by the neighbouring tile
+TILE_MERGE_THRESHOLD = float(os.environ.get("TILE_MERGE_THRESHOLD", "0.5"))
+
+MIN_SCALE = 0.1
+SCALE_STEP = 0.9
+SEAM_MARGIN = 2  # px, boxes closer to an inner tile edge are cut
+LATENCY_SMOOTHING = 0.2
+
+
+def _axis_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    n = int(math.ceil((length - tile) / stride)) + 1
+    # Last tile ends on the frame edge
+    return [int(round(i * (length - tile) / (n - 1))) for i in range(n)]
+
+
+def tile_grid(width, height, tile_size, overlap=TILE_OVERLAP):
+    """tile_grid.
+
+    Boxes [x1, y1, x2, y2] of same sized tiles covering a `width` x
+    `height` frame, neighbours overlapping by at least `overlap`.
+    """
+    stride = max(1, int(tile_size * (1 - overlap)))
+    tile_w = min(tile_size, width)
+    tile_h = min(tile_size, height)
+    return [[x, y, x + tile_w, y + tile_h]
+            for y in _axis_starts(height, tile_h, stride)
+            for x in _axis_starts(width, tile_w, stride)]
+
+
+def pairwise_ios(boxes):
+    """pairwise_ios.
+
+    Intersection over the smaller area for every pair of [x1, y1, x2, y2]
+    boxes, as an N x N matrix.
+    """
+    x1 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y1 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    x2 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    y2 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    smaller = np.minimum(areas[:, None], areas[None, :])
+    return inter / np.maximum(smaller, 1e-9)
+
+
+def merge_detections(boxes, scores, labels, cut, method=TILE_MERGE,
+                     threshold=TILE_MERGE_THRESHOLD):
+    """merge_detections.
+
+    Merge detections of the same label seen by several tiles. Whole boxes
+    lead their cluster before boxes cut by a seam, then by score.
+    With "nms" the leader is kept, with "wbf" the whole members are fused
+    by score weighted average. Cut boxes that overlap at all are parts of
+    the same object; a cluster of cut boxes only (object wider than the
+    overlap) becomes their union.
+
+    Returns:
+        (boxes, scores, labels) as arrays.
+    """
+    if len(boxes) == 0:
+        return boxes, scores, labels
+    ios = pairwise_ios(boxes)
+    same_label = labels[:, None] == labels[None, :]
+    both_cut = cut[:, None] & cut[None, :]
+    clusters = ((ios >= threshold) | (both_cut & (ios > 0))) & same_label
+    order = np.lexsort((-scores, cut))
+    assigned = np.zeros(len(boxes), dtype=bool)
+
+    merged_boxes, merged_scores, merged_labels = [], [], []
+    for i in order:
+        if assigned[i]:
+            continue
+        members = clusters[i] & ~assigned
+        members[i] = True
+        assigned |= members
+        whole = members & ~cut
+        if not whole.any():
+            box = np.concatenate([boxes[members, :2].min(axis=0), boxes[members, 2:].max(axis=0)])
+        elif method == MERGE_WBF:
+            weights = scores[whole]
+            box = (boxes[whole] * weights[:, None]).sum(axis=0) / weights.sum()
+        else:
+            box = boxes[i]
+        merged_boxes.append(box)
+        merged_scores.append(scores[members].max())
+        merged_labels.append(labels[i])
+    return np.array(merged_boxes), np.array(merged_scores), np.array(merged_labels)
+
+
+class TiledInference:
+    """TiledInference.
+
+    Plans tiles under the latency budget and runs them through a model
+    with `predict_batch`. Per tile latency is learned from the runs.
+    """
+
+    def __init__(self, overlap=TILE_OVERLAP, budget=TILE_LATENCY_BUDGET,
+                 max_tiles=TILE_MAX_TILES, merge=TILE_MERGE,
+                 merge_threshold=TILE_MERGE_THRESHOLD):
+        self.overlap = overlap
+        self.budget = budget
+        self.max_tiles = max_tiles
+        self.merge = merge
+        self.merge_threshold = merge_threshold
+        self.tile_latency = None  # sec
+        self.last_tiles = 0
+        self.last_scale = 1.0
+
+    def tile_budget(self, budget=None):
+        budget = self.budget if budget is None else budget
+        if not self.tile_latency:
+            return self.max_tiles
+        return max(1, min(self.max_tiles, int(budget / 1000 / self.tile_latency)))
+
+    def plan(self, width, height, tile_size, budget=None):
+        """plan.
+
+        (scale, tiles) for a frame: the largest scale, at most 1, whose
+        grid fits in the tile budget. None when only one tile fits, the
+        plain whole frame inference is better then.
+        """
+        n_max = self.tile_budget(budget)
+        scale = 1.0
+        while scale >= MIN_SCALE:
+            w, h = int(width * scale), int(height * scale)
+            tiles = tile_grid(w, h, tile_size, self.overlap)
+            if len(tiles) == 1:
+                return None
+            if len(tiles) <= n_max:
+                return scale, tiles
+            scale *= SCALE_STEP
+        return None
+
+    def predict(self, model, image, budget=None):
+        """predict.
+
+        Custom Vision predictions normalized to `image`, the inference time
+        and the number of tiles; (None, 0, 0) when tiling does not apply.
+        """
+        height, width = image.shape[:2]
+        tile_size = int(math.sqrt(model.DEFAULT_INPUT_SIZE))
+        plan = self.plan(width, height, tile_size, budget)
+        if plan is None:
+            self.last_tiles = 0
+            return None, 0, 0
+        scale, tiles = plan
+        if scale != 1.0:
+            image = cv2.resize(image, (int(width * scale), int(height * scale)))
+        scaled_h, scaled_w = image.shape[:2]
+        crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in tiles]
+        tile_predictions, inf_time = model.predict_batch(crops)
+
+        per_tile = inf_time / len(tiles)
+        if self.tile_latency is None:
+            self.tile_latency = per_tile
+        else:
+            self.tile_latency += LATENCY_SMOOTHING * (per_tile - self.tile_latency)
+        self.last_tiles = len(tiles)
+        self.last_scale = scale
+
+        boxes, scores, labels, cut, tag_ids = [], [], [], [], {}
+        for (x1, y1, x2, y2), predictions in zip(tiles, tile_predictions):
+            tw, th = x2 - x1, y2 - y1
+            for p in predictions:
+                b = p["boundingBox"]
+                bx1, by1 = b["left"] * tw, b["top"] * th
+                bx2, by2 = bx1 + b["width"] * tw, by1 + b["height"] * th
+                cut.append(
+                    (bx1 < SEAM_MARGIN and x1 > 0)
+                    or (by1 < SEAM_MARGIN and y1 > 0)
+                    or (bx2 > tw - SEAM_MARGIN and x2 < scaled_w)
+                    or (by2 > th - SEAM_MARGIN and y2 < scaled_h))
+                boxes.append([x1 + bx1, y1 + by1, x1 + bx2, y1 + by2])
+                scores.append(p["probability"])
+                labels.append(p["tagName"])
+                tag_ids[p["tagName"]] = p.get("tagId")
+        boxes, scores, labels = merge_detections(
+            np.array(boxes, dtype=np.float64).reshape(-1, 4),
+            np.array(scores, dtype=np.float64),
+            np.array(labels, dtype=object),
+            np.array(cut, dtype=bool),
+            self.merge, self.merge_threshold)
+
+        results = []
+        for (bx1, by1, bx2, by2), score, label in zip(boxes, scores, labels):
+            bx1, bx2 = max(bx1, 0), min(bx2, scaled_w)
+            by1, by2 = max(by1, 0), min(by2, scaled_h)
+            results.append({
+                "probability": round(float(score), 8),
+                "tagId": tag_ids[label],
+                "tagName": label,
+                "boundingBox": {
+                    "left": round(float(bx1 / scaled_w), 8),
+                    "top": round(float(by1 / scaled_h), 8),
+                    "width": round(float((bx2 - bx1) / scaled_w), 8),
+                    "height": round(float((by2 - by1) / scaled_h), 8),
+                },
+            })
+        return results, inf_time, len(tiles)
+
+    def metrics(self):
+        return {
+            "overlap": self.overlap,
+            "budget": self.budget,
+            "merge": self.merge,
+            "tile_latency": self.tile_latency,
+            "last_tiles": self.last_tiles,
+            "last_scale": self.last_scale,
+        }
@@ -0,0 +1,373 @@
+"""Worker pool.
+
+Run inference in worker processes that each own an ONNX Runtime session,
+so the Python pre- and post-processing of concurrent cameras is not
+serialized by the GIL. Each worker has a shared memory frame buffer the
+server writes frames into; only the small predictions are pickled back.
+
+Requests go to the first idle worker. Idle workers are health checked,
+crashed or hung workers are restarted, and model updates are rolled over
+the workers one at a time so the others keep serving.
+
+Enable with INFERENCE_WORKERS=<n>, 0 infers in the server process.
+"""
+
+import logging
+import mmap
+import multiprocessing as mp
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "0"))
+# Session threads per worker, 0 splits the cores between the workers
+INFERENCE_WORKER_THREADS = int(os.environ.get("INFERENCE_WORKER_THREADS", "0"))
+INFERENCE_WORKER_TIMEOUT = float(os.environ.get("INFERENCE_WORKER_TIMEOUT", "30"))  # sec
+
+HEALTH_INTERVAL = 5  # sec
+PING_TIMEOUT = 2  # sec
+LOAD_TIMEOUT = 120  # sec
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+INITIAL_FRAME_BYTES = 1920 * 1080 * 3
+
+
+class WorkerError(Exception):
+    """Request failed inside a worker, the worker itself is fine."""
+
+
+class WorkerLost(Exception):
+    """Worker crashed, hung or closed its pipe."""
+
+
+class FrameBuffer:
+    """FrameBuffer.
+
+    File backed shared memory for one frame, created by the pool and
+    mapped by name in its worker.
+    """
+
+    def __init__(self, size=INITIAL_FRAME_BYTES, path=None):
+        self.owner = path is None
+        self.path = path or os.path.join(
+            SHM_DIR, "predictmodule-{}".format(uuid.uuid4().hex))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT if self.owner else os.O_RDWR)
+        try:
+            if self.owner:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def write(self, img):
+        np.ndarray(img.shape, dtype=np.uint8, buffer=self.mm)[:] = img
+
+    def read(self, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.mm)
+
+    def close(self):
+        self.mm.close()
+        if self.owner:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def load_worker_model(deploy, model_dir, quantization):
+    """load_worker_model.
+
+    Load `model_dir` in a worker, with the INT8 variant the server process
+    picked for it. Workers never run the quantization evaluation.
+    """
+    deploy.update_model(model_dir)
+    if quantization and quantization.get("variant") == "int8":
+        from onnxruntime_predict import ONNXRuntimeObjectDetection
+        from quantization import INT8_MODEL_FILENAME
+
+        int8 = ONNXRuntimeObjectDetection(
+            os.path.join(model_dir, INT8_MODEL_FILENAME), deploy.model.labels)
+        deploy.warm_up(int8)
+        deploy.model = int8
+        deploy.quantization = quantization
+
+
+def worker_main(conn, threads):
+    """worker_main.
+
+    Worker process loop, serves the requests sent by its Worker.
+    """
+    import model_wrapper
+    import onnxruntime_predict
+    from quantization import QUANTIZATION_NONE
+
+    if threads:
+        onnxruntime_predict.SESSION_THREADS = threads
+    model_wrapper.QUANTIZATION = QUANTIZATION_NONE
+    deploy = model_wrapper.ONNXRuntimeModelDeploy()
+    frame = None
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        command = msg[0]
+        if command == "stop":
+            break
+        try:
+            if command == "score":
+                _, path, shape, tiled, budget = msg
+                if frame is None or frame.path != path:
+                    if frame is not None:
+                        frame.close()
+                    frame = FrameBuffer(path=path)
+                img = frame.read(shape)
+                if tiled:
+                    predictions, inf_time = deploy.ScoreTiled(img, budget)
+                    conn.send(("ok", predictions, inf_time, deploy.tiling.metrics()))
+                else:
+                    predictions, inf_time = deploy.Score(img)
+                    conn.send(("ok", predictions, inf_time, None))
+            elif command == "load":
+                _, model_dir, quantization = msg
+                load_worker_model(deploy, model_dir, quantization)
+                conn.send(("ok", model_dir))
+            elif command == "ping":
+                conn.send(("ok", os.getpid()))
+        except Exception as e:
+            logger.exception("Worker request %s failed", command)
+            conn.send(("error", repr(e)))
+    if frame is not None:
+        frame.close()
+
+
+class Worker:
+    """Worker.
+
+    Server side handle of a worker process: its pipe, frame buffer and
+    the model generation it serves.
+    """
+
+    def __init__(self, ctx, index, threads):
+        self.index = index
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=worker_main, args=(child_conn, threads),
+            name="inference-worker-{}".format(index), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.frame = FrameBuffer()
+        self.generation = 0
+        self.served = 0
+
+    def call(self, msg, timeout):
+        try:
+            self.conn.send(msg)
+            if not self.conn.poll(timeout):
+                raise WorkerLost("worker {} timed out".format(self.index))
+            reply = self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerLost("worker {}: {!r}".format(self.index, e))
+        if reply[0] == "error":
+            raise WorkerError(reply[1])
+        return reply[1:]
+
+    def score(self, img, tiled, budget, timeout):
+        if img.nbytes > self.frame.size:
+            # Grown frame size, the worker maps the new buffer by its path
+            self.frame.close()
+            self.frame = FrameBuffer(img.nbytes)
+        self.frame.write(img)
+        return self.call(("score", self.frame.path, img.shape, tiled, budget), timeout)
+
+    def stop(self):
+        try:
+            self.conn.send(("stop",))
+        except (EOFError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+        self.conn.close()
+        self.frame.close()
+
+
+class WorkerPool:
+    """WorkerPool.
+
+    `score` is thread safe and blocks until a worker is free. Register
+    `load_model` as a model listener of the server's model deploy.
+    """
+
+    def __init__(self, size=INFERENCE_WORKERS, threads=INFERENCE_WORKER_THREADS,
+                 timeout=INFERENCE_WORKER_TIMEOUT, health_interval=HEALTH_INTERVAL):
+        # Workers must not inherit the server threads and sessions
+        self.ctx = mp.get_context("spawn")
+        self.size = max(1, size)
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.size)
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.workers = []
+        self.model_dir = None
+        self.quantization = None
+        self.generation = 0
+        self.restarts = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index in range(self.size):
+            worker = Worker(self.ctx, index, self.threads)
+            self.workers.append(worker)
+            self.idle.put(worker)
+        if self.health_interval:
+            threading.Thread(target=self._monitor, daemon=True).start()
+        logger.info("Started %d inference workers, %d threads each",
+                    self.size, self.threads)
+
+    def stop(self):
+        self.running = False
+        for worker in self.workers:
+            worker.stop()
+
+    def _acquire(self, timeout):
+        try:
+            return self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerLost("no idle worker after {} sec".format(timeout))
+
+    def _sync(self, worker):
+        """Load the current model into `worker` if it serves an older one."""
+        with self.lock:
+            generation = self.generation
+            model_dir, quantization = self.model_dir, self.quantization
+        if model_dir is None or worker.generation == generation:
+            return
+        worker.call(("load", model_dir, quantization), LOAD_TIMEOUT)
+        worker.generation = generation
+
+    def _restart(self, worker):
+        logger.warning("Restarting inference worker %d", worker.index)
+        worker.stop()
+        new_worker = Worker(self.ctx, worker.index, self.threads)
+        with self.lock:
+            self.workers[worker.index] = new_worker
+            self.restarts += 1
+        try:
+            self._sync(new_worker)
+        except (WorkerError, WorkerLost):
+            logger.exception("Inference worker %d failed to load the model", worker.index)
+        return new_worker
+
+    def score(self, img, tiled=False, budget=None):
+        """score.
+
+        (predictions, inf_time, tiling metrics) of a BGR frame. A request
+        lost with its worker is retried on the next one, until every
+        worker was restarted once.
+        """
+        attempts = self.size + 1
+        for attempt in range(attempts):
+            worker = self._acquire(self.timeout)
+            try:
+                self._sync(worker)
+                predictions, inf_time, tiling = worker.score(
+                    img, tiled, budget, self.timeout)
+                worker.served += 1
+                return predictions, inf_time, tiling
+            except WorkerLost:
+                logger.exception("Inference worker %d lost", worker.index)
+                worker = self._restart(worker)
+                if attempt == attempts - 1:
+                    raise
+            finally:
+                self.idle.put(worker)
+
+    def load_model(self, model_dir, quantization=None):
+        """load_model.
+
+        Roll `model_dir` over the workers, one worker at a time.
+        """
+        with self.lock:
+            self.generation += 1
+            self.model_dir = model_dir
+            self.quantization = quantization
+            generation = self.generation
+        if not self.running:
+            return
+        loaded = set()
+        while len(loaded) < self.size:
+            with self.lock:
+                if self.generation != generation:
+                    # A newer model is being rolled out
+                    return
+            worker = self._acquire(LOAD_TIMEOUT)
+            try:
+                if worker.generation == generation:
+                    loaded.add(worker.index)
+                    # Only loaded workers are idle, wait for a busy one
+                    time.sleep(0.01)
+                    continue
+                self._sync(worker)
+                loaded.add(worker.index)
+            except WorkerLost:
+                worker = self._restart(worker)
+            except WorkerError:
+                logger.exception("Inference worker %d failed to load %s",
+                                 worker.index, model_dir)
+                loaded.add(worker.index)
+            finally:
+                self.idle.put(worker)
+
+    def check_health(self):
+        """check_health.
+
+        Ping the idle workers, restart the dead or unresponsive ones.
+        Busy workers are checked by their request timeout.
+        """
+        for _ in range(self.idle.qsize()):
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if not worker.process.is_alive():
+                    raise WorkerLost("worker {} exited with {}".format(
+                        worker.index, worker.process.exitcode))
+                worker.call(("ping",), PING_TIMEOUT)
+            except (WorkerLost, WorkerError):
+                logger.exception("Inference worker %d failed its health check",
+                                 worker.index)
+                worker = self._restart(worker)
+            finally:
+                self.idle.put(worker)
+
+    def _monitor(self):
+        while self.running:
+            time.sleep(self.health_interval)
+            if self.running:
+                self.check_health()
+
+    def metrics(self):
+        with self.lock:
+            workers = list(self.workers)
+        return {
+            "workers": self.size,
+            "threads": self.threads,
+            "alive": sum(w.process.is_alive() for w in workers),
+            "idle": self.idle.qsize(),
+            "restarts": self.restarts,
+            "served": [w.served for w in workers],
+            "model_dir": self.model_dir,
+            "generation": self.generation,
+        }
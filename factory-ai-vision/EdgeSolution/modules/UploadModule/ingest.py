@@ -0,0 +1,297 @@
+"""Ingest.
+
+Video ingestion jobs for /upload. Each job streams the source once:
+- already Matroska with only H.264 video: the download is written
+  straight to the upload directory, no ffmpeg
+- H.264 in another container or with audio: ffmpeg remuxes the video
+  stream from the URL, without re-encoding
+- anything else: ffmpeg transcodes the video stream from the URL
+ffmpeg reads the URL itself, so there are no intermediate copies on
+disk. The output is renamed into place when complete, so rtspsim never
+serves a partial file.
+
+Jobs run in a bounded pool outside the request path and report their
+status and progress.
+"""
+
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "./upload")
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "2"))
+# Jobs waiting for a worker, more are refused
+UPLOAD_QUEUE = int(os.environ.get("UPLOAD_QUEUE", "16"))
+DOWNLOAD_TIMEOUT = 30  # sec, per read
+CHUNK_SIZE = 1024 * 1024
+HEAD_SIZE = 256 * 1024  # bytes sniffed for the container and codecs
+KEEP_JOBS = 100  # finished jobs kept for /jobs
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+REMUXING = "remuxing"
+TRANSCODING = "transcoding"
+DONE = "done"
+FAILED = "failed"
+
+COPY = "copy"
+REMUX = "remux"
+TRANSCODE = "transcode"
+
+MATROSKA_MAGIC = b"\x1a\x45\xdf\xa3"
+MATROSKA_H264 = "V_MPEG4/ISO/AVC"
+# Matroska CodecID element: id 0x86, a one byte size, the codec string
+MATROSKA_CODEC_ID = re.compile(rb"\x86([\x81-\xfe])([VAS]_[\x20-\x7e]+)")
+DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+class InvalidSource(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+def normalize_url(url):
+    normalized_url = url
+    if '//' not in url:
+        normalized_url = 'http://' + url
+    return normalized_url
+
+
+def output_name(url):
+    """Name of the uploaded file: the source's, as Matroska."""
+    name = os.path.basename(url.split("?")[0].split("#")[0].rstrip("/"))
+    return (name.split('.')[0] or "video") + '.mkv'
+
+
+def sniff(head):
+    """sniff.
+
+    (container, codecs) from the first bytes of a video. Codecs are
+    Matroska codec ids, or the MP4 sample entries found.
+    """
+    if head.startswith(MATROSKA_MAGIC):
+        codecs = []
+        for match in MATROSKA_CODEC_ID.finditer(head):
+            size = match.group(1)[0] & 0x7f
+            codecs.append(match.group(2)[:size].decode("ascii"))
+        return "matroska", codecs
+    if head[4:8] == b"ftyp":
+        codecs = [c.decode() for c in (b"avc1", b"hev1", b"hvc1", b"mp4a")
+                  if b"moov" in head and c in head]
+        return "mp4", codecs
+    return None, []
+
+
+def ingest_mode(head):
+    container, codecs = sniff(head)
+    video = [c for c in codecs if c.startswith("V_") or c in ("avc1", "hev1", "hvc1")]
+    audio = [c for c in codecs if c.startswith("A_") or c == "mp4a"]
+    if container == "matroska" and video == [MATROSKA_H264] and not audio:
+        return COPY
+    if video and all(c in (MATROSKA_H264, "avc1") for c in video):
+        return REMUX
+    return TRANSCODE
+
+
+def ffmpeg_command(source, output, mode):
+    codec = ["-c:v", "copy"] if mode == REMUX else ["-c:v", "libx264"]
+    return (["ffmpeg", "-hide_banner", "-nostdin", "-y", "-i", source,
+             "-map", "0:v:0"] + codec +
+            ["-an", "-f", "matroska", "-progress", "pipe:1", "-nostats", output])
+
+
+def parse_duration(line):
+    match = DURATION.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class IngestJob:
+    """IngestJob.
+
+    One upload: its status, mode and progress in [0, 1].
+    """
+
+    def __init__(self, url, filename):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.filename = filename
+        self.status = QUEUED
+        self.mode = None
+        self.progress = 0.0
+        self.bytes = 0
+        self.total_bytes = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.future = None
+
+    def to_dict(self):
+        elapsed = (self.finished or time.time()) - (self.started or time.time())
+        return {
+            "id": self.id,
+            "url": self.url,
+            "filename": self.filename,
+            "status": self.status,
+            "mode": self.mode,
+            "progress": self.progress,
+            "bytes": self.bytes,
+            "total_bytes": self.total_bytes,
+            "seconds": elapsed,
+            "error": self.error,
+        }
+
+
+class Ingestor:
+    """Ingestor.
+
+    Bounded pool of ingestion jobs. Uploads of a file already in
+    progress join the running job.
+    """
+
+    def __init__(self, upload_dir=UPLOAD_DIR, workers=UPLOAD_WORKERS,
+                 queue_size=UPLOAD_QUEUE, session=None):
+        self.upload_dir = upload_dir
+        self.workers = workers
+        self.queue_size = queue_size
+        self.session = session or requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="ingest")
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.active = {}  # filename -> job
+
+    def submit(self, url):
+        filename = output_name(url)
+        with self.lock:
+            job = self.active.get(filename)
+            if job is not None:
+                return job
+            pending = sum(job.status == QUEUED for job in self.active.values())
+            if pending >= self.queue_size:
+                raise QueueFull("{} uploads waiting".format(pending))
+            job = IngestJob(url, filename)
+            self.active[filename] = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > KEEP_JOBS:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                self.jobs.popitem(last=False)
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def _run(self, job):
+        job.started = time.time()
+        os.makedirs(self.upload_dir, exist_ok=True)
+        output = os.path.join(self.upload_dir, job.filename)
+        part = output + ".part"
+        try:
+            self._ingest(job, part)
+            os.replace(part, output)
+            job.progress = 1.0
+            job.status = DONE
+            logger.warning("Uploaded %s as %s (%s) in %.1f sec", job.url, output,
+                           job.mode, time.time() - job.started)
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e) if isinstance(e, InvalidSource) else repr(e)
+            logger.warning("Upload of %s failed: %s", job.url, job.error)
+            if os.path.exists(part):
+                os.remove(part)
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                if self.active.get(job.filename) is job:
+                    del self.active[job.filename]
+            job.done.set()
+
+    def _ingest(self, job, part):
+        url = normalize_url(job.url)
+        job.status = DOWNLOADING
+        with self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            if 'video' not in r.headers.get('content-type', ''):
+                raise InvalidSource("invalid source")
+            r.raise_for_status()
+            if r.headers.get("content-length"):
+                job.total_bytes = int(r.headers["content-length"])
+            chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= HEAD_SIZE:
+                    break
+            job.mode = ingest_mode(head)
+            if job.mode == COPY:
+                self._copy(job, head, chunks, part)
+                return
+        # ffmpeg streams the source from the URL itself
+        self._ffmpeg(job, url, part)
+
+    def _copy(self, job, head, chunks, part):
+        with open(part, "wb") as f:
+            f.write(head)
+            job.bytes += len(head)
+            for chunk in chunks:
+                f.write(chunk)
+                job.bytes += len(chunk)
+                if job.total_bytes:
+                    job.progress = min(0.99, job.bytes / job.total_bytes)
+
+    def _ffmpeg(self, job, url, part):
+        job.status = REMUXING if job.mode == REMUX else TRANSCODING
+        process = subprocess.Popen(
+            ffmpeg_command(url, part, job.mode), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True)
+        duration = {}
+        errors = deque(maxlen=20)
+
+        def _read_stderr():
+            for line in process.stderr:
+                errors.append(line.rstrip())
+                if "seconds" not in duration:
+                    seconds = parse_duration(line)
+                    if seconds:
+                        duration["seconds"] = seconds
+
+        stderr_thread = threading.Thread(target=_read_stderr, daemon=True)
+        stderr_thread.start()
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            if key == "out_time_us" and value.isdigit() and duration.get("seconds"):
+                job.progress = min(0.99, int(value) / 1e6 / duration["seconds"])
+            elif key == "total_size" and value.isdigit():
+                job.bytes = int(value)
+        returncode = process.wait()
+        stderr_thread.join(5)
+        if returncode != 0:
+            raise RuntimeError("ffmpeg exited with {}: {}".format(
+                returncode, " | ".join(list(errors)[-3:])))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -2,13 +2,13 @@ import asyncio
 import logging
 import signal
 import threading
-import subprocess
 
-import requests
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
+from ingest import DONE, Ingestor, QueueFull
+
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
@@ -51,63 +51,36 @@ is_running = True
 
 RTSPSIM_PREFIX = "rtsp://rtspsim:554/media/upload/"
 
+ingestor = Ingestor()
+
 
 @app.post("/upload")
-async def upload(stream: Stream):
+async def upload(stream: Stream, wait: bool = True):
     logger.warning("Uploading video: {}".format(stream.url))
-    url = stream.url
-    filename = 'test.mkv'
-    # FIXME use your stream manager to fix it
-
-    filename = download_file(url)
-    if filename.startswith('invalid'):
-        raise HTTPException(status_code=400, detail="invalid source")
-    output_filename = upload_file(filename)
-
-    return RTSPSIM_PREFIX+output_filename
-
-
-def normalize_url(url):
-    normalized_url = url
-    if '//' not in url:
-        normalized_url = 'http://' + url
-    return normalized_url
-
-
-def download_file(url):
-    local_filename = url.split('/')[-1]
-    # NOTE the stream=True parameter below
-    normalized_url = normalize_url(url)
-    logger.warning('download link: {}'.format(normalized_url))
-    with requests.get(normalized_url, stream=True) as r:
-        if 'video' not in r.headers.get('content-type'):
-            return 'invalid url'
-        r.raise_for_status()
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                # if chunk:
-                f.write(chunk)
-
-    return local_filename
-
-
-def upload_file(filename):
-    output_filename = filename.split('.')[0] + '.mkv'
-    tmp_filename = filename.split('.')[0] + '_tmp.mkv'
-    if '.mkv' not in filename:
-        subprocess.run(["ffmpeg", "-i", filename, tmp_filename, "-y"])
-    else:
-        subprocess.run(["cp", output_filename, tmp_filename])
-
-    subprocess.run(["ffmpeg", "-i", tmp_filename, "-vcodec",
-                    "copy", "-an", output_filename, "-y"])
-    subprocess.run(["cp", output_filename, "./upload/"])
-    subprocess.run(["rm", filename])
-    subprocess.run(["rm", tmp_filename])
-    subprocess.run(["rm", output_filename])
-    return output_filename
+    try:
+        job = ingestor.submit(stream.url)
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if not wait:
+        return job.to_dict()
+
+    await asyncio.wrap_future(job.future)
+    if job.status != DONE:
+        raise HTTPException(status_code=400, detail=job.error)
+    return RTSPSIM_PREFIX + job.filename
+
+
+@app.get("/jobs")
+async def list_jobs():
+    return ingestor.list()
+
+
+@app.get("/jobs/{job_id}")
+async def read_job(job_id):
+    job = ingestor.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="no such job")
+    return job.to_dict()
 
 
 def main():
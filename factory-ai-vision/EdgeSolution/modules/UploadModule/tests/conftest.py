@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Modules in this package import each other as top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLE_CLIP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "upload", "big_buck_bunny_720p_2mb.mkv")
+
+
+class ClipServer:
+    """ClipServer.
+
+    Local HTTP server for sample clips. `files` maps a path to
+    (content_type, data); `rate` caps each response at bytes per sec.
+    """
+
+    def __init__(self, rate=None, chunk_size=64 * 1024):
+        self.files = {}
+        self.rate = rate
+        self.chunk_size = chunk_size
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in server.files:
+                    self.send_error(404)
+                    return
+                content_type, data = server.files[self.path]
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    for start in range(0, len(data), server.chunk_size):
+                        if server.rate:
+                            time.sleep(server.chunk_size / server.rate)
+                        self.wfile.write(data[start:start + server.chunk_size])
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def add(self, path, data, content_type="video/x-matroska"):
+        self.files[path] = (content_type, data)
+        return self.url(path)
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.httpd.server_address[1], path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
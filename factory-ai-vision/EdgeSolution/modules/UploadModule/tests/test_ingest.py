@@ -0,0 +1,244 @@
+import os
+import shutil
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import ingest
+import main
+from conftest import SAMPLE_CLIP, ClipServer
+from ingest import (
+    COPY, DONE, FAILED, REMUX, TRANSCODE, Ingestor, QueueFull, ffmpeg_command,
+    ingest_mode, output_name, parse_duration, sniff,
+)
+
+HAS_FFMPEG = shutil.which("ffmpeg") is not None
+
+with open(SAMPLE_CLIP, "rb") as f:
+    CLIP = f.read()
+
+
+def mkv_head(*codecs):
+    head = ingest.MATROSKA_MAGIC + b"\x42\x86\x81\x01"
+    for codec in codecs:
+        head += b"\x86" + bytes([0x80 | len(codec)]) + codec.encode()
+    return head
+
+
+@pytest.fixture
+def server():
+    server = ClipServer()
+    yield server
+    server.close()
+
+
+def wait_for(job, timeout=30):
+    assert job.done.wait(timeout)
+    return job
+
+
+def test_sniff():
+    assert sniff(CLIP[:ingest.HEAD_SIZE]) == ("matroska", ["V_MPEG4/ISO/AVC"])
+    assert sniff(mkv_head("V_MPEG4/ISO/AVC", "A_AAC"))[1] == ["V_MPEG4/ISO/AVC", "A_AAC"]
+    mp4 = b"\x00\x00\x00\x18ftypisom" + b"\x00" * 8 + b"moov....avc1....mp4a"
+    assert sniff(mp4) == ("mp4", ["avc1", "mp4a"])
+    assert sniff(b"RIFF....AVI LIST") == (None, [])
+
+
+def test_ingest_mode():
+    assert ingest_mode(CLIP[:ingest.HEAD_SIZE]) == COPY
+    assert ingest_mode(mkv_head("V_MPEG4/ISO/AVC", "S_TEXT/UTF8")) == COPY
+    assert ingest_mode(mkv_head("V_MPEG4/ISO/AVC", "A_AAC")) == REMUX
+    assert ingest_mode(b"\x00\x00\x00\x18ftypisom" + b"moov avc1 mp4a") == REMUX
+    assert ingest_mode(mkv_head("V_VP8")) == TRANSCODE
+    # An MP4 with its index at the end can not be sniffed
+    assert ingest_mode(b"\x00\x00\x00\x18ftypisom" + b"mdat") == TRANSCODE
+    assert ingest_mode(b"RIFF....AVI LIST") == TRANSCODE
+
+
+def test_ffmpeg_command():
+    remux = ffmpeg_command("http://host/a.mp4", "upload/a.mkv.part", REMUX)
+    assert remux[remux.index("-i") + 1] == "http://host/a.mp4"
+    assert remux[remux.index("-c:v") + 1] == "copy"
+    assert "-an" in remux and remux[-1] == "upload/a.mkv.part"
+    transcode = ffmpeg_command("http://host/a.avi", "upload/a.mkv.part", TRANSCODE)
+    assert transcode[transcode.index("-c:v") + 1] == "libx264"
+    assert transcode[transcode.index("-progress") + 1] == "pipe:1"
+
+
+def test_parse_duration():
+    line = "  Duration: 00:01:02.50, start: 0.000000, bitrate: 1205 kb/s"
+    assert parse_duration(line) == pytest.approx(62.5)
+    assert parse_duration("Input #0, matroska,webm, from 'a.mkv':") is None
+
+
+def test_output_name():
+    assert output_name("http://host/videos/clip.mp4") == "clip.mkv"
+    assert output_name("host/clip.avi?sig=abc") == "clip.mkv"
+    assert output_name("http://host/") == "host.mkv"
+
+
+def test_copy_streams_to_upload_dir(server, tmp_path):
+    url = server.add("/videos/bunny.mkv", CLIP)
+    ingestor = Ingestor(upload_dir=str(tmp_path), workers=1)
+    job = wait_for(ingestor.submit(url))
+    assert job.status == DONE, job.error
+    assert job.mode == COPY
+    assert job.progress == 1.0
+    assert job.bytes == job.total_bytes == len(CLIP)
+    with open(tmp_path / "bunny.mkv", "rb") as f:
+        assert f.read() == CLIP
+    assert os.listdir(tmp_path) == ["bunny.mkv"]
+
+
+def test_invalid_source(server, tmp_path):
+    url = server.add("/index.html", b"<html></html>", content_type="text/html")
+    ingestor = Ingestor(upload_dir=str(tmp_path), workers=1)
+    job = wait_for(ingestor.submit(url))
+    assert job.status == FAILED
+    assert job.error == "invalid source"
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_download_leaves_no_file(server, tmp_path):
+    ingestor = Ingestor(upload_dir=str(tmp_path), workers=1)
+    job = wait_for(ingestor.submit(server.url("/missing.mkv")))
+    assert job.status == FAILED
+    assert os.listdir(tmp_path) == []
+
+
+def test_same_file_joins_running_job(tmp_path):
+    server = ClipServer(rate=4 * 1024 * 1024)
+    try:
+        url = server.add("/bunny.mkv", CLIP)
+        ingestor = Ingestor(upload_dir=str(tmp_path), workers=2)
+        first = ingestor.submit(url)
+        assert ingestor.submit(url) is first
+        wait_for(first)
+        assert first.status == DONE
+        # Finished jobs are not joined, the file is uploaded again
+        assert ingestor.submit(url) is not first
+    finally:
+        server.close()
+
+
+def test_queue_is_bounded(tmp_path):
+    server = ClipServer(rate=2 * 1024 * 1024)
+    try:
+        urls = [server.add("/clip{}.mkv".format(i), CLIP) for i in range(3)]
+        ingestor = Ingestor(upload_dir=str(tmp_path), workers=1, queue_size=1)
+        running = ingestor.submit(urls[0])
+        deadline = time.monotonic() + 5
+        while running.status == ingest.QUEUED and time.monotonic() < deadline:
+            time.sleep(0.01)
+        queued = ingestor.submit(urls[1])
+        assert queued.status == ingest.QUEUED
+        with pytest.raises(QueueFull):
+            ingestor.submit(urls[2])
+        wait_for(queued)
+        assert queued.status == DONE
+    finally:
+        server.close()
+
+
+def test_concurrent_upload_throughput(tmp_path):
+    """Uploads run in parallel up to the pool size, each at the server's
+    rate, instead of one after the other in the request path."""
+    rate = 8 * 1024 * 1024
+    n_uploads, workers = 6, 3
+    server = ClipServer(rate=rate)
+    try:
+        urls = [server.add("/clip{}.mkv".format(i), CLIP) for i in range(n_uploads)]
+        ingestor = Ingestor(upload_dir=str(tmp_path), workers=workers)
+
+        t0 = time.monotonic()
+        wait_for(ingestor.submit(server.add("/single.mkv", CLIP)))
+        single = time.monotonic() - t0
+
+        t0 = time.monotonic()
+        jobs = [ingestor.submit(url) for url in urls]
+        for job in jobs:
+            wait_for(job, timeout=60)
+        elapsed = time.monotonic() - t0
+    finally:
+        server.close()
+
+    assert all(job.status == DONE for job in jobs)
+    events = sorted([(job.started, 1) for job in jobs] + [(job.finished, -1) for job in jobs])
+    running = [sum(change for _, change in events[:i + 1]) for i in range(len(events))]
+    assert max(running) == workers
+    for i in range(n_uploads):
+        assert os.path.getsize(tmp_path / "clip{}.mkv".format(i)) == len(CLIP)
+    throughput = n_uploads * len(CLIP) / elapsed / 1e6
+    print("\n{} uploads: {:.2f} sec, {:.1f} MB/s, one upload {:.2f} sec".format(
+        n_uploads, elapsed, throughput, single))
+    assert elapsed < n_uploads * single * 0.6
+
+
+@pytest.mark.skipif(HAS_FFMPEG, reason="ffmpeg is installed")
+def test_transcode_without_ffmpeg_fails_cleanly(server, tmp_path):
+    url = server.add("/clip.avi", b"RIFF\x00\x00\x00\x00AVI LIST" + b"\x00" * 1024,
+                     content_type="video/x-msvideo")
+    ingestor = Ingestor(upload_dir=str(tmp_path), workers=1)
+    job = wait_for(ingestor.submit(url))
+    assert job.status == FAILED
+    assert job.mode == TRANSCODE
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="ffmpeg is not installed")
+def test_transcode(server, tmp_path):
+    import cv2
+    import numpy as np
+
+    source = str(tmp_path / "source.avi")
+    writer = cv2.VideoWriter(source, cv2.VideoWriter_fourcc(*"MJPG"), 15, (320, 240))
+    for i in range(45):
+        writer.write(np.full((240, 320, 3), i * 5, np.uint8))
+    writer.release()
+    with open(source, "rb") as f:
+        url = server.add("/clip.avi", f.read(), content_type="video/x-msvideo")
+
+    upload_dir = tmp_path / "upload"
+    ingestor = Ingestor(upload_dir=str(upload_dir), workers=1)
+    job = wait_for(ingestor.submit(url), timeout=120)
+    assert job.status == DONE, job.error
+    assert job.mode == TRANSCODE
+    with open(upload_dir / "clip.mkv", "rb") as f:
+        assert ingest_mode(f.read(ingest.HEAD_SIZE)) == COPY
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ingestor", Ingestor(upload_dir=str(tmp_path), workers=2))
+    return TestClient(main.app)
+
+
+def test_upload_endpoint(client, server):
+    url = server.add("/videos/bunny.mkv", CLIP)
+    res = client.post("/upload", json={"url": url})
+    assert res.status_code == 200
+    assert res.json() == main.RTSPSIM_PREFIX + "bunny.mkv"
+
+    html = server.add("/index.html", b"<html></html>", content_type="text/html")
+    res = client.post("/upload", json={"url": html})
+    assert res.status_code == 400
+    assert res.json()["detail"] == "invalid source"
+
+
+def test_upload_without_waiting(client, server):
+    url = server.add("/bunny.mkv", CLIP)
+    res = client.post("/upload?wait=false", json={"url": url})
+    assert res.status_code == 200
+    job_id = res.json()["id"]
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        job = client.get("/jobs/{}".format(job_id)).json()
+        if job["status"] in (DONE, FAILED):
+            break
+        time.sleep(0.05)
+    assert job["status"] == DONE
+    assert job["progress"] == 1.0
+    assert [j["id"] for j in client.get("/jobs").json()] == [job_id]
+    assert client.get("/jobs/unknown").status_code == 404
@@ -5,12 +5,18 @@ from unittest import mock
 
 import pytest
 
+from ...azure_projects.models import Project
 from ...azure_settings.models import Setting
 from ...cameras.models import Camera
 
 pytestmark = pytest.mark.django_db
 
 
+class MockedProject:
+    def __init__(self):
+        self.name = "Mocked Project Name"
+
+
 @pytest.fixture(scope="function", autouse=True)
 def mock_validate(monkeypatch):
     monkeypatch.setattr(Setting, "validate", mock.MagicMock(return_value=True))
@@ -23,6 +29,13 @@ def mock_get_domain_id(monkeypatch):
     )
 
 
+@pytest.fixture(scope="function", autouse=True)
+def mock_get_project_obj(monkeypatch):
+    monkeypatch.setattr(
+        Project, "get_project_obj", mock.MagicMock(return_value=MockedProject())
+    )
+
+
 # @pytest.fixture(scope="module")
 # def mock_validate(monkeypatch):
 # class FakeProject:
@@ -0,0 +1,127 @@
+"""Fake inference module.
+
+A local HTTP server with the update endpoints deploy_worker calls,
+recording each call. Point an InferenceModule's url at
+FakeInference.url to deploy to it.
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+LEGACY_PATHS = {
+    "/update_part_detection_id",
+    "/update_part_detection_mode",
+    "/update_endpoint",
+    "/update_model",
+    "/update_parts",
+    "/update_cams",
+    "/update_retrain_parameters",
+    "/update_iothub_parameters",
+    "/update_prob_threshold",
+}
+
+
+class FakeInference:
+    """FakeInference.
+
+    latency: seconds added to each call
+    batch: whether /update_config exists, as in newer modules
+    device: answer of /get_device
+    refuse: /update_config sections answered as failed
+    """
+
+    def __init__(self, latency=0.0, batch=True, device="cpu"):
+        self.latency = latency
+        self.batch = batch
+        self.device = device
+        self.refuse = set()
+        self.boot_id = uuid.uuid4().hex
+        self.calls = []  # (path, body)
+        self.lock = threading.Lock()
+
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        """host:port, as InferenceModule.url."""
+        return "127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def restart(self):
+        """Forget the settings, as a restarted module."""
+        self.boot_id = uuid.uuid4().hex
+
+    def paths(self):
+        with self.lock:
+            return [path for path, _ in self.calls]
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        if method == "GET":
+            data = dict(parse_qsl(url.query))
+        else:
+            data = json.loads(body or b"null")
+        time.sleep(self.latency)
+
+        if url.path == "/get_device":
+            return self.reply(request, 200, {"device": self.device})
+        if url.path == "/update_config" and self.batch:
+            with self.lock:
+                self.calls.append((url.path, data))
+            if data.get("boot_id") not in (None, self.boot_id):
+                return self.reply(
+                    request, 409, {"boot_id": self.boot_id, "applied": [], "failed": {}}
+                )
+            sections = [section for section in data if section != "boot_id"]
+            return self.reply(
+                request,
+                200,
+                {
+                    "boot_id": self.boot_id,
+                    "applied": [s for s in sections if s not in self.refuse],
+                    "failed": {s: "refused" for s in sections if s in self.refuse},
+                },
+            )
+        if url.path in LEGACY_PATHS:
+            with self.lock:
+                self.calls.append((url.path, data))
+            return self.reply(request, 200, "ok")
+        return self.reply(request, 404, {"detail": "Not Found"})
+
+    @staticmethod
+    def reply(request, status, data):
+        body = json.dumps(data).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,240 @@
+"""App utilities tests.
+"""
+
+import threading
+import time
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ...azure_parts.tests.factories import PartFactory
+from ...azure_pd_deploy_status.models import DeployStatus
+from ...azure_training_status import progress
+from ...azure_training_status.models import TrainingStatus
+from ...azure_training_status.utils import training_status_events
+from ...camera_tasks.models import CameraTask
+from ...cameras.tests.factories import CameraFactory
+from .. import utils
+from .factories import PartDetectionFactory
+from .fake_inference import FakeInference
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def fake_inference(monkeypatch):
+    monkeypatch.setattr(utils, "deployed_configs", {})
+    server = FakeInference()
+    yield server
+    server.close()
+
+
+def create_part_detection(url, cameras=2):
+    part_detection = PartDetectionFactory(
+        inference_module__url=url, has_configured=True
+    )
+    project = part_detection.project
+    project.customvision_id = "cv-project"
+    project.download_uri = "https://export/onnx"
+    project.download_uri_fp16 = "https://export/fp16"
+    project.save()
+    parts = [PartFactory(project=project, name="part-{}".format(i)) for i in range(2)]
+    part_detection.parts.set(parts)
+    for i in range(cameras):
+        camera = CameraFactory(
+            name="camera-{}-{}".format(part_detection.id, i), is_demo=True
+        )
+        camera_task = CameraTask.objects.create(camera=camera)
+        camera_task.parts.set(parts[:1])
+        part_detection.cameras.add(camera)
+    return part_detection
+
+
+def test_if_trained_then_deploy_worker(monkeypatch):
+    """test_if_trained_then_deploy_worker.
+
+    Waits on the training status events, reading the status once.
+    """
+    part_detection = PartDetectionFactory()
+    project = part_detection.project
+    TrainingStatus.objects.create(
+        project=project, **progress.PROGRESS_1_FINDING_PROJECT
+    )
+    DeployStatus.objects.create(part_detection=part_detection)
+    deployed = []
+    monkeypatch.setattr(
+        utils, "deploy_worker", lambda part_detection_id: deployed.append(1)
+    )
+
+    def _train():
+        for status in (
+            progress.PROGRESS_7_TRAINING,
+            progress.PROGRESS_8_EXPORTING,
+            progress.PROGRESS_0_OK,
+        ):
+            time.sleep(0.05)
+            training_status_events.publish(project.id, **status)
+
+    threading.Thread(target=_train).start()
+    time_start = time.time()
+    with CaptureQueriesContext(connection) as queries:
+        utils.if_trained_then_deploy_worker(part_detection.id)
+
+    assert time.time() - time_start < 1
+    assert deployed == [1]
+    assert DeployStatus.objects.get(part_detection=part_detection).status == "ok"
+    status_reads = [
+        query
+        for query in queries.captured_queries
+        if "azure_training_status_trainingstatus" in query["sql"]
+    ]
+    assert len(status_reads) == 1
+
+
+def test_build_deploy_config_queries():
+    """test_build_deploy_config_queries.
+
+    The same number of queries for 2 or 10 cameras.
+    """
+    counts = []
+    for cameras in (2, 10):
+        part_detection = create_part_detection("127.0.0.1:1", cameras=cameras)
+        with CaptureQueriesContext(connection) as queries:
+            instance = utils.PartDetection.objects.select_related(
+                "project", "inference_module"
+            ).get(pk=part_detection.id)
+            config = utils.build_deploy_config(instance)
+        counts.append(len(queries))
+        assert len(config["cams"]["cameras"]) == cameras
+    assert counts[0] == counts[1]
+    camera = config["cams"]["cameras"][0]
+    assert camera["send_video_to_cloud_parts"] == [
+        {"id": str(part_detection.parts.get(name="part-0").id), "name": "part-0"}
+    ]
+    assert config["model"] == {
+        "model_uri": "https://export/onnx",
+        "model_uri_fp16": "https://export/fp16",
+    }
+
+
+def test_deploy_worker_sends_changes(fake_inference):
+    """test_deploy_worker_sends_changes.
+
+    One /update_config request, with only what changed since the last
+    deployment, and everything after the module restarted.
+    """
+    part_detection = create_part_detection(fake_inference.url)
+    utils.deploy_worker(part_detection.id)
+    ((path, body),) = fake_inference.calls
+    assert path == "/update_config"
+    assert "boot_id" not in body
+    assert body["part_detection_id"] == part_detection.id
+
+    fake_inference.clear()
+    utils.deploy_worker(part_detection.id)
+    assert fake_inference.calls == [
+        ("/update_config", {"boot_id": fake_inference.boot_id})
+    ]
+
+    fake_inference.clear()
+    part_detection.inference_mode = "ES"
+    part_detection.prob_threshold = 70
+    part_detection.save()
+    utils.deploy_worker(part_detection.id)
+    ((path, body),) = fake_inference.calls
+    assert set(body) == {
+        "boot_id",
+        "part_detection_mode",
+        "model",
+        "cams",
+        "retrain",
+        "iothub",
+        "prob_threshold",
+    }
+
+    fake_inference.clear()
+    fake_inference.restart()
+    utils.deploy_worker(part_detection.id)
+    assert fake_inference.paths() == ["/update_config"] * 2
+    assert fake_inference.calls[1][1]["parts"]
+    assert utils.deployed_configs[fake_inference.url][0] == fake_inference.boot_id
+
+
+def test_deploy_worker_sends_failed_sections_again(fake_inference):
+    part_detection = create_part_detection(fake_inference.url)
+    fake_inference.refuse = {"model"}
+    utils.deploy_worker(part_detection.id)
+    assert "model" not in utils.deployed_configs[fake_inference.url][1]
+
+    fake_inference.clear()
+    fake_inference.refuse = set()
+    utils.deploy_worker(part_detection.id)
+    ((path, body),) = fake_inference.calls
+    # With the sections depending on it
+    assert set(body) == {
+        "boot_id",
+        "model",
+        "cams",
+        "retrain",
+        "iothub",
+        "prob_threshold",
+    }
+
+    fake_inference.clear()
+    utils.deploy_worker(part_detection.id)
+    assert fake_inference.calls == [
+        ("/update_config", {"boot_id": fake_inference.boot_id})
+    ]
+
+
+def test_deploy_worker_legacy_module(fake_inference):
+    """test_deploy_worker_legacy_module.
+
+    Modules without /update_config get every update_* call, the VPU one
+    the FP16 model.
+    """
+    fake_inference.batch = False
+    fake_inference.device = "vpu"
+    part_detection = create_part_detection(fake_inference.url)
+    utils.deploy_worker(part_detection.id)
+    paths = fake_inference.paths()
+    assert sorted(paths) == sorted(
+        path for _, path in utils.LEGACY_DEPLOY_CALLS.values()
+    )
+    assert paths.index("/update_model") < paths.index("/update_cams")
+    assert paths.index("/update_cams") < paths.index("/update_prob_threshold")
+    calls = dict(fake_inference.calls)
+    assert calls["/update_model"] == {"model_uri": "https://export/fp16"}
+    assert calls["/update_prob_threshold"] == {"prob_threshold": "60"}
+    assert fake_inference.url not in utils.deployed_configs
+
+
+def test_deploy_worker_round_trips(fake_inference):
+    """test_deploy_worker_round_trips.
+
+    A deployment takes one round trip, four stages to older modules,
+    against ten one after another before.
+    """
+    latency = 0.1
+    fake_inference.latency = latency
+    part_detection = create_part_detection(fake_inference.url, cameras=4)
+
+    time_start = time.time()
+    utils.deploy_worker(part_detection.id)
+    batch = time.time() - time_start
+
+    fake_inference.batch = False
+    utils.deployed_configs.clear()
+    time_start = time.time()
+    utils.deploy_worker(part_detection.id)
+    legacy = time.time() - time_start
+
+    print(
+        "\ndeploy: {:.2f}s batch, {:.2f}s legacy, {:.2f}s sequential".format(
+            batch, legacy, 10 * latency
+        )
+    )
+    assert batch < 2 * latency
+    # /update_config, 4 stages and /get_device
+    assert legacy < 7 * latency
@@ -4,20 +4,58 @@
 import json
 import logging
 import threading
-import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from django.db.models import Prefetch
 from django.utils import timezone
 
 from ..azure_pd_deploy_status import progress as deploy_progress
 from ..azure_pd_deploy_status.utils import upcreate_deploy_status
 from ..azure_training_status.models import TrainingStatus
+from ..azure_training_status.utils import training_status_events
+from ..camera_tasks.models import CameraTask
 from .api.serializers import UpdateCamBodySerializer
 from .models import PartDetection
 
 logger = logging.getLogger(__name__)
 
+TRAINING_STATUS_TIMEOUT = 30  # sec, between reads of a status no one published
+DEPLOY_TIMEOUT = 60  # sec
+# Sections sent again with another: update_model resets the detection
+# mode, cameras take the mode when updated, and the stream parameters
+# only reach the cameras that exist when they are sent.
+DEPLOY_DEPENDENCIES = {
+    "part_detection_mode": ("model",),
+    "model": ("cams",),
+    "cams": ("retrain", "iothub", "prob_threshold"),
+}
+# Section -> (method, path) of inference modules without /update_config
+LEGACY_DEPLOY_CALLS = {
+    "part_detection_id": ("get", "/update_part_detection_id"),
+    "part_detection_mode": ("get", "/update_part_detection_mode"),
+    "endpoint": ("post", "/update_endpoint"),
+    "model": ("post", "/update_model"),
+    "parts": ("post", "/update_parts"),
+    "cams": ("post", "/update_cams"),
+    "retrain": ("get", "/update_retrain_parameters"),
+    "iothub": ("get", "/update_iothub_parameters"),
+    "prob_threshold": ("get", "/update_prob_threshold"),
+}
+# Each stage after the one before, its calls concurrently
+LEGACY_DEPLOY_STAGES = (
+    ("part_detection_id", "part_detection_mode", "endpoint", "parts"),
+    ("model",),
+    ("cams",),
+    ("retrain", "iothub", "prob_threshold"),
+)
+
+# Inference module url -> (boot_id, config) last deployed, boot_id also
+# covering the PredictModule serving the model
+deployed_configs = {}
+deployed_configs_lock = threading.Lock()
+
 
 def if_trained_then_deploy_worker(part_detection_id):
     """if_trained_then_deploy_worker.
@@ -32,30 +70,37 @@ def if_trained_then_deploy_worker(part_detection_id):
     logger.info("Wait for project to be trained")
     part_detection_obj = PartDetection.objects.get(pk=part_detection_id)
     project_obj = part_detection_obj.project
+    # Read the version first so no status published after the read is missed
+    version = training_status_events.version(project_obj.id)
+    training_status_obj = TrainingStatus.objects.get(project=project_obj)
+    status, log = training_status_obj.status, training_status_obj.log
     last_log = None
-    while True:
-        time.sleep(1)
-        training_status_obj = TrainingStatus.objects.get(project=project_obj)
-        logger.info("Listening on Training Status: %s", training_status_obj)
-        if training_status_obj.status in ["ok", "failed"]:
-            break
-        if training_status_obj.log != last_log:
+    while status not in ["ok", "failed"]:
+        if log != last_log:
+            logger.info("Listening on Training Status: %s %s", status, log)
             upcreate_deploy_status(
-                part_detection_id=part_detection_id,
-                status=training_status_obj.status,
-                log=training_status_obj.log,
+                part_detection_id=part_detection_id, status=status, log=log
             )
-            last_log = training_status_obj.log
+            last_log = log
+        event = training_status_events.wait(
+            project_obj.id, version, timeout=TRAINING_STATUS_TIMEOUT
+        )
+        if event:
+            version, status, log = event
+        else:
+            # Nothing published here, the status may be saved elsewhere
+            training_status_obj.refresh_from_db()
+            status, log = training_status_obj.status, training_status_obj.log
 
     # =====================================================
     # 2. Project training failed                        ===
     # =====================================================
-    if training_status_obj.status == "failed":
+    if status == "failed":
         logger.info("Project train/export failed.")
         upcreate_deploy_status(
             part_detection_id=part_detection_id,
-            status=training_status_obj.status,
-            log=training_status_obj.log,
+            status=status,
+            log=log,
         )
         return
 
@@ -88,18 +133,12 @@ def if_trained_then_deploy_worker(part_detection_id):
     )
 
 
-def deploy_worker(part_detection_id):
-    """deploy.
+def build_deploy_config(instance: PartDetection) -> dict:
+    """build_deploy_config.
 
-    Args:
-        part_detection_obj: Part Detection Objects
+    Every setting the inference module needs, by /update_config section,
+    in a fixed number of queries whatever the number of cameras.
     """
-    REQUEST_TIMEOUT = 60
-    instance: PartDetection = PartDetection.objects.get(pk=part_detection_id)
-    if not instance.has_configured:
-        logger.error("This PartDetection is not configured")
-        logger.error("Not sending any request to inference")
-        return
     confidence_min = getattr(instance, "accuracyRangeMin", 30)
     confidence_max = getattr(instance, "accuracyRangeMax", 80)
     max_images = getattr(instance, "maxImages", 10)
@@ -108,104 +147,43 @@ def deploy_worker(part_detection_id):
     metrics_frame_per_minutes = getattr(instance, "metrics_frame_per_minutes", 6)
     need_retraining = getattr(instance, "needRetraining", False)
 
-    # =====================================================
-    # 1. Update params                                  ===
-    # =====================================================
-    requests.get(
-        "http://" + str(instance.inference_module.url) + "/update_part_detection_id",
-        params={"part_detection_id": instance.id},
-        timeout=REQUEST_TIMEOUT,
-    )
-    requests.get(
-        "http://" + str(instance.inference_module.url) + "/update_part_detection_mode",
-        params={"part_detection_mode": instance.inference_mode},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    # =====================================================
-    # 2.1 Update endpoint                               ===
-    # =====================================================
-    requests.post(
-        "http://" + str(instance.inference_module.url) + "/update_endpoint",
-        json={
-            "endpoint": instance.project.get_prediction_uri(),
-            "headers": instance.project.prediction_header,
-        },
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    # =====================================================
-    # 2.2 Update model                                  ===
-    # =====================================================
-    if not instance.project:
-        pass
-    elif instance.project.is_demo:
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_model",
-            json={"model_dir": instance.project.download_uri},
-            timeout=REQUEST_TIMEOUT,
-        )
-
-    elif not instance.inference_module.is_vpu():
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_model",
-            json={"model_uri": instance.project.download_uri},
-            timeout=REQUEST_TIMEOUT,
-        )
-    else:
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_model",
-            json={"model_uri": instance.project.download_uri_fp16},
-            timeout=REQUEST_TIMEOUT,
-        )
-
-    # =====================================================
-    # 3. Update parts                                   ===
-    # =====================================================
-    logger.info("Update Parts!!!")
-    parts = instance.parts.all()
-    res_data = {"parts": []}
-
-    for part in parts.all():
-        res_data["parts"].append({"id": part.id, "name": part.name})
-    requests.post(
-        url="http://" + instance.inference_module.url + "/update_parts",
-        json=res_data,
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    requests.get(
-        "http://" + instance.inference_module.url + "/update_retrain_parameters",
-        params={
-            "is_retrain": need_retraining,
-            "confidence_min": confidence_min,
-            "confidence_max": confidence_max,
-            "max_images": max_images,
-        },
-        timeout=REQUEST_TIMEOUT,
-    )
-    requests.get(
-        "http://" + instance.inference_module.url + "/update_iothub_parameters",
-        params={
-            "is_send": metrics_is_send_iothub,
-            "threshold": metrics_accuracy_threshold,
-            "fpm": metrics_frame_per_minutes,
-        },
-        timeout=REQUEST_TIMEOUT,
-    )
+    config = {
+        "part_detection_id": instance.id,
+        "part_detection_mode": instance.inference_mode,
+    }
+    project_obj = instance.project
+    if project_obj:
+        endpoint = {
+            "endpoint": project_obj.get_prediction_uri(),
+            "headers": project_obj.prediction_header,
+        }
+        config["endpoint"] = {k: v for k, v in endpoint.items() if v is not None}
+        if project_obj.is_demo:
+            config["model"] = {"model_dir": project_obj.download_uri}
+        else:
+            config["model"] = {
+                "model_uri": project_obj.download_uri,
+                "model_uri_fp16": project_obj.download_uri_fp16,
+            }
+    config["parts"] = {
+        "parts": [{"id": part.id, "name": part.name} for part in instance.parts.all()]
+    }
 
-    # =====================================================
-    # 4. Update cams                                    ===
-    # =====================================================
-    logger.info("Update Cam!!!")
-    cameras = instance.cameras.all()
-    res_data = {
+    cam_data = {
         "fps": instance.fps,
         "lva_mode": instance.inference_protocol,
         "cameras": [],
     }
-
-    for cam in cameras.all():
+    cameras = instance.cameras.prefetch_related(
+        Prefetch(
+            "cameratask_set",
+            queryset=CameraTask.objects.order_by("pk").prefetch_related("parts"),
+        )
+    )
+    for cam in cameras:
+        # cameratask_set.first() would query again
+        camera_tasks = cam.cameratask_set.all()
+        camera_task = camera_tasks[0] if camera_tasks else None
         cam_info = {
             "id": cam.id,
             "name": cam.name,
@@ -213,35 +191,161 @@ def deploy_worker(part_detection_id):
             "source": cam.rtsp,
             "lines": cam.lines,
             "zones": cam.danger_zones,
-            "send_video_to_cloud": cam.cameratask_set.first().send_video_to_cloud,
+            "send_video_to_cloud": camera_task.send_video_to_cloud
+            if camera_task
+            else False,
             "send_video_to_cloud_parts": [
                 {"id": part.id, "name": part.name}
-                for part in cam.cameratask_set.first().parts.all()
+                for part in (camera_task.parts.all() if camera_task else [])
             ],
-            "send_video_to_cloud_threshold": cam.cameratask_set.first().send_video_to_cloud_threshold,
-            "recording_duration": cam.cameratask_set.first().recording_duration,
-            "enable_tracking": cam.cameratask_set.first().enable_tracking,
+            "send_video_to_cloud_threshold": camera_task.send_video_to_cloud_threshold
+            if camera_task
+            else 60,
+            "recording_duration": camera_task.recording_duration if camera_task else 1,
+            "enable_tracking": camera_task.enable_tracking if camera_task else False,
         }
         if cam.area:
             cam_info["aoi"] = cam.area
-        res_data["cameras"].append(cam_info)
-
-    serializer = UpdateCamBodySerializer(data=res_data)
+        cam_data["cameras"].append(cam_info)
+    serializer = UpdateCamBodySerializer(data=cam_data)
     serializer.is_valid(raise_exception=True)
-    logger.info(serializer.validated_data)
-    requests.post(
-        url="http://" + instance.inference_module.url + "/update_cams",
-        json=dict(serializer.validated_data),
-        timeout=REQUEST_TIMEOUT,
+    config["cams"] = json.loads(json.dumps(serializer.validated_data))
+
+    config["retrain"] = {
+        "is_retrain": need_retraining,
+        "confidence_min": confidence_min,
+        "confidence_max": confidence_max,
+        "max_images": max_images,
+    }
+    config["iothub"] = {
+        "is_send": metrics_is_send_iothub,
+        "threshold": metrics_accuracy_threshold,
+        "fpm": metrics_frame_per_minutes,
+    }
+    config["prob_threshold"] = instance.prob_threshold
+    return config
+
+
+def diff_deploy_config(config: dict, last: dict) -> dict:
+    """diff_deploy_config.
+
+    The sections of config that changed since last, and the ones they
+    make stale.
+    """
+    changed = {section for section in config if config[section] != last.get(section)}
+    stack = list(changed)
+    while stack:
+        for section in DEPLOY_DEPENDENCIES.get(stack.pop(), ()):
+            if section in config and section not in changed:
+                changed.add(section)
+                stack.append(section)
+    return {section: config[section] for section in config if section in changed}
+
+
+def send_legacy_deploy_call(url, section, value, is_vpu=None):
+    """One update_* call of a section, for inference modules without
+    /update_config."""
+    method, path = LEGACY_DEPLOY_CALLS[section]
+    if section == "model":
+        value = dict(value)
+        model_uri_fp16 = value.pop("model_uri_fp16", None)
+        if model_uri_fp16 and is_vpu():
+            value["model_uri"] = model_uri_fp16
+    elif not isinstance(value, dict):
+        value = {section: value}
+    kwargs = {"params": value} if method == "get" else {"json": value}
+    return requests.request(
+        method, "http://" + url + path, timeout=DEPLOY_TIMEOUT, **kwargs
     )
-    # =====================================================
-    # 5. Update prob_threshold                          ===
-    # =====================================================
-    requests.get(
-        "http://" + instance.inference_module.url + "/update_prob_threshold",
-        params={"prob_threshold": instance.prob_threshold},
-        timeout=REQUEST_TIMEOUT,
+
+
+def send_legacy_deploy_config(url, config: dict, is_vpu=None):
+    """send_legacy_deploy_config.
+
+    The update_* calls of every section, those of a stage concurrently.
+    """
+    with ThreadPoolExecutor(
+        max_workers=max(len(stage) for stage in LEGACY_DEPLOY_STAGES),
+        thread_name_prefix="deploy",
+    ) as executor:
+        for stage in LEGACY_DEPLOY_STAGES:
+            calls = [
+                executor.submit(
+                    send_legacy_deploy_call, url, section, config[section], is_vpu
+                )
+                for section in stage
+                if section in config
+            ]
+            for call in calls:
+                call.result()
+
+
+def send_deploy_config(url, config: dict, is_vpu=None) -> list:
+    """send_deploy_config.
+
+    Send what changed since the last deployment to this inference module
+    in one /update_config request, all of it when the module or its
+    PredictModule restarted since, or PredictModule failed to download
+    the model. Only the sections applied are remembered as deployed.
+    Modules without /update_config get the update_* calls.
+
+    Returns:
+        list: sections applied
+    """
+    with deployed_configs_lock:
+        boot_id, last = deployed_configs.get(url, (None, {}))
+    body = diff_deploy_config(config, last) if boot_id else dict(config)
+    if boot_id:
+        body["boot_id"] = boot_id
+    response = requests.post(
+        "http://" + url + "/update_config", json=body, timeout=DEPLOY_TIMEOUT
+    )
+    if response.status_code == 409:
+        logger.info("Inference module %s restarted, send all", url)
+        body, last = dict(config), {}
+        response = requests.post(
+            "http://" + url + "/update_config", json=body, timeout=DEPLOY_TIMEOUT
+        )
+    if response.status_code in (404, 405):
+        logger.info("Inference module %s has no /update_config", url)
+        with deployed_configs_lock:
+            deployed_configs.pop(url, None)
+        send_legacy_deploy_config(url, config, is_vpu=is_vpu)
+        return list(config)
+    response.raise_for_status()
+    result = response.json()
+    if result.get("failed"):
+        logger.error("Inference module %s failed to apply %s", url, result["failed"])
+    # Sections not sent stay as deployed, the failed ones are sent again
+    deployed = {section: last[section] for section in last if section not in body}
+    deployed.update(
+        {section: config[section] for section in result["applied"] if section in config}
+    )
+    with deployed_configs_lock:
+        deployed_configs[url] = (result["boot_id"], deployed)
+    return result["applied"]
+
+
+def deploy_worker(part_detection_id):
+    """deploy.
+
+    Args:
+        part_detection_obj: Part Detection Objects
+    """
+    instance: PartDetection = PartDetection.objects.select_related(
+        "project", "inference_module"
+    ).get(pk=part_detection_id)
+    if not instance.has_configured:
+        logger.error("This PartDetection is not configured")
+        logger.error("Not sending any request to inference")
+        return
+    config = build_deploy_config(instance)
+    applied = send_deploy_config(
+        instance.inference_module.url,
+        config,
+        is_vpu=instance.inference_module.is_vpu,
     )
+    logger.info("Deployed %s", applied)
 
 
 def if_trained_then_deploy_catcher(part_detection_id):
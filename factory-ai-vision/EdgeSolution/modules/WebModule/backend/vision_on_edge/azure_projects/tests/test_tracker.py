@@ -0,0 +1,223 @@
+"""Training tracker tests.
+"""
+
+import json
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from django.db.models.signals import post_save
+
+from ...azure_settings.models import Setting
+from ...azure_training_status import progress
+from ...azure_training_status.models import TrainingStatus
+from ..models import Project
+from ..tracker import DONE, FAILED, MAX_ERRORS, TrainingTracker
+from .factories import ProjectFactory
+
+pytestmark = pytest.mark.django_db
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeTrainer:
+    """FakeTrainer.
+
+    Custom Vision training on a script: the iteration shows up at
+    `queued`, is trained at `trained` and each export is ready `export`
+    seconds after it is requested, all on the test clock.
+    """
+
+    def __init__(self, clock, queued=3, trained=900, export=20, status="Completed"):
+        self.clock = clock
+        self.queued = queued
+        self.trained = trained
+        self.export = export
+        self.status = status
+        self.exports = {}  # flavor -> time requested
+        self.calls = Counter()
+        self.errors = 0
+
+    def get_iterations(self, project_id):
+        self.calls["get_iterations"] += 1
+        if self.errors:
+            self.errors -= 1
+            raise ConnectionError("Custom Vision unreachable")
+        if self.clock() < self.queued:
+            return []
+        done = self.clock() >= self.trained
+        iteration = SimpleNamespace(
+            id="iteration-" + project_id,
+            status=self.status if done else "Training",
+            exportable=done and self.status == "Completed",
+        )
+        return [iteration]
+
+    def export_iteration(self, project_id, iteration_id, platform, flavor):
+        self.calls["export_iteration"] += 1
+        self.exports.setdefault(flavor, self.clock())
+
+    def get_exports(self, project_id, iteration_id):
+        self.calls["get_exports"] += 1
+        return [
+            SimpleNamespace(
+                flavor=flavor or None,
+                status="Done" if self.clock() >= since + self.export else "Exporting",
+                download_uri=(
+                    "https://export/{}/{}".format(iteration_id, flavor or "onnx")
+                    if self.clock() >= since + self.export
+                    else None
+                ),
+            )
+            for flavor, since in self.exports.items()
+        ]
+
+    def get_iteration_performance(self, project_id, iteration_id):
+        self.calls["get_iteration_performance"] += 1
+        return SimpleNamespace(as_dict=lambda: {"precision": 0.9})
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def writes():
+    counter = Counter()
+
+    def _count(sender, **kwargs):
+        counter[sender.__name__] += 1
+
+    for sender in (TrainingStatus, Project):
+        post_save.connect(_count, sender=sender, dispatch_uid="count_writes")
+    yield counter
+    for sender in (TrainingStatus, Project):
+        post_save.disconnect(sender=sender, dispatch_uid="count_writes")
+
+
+def fake_trainers(monkeypatch, trainers):
+    """Setting.get_trainer_obj returns the trainer of the setting's name."""
+    monkeypatch.setattr(Setting, "get_trainer_obj", lambda self: trainers[self.name])
+
+
+def create_project(name, customvision_id):
+    project = ProjectFactory(customvision_id=customvision_id)
+    project.setting.name = name
+    project.setting.save()
+    TrainingStatus.objects.create(
+        project=project, **progress.PROGRESS_6_PREPARING_CUSTOM_VISION_ENV
+    )
+    return project
+
+
+def run(tracker, clock, until=3600):
+    polls = 0
+    while clock.now < until:
+        delay = tracker.step()
+        if delay is None:
+            break
+        clock.now += delay
+        polls += 1
+    return polls
+
+
+def test_track(monkeypatch, clock, writes):
+    """test_track.
+
+    A 15 minutes training is followed with a few dozen calls, and status
+    is written once per phase.
+    """
+    trainer = FakeTrainer(clock)
+    fake_trainers(monkeypatch, {"setting": trainer})
+    project = create_project("setting", "cv-project")
+    tracker = TrainingTracker(clock=clock, threaded=False)
+    writes.clear()
+
+    tracking = tracker.track(project.id, counter="training_counter")
+    assert tracker.is_tracking(project.id)
+    assert tracker.track(project.id) is tracking
+    run(tracker, clock)
+    print("\n15 min training: {} calls".format(sum(trainer.calls.values())))
+
+    assert tracking.phase == DONE and tracking.done.is_set()
+    assert not tracker.is_tracking(project.id)
+    assert 900 <= clock.now < 900 + 30 + 20 + 10
+    assert trainer.calls["get_iterations"] < 50
+    assert trainer.calls["get_exports"] < 10
+    assert trainer.calls["export_iteration"] == 2
+
+    project.refresh_from_db()
+    assert project.download_uri == "https://export/iteration-cv-project/onnx"
+    assert project.download_uri_fp16.endswith("/ONNXFloat16")
+    assert project.training_counter == 1
+    status = TrainingStatus.objects.get(project=project)
+    assert status.status == "ok"
+    assert json.loads(status.performance) == [{"precision": 0.9}]
+    assert writes == {"TrainingStatus": 3, "Project": 1}
+
+
+def test_track_multiplexes(monkeypatch, clock):
+    trainers = {
+        "fast": FakeTrainer(clock, trained=60),
+        "slow": FakeTrainer(clock, trained=600),
+    }
+    fake_trainers(monkeypatch, trainers)
+    fast = create_project("fast", "cv-fast")
+    slow = create_project("slow", "cv-slow")
+    tracker = TrainingTracker(clock=clock, threaded=False)
+    fast_tracking = tracker.track(fast.id)
+    slow_tracking = tracker.track(slow.id)
+
+    run(tracker, clock, until=200)
+    assert fast_tracking.phase == DONE
+    assert tracker.is_tracking(slow.id)
+    run(tracker, clock)
+    assert slow_tracking.phase == DONE
+    assert Project.objects.get(pk=slow.id).download_uri
+
+
+@pytest.mark.parametrize(
+    "script, log",
+    [
+        ({"queued": 1e9}, "Get iteration from custom vision occurs error."),
+        ({"status": "Failed"}, "Training on custom vision failed."),
+    ],
+)
+def test_track_fails(monkeypatch, clock, script, log):
+    trainer = FakeTrainer(clock, **script)
+    fake_trainers(monkeypatch, {"setting": trainer})
+    project = create_project("setting", "cv-project")
+    tracker = TrainingTracker(clock=clock, threaded=False)
+    tracking = tracker.track(project.id)
+    run(tracker, clock)
+
+    assert tracking.phase == FAILED and tracking.done.is_set()
+    status = TrainingStatus.objects.get(project=project)
+    assert (status.status, status.log) == ("failed", log)
+
+
+def test_track_retries_errors(monkeypatch, clock):
+    trainer = FakeTrainer(clock)
+    trainer.errors = MAX_ERRORS - 1
+    fake_trainers(monkeypatch, {"setting": trainer})
+    project = create_project("setting", "cv-project")
+    tracker = TrainingTracker(clock=clock, threaded=False)
+    tracking = tracker.track(project.id)
+    run(tracker, clock)
+    assert tracking.phase == DONE
+
+    trainer = FakeTrainer(clock)
+    trainer.errors = MAX_ERRORS
+    fake_trainers(monkeypatch, {"setting": trainer})
+    tracking = tracker.track(project.id)
+    run(tracker, clock, until=clock.now + 3600)
+    assert tracking.phase == FAILED
+    status = TrainingStatus.objects.get(project=project)
+    assert "custom vision unreachable" in status.log
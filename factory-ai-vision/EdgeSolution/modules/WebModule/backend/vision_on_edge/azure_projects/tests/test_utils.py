@@ -0,0 +1,178 @@
+"""App utilities tests.
+"""
+
+import json
+import time
+
+import pytest
+from django.db import DataError, connection
+from django.test.utils import CaptureQueriesContext
+
+from ...azure_parts.models import Part
+from ...azure_settings.tests.factories import SettingFactory
+from ...azure_settings.tests.fake_customvision import FakeCustomVision
+from ...images.models import Image
+from .. import utils
+from ..models import Task
+from ..utils import import_customvision_images, pull_cv_project_helper
+from .factories import ProjectFactory
+
+pytestmark = pytest.mark.django_db
+
+TAGS = ["bolt", "nut", "washer"]
+
+
+@pytest.fixture
+def customvision():
+    fake = FakeCustomVision()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def project(customvision):
+    setting = SettingFactory(endpoint=customvision.endpoint, training_key="key")
+    setting.is_trainer_valid = True
+    setting.save()
+    return ProjectFactory(setting=setting)
+
+
+def pull(project, customvision_id, is_partial=False, on_progress=None):
+    with CaptureQueriesContext(connection) as queries:
+        pull_cv_project_helper(
+            project_id=project.id,
+            customvision_project_id=customvision_id,
+            is_partial=is_partial,
+            on_progress=on_progress,
+        )
+    return len(queries)
+
+
+def test_pull_full(customvision, project):
+    """test_pull_full.
+
+    Every tagged image is imported with all its regions, over a few
+    persistent connections.
+    """
+    customvision_id = customvision.add_project(
+        "Factory", TAGS, images_per_tag=40, regions_per_image=2
+    )
+    progress = []
+    pull(project, customvision_id, on_progress=lambda *args: progress.append(args))
+
+    assert Part.objects.filter(project=project).count() == len(TAGS)
+    images = Image.objects.filter(project=project)
+    assert images.count() == 120
+    for tag_name in TAGS:
+        assert images.filter(part__name=tag_name).count() == 40
+    img = images.first()
+    assert img.manual_checked and not img.uploaded
+    assert img.customvision_id in customvision.images
+    assert len(json.loads(img.labels)) == 2
+    assert json.loads(img.labels)[0] == {"x1": 0, "y1": 4, "x2": 16, "y2": 28}
+    assert img.image.read() == customvision.png
+
+    assert progress[-1] == (120, 120)
+    assert [done for done, _ in progress] == list(range(1, 121))
+    assert customvision.count("image") == 120
+    assert customvision.connections < 20
+
+
+def test_pull_queries_do_not_grow_per_image(customvision, project):
+    """test_pull_queries_do_not_grow_per_image.
+
+    Parts are resolved in memory and images bulk created, so the query
+    count grows with batches of images, not with images.
+    """
+    small = customvision.add_project("Small", TAGS, images_per_tag=20)
+    large = customvision.add_project("Large", TAGS, images_per_tag=200)
+    small_queries = pull(project, small)
+    assert Image.objects.filter(project=project).count() == 60
+    large_project = ProjectFactory(setting=project.setting)
+    large_queries = pull(large_project, large)
+    assert Image.objects.filter(project=large_project).count() == 600
+    print(f"\nqueries: 60 images {small_queries}, 600 images {large_queries}")
+    # A few per batch of PULL_BULK_SIZE images, none per image
+    assert large_queries - small_queries < (600 - 60) // 10
+
+
+def test_pull_partial(monkeypatch, customvision, project):
+    """test_pull_partial.
+
+    One image per part as icon.
+    """
+    monkeypatch.setattr(Task, "start_exporting", lambda self: None)
+    customvision_id = customvision.add_project("Factory", TAGS, images_per_tag=10)
+    pull(project, customvision_id, is_partial=True)
+    images = Image.objects.filter(project=project)
+    assert images.count() == len(TAGS)
+    assert all(img.uploaded and img.manual_checked for img in images)
+    assert customvision.count("image") == len(TAGS)
+
+
+def test_pull_discards_missing_images(customvision, project):
+    customvision_id = customvision.add_project("Factory", TAGS, images_per_tag=5)
+    missing = customvision.projects[customvision_id]["images"][0]["id"]
+    del customvision.images[missing]
+    pull(project, customvision_id)
+    assert Image.objects.filter(project=project).count() == 14
+    assert not Image.objects.filter(customvision_id=missing).exists()
+
+
+def test_concurrent_downloads_are_faster(customvision, project):
+    """test_concurrent_downloads_are_faster.
+
+    100 images at 20 ms each, one worker against eight.
+    """
+    customvision.latency = 0.02
+    customvision_id = customvision.add_project("Factory", ["bolt"], images_per_tag=100)
+    part = Part.objects.create(project=project, name="bolt")
+    trainer = project.setting.get_trainer_obj()
+    imgs = trainer.get_tagged_images(customvision_id, take=100)
+    entries = [(part, img, img.regions) for img in imgs]
+
+    durations = {}
+    for workers in (1, 8):
+        time_start = time.time()
+        created = import_customvision_images(project, entries, workers=workers)
+        durations[workers] = time.time() - time_start
+        assert created == 100
+    print(f"\n100 images: 1 worker {durations[1]:.2f}s, 8 workers {durations[8]:.2f}s")
+    assert customvision.max_active == 8
+    assert durations[8] < durations[1] / 3
+
+
+def test_pull_keeps_every_region(customvision, project):
+    customvision_id = customvision.add_project(
+        "Factory", ["bolt"], images_per_tag=2, regions_per_image=40
+    )
+    pull(project, customvision_id)
+    for img in Image.objects.filter(project=project):
+        assert len(img.labels) > 1000
+        assert len(json.loads(img.labels)) == 40
+
+
+def test_pull_skips_failed_batches(monkeypatch, customvision, project):
+    """test_pull_skips_failed_batches.
+
+    A batch the database refuses is discarded like a failed download, the
+    next batches are still saved.
+    """
+    monkeypatch.setattr(utils, "PULL_BULK_SIZE", 10)
+    bulk_create = Image.objects.bulk_create
+    batches = []
+
+    def _bulk_create(objs, *args, **kwargs):
+        batches.append([img.image.name for img in objs])
+        if len(batches) == 1:
+            raise DataError("value too long for type character varying(1000)")
+        return bulk_create(objs, *args, **kwargs)
+
+    monkeypatch.setattr(Image.objects, "bulk_create", _bulk_create)
+    customvision_id = customvision.add_project("Factory", ["bolt"], images_per_tag=30)
+    pull(project, customvision_id)
+
+    assert len(batches) == 3
+    assert Image.objects.filter(project=project).count() == 20
+    storage = Image._meta.get_field("image").storage
+    assert not any(storage.exists(name) for name in batches[0])
@@ -0,0 +1,281 @@
+"""Training tracker.
+
+Follows trainings submitted to Custom Vision until their models are
+exported. One scheduler thread polls every project in flight, each at
+the pace of its phase: often while the iteration is queued or exporting,
+rarely while it trains for minutes. The delay grows while nothing
+changes and resets on each new phase. Training status is written on
+phase changes only, and waiters are woken by the training status
+events rather than polling it.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+from ..azure_training_status import progress
+from ..azure_training_status.utils import upcreate_training_status
+from .models import Project
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+TRAINING = "training"
+EXPORTING = "exporting"
+DONE = "done"
+FAILED = "failed"
+
+# Phase -> (first, max) seconds between polls
+PHASE_DELAYS = {QUEUED: (1, 5), TRAINING: (10, 30), EXPORTING: (2, 10)}
+BACKOFF = 1.5
+QUEUED_TIMEOUT = 60  # sec, for the iteration to show up
+MAX_ERRORS = 5  # consecutive failed polls before giving up
+EXPORT_FLAVORS = ("", "ONNXFloat16")
+
+
+class Tracking:
+    """Tracking.
+
+    One training in flight.
+    """
+
+    def __init__(self, project_id, trainer, customvision_id, counter=None, now=0.0):
+        self.project_id = project_id
+        self.trainer = trainer
+        self.customvision_id = customvision_id
+        self.counter = counter
+        self.phase = QUEUED
+        self.started = now
+        self.delay = PHASE_DELAYS[QUEUED][0]
+        self.iterations = []
+        self.errors = 0
+        self.done = threading.Event()
+
+    @property
+    def iteration(self):
+        return self.iterations[0]
+
+    def __repr__(self):
+        return "<Tracking project:{} {}>".format(self.project_id, self.phase)
+
+
+class TrainingTracker:
+    """TrainingTracker.
+
+    A single scheduler for every tracking. `step` polls the trackings
+    due and is what the thread runs. Unthreaded, the caller steps it.
+    """
+
+    def __init__(self, clock=time.monotonic, threaded: bool = True):
+        self.clock = clock
+        self.threaded = threaded
+        self.cond = threading.Condition()
+        self.trackings = {}  # project_id -> Tracking
+        self.queue = []  # (due, seq, Tracking)
+        self.seq = itertools.count()
+        self.thread = None
+
+    def track(self, project_id, counter=None) -> Tracking:
+        """track.
+
+        Follow the training just submitted for a project, until exported.
+
+        Args:
+            project_id: Django ORM project id
+            counter: Project counter to increment when done
+        """
+        project_obj = Project.objects.get(pk=project_id)
+        with self.cond:
+            tracking = self.trackings.get(project_obj.id)
+            if tracking:
+                return tracking
+            tracking = Tracking(
+                project_id=project_obj.id,
+                trainer=project_obj.setting.get_trainer_obj(),
+                customvision_id=project_obj.customvision_id,
+                counter=counter,
+                now=self.clock(),
+            )
+            self.trackings[project_obj.id] = tracking
+            self._schedule(tracking)
+            if self.threaded and self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="training_tracker", daemon=True
+                )
+                self.thread.start()
+            self.cond.notify_all()
+        return tracking
+
+    def is_tracking(self, project_id) -> bool:
+        with self.cond:
+            return int(project_id) in self.trackings
+
+    def _schedule(self, tracking):
+        heapq.heappush(
+            self.queue, (self.clock() + tracking.delay, next(self.seq), tracking)
+        )
+
+    def run(self):
+        while True:
+            delay = self.step()
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait()
+                elif delay is not None:
+                    self.cond.wait(delay)
+
+    def step(self) -> float:
+        """step.
+
+        Poll the trackings due. Returns the seconds until the next one
+        is due, None if there is none.
+        """
+        while True:
+            with self.cond:
+                if not self.queue:
+                    return None
+                due, _, tracking = self.queue[0]
+                delay = due - self.clock()
+                if delay > 0:
+                    return delay
+                heapq.heappop(self.queue)
+            try:
+                self._poll(tracking)
+            except Exception:
+                logger.exception("%s lost", tracking)
+                tracking.phase = FAILED
+            with self.cond:
+                if tracking.phase in (DONE, FAILED):
+                    del self.trackings[tracking.project_id]
+                    tracking.done.set()
+                else:
+                    self._schedule(tracking)
+
+    def _poll(self, tracking):
+        phase = tracking.phase
+        try:
+            self._advance(tracking)
+            tracking.errors = 0
+        except Exception as e:
+            tracking.errors += 1
+            logger.exception("%s poll failed (%s)", tracking, tracking.errors)
+            if tracking.errors >= MAX_ERRORS:
+                self._fail(tracking, "Custom Vision error: {!r}".format(e))
+        if tracking.phase != phase:
+            logger.info("%s from %s", tracking, phase)
+            if tracking.phase in PHASE_DELAYS:
+                tracking.delay = PHASE_DELAYS[tracking.phase][0]
+        elif tracking.phase in PHASE_DELAYS:
+            tracking.delay = min(
+                tracking.delay * BACKOFF, PHASE_DELAYS[tracking.phase][1]
+            )
+
+    def _advance(self, tracking):
+        trainer = tracking.trainer
+        if tracking.phase in (QUEUED, TRAINING):
+            tracking.iterations = trainer.get_iterations(tracking.customvision_id)
+        if tracking.phase == QUEUED:
+            if not tracking.iterations:
+                if self.clock() - tracking.started > QUEUED_TIMEOUT:
+                    self._fail(
+                        tracking, "Get iteration from Custom Vision occurs error."
+                    )
+                return
+            logger.info("Iteration Found %s", tracking.iteration)
+            upcreate_training_status(
+                project_id=tracking.project_id,
+                need_to_send_notification=True,
+                **progress.PROGRESS_7_TRAINING,
+            )
+            tracking.phase = TRAINING
+        if tracking.phase == TRAINING:
+            iteration = tracking.iteration
+            if iteration.status == "Failed":
+                self._fail(tracking, "Training on Custom Vision failed.")
+                return
+            if not (iteration.exportable and iteration.status == "Completed"):
+                return
+            upcreate_training_status(
+                project_id=tracking.project_id,
+                need_to_send_notification=True,
+                **progress.PROGRESS_8_EXPORTING,
+            )
+            tracking.phase = EXPORTING
+            self._export(tracking, EXPORT_FLAVORS)
+            return
+        if tracking.phase == EXPORTING:
+            exports = trainer.get_exports(
+                tracking.customvision_id, tracking.iteration.id
+            )
+            flavors = {export.flavor or "": export for export in exports}
+            missing = [flavor for flavor in EXPORT_FLAVORS if flavor not in flavors]
+            if missing:
+                self._export(tracking, missing)
+                return
+            if any(export.status == "Failed" for export in flavors.values()):
+                self._fail(tracking, "Exporting model failed.")
+                return
+            if all(flavors[flavor].download_uri for flavor in EXPORT_FLAVORS):
+                self._finish(tracking, flavors)
+
+    def _export(self, tracking, flavors):
+        for flavor in flavors:
+            try:
+                tracking.trainer.export_iteration(
+                    project_id=tracking.customvision_id,
+                    iteration_id=tracking.iteration.id,
+                    platform="ONNX",
+                    flavor=flavor,
+                )
+            except Exception:
+                logger.exception("Export already in queue")
+
+    def _finish(self, tracking, exports):
+        project_obj = Project.objects.get(pk=tracking.project_id)
+        project_obj.download_uri = exports[""].download_uri
+        project_obj.download_uri_fp16 = exports["ONNXFloat16"].download_uri
+        logger.info("Successfully export model: %s", project_obj.download_uri)
+
+        train_performance_list = [
+            tracking.trainer.get_iteration_performance(
+                tracking.customvision_id, iteration.id
+            ).as_dict()
+            for iteration in tracking.iterations[:2]
+        ]
+        logger.info("Training Performance: %s", train_performance_list)
+        if tracking.counter:
+            setattr(
+                project_obj,
+                tracking.counter,
+                getattr(project_obj, tracking.counter) + 1,
+            )
+        project_obj.save()
+        tracking.phase = DONE
+        try:
+            upcreate_training_status(
+                project_id=tracking.project_id,
+                performance=json.dumps(train_performance_list),
+                need_to_send_notification=True,
+                **progress.PROGRESS_0_OK,
+            )
+        except Exception:
+            logger.exception("%s status not saved", tracking)
+
+    def _fail(self, tracking, log):
+        logger.error("%s failed: %s", tracking, log)
+        tracking.phase = FAILED
+        try:
+            upcreate_training_status(
+                project_id=tracking.project_id,
+                status="failed",
+                log=log,
+                need_to_send_notification=True,
+            )
+        except Exception:
+            logger.exception("%s status not saved", tracking)
+
+
+training_tracker = TrainingTracker()
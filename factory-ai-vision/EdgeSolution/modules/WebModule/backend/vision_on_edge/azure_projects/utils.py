@@ -7,6 +7,13 @@ import sys
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+import requests
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image as PILImage
 
 from configs.general_configs import PRINT_THREAD
 
@@ -16,13 +23,20 @@ from ..azure_parts.utils import batch_upload_parts_to_customvision
 from ..azure_settings.exceptions import SettingCustomVisionAccessFailed
 from ..azure_training_status import progress
 from ..azure_training_status.utils import upcreate_training_status
+from ..images.exceptions import ImageGetRemoteImageRequestsError
 from ..images.models import Image
 from ..images.utils import upload_images_to_customvision_helper
 from .exceptions import ProjectAlreadyTraining, ProjectRemovedError
 from .models import Project, Task
+from .tracker import training_tracker
 
 logger = logging.getLogger(__name__)
 
+# Pull Custom Vision Project
+PULL_DOWNLOAD_WORKERS = 8
+PULL_PAGE_SIZE = 256  # Most tagged images Custom Vision returns at once
+PULL_BULK_SIZE = 100
+
 
 def update_app_insight_counter(
     project_obj,
@@ -68,13 +82,138 @@ def update_app_insight_counter(
         raise
 
 
-def pull_cv_project_helper(project_id, customvision_project_id: str, is_partial: bool):
+def get_download_session(pool_size: int = PULL_DOWNLOAD_WORKERS):
+    """get_download_session.
+
+    requests session keeping a connection per download worker alive.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def region_labels(regions, width: int, height: int) -> list:
+    """region_labels.
+
+    Pixel labels of Custom Vision regions, the ones out of range
+    dropped as Image.set_labels does.
+    """
+    labels = []
+    for region in regions:
+        left, top = region.left, region.top
+        right, bottom = left + region.width, top + region.height
+        if min(left, top, region.width, region.height) < 0 or max(right, bottom) > 1:
+            logger.error("Region %s out of range", region)
+            continue
+        labels.append(
+            {
+                "x1": int(width * left),
+                "y1": int(height * top),
+                "x2": int(width * right),
+                "y2": int(height * bottom),
+            }
+        )
+    return labels
+
+
+def import_customvision_images(
+    project_obj,
+    entries,
+    workers: int = PULL_DOWNLOAD_WORKERS,
+    on_progress=None,
+    **image_fields,
+) -> int:
+    """import_customvision_images.
+
+    Download Custom Vision images concurrently and bulk create them.
+    Database writes stay in the calling thread.
+
+    Args:
+        project_obj:        Django ORM project
+        entries:            (part_obj, customvision image, regions) tuples
+        workers (int):      concurrent downloads
+        on_progress:        called with (done, total) as images complete
+        image_fields:       extra Image fields
+
+    Returns:
+        int: images created
+    """
+    session = get_download_session(workers)
+
+    def _download(entry):
+        part_obj, img, regions = entry
+        url = img.original_image_uri
+        try:
+            resp = session.get(url, timeout=30)
+        except requests.exceptions.RequestException:
+            raise ImageGetRemoteImageRequestsError(detail=("url: " + url))
+        if resp.status_code != 200:
+            raise ImageGetRemoteImageRequestsError(detail=("url: " + url))
+        with PILImage.open(BytesIO(resp.content)) as pil_img:
+            labels = region_labels(regions, *pil_img.size)
+        img_obj = Image(
+            project=project_obj,
+            part=part_obj,
+            remote_url=url,
+            customvision_id=img.id,
+            labels=json.dumps(labels) if labels else None,
+            **image_fields,
+        )
+        file_name = f"{part_obj.name}-{url.split('?')[0].split('/')[-1]}"
+        img_obj.image.save(file_name, ContentFile(resp.content), save=False)
+        return img_obj
+
+    created = 0
+    pending = []
+
+    def _save():
+        nonlocal created, pending
+        if not pending:
+            return
+        try:
+            with transaction.atomic():
+                Image.objects.bulk_create(pending)
+            created += len(pending)
+        except Exception:
+            # Skip the batch as a failed download, the next ones go on
+            logger.exception("Save %s remote images occur exception.", len(pending))
+            logger.exception("Images discarded...")
+            for img_obj in pending:
+                img_obj.image.delete(save=False)
+        pending = []
+
+    total = len(entries)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_download, entry) for entry in entries]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                pending.append(future.result())
+            except Exception:
+                logger.exception("Download remote image occur exception.")
+                logger.exception("Image discarded...")
+            if len(pending) >= PULL_BULK_SIZE:
+                _save()
+            if on_progress:
+                on_progress(done, total)
+    _save()
+    session.close()
+    return created
+
+
+def pull_cv_project_helper(
+    project_id, customvision_project_id: str, is_partial: bool, on_progress=None
+):
     """pull_cv_project_helper.
 
     Args:
         project_id:                     Django ORM project id
         customvision_project_id (str):  customvision_project_id
         is_partial (bool):              is_partial
+        on_progress:                    called with (done, total) images
     """
 
     logger.info("pull_cv_project_helper")
@@ -109,6 +248,7 @@ def pull_cv_project_helper(project_id, customvision_project_id: str, is_partial:
     # Download parts and images
     logger.info("Pulling Parts...")
     counter = 0
+    entries = []
     tags = trainer.get_tags(customvision_project_id)
     for tag in tags:
         logger.info("Creating Part %s: %s %s", counter, tag.name, tag.description)
@@ -140,39 +280,21 @@ def pull_cv_project_helper(project_id, customvision_project_id: str, is_partial:
                 logger.info("This tag does not have an image")
                 continue
             img = imgs_with_tag[0]
-            img_obj, created = Image.objects.update_or_create(
-                part=part_obj,
-                remote_url=img.original_image_uri,
-                customvision_id=img.id,
-                project_id=project_id,
-                uploaded=True,
-                manual_checked=True,
-            )
-            try:
-                img_obj.get_remote_image()
-            except Exception:
-                logger.exception("Download remote image occur exception.")
-                logger.exception("Image discarded...")
-                img_obj.delete()
-                continue
-
             # Image Labels
-            logger.info("Finding region with tag (%s, %s)", tag.name, tag.id)
-            for region in img.regions:
-                if region.tag_id == tag.id:
-                    logger.info("Region Found")
-                    img_obj.set_labels(
-                        left=region.left,
-                        top=region.top,
-                        width=region.width,
-                        height=region.height,
-                    )
-                    break
+            regions = [region for region in img.regions if region.tag_id == tag.id]
+            entries.append((part_obj, img, regions[:1]))
 
     logger.info("Pulled %s Parts... End", counter)
 
     # Partial Download
     if is_partial:
+        import_customvision_images(
+            project_obj,
+            entries,
+            on_progress=on_progress,
+            uploaded=True,
+            manual_checked=True,
+        )
         exporting_task_obj = Task.objects.create(
             task_type="export_iteration",
             status="init",
@@ -184,55 +306,40 @@ def pull_cv_project_helper(project_id, customvision_project_id: str, is_partial:
 
     # Full Download
     logger.info("Pulling Tagged Images...")
-    img_counter = 0
+    parts_by_tag = {}
+    for part_obj in Part.objects.filter(project_id=project_id):
+        parts_by_tag[part_obj.customvision_id] = part_obj
+        parts_by_tag[part_obj.name_lower] = part_obj
     imgs_count = trainer.get_tagged_image_count(project_id=customvision_project_id)
-    img_batch_size = 50
-    img_index = 0
 
-    while img_index <= imgs_count:
+    # One image per part, with all the regions of the part
+    for img_index in range(0, imgs_count, PULL_PAGE_SIZE):
         logger.info("Img Index: %s. Img Count: %s", img_index, imgs_count)
         imgs = trainer.get_tagged_images(
-            project_id=customvision_project_id, take=img_batch_size, skip=img_index
+            project_id=customvision_project_id, take=PULL_PAGE_SIZE, skip=img_index
         )
         for img in imgs:
-            logger.info("*** img %s", img_counter)
+            regions_by_part = {}
             for region in img.regions:
-                part_objs = Part.objects.filter(
-                    name=region.tag_name, project_id=project_id
+                part_obj = parts_by_tag.get(region.tag_id) or parts_by_tag.get(
+                    str(region.tag_name).lower()
                 )
-                if not part_objs.exists():
+                if part_obj is None:
                     continue
-                part_obj = part_objs.first()
-                img_obj, created = Image.objects.update_or_create(
-                    part=part_obj,
-                    remote_url=img.original_image_uri,
-                    project=project_obj,
-                    customvision_id=img.id,
-                    manual_checked=True,
-                )
-                if created:
-                    logger.info("Downloading img %s", img.id)
-                    img_obj.get_remote_image()
-                    logger.info("Setting label of %s", img.id)
-                    img_obj.set_labels(
-                        left=region.left,
-                        top=region.top,
-                        width=region.width,
-                        height=region.height,
-                    )
-                    img_counter += 1
-                else:
-                    # TODO:  Multiple region with same tag
-                    logger.info("Adding label to %s", img.id)
-                    img_obj.add_labels(
-                        left=region.left,
-                        top=region.top,
-                        width=region.width,
-                        height=region.height,
-                    )
-
-        img_index += img_batch_size
-    logger.info("Pulled %s images", counter)
+                regions_by_part.setdefault(part_obj, []).append(region)
+            for part_obj, regions in regions_by_part.items():
+                entries.append((part_obj, img, regions))
+
+    def _log_progress(done, total):
+        if done % PULL_BULK_SIZE == 0 or done == total:
+            logger.info("Pulled %s/%s images", done, total)
+        if on_progress:
+            on_progress(done, total)
+
+    img_counter = import_customvision_images(
+        project_obj, entries, on_progress=_log_progress, manual_checked=True
+    )
+    logger.info("Pulled %s images", img_counter)
     logger.info("Pulling Tagged Images... End")
     logger.info("Pulling Custom Vision Project... End")
 
@@ -380,131 +487,21 @@ def train_project_worker(project_id):
         )
 
     # =====================================================
-    # 6. Training (Finding Iteration)                   ===
-    # =====================================================
-    logger.info("Finding Iteration")
-    customvision_id = project_obj.customvision_id
-    wait_prepare = 0
-    max_wait_prepare = 60
-    status_init = False
-    while True:
-        time.sleep(1)
-        wait_prepare += 1
-        iterations = trainer.get_iterations(customvision_id)
-        if not status_init:
-            upcreate_training_status(
-                project_id=project_obj.id,
-                need_to_send_notification=True,
-                **progress.PROGRESS_6_PREPARING_CUSTOM_VISION_ENV,
-            )
-            status_init = True
-        if len(iterations) > 0:
-            logger.info("Iteration Found %s", iterations[0])
-            break
-        if wait_prepare > max_wait_prepare:
-            logger.info("Something went wrong...")
-            upcreate_training_status(
-                project_id=project_obj.id,
-                status="failed",
-                log="Get iteration from Custom Vision occurs error.",
-                need_to_send_notification=True,
-            )
-            break
-
-    # =====================================================
-    # 6. Training (Waiting)                             ===
-    # =====================================================
-    logger.info("Training")
-    status_init = False
-    while True:
-        time.sleep(1)
-        iterations = trainer.get_iterations(customvision_id)
-        iteration = iterations[0]
-        if not status_init:
-            upcreate_training_status(
-                project_id=project_obj.id,
-                need_to_send_notification=True,
-                **progress.PROGRESS_7_TRAINING,
-            )
-            status_init = True
-        if iteration.exportable and iteration.status == "Completed":
-            break
-        logger.info("Still training...")
-
-    # =====================================================
-    # 7. Exporting                                      ===
-    # =====================================================
-    status_init = False
-    while True:
-        time.sleep(1)
-        if not status_init:
-            upcreate_training_status(
-                project_id=project_obj.id,
-                need_to_send_notification=True,
-                **progress.PROGRESS_8_EXPORTING,
-            )
-            status_init = True
-        try:
-            project_obj.export_iteration(iteration.id)
-        except Exception:
-            logger.exception("Export already in queue")
-        try:
-            project_obj.export_iteration(iteration.id, flavor="ONNXFloat16")
-        except Exception:
-            logger.exception("Export already in queue")
-        try:
-            exports = project_obj.get_exports(iteration.id)
-        except:
-            logger.exception("get_exports exception")
-            continue
-        if (
-            len(exports) < 2
-            or not exports[0].download_uri
-            or not exports[1].download_uri
-        ):
-            logger.info("Status: exporting model")
-            continue
-        break
-
-    # =====================================================
-    # 8. Saving model and performance                   ===
+    # 6. Training, Exporting and Saving in the tracker  ===
     # =====================================================
-    logger.info("Successfully export model: %s", project_obj.download_uri)
-    logger.info("Training about to completed.")
-
-    exports = trainer.get_exports(customvision_id, iteration.id)
-    if not exports[0].flavor:
-        project_obj.download_uri = exports[0].download_uri
-        project_obj.download_uri_fp16 = exports[1].download_uri
-    else:
-        project_obj.download_uri = exports[1].download_uri
-        project_obj.download_uri_fp16 = exports[0].download_uri
-
-    train_performance_list = []
-
-    for iteration in iterations[:2]:
-        train_performance_list.append(
-            trainer.get_iteration_performance(customvision_id, iteration.id).as_dict()
-        )
-
     upcreate_training_status(
         project_id=project_obj.id,
-        performance=json.dumps(train_performance_list),
         need_to_send_notification=True,
-        **progress.PROGRESS_0_OK,
+        **progress.PROGRESS_6_PREPARING_CUSTOM_VISION_ENV,
     )
-    logger.info("Training Performance: %s", train_performance_list)
-
-    # =====================================================
-    # 0. End                                            ===
-    # =====================================================
+    counter = None
     if has_new_parts:
         logger.info("This is a training job")
-        project_obj.training_counter += 1
+        counter = "training_counter"
     elif has_new_images:
         logger.info("This is a re-training job")
-        project_obj.retraining_counter += 1
-    project_obj.save()
+        counter = "retraining_counter"
+    training_tracker.track(project_id=project_obj.id, counter=counter)
 
 
 def train_project_catcher(project_id):
@@ -540,7 +537,9 @@ class TrainingManager:
 
         Add a project in training tasks.
         """
-        if project_id in self.training_tasks:
+        if project_id in self.training_tasks or training_tracker.is_tracking(
+            project_id
+        ):
             raise ProjectAlreadyTraining
         self.mutex.acquire()
         task = TrainingTask(project_id=project_id)
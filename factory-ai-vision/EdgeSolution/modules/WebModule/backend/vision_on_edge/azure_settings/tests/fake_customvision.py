@@ -0,0 +1,292 @@
+"""Fake Custom Vision training API.
+
+A local HTTP server with the training endpoints the app uses, serving
+synthetic projects and images. Point a Setting's endpoint at
+FakeCustomVision.endpoint to use the real training client against it.
+"""
+
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+BASE_PATH = "/customvision/v3.3/training"
+CREATED = "2020-12-31T00:00:00Z"
+
+
+def synthetic_png(width=64, height=48, seed=0):
+    """PNG bytes of a small noisy image."""
+    rng = np.random.RandomState(seed)
+    img = rng.randint(0, 256, (height, width, 3), np.uint8)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+class FakeCustomVision:
+    """FakeCustomVision.
+
+    latency: seconds added to each image download
+    upload_latency: seconds added to each image upload call
+    rate_limit: upload calls per second, more are answered 429
+    retry_after: Retry-After of a 429, in seconds
+    fail_once: names of uploaded images answered ErrorStorage once
+    reverse_results: answer upload results in reverse order
+    lose_results: names of uploaded images answered under another name
+    """
+
+    def __init__(self, latency=0.0, upload_latency=0.0, rate_limit=None):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.rate_limit = rate_limit
+        self.retry_after = 1
+        self.fail_once = set()
+        self.reverse_results = False
+        self.lose_results = set()
+        self.uploads = {}  # name -> upload entry
+        self.upload_calls = []  # monotonic times
+        self.projects = {}
+        self.images = {}
+        self.png = synthetic_png()
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_project(self, name, tags, images_per_tag=0, regions_per_image=1):
+        """add_project.
+
+        A project with `images_per_tag` tagged images per tag name.
+        Returns the project id.
+        """
+        project_id = str(uuid.uuid4())
+        project = {"id": project_id, "name": name, "tags": [], "images": []}
+        for tag_name in tags:
+            tag = {
+                "id": str(uuid.uuid4()),
+                "name": tag_name,
+                "description": "",
+                "type": "Regular",
+                "imageCount": images_per_tag,
+            }
+            project["tags"].append(tag)
+            for _ in range(images_per_tag):
+                project["images"].append(self._image(tag, regions_per_image))
+        self.projects[project_id] = project
+        return project_id
+
+    def _image(self, tag, regions_per_image):
+        image_id = str(uuid.uuid4())
+        self.images[image_id] = self.png
+        regions = [
+            {
+                "regionId": str(uuid.uuid4()),
+                "tagName": tag["name"],
+                "created": CREATED,
+                "tagId": tag["id"],
+                "left": 0.1 * (i % 7),
+                "top": 0.1,
+                "width": 0.25,
+                "height": 0.5,
+            }
+            for i in range(regions_per_image)
+        ]
+        url = "{}/images/{}.png?sv=signature".format(self.endpoint, image_id)
+        return {
+            "id": image_id,
+            "created": CREATED,
+            "width": 64,
+            "height": 48,
+            "resizedImageUri": url,
+            "thumbnailUri": url,
+            "originalImageUri": url,
+            "tags": [],
+            "regions": regions,
+        }
+
+    def count(self, kind):
+        with self.lock:
+            return self.requests.get(kind, 0)
+
+    def _reply(self, handler, code, body, content_type="application/json",
+               headers=None):
+        if content_type == "application/json":
+            body = json.dumps(body).encode()
+        handler.send_response(code)
+        handler.send_header("Content-Type", content_type)
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler, method):
+        url = urlparse(handler.path)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length)) if length else None
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        match = re.fullmatch(r"/images/([\w-]+)\.png", url.path)
+        if match:
+            self._count("image")
+            self._download(handler, match.group(1))
+            return
+
+        path = url.path[len(BASE_PATH):] if url.path.startswith(BASE_PATH) else None
+        if path == "/domains":
+            self._count("domains")
+            self._reply(handler, 200, [{
+                "id": "domain-id",
+                "name": "General (compact)",
+                "type": "ObjectDetection",
+                "exportable": True,
+                "enabled": True,
+            }])
+            return
+        match = re.fullmatch(r"/projects/([\w-]+)(/.*)?", path or "")
+        if not match or match.group(1) not in self.projects:
+            self._reply(handler, 404, {"code": "BadRequestProjectNotFound",
+                                       "message": "Not found"})
+            return
+        project = self.projects[match.group(1)]
+        route = (method, match.group(2) or "")
+        self._count(route[1] or "project")
+        if route == ("GET", ""):
+            self._reply(handler, 200, {
+                "id": project["id"],
+                "name": project["name"],
+                "description": "",
+                "created": CREATED,
+                "lastModified": CREATED,
+            })
+        elif route == ("GET", "/tags"):
+            self._reply(handler, 200, project["tags"])
+        elif route == ("GET", "/images/tagged/count"):
+            self._reply(handler, 200, len(self._tagged(project, query)))
+        elif route == ("GET", "/images/tagged"):
+            skip = int(query.get("skip", 0))
+            take = int(query.get("take", 50))
+            self._reply(handler, 200, self._tagged(project, query)[skip:skip + take])
+        elif route == ("POST", "/images/files"):
+            self._upload(handler, project, body)
+        else:
+            self._reply(handler, 404, {"code": "NotFound", "message": route[1]})
+
+    def _count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def _tagged(self, project, query):
+        tag_ids = query.get("tagIds")
+        if not tag_ids:
+            return project["images"]
+        tag_ids = set(tag_ids.split(","))
+        return [
+            img for img in project["images"]
+            if any(region["tagId"] in tag_ids for region in img["regions"])
+        ]
+
+    def _download(self, handler, image_id):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            if image_id not in self.images:
+                self._reply(handler, 404, b"", content_type="text/plain")
+                return
+            self._reply(handler, 200, self.images[image_id], content_type="image/png")
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.rate_limit:
+                recent = [t for t in self.upload_calls if t > now - 1]
+                if len(recent) >= self.rate_limit:
+                    return True
+            self.upload_calls.append(now)
+            return False
+
+    def _upload(self, handler, project, body):
+        if self._throttled():
+            self._count("throttled")
+            self._reply(handler, 429, {"code": "TooManyRequests",
+                                       "message": "Rate limit exceeded"},
+                        headers={"Retry-After": str(self.retry_after)})
+            return
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.upload_latency)
+            results = []
+            for entry in body["images"]:
+                name = entry["name"]
+                # The service quotes file names in sourceUrl
+                source_url = '"{}"'.format(
+                    "lost" if name in self.lose_results else name
+                )
+                with self.lock:
+                    failed = name in self.fail_once
+                    self.fail_once.discard(name)
+                if failed:
+                    results.append({"sourceUrl": source_url, "status": "ErrorStorage"})
+                    continue
+                image_id = str(uuid.uuid4())
+                url = "{}/images/{}.png".format(self.endpoint, image_id)
+                with self.lock:
+                    self.uploads[name] = entry
+                results.append({
+                    "sourceUrl": source_url,
+                    "status": "OK",
+                    "image": {"id": image_id, "created": CREATED,
+                              "originalImageUri": url, "regions": []},
+                })
+            if self.reverse_results:
+                results.reverse()
+            self._reply(handler, 200, {
+                "isBatchSuccessful": all(r["status"] == "OK" for r in results),
+                "images": results,
+            })
+        finally:
+            with self.lock:
+                self.active -= 1
@@ -0,0 +1,76 @@
+"""App utilities tests.
+"""
+
+import threading
+
+import pytest
+from django.db.models.signals import post_save
+
+from ...azure_projects.tests.factories import ProjectFactory
+from .. import progress
+from ..models import TrainingStatus
+from ..utils import (
+    TrainingStatusEvents,
+    training_status_events,
+    upcreate_training_status,
+)
+
+pytestmark = pytest.mark.django_db
+
+
+def test_upcreate_training_status_writes_changes_only():
+    project = ProjectFactory()
+    TrainingStatus.objects.create(project=project)
+    saves = []
+    post_save.connect(
+        lambda **kwargs: saves.append(kwargs["instance"]),
+        sender=TrainingStatus,
+        weak=False,
+        dispatch_uid="test_saves",
+    )
+    try:
+        version = training_status_events.version(project.id)
+        for _ in range(3):
+            upcreate_training_status(
+                project_id=project.id, **progress.PROGRESS_7_TRAINING
+            )
+        assert not upcreate_training_status(
+            project_id=project.id, **progress.PROGRESS_7_TRAINING
+        )
+        assert upcreate_training_status(
+            project_id=project.id,
+            need_to_send_notification=True,
+            **progress.PROGRESS_7_TRAINING
+        )
+    finally:
+        post_save.disconnect(sender=TrainingStatus, dispatch_uid="test_saves")
+
+    assert len(saves) == 2
+    assert training_status_events.version(project.id) == version + 2
+    assert training_status_events.wait(project.id, version + 1, timeout=0) == (
+        version + 2,
+        "training",
+        "Training on custom vision (may take 10-15 minutes).",
+    )
+
+
+def test_events_wake_waiters():
+    events = TrainingStatusEvents()
+    received = []
+
+    def _wait():
+        version = 0
+        while True:
+            version, status, log = events.wait(1, version, timeout=5)
+            received.append(status)
+            if status == "ok":
+                return
+
+    waiter = threading.Thread(target=_wait)
+    waiter.start()
+    for status in ("training", "exporting", "ok"):
+        events.publish(1, status, "")
+    waiter.join(5)
+    # Statuses published before the waiter woke up are skipped, not the last
+    assert received[-1] == "ok"
+    assert events.wait(2, timeout=0.01) is None
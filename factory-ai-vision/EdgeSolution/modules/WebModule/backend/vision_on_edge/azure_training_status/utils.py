@@ -2,19 +2,58 @@
 """
 
 import logging
+import threading
 
 from .models import TrainingStatus
 
 logger = logging.getLogger(__name__)
 
 
+class TrainingStatusEvents:
+    """TrainingStatusEvents.
+
+    The latest training status of each project, published when it
+    changes, for threads waiting on it instead of polling the database.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.statuses = {}  # project_id -> (version, status, log)
+
+    def version(self, project_id) -> int:
+        with self.cond:
+            return self.statuses.get(int(project_id), (0, None, None))[0]
+
+    def publish(self, project_id, status: str, log: str):
+        with self.cond:
+            version = self.version(project_id) + 1
+            self.statuses[int(project_id)] = (version, status, log)
+            self.cond.notify_all()
+
+    def wait(self, project_id, version: int = 0, timeout: float = None):
+        """wait.
+
+        (version, status, log) of the first status published after
+        `version`, None on timeout.
+        """
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.version(project_id) > version, timeout
+            ):
+                return None
+            return self.statuses[int(project_id)]
+
+
+training_status_events = TrainingStatusEvents()
+
+
 def upcreate_training_status(
     project_id,
     status: str,
     log: str,
     performance: str = "{}",
     need_to_send_notification: bool = False,
-):
+) -> bool:
     """upcreate_training_status.
 
     Consider using constants.PROGRESS_X to replace status and log.
@@ -34,17 +73,28 @@ def upcreate_training_status(
             performance
         need_to_send_notification (bool):
             If true, notification will be created.
+
+    Returns:
+        bool: False if the status was unchanged and not saved
     """
+    training_status_object = TrainingStatus.objects.get(project_id=project_id)
+    fields = {
+        "status": status,
+        "log": log.capitalize(),
+        "performance": performance,
+        "need_to_send_notification": need_to_send_notification,
+    }
+    if all(getattr(training_status_object, k) == v for k, v in fields.items()):
+        return False
+
     logger.info("Updating Training Status   :%s", status)
     logger.info("Updating Training Log      :%s", log)
     logger.info("need_to_send_notification  :%s", need_to_send_notification)
-
-    training_status_object = TrainingStatus.objects.get(project_id=project_id)
-    training_status_object.status = status
-    training_status_object.log = log.capitalize()
-    training_status_object.performance = performance
-    training_status_object.need_to_send_notification = need_to_send_notification
+    for key, value in fields.items():
+        setattr(training_status_object, key, value)
     training_status_object.save()
+    training_status_events.publish(project_id, status, fields["log"])
+    return True
 
 
 # def training_status_failed(project_id,
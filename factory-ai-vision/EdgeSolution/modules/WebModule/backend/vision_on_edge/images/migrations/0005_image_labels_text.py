@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-19 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0004_image_manual_checked"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="image",
+            name="labels",
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -29,7 +29,7 @@ class Image(models.Model):
     part = models.ForeignKey(Part, on_delete=models.SET_NULL, null=True)
     camera = models.ForeignKey(Camera, on_delete=models.SET_NULL, null=True)
     image = models.ImageField(upload_to="images/")
-    labels = models.CharField(max_length=1000, null=True)
+    labels = models.TextField(null=True)
     is_relabel = models.BooleanField(default=False)
     confidence = models.FloatField(default=0.0)
     uploaded = models.BooleanField(default=False)
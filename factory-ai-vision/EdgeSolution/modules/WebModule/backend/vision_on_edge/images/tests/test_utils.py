@@ -0,0 +1,158 @@
+"""App utilities tests.
+"""
+
+import json
+import time
+
+import pytest
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ...azure_parts.tests.factories import PartFactory
+from ...azure_projects.tests.factories import ProjectFactory
+from ...azure_settings.tests.factories import SettingFactory
+from ...azure_settings.tests.fake_customvision import FakeCustomVision
+from .. import utils
+from ..models import Image
+from ..utils import upload_images_to_customvision_helper
+
+pytestmark = pytest.mark.django_db
+
+LABEL = {"x1": 16, "y1": 12, "x2": 48, "y2": 36}
+
+
+@pytest.fixture
+def customvision():
+    fake = FakeCustomVision()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def part(customvision):
+    customvision_id = customvision.add_project("Factory", ["bolt"])
+    tag_id = customvision.projects[customvision_id]["tags"][0]["id"]
+    setting = SettingFactory(endpoint=customvision.endpoint, training_key="key")
+    setting.is_trainer_valid = True
+    setting.save()
+    project = ProjectFactory(setting=setting, customvision_id=customvision_id)
+    return PartFactory(project=project, name="bolt", customvision_id=tag_id)
+
+
+def create_images(part, count, labels=(LABEL,), png=None):
+    images = []
+    for _ in range(count):
+        image = Image(
+            project=part.project,
+            part=part,
+            labels=json.dumps(list(labels)),
+            manual_checked=True,
+        )
+        image.image.save("img.png", ContentFile(png), save=False)
+        images.append(image)
+    Image.objects.bulk_create(images)
+
+
+def upload(part, **kwargs):
+    return upload_images_to_customvision_helper(
+        project_id=part.project.id, part_id=part.id, **kwargs
+    )
+
+
+def test_upload(customvision, part):
+    """test_upload.
+
+    Full batches, results mapped back to the images and saved in bulk.
+    """
+    create_images(part, 150, png=customvision.png)
+    with CaptureQueriesContext(connection) as queries:
+        assert upload(part)
+    assert len(queries) < 10
+
+    assert customvision.count("/images/files") == 3
+    images = Image.objects.filter(part=part)
+    assert all(img.uploaded for img in images)
+    for img in images:
+        entry = customvision.uploads["img-{}".format(img.id)]
+        assert img.remote_url.endswith(img.customvision_id + ".png")
+        region = entry["regions"][0]
+        assert region["tagId"] == part.customvision_id
+        assert (region["left"], region["top"]) == (0.25, 0.25)
+        assert (region["width"], region["height"]) == (0.5, 0.5)
+    assert len({img.customvision_id for img in images}) == 150
+
+
+def test_upload_skips_unlabeled(customvision, part):
+    create_images(part, 2, png=customvision.png)
+    create_images(part, 1, labels=(), png=customvision.png)
+    assert upload(part)
+    assert Image.objects.filter(part=part, uploaded=True).count() == 2
+    assert len(customvision.uploads) == 2
+
+
+def test_upload_nothing(customvision, part):
+    assert not upload(part)
+    assert customvision.count("/images/files") == 0
+
+
+def test_upload_retries_throttled(monkeypatch, customvision, part):
+    """test_upload_retries_throttled.
+
+    Calls over the server's rate limit are sent again after Retry-After.
+    """
+    monkeypatch.setattr(utils, "UPLOAD_BACKOFF", 0.05)
+    customvision.rate_limit = 4
+    create_images(part, 40, png=customvision.png)
+    upload(part, batch_size=5, rate=0)
+    assert customvision.count("throttled") > 0
+    assert Image.objects.filter(part=part, uploaded=True).count() == 40
+
+
+@pytest.mark.parametrize("reverse_results", [False, True])
+def test_upload_retries_failed_images(monkeypatch, customvision, part, reverse_results):
+    monkeypatch.setattr(utils, "UPLOAD_BACKOFF", 0.05)
+    # Results are matched to images by name, not by position
+    customvision.reverse_results = reverse_results
+    create_images(part, 20, png=customvision.png)
+    failing = list(Image.objects.filter(part=part)[:3])
+    customvision.fail_once = {"img-{}".format(img.id) for img in failing}
+    upload(part)
+    assert customvision.count("/images/files") == 2
+    assert Image.objects.filter(part=part, uploaded=True).count() == 20
+
+
+def test_upload_counts_unmatched_results(caplog, customvision, part):
+    create_images(part, 5, png=customvision.png)
+    lost = Image.objects.filter(part=part).first()
+    customvision.lose_results = {"img-{}".format(lost.id)}
+    with caplog.at_level("INFO", logger=utils.logger.name):
+        upload(part)
+    assert "4 uploaded, 1 failed" in caplog.text
+    assert not Image.objects.get(pk=lost.id).uploaded
+    assert Image.objects.filter(part=part, uploaded=True).count() == 4
+
+
+def test_upload_throughput(customvision, part):
+    """test_upload_throughput.
+
+    256 images at 100 ms per call: batches of 10 one at a time, against
+    full batches in parallel.
+    """
+    customvision.upload_latency = 0.1
+    create_images(part, 256, png=customvision.png)
+
+    time_start = time.time()
+    upload(part, batch_size=10, workers=1)
+    serial = time.time() - time_start
+    Image.objects.filter(part=part).update(uploaded=False)
+    time_start = time.time()
+    upload(part)
+    concurrent = time.time() - time_start
+
+    print(
+        "\n256 images: {:.0f} images/sec in batches of 10, {:.0f} images/sec "
+        "concurrent".format(256 / serial, 256 / concurrent)
+    )
+    assert customvision.max_active > 1
+    assert concurrent < serial / 4
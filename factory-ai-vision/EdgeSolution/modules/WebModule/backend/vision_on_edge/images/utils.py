@@ -1,15 +1,21 @@
 """App utilities.
 """
 
-import datetime
 import json
 import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
 
 from azure.cognitiveservices.vision.customvision.training.models import (
+    CustomVisionErrorException,
     ImageFileCreateBatch,
     ImageFileCreateEntry,
     Region,
 )
+from PIL import Image as PILImage
 
 from vision_on_edge.azure_parts.models import Part
 from vision_on_edge.azure_projects.models import Project
@@ -18,9 +24,174 @@ from .models import Image
 
 logger = logging.getLogger(__name__)
 
+UPLOAD_BATCH_SIZE = 64  # Most images Custom Vision accepts in one call
+UPLOAD_WORKERS = 4  # Batches in flight
+UPLOAD_READ_AHEAD = 2 * UPLOAD_BATCH_SIZE  # Image files read ahead of the uploads
+UPLOAD_RATE = 10  # Calls per second, the Custom Vision S0 training limit
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF = 1  # sec, doubled on each retry
+THROTTLED = (429, 503)
+# Per image statuses worth sending again
+RETRY_STATUSES = ("ErrorStorage", "ErrorUnknown")
+UPLOADED_STATUSES = ("OK", "OKDuplicate")
+
+
+class RateLimiter:
+    """RateLimiter.
+
+    Spaces calls shared by threads to at most `rate` per second. A
+    throttled call pauses every caller.
+    """
+
+    def __init__(self, rate: float = UPLOAD_RATE):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+def get_regions(labels: list, tag_id: str, width: int, height: int) -> list:
+    """get_regions.
+
+    Custom Vision regions, relative to the image size, of labels in pixels.
+    """
+    return [
+        Region(
+            tag_id=tag_id,
+            left=label["x1"] / width,
+            top=label["y1"] / height,
+            width=(label["x2"] - label["x1"]) / width,
+            height=(label["y2"] - label["y1"]) / height,
+        )
+        for label in labels
+    ]
+
+
+def read_image_entry(image_obj: Image, tag_id: str):
+    """read_image_entry.
+
+    The upload entry of a labeled image, None if it has no labels or
+    cannot be read. Named after the image id to map results back.
+    """
+    try:
+        labels = json.loads(image_obj.labels)
+        if not labels:
+            return None
+        image = image_obj.image
+        image.open()
+        try:
+            contents = image.read()
+        finally:
+            image.close()
+        with PILImage.open(BytesIO(contents)) as pil_img:
+            regions = get_regions(labels, tag_id, *pil_img.size)
+        return ImageFileCreateEntry(
+            name="img-{}".format(image_obj.id), contents=contents, regions=regions
+        )
+    except Exception:
+        logger.exception("Cannot read image %s", image_obj.id)
+        return None
+
+
+def read_ahead(func, items, workers: int, read_ahead: int):
+    """read_ahead.
+
+    Yields func(item) in order, computed by `workers` threads at most
+    `read_ahead` items ahead of the consumer.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="read_ahead"
+    ) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= read_ahead:
+                break
+        while futures:
+            result = futures.popleft().result()
+            for item in items:
+                futures.append(executor.submit(func, item))
+                break
+            yield result
+
+
+def retry_after(error: CustomVisionErrorException, attempt: int) -> float:
+    """Seconds to wait before sending again, at least the server's Retry-After."""
+    backoff = UPLOAD_BACKOFF * 2 ** attempt
+    try:
+        return max(backoff, float(error.response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return backoff
+
+
+def upload_image_batch(trainer, customvision_project_id, entries, limiter) -> dict:
+    """upload_image_batch.
+
+    Uploads one batch, sending again the whole batch when throttled and
+    the images with a transient error status, with backoff.
+
+    Returns:
+        dict: entry name to ImageCreateResult, for every entry the
+            service answered
+    """
+    results = {}
+    pending = list(entries)
+    attempt = 0
+    while pending:
+        limiter.wait()
+        try:
+            summary = trainer.create_images_from_files(
+                project_id=customvision_project_id,
+                batch=ImageFileCreateBatch(images=pending),
+            )
+        except CustomVisionErrorException as error:
+            status_code = getattr(error.response, "status_code", None)
+            if status_code not in THROTTLED or attempt >= UPLOAD_RETRIES:
+                raise
+            delay = retry_after(error, attempt)
+            logger.warning(
+                "Upload of %s images throttled, retry in %.1f sec", len(pending), delay
+            )
+            limiter.pause(delay)
+            attempt += 1
+            continue
+        retry = []
+        by_name = {entry.name: entry for entry in pending}
+        for result in summary.images:
+            # The service answers file names in quotes, e.g. '"img-12"'
+            entry = by_name.get((result.source_url or "").strip('"'))
+            if entry is None:
+                logger.error("Upload result of unknown image %s", result.source_url)
+                continue
+            results[entry.name] = result
+            if result.status in RETRY_STATUSES and attempt < UPLOAD_RETRIES:
+                retry.append(entry)
+        if retry:
+            logger.warning("Retry %s images with errors", len(retry))
+            time.sleep(UPLOAD_BACKOFF * 2 ** attempt)
+            attempt += 1
+        pending = retry
+    return results
+
 
 def upload_images_to_customvision_helper(
-    project_id, part_id, batch_size: int = 10
+    project_id,
+    part_id,
+    batch_size: int = UPLOAD_BATCH_SIZE,
+    workers: int = UPLOAD_WORKERS,
+    rate: float = UPLOAD_RATE,
 ) -> bool:
     """upload_images_to_customvision_helper.
 
@@ -28,103 +199,118 @@ def upload_images_to_customvision_helper(
     Make sure part already upload to Custom Vision (
     customvision_id not null or blank).
 
+    Image files are read ahead in threads, full batches are uploaded
+    `workers` at a time within `rate` calls per second, and the images
+    uploaded are updated in bulk.
+
     Args:
         project_id:
         part_id:
-        batch_size (int): batch_size
+        batch_size (int): images per call
+        workers (int): calls in flight
+        rate (float): calls per second
 
     Returns:
-        bool:
+        bool: if there were images to upload
     """
 
     logger.info("Uploading images with part_id %s", part_id)
 
-    has_new_images = False
     project_obj = Project.objects.get(pk=project_id)
     trainer = project_obj.setting.get_trainer_obj()
     part_obj: Part = Part.objects.get(pk=part_id)
     tag_id = part_obj.customvision_id
-    images = Image.objects.filter(part_id=part_id, manual_checked=True, uploaded=False)
+    images = list(
+        Image.objects.filter(part_id=part_id, manual_checked=True, uploaded=False)
+    )
     logger.info("Tag id %s", tag_id)
-    count = 0
-    img_entries = []
-    img_objs = []
-
     logger.info("Image length: %s", len(images))
+    if not images:
+        return False
 
-    for index, image_obj in enumerate(images):
-        logger.info("*** image %s, %s", index + 1, image_obj)
-        has_new_images = True
-
-        img_name = "img-" + datetime.datetime.utcnow().isoformat()
+    image_objs = {"img-{}".format(image_obj.id): image_obj for image_obj in images}
+    limiter = RateLimiter(rate)
+    time_start = time.time()
+    uploaded = []
+    failed = 0
 
-        regions = []
-        width = image_obj.image.width
-        height = image_obj.image.height
+    def _collect(future):
+        nonlocal failed
         try:
-            labels = json.loads(image_obj.labels)
-            if len(labels) == 0:
+            results = future.result()
+        except Exception:
+            logger.exception("Upload of a batch failed")
+            failed += future.batch_size
+            return
+        # Images without a result of their own
+        failed += future.batch_size - len(results)
+        for name, result in results.items():
+            image_obj = image_objs.get(name)
+            if image_obj is None:
                 continue
-            for label in labels:
-                label_x = label["x1"] / width
-                label_y = label["y1"] / height
-                label_w = (label["x2"] - label["x1"]) / width
-                label_h = (label["y2"] - label["y1"]) / height
-                region = Region(
-                    tag_id=tag_id,
-                    left=label_x,
-                    top=label_y,
-                    width=label_w,
-                    height=label_h,
-                )
-                regions.append(region)
-
-            image = image_obj.image
-            image.open()
-            img_entry = ImageFileCreateEntry(
-                name=img_name, contents=image.read(), regions=regions
-            )
-            img_objs.append(image_obj)
-            img_entries.append(img_entry)
-            count += 1
-        except:
-            logger.exception("unexpected error")
-
-        if len(img_entries) >= batch_size:
-            logger.info("Uploading %s images", len(img_entries))
-            upload_result = trainer.create_images_from_files(
-                project_id=project_obj.customvision_id,
-                batch=ImageFileCreateBatch(images=img_entries),
-            )
-            logger.info(
-                "Uploading images... Is batch success: %s",
-                upload_result.is_batch_successful,
+            if result.status not in UPLOADED_STATUSES:
+                logger.warning("Upload of image %s: %s", image_obj.id, result.status)
+                failed += 1
+                continue
+            if result.image:
+                image_obj.customvision_id = result.image.id
+                image_obj.remote_url = result.image.original_image_uri
+            image_obj.uploaded = True
+            uploaded.append(image_obj)
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="upload_images"
+    ) as executor:
+        in_flight = set()
+
+        def _submit(batch):
+            future = executor.submit(
+                upload_image_batch,
+                trainer,
+                project_obj.customvision_id,
+                batch,
+                limiter,
             )
-            img_entries = []
-            for i, img_obj in enumerate(img_objs):
-                img_obj.customvision_id = upload_result.images[i].image.id
-                img_obj.uploaded = True
-                img_obj.save()
-            img_objs = []
-
-    if len(img_entries) >= 1:
-        logger.info("Uploading %s images", len(img_entries))
-        upload_result = trainer.create_images_from_files(
-            project_id=project_obj.customvision_id,
-            batch=ImageFileCreateBatch(images=img_entries),
-        )
-        logger.info(
-            "Uploading images... Is batch success: %s",
-            upload_result.is_batch_successful,
+            future.batch_size = len(batch)
+            in_flight.add(future)
+            # Keep reading while uploading, but no more than a batch per worker
+            while len(in_flight) >= workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for done_future in done:
+                    in_flight.remove(done_future)
+                    _collect(done_future)
+
+        batch = []
+        entries = read_ahead(
+            lambda image_obj: read_image_entry(image_obj, tag_id),
+            images,
+            workers=workers,
+            read_ahead=max(UPLOAD_READ_AHEAD, batch_size),
         )
-        for i, img_obj in enumerate(img_objs):
-            img_obj.customvision_id = upload_result.images[i].image.id
-            img_obj.remote_url = upload_result.images[i].image.original_image_uri
-            img_obj.uploaded = True
-            img_obj.save()
-    logger.info("Uploading images... Done")
-    logger.info("Has new images: %s", has_new_images)
-    return has_new_images
+        for entry in entries:
+            if entry is None:
+                continue
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                _submit(batch)
+                batch = []
+        if batch:
+            _submit(batch)
+        for future in in_flight:
+            _collect(future)
+
+    Image.objects.bulk_update(
+        uploaded, ["customvision_id", "remote_url", "uploaded"], batch_size=500
+    )
+    elapsed = time.time() - time_start
+    logger.info(
+        "Uploading images... Done, %s uploaded, %s failed in %.1f sec (%.1f images/sec)",
+        len(uploaded),
+        failed,
+        elapsed,
+        len(uploaded) / elapsed if elapsed else 0,
+    )
+    return True
 
 
 def upload_and_sync_images(part_id):
@@ -1,6 +1,7 @@
 """App models.
 """
 
+import atexit
 import logging
 import threading
 import time
@@ -9,7 +10,7 @@ import cv2
 
 from configs.general_configs import PRINT_THREAD
 
-from ..cameras.utils import normalize_rtsp, verify_rtsp
+from ..cameras.utils import normalize_rtsp
 from .exceptions import StreamOpenRTSPError
 
 logger = logging.getLogger(__name__)
@@ -20,11 +21,215 @@ KEEP_ALIVE_THRESHOLD = 10  # Seconds
 # Stream Manager
 STREAM_GC_TIME_THRESHOLD = 5  # Seconds
 
+# Capture Relay
+RELAY_IDLE_GRACE = 10  # Seconds a capture stays open without viewers
+RELAY_MAX_FPS = 30
+RELAY_RECONNECT_DELAY = 1  # Seconds
+FRAME_WAIT_TIMEOUT = 5  # Seconds
+
+
+class CaptureRelay:
+    """CaptureRelay.
+
+    One capture of a camera shared by all its viewers. Frames are
+    resized and encoded once, then handed to every viewer.
+    """
+
+    def __init__(self, rtsp, idle_grace=RELAY_IDLE_GRACE, max_fps=RELAY_MAX_FPS):
+        self.rtsp = rtsp
+        self.idle_grace = idle_grace
+        self.max_fps = max_fps
+
+        self.open_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.status = "init"
+        self.viewers = 0
+        self.idle_since = None
+        self.cap = None
+        self.thread = None
+        self.closed = False
+        self.opens = 0
+        self.index = 0
+        self.img = None
+        self.jpeg = None
+
+    def _open(self):
+        self.opens += 1
+        cap = cv2.VideoCapture(self.rtsp)
+        if not cap.isOpened():
+            cap.release()
+            return None, None
+        has_img, img = cap.read()
+        if not has_img:
+            cap.release()
+            return None, None
+        return cap, img
+
+    def _publish(self, img):
+        img = cv2.resize(img, None, fx=0.5, fy=0.5)
+        jpeg = cv2.imencode(".jpg", img)[1].tobytes()
+        with self.cond:
+            self.index += 1
+            self.img = img
+            self.jpeg = jpeg
+            self.cond.notify_all()
+
+    def acquire(self):
+        """acquire.
+
+        Add a viewer, opening the capture for the first one. False if the
+        relay was torn down and a new one is needed.
+        """
+        with self.open_lock:
+            with self.cond:
+                if self.status == "stopped":
+                    return False
+                if self.status == "running":
+                    self.viewers += 1
+                    self.idle_since = None
+                    return True
+            cap, img = self._open()
+            if cap is None:
+                with self.cond:
+                    self.status = "stopped"
+                raise StreamOpenRTSPError
+            self.cap = cap
+            self._publish(img)
+            with self.cond:
+                self.status = "running"
+                self.viewers = 1
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            logger.info("%s opened.", self)
+            return True
+
+    def release(self):
+        """Remove a viewer, the capture closes after the idle grace."""
+        with self.cond:
+            self.viewers = max(0, self.viewers - 1)
+            if self.viewers == 0:
+                self.idle_since = time.time()
+
+    def stop(self):
+        """Close the capture now, whatever the viewers."""
+        with self.cond:
+            self.status = "stopped"
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=RELAY_RECONNECT_DELAY + 1)
+
+    def _idle(self):
+        with self.cond:
+            if self.status == "stopped":
+                return True
+            if self.viewers or self.idle_since + self.idle_grace > time.time():
+                return False
+            self.status = "stopped"
+            self.img = self.jpeg = None
+            self.cond.notify_all()
+            return True
+
+    def _run(self):
+        period = 1 / self.max_fps
+        next_read = time.time()
+        while not self._idle():
+            delay = next_read - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_read = max(next_read + period, time.time())
+            has_img, img = self.cap.read()
+            if not has_img:
+                self.cap.release()
+                time.sleep(RELAY_RECONNECT_DELAY)
+                self.cap = cv2.VideoCapture(self.rtsp)
+                self.opens += 1
+                continue
+            self._publish(img)
+        self.cap.release()
+        if not self.closed:
+            # Logging may already be shut down at exit
+            logger.info("%s cap released.", self)
+
+    def next_frame(self, after, timeout=FRAME_WAIT_TIMEOUT):
+        """next_frame.
+
+        (index, jpeg) of the first frame after index `after`, the latest
+        frame after `timeout`, None if there is none.
+        """
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.index > after or self.status == "stopped", timeout
+            )
+            if self.jpeg is None:
+                return None
+            return self.index, self.jpeg
+
+    def __str__(self):
+        return f"<CaptureRelay rtsp:{self.rtsp} viewers:{self.viewers}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class CaptureRelays:
+    """CaptureRelays.
+
+    The relays, one per camera source.
+    """
+
+    def __init__(self, idle_grace=RELAY_IDLE_GRACE, max_fps=RELAY_MAX_FPS):
+        self.idle_grace = idle_grace
+        self.max_fps = max_fps
+        self.mutex = threading.Lock()
+        self.relays = {}
+
+    def acquire(self, rtsp) -> CaptureRelay:
+        """acquire.
+
+        The relay of rtsp, with one more viewer.
+        """
+        while True:
+            with self.mutex:
+                relay = self.relays.get(rtsp)
+                if relay is None:
+                    relay = CaptureRelay(
+                        rtsp, idle_grace=self.idle_grace, max_fps=self.max_fps
+                    )
+                    self.relays[rtsp] = relay
+            try:
+                if relay.acquire():
+                    return relay
+            finally:
+                with self.mutex:
+                    if relay.status == "stopped" and self.relays.get(rtsp) is relay:
+                        del self.relays[rtsp]
+
+    def running(self):
+        """running relays."""
+        with self.mutex:
+            return [
+                relay for relay in self.relays.values() if relay.status == "running"
+            ]
+
+    def close(self):
+        """Close all captures."""
+        with self.mutex:
+            relays = list(self.relays.values())
+            self.relays.clear()
+        for relay in relays:
+            relay.stop()
+
+
+capture_relays = CaptureRelays()
+# A capture thread still in OpenCV at interpreter exit aborts the process
+atexit.register(capture_relays.close)
+
 
 class Stream:
     """Stream Class"""
 
-    def __init__(self, rtsp, camera_id, part_id=None):
+    def __init__(self, rtsp, camera_id, part_id=None, relays=None):
         self.rtsp = normalize_rtsp(rtsp=rtsp)
         self.camera_id = camera_id
         self.part_id = part_id
@@ -33,13 +238,17 @@ class Stream:
         self.status = "init"
         self.cur_img_index = 0
         self.last_get_img_index = 1
+        self.last_frame_index = 0
         self.id = id(self)
 
-        # test rtsp
-        if not verify_rtsp(self.rtsp):
-            raise StreamOpenRTSPError
-        self.cap = cv2.VideoCapture(self.rtsp)
-        self.last_img = self.cap.read()[1]
+        # Opens the camera for its first viewer only
+        self.relay = (relays or capture_relays).acquire(self.rtsp)
+        self.released = False
+
+    @property
+    def last_img(self):
+        """Latest frame of the camera, resized."""
+        return self.relay.img
 
     def update_keep_alive(self):
         """update_keep_alive."""
@@ -53,45 +262,30 @@ class Stream:
         while self.status == "running" and (
             self.last_active + KEEP_ALIVE_THRESHOLD > time.time()
         ):
-            if not self.cap.isOpened():
-                raise StreamOpenRTSPError
-            has_img, img = self.cap.read()
-            # Need to add the video flag FIXME
-            if not has_img:
-                self.cap = cv2.VideoCapture(self.rtsp)
-                time.sleep(1)
+            frame = self.relay.next_frame(self.last_frame_index, timeout=1)
+            if frame is None or frame[0] == self.last_frame_index:
                 continue
-
-            img = cv2.resize(img, None, fx=0.5, fy=0.5)
+            self.last_frame_index, jpeg = frame
             self.last_active = time.time()
-            self.last_img = img.copy()
             self.cur_img_index = (self.cur_img_index + 1) % 10000
             yield (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n"
-                + cv2.imencode(".jpg", img)[1].tobytes()
-                + b"\r\n"
+                b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + jpeg + b"\r\n"
             )
-        self.cap.release()
-        logger.info("%s cap released.", self)
+        self.close()
 
     def get_frame(self):
-        """get_frame."""
+        """get_frame.
+
+        A frame newer than the last one this stream sent, or the latest
+        after 5 seconds.
+        """
         logger.info("%s get frame.", self)
-        # b, img = self.cap.read()
-        time_begin = time.time()
-        while True:
-            if time.time() - time_begin > 5:
-                break
-            if self.last_get_img_index == self.cur_img_index:
-                time.sleep(0.01)
-            else:
-                break
+        frame = self.relay.next_frame(self.last_frame_index)
+        if frame is None:
+            raise StreamOpenRTSPError
+        self.last_frame_index, jpeg = frame
         self.last_get_img_index = self.cur_img_index
-        img = self.last_img.copy()
-        # if b: return cv2.imencode('.jpg', img)[1].tobytes()
-        # else : return None
-        return cv2.imencode(".jpg", img)[1].tobytes()
+        return jpeg
 
     def close(self):
         """close.
@@ -99,6 +293,9 @@ class Stream:
         close the stream.
         """
         self.status = "stopped"
+        if not self.released:
+            self.released = True
+            self.relay.release()
         logger.info("%s stopped.", self)
 
     def __str__(self):
@@ -100,13 +100,13 @@ def test_method_get_frame_after_generated(camera):
 def test_method_get_frame_no_generated(camera):
     """test_method_get_frame.
 
-    Make sure a stream will wait to try get a new image
+    Make sure a stream will wait to get a new image
     """
-    time_start = time.time()
     stream_obj = Stream(rtsp=camera.rtsp, camera_id=camera.id)
     stream_obj.get_frame()
+    first_index = stream_obj.last_frame_index
     stream_obj.get_frame()
-    assert time.time() - time_start > 3
+    assert stream_obj.last_frame_index > first_index
 
 
 @pytest.mark.fast
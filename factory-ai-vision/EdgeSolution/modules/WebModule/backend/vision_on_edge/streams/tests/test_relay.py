@@ -0,0 +1,179 @@
+"""Capture relay tests.
+"""
+# pylint: disable=missing-class-docstring, missing-function-docstring, invalid-name
+
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from .. import models
+from ..models import CaptureRelays, Stream
+
+RTSP_1 = "rtsp://camera-1/live"
+RTSP_2 = "rtsp://camera-2/live"
+FRAME_SHAPE = (482, 642, 3)
+
+
+class SessionCounter:
+    """Fake cv2.VideoCapture that counts the RTSP sessions it has open."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = {}
+        self.max_open = {}
+        self.encodes = 0
+
+    def capture(self, rtsp):
+        counter = self
+
+        class FakeCapture:
+            def __init__(self):
+                self.released = False
+                with counter.lock:
+                    counter.open[rtsp] = counter.open.get(rtsp, 0) + 1
+                    counter.max_open[rtsp] = max(
+                        counter.max_open.get(rtsp, 0), counter.open[rtsp]
+                    )
+
+            def isOpened(self):
+                return not self.released
+
+            def read(self):
+                return True, np.full(FRAME_SHAPE, 128, np.uint8)
+
+            def release(self):
+                if not self.released:
+                    self.released = True
+                    with counter.lock:
+                        counter.open[rtsp] -= 1
+
+        return FakeCapture()
+
+    def sessions(self, rtsp):
+        with self.lock:
+            return self.open.get(rtsp, 0)
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    counter = SessionCounter()
+    imencode = cv2.imencode
+
+    def _imencode(ext, img, *args):
+        # Other tests' relays may still be encoding their frames
+        if img.shape == (FRAME_SHAPE[0] // 2, FRAME_SHAPE[1] // 2, 3):
+            with counter.lock:
+                counter.encodes += 1
+        return imencode(ext, img, *args)
+
+    monkeypatch.setattr(cv2, "VideoCapture", counter.capture)
+    monkeypatch.setattr(cv2, "imencode", _imencode)
+    return counter
+
+
+@pytest.fixture
+def relays():
+    relays = CaptureRelays(idle_grace=0.3, max_fps=50)
+    yield relays
+    relays.close()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.mark.fast
+def test_one_session_per_camera(sessions, relays):
+    streams = [
+        Stream(rtsp=rtsp, camera_id=i, relays=relays)
+        for i, rtsp in enumerate([RTSP_1] * 8 + [RTSP_2] * 4)
+    ]
+    received = {stream.id: [] for stream in streams}
+
+    def _view(stream):
+        gen = stream.gen()
+        for _ in range(10):
+            received[stream.id].append(next(gen))
+
+    threads = [threading.Thread(target=_view, args=(s,)) for s in streams]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert all(len(frames) == 10 for frames in received.values())
+    assert sessions.max_open == {RTSP_1: 1, RTSP_2: 1}
+    assert len(relays.running()) == 2
+    assert relays.relays[RTSP_1].viewers == 8
+    # Encoded once per camera frame, not once per viewer
+    relayed = sum(relay.index for relay in relays.running())
+    assert sessions.encodes == relayed
+
+
+@pytest.mark.fast
+def test_viewers_share_frames(sessions, relays):
+    stream_1 = Stream(rtsp=RTSP_1, camera_id=1, relays=relays)
+    stream_2 = Stream(rtsp=RTSP_1, camera_id=1, relays=relays)
+    assert stream_1.relay is stream_2.relay
+    frame = stream_1.get_frame()
+    assert frame.startswith(b"\xff\xd8")
+    assert stream_1.last_img.shape == (241, 321, 3)
+
+
+@pytest.mark.fast
+def test_idle_capture_closes_after_grace(sessions, relays):
+    streams = [Stream(rtsp=RTSP_1, camera_id=1, relays=relays) for _ in range(3)]
+    relay = streams[0].relay
+    for stream in streams[:2]:
+        stream.close()
+    time.sleep(0.5)
+    assert sessions.sessions(RTSP_1) == 1
+    streams[2].close()
+    streams[2].close()
+    assert relay.viewers == 0
+    # Still open during the grace period
+    assert sessions.sessions(RTSP_1) == 1
+    assert wait_until(lambda: sessions.sessions(RTSP_1) == 0)
+    assert relay.status == "stopped"
+    assert relays.running() == []
+
+    # The next viewer opens a new capture
+    stream = Stream(rtsp=RTSP_1, camera_id=1, relays=relays)
+    assert stream.relay is not relay
+    assert sessions.sessions(RTSP_1) == 1
+    stream.get_frame()
+
+
+@pytest.mark.fast
+def test_viewer_within_grace_keeps_capture(sessions, relays):
+    stream = Stream(rtsp=RTSP_1, camera_id=1, relays=relays)
+    relay = stream.relay
+    stream.close()
+    stream = Stream(rtsp=RTSP_1, camera_id=1, relays=relays)
+    time.sleep(0.5)
+    assert stream.relay is relay
+    assert relay.status == "running"
+    assert relay.opens == 1
+
+
+@pytest.mark.fast
+def test_unavailable_camera(monkeypatch, relays):
+    class Closed:
+        def isOpened(self):
+            return False
+
+        def release(self):
+            pass
+
+    monkeypatch.setattr(cv2, "VideoCapture", lambda rtsp: Closed())
+    with pytest.raises(models.StreamOpenRTSPError):
+        Stream(rtsp=RTSP_1, camera_id=1, relays=relays)
+    assert relays.relays == {}
@@ -0,0 +1,73 @@
+"""Frame stamp.
+
+A frame sequence number and the wall-clock time the frame was produced,
+drawn as a row of black and white blocks along the top edge of the
+image. The blocks survive H.264 compression, so a module receiving a
+gst-rtsp.py stream can read them back from its decoded frames:
+
+    seq, produced_ms = read_stamp(frame)
+    latency_ms = time.time() * 1000 - produced_ms
+
+Gaps in seq are frames dropped between the generator and the reader.
+"""
+
+import numpy as np
+
+SEQ_BITS = 32
+TIME_BITS = 48  # milliseconds since the epoch
+# Start and end markers that tell a stamped frame from any other frame
+MARKER = (1, 0, 1, 1)
+STAMP_BITS = len(MARKER) + SEQ_BITS + TIME_BITS + len(MARKER)
+MIN_BLOCK = 4  # pixels, smaller blocks blur under compression
+
+
+def block_size(width):
+    return max(MIN_BLOCK, width // STAMP_BITS)
+
+
+def stamp_height(width):
+    """Rows at the top of the image the stamp covers."""
+    return block_size(width)
+
+
+def _bits(value, n):
+    return [(value >> i) & 1 for i in reversed(range(n))]
+
+
+def stamp(img, seq, produced_ms):
+    """Draw the stamp in place on a BGR or grayscale image."""
+    block = block_size(img.shape[1])
+    if block * STAMP_BITS > img.shape[1]:
+        raise ValueError("Image is narrower than {} pixels".format(
+            MIN_BLOCK * STAMP_BITS))
+    bits = (list(MARKER) + _bits(seq % (1 << SEQ_BITS), SEQ_BITS)
+            + _bits(int(produced_ms) % (1 << TIME_BITS), TIME_BITS) + list(MARKER))
+    row = np.repeat(np.array(bits, np.uint8) * 255, block)
+    img[:block, :len(row)] = row.reshape(1, -1, *([1] * (img.ndim - 2)))
+    img[:block, len(row):] = 0
+    return img
+
+
+def read_stamp(img):
+    """read_stamp.
+
+    (seq, produced_ms) of a stamped image, None when it carries no stamp.
+    """
+    block = block_size(img.shape[1])
+    if block * STAMP_BITS > img.shape[1] or img.shape[0] < block:
+        return None
+    strip = img[:block, :block * STAMP_BITS].astype(np.float32)
+    if strip.ndim == 3:
+        strip = strip.mean(axis=2)
+    # Sample the middle of each block, its edges bleed into the next
+    margin = block // 4
+    centers = strip[margin:block - margin].reshape(
+        block - 2 * margin, STAMP_BITS, block)[:, :, margin:block - margin]
+    bits = (centers.mean(axis=(0, 2)) > 127).astype(int).tolist()
+    n = len(MARKER)
+    if tuple(bits[:n]) != MARKER or tuple(bits[-n:]) != MARKER:
+        return None
+    payload = bits[n:-n]
+    seq = int("".join(map(str, payload[:SEQ_BITS])), 2)
+    produced_ms = int("".join(map(str, payload[SEQ_BITS:])), 2)
+    return seq, produced_ms
@@ -1,72 +1,334 @@
 #!/usr/bin/env python3
+"""Synthetic RTSP streams for load testing.
+
+One decoder thread plays the video in a loop. Each profile, a resolution
+and fps, takes the latest decoded frame at its own rate, resizes it,
+stamps it with a sequence number and timestamp (see frame_stamp.py) and
+converts it to I420 once. All streams of a profile push shallow copies
+of that buffer: the pixels are shared, only the timestamps differ.
+
+    python3 gst-rtsp.py                                  # rtsp://<ip>:8554/test
+    python3 gst-rtsp.py --streams 24 --profile 640x360@15  # /test0 ... /test23
+    python3 gst-rtsp.py --stream line=1280x720@30 --stream door=640x360@5
+"""
+
+import argparse
+import logging
+import threading
+import time
 
 import cv2
 import gi
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
-from gi.repository import Gst, GstRtspServer, GObject
-
-import netifaces as ni
-ni.ifaddresses('eth0')
-ip = ni.ifaddresses('eth0')[ni.AF_INET][0]['addr']
-
-class SensorFactory(GstRtspServer.RTSPMediaFactory):
-    def __init__(self, **properties):
-        super(SensorFactory, self).__init__(**properties)
-        self.cap = cv2.VideoCapture("taiwan_culture.mp4")
-        self.number_frames = 0
-        self.fps = 30
-        self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
-        self.launch_string = 'appsrc name=source is-live=true block=true format=GST_FORMAT_TIME ' \
-                             'caps=video/x-raw,format=BGR,width=1280,height=720,framerate={}/1 ' \
-                             '! videoconvert ! video/x-raw,format=I420 ' \
-                             '! x264enc speed-preset=ultrafast tune=zerolatency ' \
-                             '! rtph264pay config-interval=1 name=pay0 pt=96'.format(self.fps)
-
-    def on_need_data(self, src, lenght):
-        if self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if ret:
-                data = frame.tostring()
-                #print (data)
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                buf.fill(0, data)
-                buf.duration = self.duration
-                timestamp = self.number_frames * self.duration
-                buf.pts = buf.dts = int(timestamp)
-                buf.offset = timestamp
-                self.number_frames += 1
-                retval = src.emit('push-buffer', buf)
-                print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
-                                                                                       self.duration,
-                                                                                       self.duration / Gst.SECOND))
-                if retval != Gst.FlowReturn.OK:
-                    print(retval)
+from gi.repository import GLib, Gst, GstRtspServer
+
+from frame_stamp import STAMP_BITS, MIN_BLOCK, stamp
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOURCE = "taiwan_culture.mp4"
+DEFAULT_PROFILE = "1280x720@30"
+WAIT_TIMEOUT = 1  # sec, need-data gives up and is asked again
+
+
+def local_ip(interface='eth0'):
+    try:
+        import netifaces as ni
+        return ni.ifaddresses(interface)[ni.AF_INET][0]['addr']
+    except (ImportError, ValueError, KeyError):
+        return '0.0.0.0'
+
+
+def parse_profile(spec):
+    """(width, height, fps) of WIDTHxHEIGHT@FPS."""
+    try:
+        size, fps = spec.split('@')
+        width, height = (int(v) for v in size.lower().split('x'))
+        fps = int(fps)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT@FPS, got " + spec)
+    if width % 2 or height % 2:
+        raise argparse.ArgumentTypeError("I420 needs an even width and height")
+    if width < MIN_BLOCK * STAMP_BITS or fps <= 0:
+        raise argparse.ArgumentTypeError("at least {} pixels wide and 1 fps".format(
+            MIN_BLOCK * STAMP_BITS))
+    return width, height, fps
+
+
+def parse_stream(spec):
+    name, _, profile = spec.partition('=')
+    return name.strip('/'), parse_profile(profile or DEFAULT_PROFILE)
+
+
+class LoopingSource:
+    """LoopingSource.
+
+    Decodes a video at its native fps in a thread and restarts it at the
+    end, so `latest` always has a frame and the loop has no gap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise RuntimeError("Cannot open " + path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.frame = None
+        self.decoded = 0
+        self.loops = 0
+
+    def start(self):
+        threading.Thread(target=self.run, name='decoder', daemon=True).start()
+        self.ready.wait()
+
+    def _read(self):
+        is_ok, frame = self.cap.read()
+        if is_ok:
+            return frame
+        self.loops += 1
+        # Seek back rather than reopen, it costs no more than a frame
+        if not self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+            self.cap.release()
+            self.cap = cv2.VideoCapture(self.path)
+        is_ok, frame = self.cap.read()
+        if not is_ok:
+            raise RuntimeError("Cannot read " + self.path)
+        return frame
+
+    def run(self):
+        period = 1 / self.fps
+        deadline = time.monotonic()
+        while True:
+            frame = self._read()
+            with self.lock:
+                self.frame = frame
+                self.decoded += 1
+            self.ready.set()
+            # Deadlines, not sleeps, so a slow read does not slow the loop
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                deadline = time.monotonic()
+
+    def latest(self):
+        with self.lock:
+            return self.frame
+
+
+class Profile:
+    """Profile.
+
+    Stamped I420 frames of one resolution and fps, produced once and
+    shared by every stream of the profile, while any has a client.
+    """
+
+    def __init__(self, source, width, height, fps):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.duration = Gst.SECOND // fps
+        self.caps = ('video/x-raw,format=I420,width={},height={},framerate={}/1'
+                     .format(width, height, fps))
+        self.cond = threading.Condition()
+        self.seq = -1
+        self.buffer = None
+        self.produce_time = 0.0
+        self.users = 0
+        self.active = threading.Event()
+
+    def acquire(self):
+        with self.cond:
+            self.users += 1
+            self.active.set()
+
+    def release(self):
+        with self.cond:
+            self.users -= 1
+            if self.users <= 0:
+                self.active.clear()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True,
+                         name='profile-{}x{}@{}'.format(self.width, self.height,
+                                                        self.fps)).start()
+
+    def _produce(self, seq):
+        frame = self.source.latest()
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height))
+        else:
+            frame = frame.copy()
+        stamp(frame, seq, time.time() * 1000)
+        data = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420).tobytes()
+        # The one copy of the frame into GStreamer memory
+        return Gst.Buffer.new_wrapped(data)
+
+    def run(self):
+        period = 1 / self.fps
+        deadline = time.monotonic()
+        seq = 0
+        while True:
+            if not self.active.is_set():
+                self.active.wait()
+                deadline = time.monotonic()
+            t0 = time.process_time()
+            buffer = self._produce(seq)
+            with self.cond:
+                self.seq = seq
+                self.buffer = buffer
+                self.produce_time += time.process_time() - t0
+                self.cond.notify_all()
+            seq += 1
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                # Too slow to keep up: the skipped frames show as seq gaps
+                skipped = int(-delay / period)
+                seq += skipped
+                deadline += skipped * period
+
+    def next_after(self, seq, timeout=WAIT_TIMEOUT):
+        """(seq, buffer) of the first frame after `seq`, None on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > seq, timeout):
+                return None
+            return self.seq, self.buffer
+
+
+class StreamFactory(GstRtspServer.RTSPMediaFactory):
+    """StreamFactory.
+
+    One mount point. Its clients share one encoder, streams share the
+    frames of their profile.
+    """
+
+    def __init__(self, name, profile, **properties):
+        super(StreamFactory, self).__init__(**properties)
+        self.name = name
+        self.profile = profile
+        self.pushed = 0
+        self.skipped = 0
+        self.launch_string = (
+            'appsrc name=source is-live=true block=true format=GST_FORMAT_TIME '
+            'caps={caps} '
+            '! x264enc speed-preset=ultrafast tune=zerolatency key-int-max={fps} '
+            '! rtph264pay config-interval=1 name=pay0 pt=96').format(
+                caps=profile.caps, fps=profile.fps)
+        self.set_shared(True)
 
     def do_create_element(self, url):
         return Gst.parse_launch(self.launch_string)
 
     def do_configure(self, rtsp_media):
-        self.number_frames = 0
+        state = {'first': None, 'last': -1}
         appsrc = rtsp_media.get_element().get_child_by_name('source')
-        appsrc.connect('need-data', self.on_need_data)
+        appsrc.connect('need-data', self.on_need_data, state)
+        self.profile.acquire()
+        rtsp_media.connect('unprepared', lambda media: self.profile.release())
+
+    def on_need_data(self, src, length, state):
+        frame = self.profile.next_after(state['last'])
+        if frame is None:
+            return
+        seq, shared = frame
+        if state['first'] is None:
+            state['first'] = seq
+        elif seq > state['last'] + 1:
+            self.skipped += seq - state['last'] - 1
+        state['last'] = seq
+        # Shallow copy: new timestamps on the same memory
+        buf = shared.copy_region(
+            Gst.BufferCopyFlags.FLAGS | Gst.BufferCopyFlags.MEMORY, 0, shared.get_size())
+        buf.duration = self.profile.duration
+        buf.pts = buf.dts = (seq - state['first']) * self.profile.duration
+        buf.offset = seq
+        retval = src.emit('push-buffer', buf)
+        if retval != Gst.FlowReturn.OK:
+            logger.warning("/%s push-buffer: %s", self.name, retval)
+        self.pushed += 1
 
 
 class GstServer(GstRtspServer.RTSPServer):
-    def __init__(self, **properties):
+    def __init__(self, streams, port=8554, **properties):
         super(GstServer, self).__init__(**properties)
-        self.factory = SensorFactory()
-        self.factory.set_shared(True)
-        self.get_mount_points().add_factory("/test", self.factory)
+        self.set_service(str(port))
+        self.factories = []
+        for name, profile in streams:
+            factory = StreamFactory(name, profile)
+            self.get_mount_points().add_factory('/' + name, factory)
+            self.factories.append(factory)
         self.attach(None)
 
 
-GObject.threads_init()
-Gst.init(None)
+def log_stats(source, profiles, factories, interval):
+    last = {'time': time.monotonic(), 'pushed': 0}
+
+    def _log():
+        now = time.monotonic()
+        pushed = sum(f.pushed for f in factories)
+        produce = sum(p.produce_time for p in profiles)
+        logger.info("decoded %d frames (%d loops), %d profiles used %.1f s cpu, "
+                    "%.0f frames/s pushed, %d skipped",
+                    source.decoded, source.loops, len(profiles), produce,
+                    (pushed - last['pushed']) / (now - last['time']),
+                    sum(f.skipped for f in factories))
+        last.update(time=now, pushed=pushed)
+        return True
+
+    GLib.timeout_add_seconds(interval, _log)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default=DEFAULT_SOURCE,
+                        help="video file or url, played in a loop")
+    parser.add_argument('--port', type=int, default=8554)
+    parser.add_argument('--stream', action='append', type=parse_stream, default=[],
+                        help="NAME=WIDTHxHEIGHT@FPS, repeatable")
+    parser.add_argument('--streams', type=int, default=0,
+                        help="serve /test0 ... /testN-1 with --profile")
+    parser.add_argument('--profile', type=parse_profile, default=DEFAULT_PROFILE)
+    parser.add_argument('--stats-interval', type=int, default=10, help="sec")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    specs = list(args.stream)
+    specs += [('test{}'.format(i), args.profile) for i in range(args.streams)]
+    if not specs:
+        specs = [('test', args.profile)]
+
+    Gst.init(None)
+    source = LoopingSource(args.source)
+    source.start()
+    profiles = {}
+    streams = []
+    for name, spec in specs:
+        if spec not in profiles:
+            profiles[spec] = Profile(source, *spec)
+            profiles[spec].start()
+        streams.append((name, profiles[spec]))
+
+    server = GstServer(streams, port=args.port)
+    ip = local_ip()
+    for name, (width, height, fps) in specs:
+        print("Running as - rtsp://{}:{}/{} {}x{}@{}".format(
+            ip, args.port, name, width, height, fps))
+    if args.stats_interval > 0:
+        log_stats(source, list(profiles.values()), server.factories,
+                  args.stats_interval)
+
+    loop = GLib.MainLoop()
+    loop.run()
 
-server = GstServer()
-print("Running as - rtsp://"+ip+":8554/test")
 
-loop = GObject.MainLoop()
-loop.run()
+if __name__ == '__main__':
+    main()
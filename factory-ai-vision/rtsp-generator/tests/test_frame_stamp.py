@@ -0,0 +1,48 @@
+"""Tests for frame_stamp.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from frame_stamp import MIN_BLOCK, STAMP_BITS, read_stamp, stamp
+
+MIN_WIDTH = MIN_BLOCK * STAMP_BITS
+SEQ = 123456789
+PRODUCED_MS = 1700000000123
+
+
+def frame(width, seed=0):
+    height = width * 9 // 16
+    rng = np.random.RandomState(seed)
+    img = rng.randint(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    return cv2.resize(img, (width, height))
+
+
+def i420(img):
+    yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420)
+    return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+
+
+def jpeg(img, quality=30):
+    _, data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+@pytest.mark.parametrize("width", [MIN_WIDTH, 1920])
+def test_stamp_survives_i420_and_jpeg(width):
+    img = stamp(frame(width), SEQ, PRODUCED_MS)
+    assert read_stamp(img) == (SEQ, PRODUCED_MS)
+    assert read_stamp(i420(img)) == (SEQ, PRODUCED_MS)
+    assert read_stamp(jpeg(i420(img))) == (SEQ, PRODUCED_MS)
+
+
+def test_unstamped_frame_reads_none():
+    assert read_stamp(frame(1920)) is None
+    assert read_stamp(np.zeros((1080, 1920, 3), np.uint8)) is None
+
+
+def test_narrow_frame_is_refused():
+    with pytest.raises(ValueError):
+        stamp(frame(MIN_WIDTH - 8), SEQ, PRODUCED_MS)
+    assert read_stamp(frame(MIN_WIDTH - 8)) is None